@@ -0,0 +1,592 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+End to end benchmarks of the sync and restore operations against the mock Gmail server (gmv/mock_gmail_server.py)
+
+    python bench_suite.py run --sizes 10000,100000,1000000 --output results.json
+    python bench_suite.py compare baseline.json results.json --threshold 10
+    python bench_suite.py generate /tmp/gmvault-db --emails 1000000 --chats 10000 --seed 1
+
+For each size, a synthetic gmvault-db of that many emails is generated (gmv/vault_generator.py) and the mailbox
+of the mock server is loaded from it:
+- full_sync      : sync of the whole mailbox in an empty db
+- inventory      : loading of the gmail ids of the generated db (get_all_existing_gmail_ids)
+- check_clean_db : check of the generated db against the mailbox (db cleaning)
+- resumed_sync   : restart of a sync interrupted in the middle (copy of the full sync db)
+- quick_sync     : quick sync (last days) after new emails and label changes in the mailbox (copy of the full sync db)
+- restore        : restore of the generated db in an empty mailbox
+
+Each benchmark runs in its own process and the mock server in another one so the peak RSS, the I/O system calls
+(read and write calls counted by /proc/self/io, Linux only: io_syscalls is not the total number of system calls)
+and the context switches measured are the ones of the operation.
+The results are written in JSON. The compare mode flags the benchmarks slower or heavier than in a baseline.
+'''
+
+import sys
+import os
+import time
+import json
+import shutil
+import random
+import datetime
+import platform
+import resource
+import argparse
+import multiprocessing
+
+import logbook
+
+import gmv.log_utils as log_utils
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.imap_utils as imap_utils
+import gmv.mock_gmail_server as mock_gmail_server
+import gmv.vault_generator as vault_generator
+
+CREDENTIAL    = { 'type' : 'passwd', 'value' : 'bench' }
+
+BENCHMARKS    = ['full_sync', 'inventory', 'check_clean_db', 'resumed_sync', 'quick_sync', 'restore']
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+CHANGED_LABEL = 'bench-changed'
+
+# compared metrics: (name, True if higher is better)
+METRICS       = [('msgs_per_s', True), ('mb_per_s', True), ('peak_rss_kb', False), ('io_syscalls', False)]
+
+def get_proc_io():
+    """
+       Return the number of I/O system calls (syscr and syscw: read and write calls) of the process
+       or None if /proc/self/io is not available. The other system calls are not counted
+    """
+    try:
+        the_fd = open('/proc/self/io')
+        try:
+            values = dict([ line.split(':', 1) for line in the_fd if ':' in line ])
+        finally:
+            the_fd.close()
+        return int(values['syscr']), int(values['syscw'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+def change_mailbox(a_mailbox, a_generator, a_days, a_ratio):
+    """
+       Add the next emails of a_generator and change the labels of emails of the last a_days days
+       (a_ratio of the mailbox each).
+       Return the first and last days of the quick sync and the number of emails changed or added
+    """
+    rand = random.Random(a_generator.seed)
+
+    with a_mailbox.lock:
+        emails = a_mailbox.get_emails()
+        last   = emails[-1].internal_date if emails else datetime.datetime(2010, 1, 1)
+        begin  = last.date() - datetime.timedelta(a_days)
+        recent = [ email for email in emails if email.internal_date.date() >= begin ]
+        nb_changes = max(1, int(len(emails) * a_ratio))
+
+        changed = rand.sample(recent, min(nb_changes, len(recent)))
+        a_mailbox.add_labels([CHANGED_LABEL])
+        for email in changed:
+            email.labels.append(CHANGED_LABEL)
+            email.modseq = a_mailbox.next_modseq()
+
+        for num in xrange(a_generator.nb_emails, a_generator.nb_emails + nb_changes):
+            body, _, labels, flags = a_generator.build_email(num)
+            last = datetime.datetime.utcfromtimestamp(a_generator.get_date(vault_generator.EMAIL, num))
+            a_mailbox.add_email(body, labels, flags, last, a_generator.get_gm_id(vault_generator.EMAIL, num), \
+                                a_generator.get_gm_id(vault_generator.EMAIL, a_generator.get_thread(num)[1]))
+
+    return begin, last.date() + datetime.timedelta(1), len(changed) + nb_changes
+
+def _serve(a_conn, a_db_dir, a_args):
+    """
+       Main of the mock server process: load the mailbox from the db a_db_dir (empty mailbox if None) and answer
+       the requests (stats, change, stop) received on the pipe a_conn
+    """
+    logbook.NullHandler().push_application()
+
+    if a_db_dir:
+        mailbox = mock_gmail_server.MockMailbox.from_gmvault_db(a_db_dir)
+    else:
+        mailbox = mock_gmail_server.MockMailbox()
+
+    server = mock_gmail_server.MockGmailServer(mailbox, a_latency = a_args.latency, a_bandwidth = a_args.bandwidth).start()
+    a_conn.send((server.host, server.port, mailbox.login))
+
+    while True:
+        request, args = a_conn.recv()
+        if request == 'stats':
+            with mailbox.lock:
+                stats = dict(server.stats, nb_emails = len(mailbox.get_emails()), \
+                             nb_chats = len(mailbox.get_emails(mailbox.CHATS)))
+            a_conn.send(stats)
+        elif request == 'change':
+            a_conn.send(change_mailbox(mailbox, *args))
+        elif request == 'stop':
+            server.stop()
+            a_conn.send(None)
+            return
+
+class MockServerProcess(object):
+    """
+       Mock Gmail server running in its own process (its mailbox is not measured with the benchmarks)
+    """
+    def __init__(self, a_db_dir, a_args):
+        """
+           a_db_dir: db of the emails and chats of the mailbox (empty mailbox if None)
+        """
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target = _serve, args = (child_conn, a_db_dir, a_args))
+        self._process.start()
+
+        self.host, self.port, self.login = self._conn.recv()
+
+    def request(self, a_request, *args):
+        """
+           Send a request to the server process and return its answer
+        """
+        self._conn.send((a_request, args))
+        return self._conn.recv()
+
+    def stop(self):
+        """
+           Stop the server process
+        """
+        self.request('stop')
+        self._process.join()
+
+def _measure(a_conn, a_func, a_args):
+    """
+       Main of a benchmark process: run a_func(*a_args) and send its measures on the pipe a_conn
+    """
+    logbook.NullHandler().push_application()
+
+    io_start    = get_proc_io()
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start       = time.time()
+
+    error = None
+    try:
+        a_func(*a_args)
+    except Exception, _: #pylint:disable-msg=W0703
+        error = gmvault_utils.get_exception_traceback()
+
+    elapsed  = time.time() - start
+    io_end   = get_proc_io()
+    usage    = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    a_conn.send({ 'elapsed'              : elapsed,
+                  'cpu_time'             : (usage.ru_utime + usage.ru_stime) - (usage_start.ru_utime + usage_start.ru_stime),
+                  'peak_rss_kb'          : usage.ru_maxrss,
+                  'children_peak_rss_kb' : children.ru_maxrss,
+                  'read_syscalls'        : io_end[0] - io_start[0] if io_start and io_end else None,
+                  'write_syscalls'       : io_end[1] - io_start[1] if io_start and io_end else None,
+                  'ctx_switches'         : (usage.ru_nvcsw + usage.ru_nivcsw) - (usage_start.ru_nvcsw + usage_start.ru_nivcsw),
+                  'error'                : error })
+
+def _sync(a_server, a_db_dir, a_imap_req, a_restart, a_nb_connections):
+    """
+       Sync the mailbox of a_server in a_db_dir
+    """
+    syncer = gmvault.GMVaulter(a_db_dir, a_server.host, a_server.port, a_server.login, dict(CREDENTIAL), use_ssl = False)
+    syncer.sync(a_imap_req, restart = a_restart, nb_connections = a_nb_connections)
+
+def _inventory(a_db_dir):
+    """
+       Load the gmail ids of the db
+    """
+    gmvault.get_storer(a_db_dir).get_all_existing_gmail_ids()
+
+def _check_clean_db(a_server, a_db_dir):
+    """
+       Check the db against the mailbox of a_server
+    """
+    syncer = gmvault.GMVaulter(a_db_dir, a_server.host, a_server.port, a_server.login, dict(CREDENTIAL), use_ssl = False)
+    syncer.check_clean_db(db_cleaning = True)
+
+def _restore(a_server, a_db_dir, a_nb_connections):
+    """
+       Restore the db in the mailbox of a_server
+    """
+    restorer = gmvault.GMVaulter(a_db_dir, a_server.host, a_server.port, a_server.login, dict(CREDENTIAL), \
+                                 read_only_access = False, use_ssl = False)
+    restorer.restore(nb_connections = a_nb_connections)
+
+def interrupt_sync(a_db_dir, a_login):
+    """
+       Make the db a_db_dir look like a sync interrupted in the middle: keep the first half of the sync journal,
+       delete the emails of the second half and the folder state of the last complete sync.
+       Return the number of emails left to sync
+    """
+    gstorer  = gmvault.get_storer(a_db_dir)
+    journal  = '%s/%s_%s' % (gstorer.get_info_dir(), a_login, gmvault.GMVaulter.OP_TO_JOURNAL[gmvault.GMVaulter.OP_EMAIL_SYNC])
+
+    the_fd = open(journal)
+    lines  = the_fd.readlines()
+    the_fd.close()
+
+    done, left = lines[:len(lines) / 2], lines[len(lines) / 2:]
+
+    the_fd = open(journal, 'w')
+    the_fd.writelines(done)
+    the_fd.close()
+
+    gm_ids = gstorer.get_all_existing_gmail_ids()
+    gstorer.delete_emails([ (long(line.split()[1]), gm_ids[long(line.split()[1])]) for line in left \
+                            if long(line.split()[1]) in gm_ids ], 'email')
+    gstorer.flush()
+
+    state = '%s/%s' % (gstorer.get_info_dir(), gmvault.GmailStorer.SYNC_STATE)
+    if os.path.exists(state):
+        os.remove(state)
+
+    return len(left)
+
+class BenchSuite(object):
+    """
+       Run the benchmarks for one mailbox size
+    """
+    def __init__(self, a_size, a_args):
+        """
+           constructor
+        """
+        self.size     = a_size
+        self.args     = a_args
+        self.work_dir = '%s/%d' % (a_args.work_dir, a_size)
+        self.vault    = '%s/vault' % (self.work_dir)
+        self.ref_db   = '%s/ref-db' % (self.work_dir)
+        self.results  = []
+
+    def _copy_db(self, a_name):
+        """
+           Return a copy of the reference db (full sync db)
+        """
+        db_dir = '%s/%s' % (self.work_dir, a_name)
+        gmvault_utils.delete_all_under(db_dir, delete_top_dir = True)
+        shutil.copytree(self.ref_db, db_dir)
+        return db_dir
+
+    def _run(self, a_name, a_server, a_nb_messages, a_func, *args):
+        """
+           Run a_func(*args) in its own process and record its measures
+        """
+        stats = a_server.request('stats')
+
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target = _measure, args = (child_conn, a_func, args))
+        process.start()
+        child_conn.close()
+
+        deadline = time.time() + self.args.timeout if self.args.timeout else None
+        # poll with a timeout to not block CTRL^C
+        while not parent_conn.poll(1) and (not deadline or time.time() < deadline) and process.is_alive():
+            pass
+
+        try:
+            if parent_conn.poll():
+                result = parent_conn.recv()
+            elif process.is_alive():
+                process.terminate()
+                result = { 'error' : 'Stopped after %d sec' % (self.args.timeout) }
+            else:
+                result = { 'error' : 'The benchmark process died' }
+        except EOFError:
+            result = { 'error' : 'The benchmark process died' }
+        process.join()
+
+        new_stats  = a_server.request('stats')
+        imap_bytes = (new_stats['bytes_sent'] + new_stats['bytes_received']) - (stats['bytes_sent'] + stats['bytes_received'])
+        elapsed    = result.get('elapsed')
+
+        result.update({ 'benchmark'   : a_name,
+                        'size'        : self.size,
+                        'nb_messages' : a_nb_messages,
+                        'imap_mb'     : imap_bytes / (1024.0 * 1024),
+                        'msgs_per_s'  : a_nb_messages / elapsed if elapsed else None,
+                        'mb_per_s'    : imap_bytes / (1024.0 * 1024) / elapsed if elapsed and imap_bytes else None,
+                        'io_syscalls' : result['read_syscalls'] + result['write_syscalls'] \
+                                        if result.get('read_syscalls') is not None else None })
+        self.results.append(result)
+
+        print(format_result(result))
+        if result['error']:
+            print(result['error'])
+
+        return result
+
+    def run(self):
+        """
+           Run the selected benchmarks. The full sync is always run as it creates the reference db
+        """
+        gmvault_utils.delete_all_under(self.work_dir, delete_top_dir = True)
+        gmvault_utils.makedirs(self.work_dir)
+
+        generator = vault_generator.VaultGenerator(self.size, self.size / 100, self.args.seed, \
+                                                   a_attachment_ratio = self.args.attachment_ratio, \
+                                                   a_max_attachment_size = self.args.max_attachment_size)
+        start = time.time()
+        nb_messages, nb_bytes = vault_generator.generate_vault(self.vault, generator, a_nb_processes = self.args.processes)
+        print('%-15s %8d msgs: %9.2f sec %10.1f MB' % ('generate', nb_messages, time.time() - start, nb_bytes / (1024.0 * 1024)))
+
+        server = MockServerProcess(self.vault, self.args)
+        try:
+            stats  = server.request('stats')
+            nb_all = stats['nb_emails'] + stats['nb_chats']
+
+            if self._run('full_sync', server, nb_all, _sync, server, self.ref_db, imap_utils.GIMAPFetcher.IMAP_ALL, \
+                         False, self.args.connections)['error']:
+                return self.results
+
+            if 'inventory' in self.args.benchmarks:
+                self._run('inventory', server, stats['nb_emails'], _inventory, self.vault)
+
+            # the mailbox is the generated db: nothing to clean
+            if 'check_clean_db' in self.args.benchmarks:
+                self._run('check_clean_db', server, nb_all, _check_clean_db, server, self.vault)
+
+            # the reference db must not be changed by the other benchmarks
+
+            if 'resumed_sync' in self.args.benchmarks:
+                db_dir  = self._copy_db('resumed-db')
+                nb_left = interrupt_sync(db_dir, server.login)
+                self._run('resumed_sync', server, nb_left, _sync, server, db_dir, imap_utils.GIMAPFetcher.IMAP_ALL, \
+                          True, self.args.connections)
+
+            if 'quick_sync' in self.args.benchmarks:
+                db_dir = self._copy_db('quick-db')
+                begin, end, nb_changed = server.request('change', generator, \
+                                                        gmvault_utils.get_conf_defaults().getint("Sync", "quick_days", 8), \
+                                                        self.args.changed_ratio)
+                imap_req = { 'type' : 'imap', 'req' : gmvault.GMVaulter.get_imap_request_btw_2_dates(begin, end) }
+                self._run('quick_sync', server, nb_changed, _sync, server, db_dir, imap_req, False, self.args.connections)
+        finally:
+            server.stop()
+
+        if 'restore' in self.args.benchmarks:
+            server = MockServerProcess(None, self.args)
+            try:
+                self._run('restore', server, nb_all, _restore, server, self.vault, self.args.connections)
+            finally:
+                server.stop()
+
+        if not self.args.keep:
+            gmvault_utils.delete_all_under(self.work_dir, delete_top_dir = True)
+
+        return self.results
+
+def format_result(a_result):
+    """
+       Return a one line summary of a result
+    """
+    if a_result.get('elapsed') is None:
+        return '%-15s %8d msgs: failed' % (a_result['benchmark'], a_result['size'])
+
+    return '%-15s %8d msgs: %9.2f sec %10.1f msgs/s %8s MB/s %9d KB peak RSS %10s io syscalls%s' % \
+           (a_result['benchmark'], a_result['nb_messages'], a_result['elapsed'], a_result['msgs_per_s'] or 0, \
+            '%.2f' % (a_result['mb_per_s']) if a_result['mb_per_s'] else '-', a_result['peak_rss_kb'], \
+            a_result['io_syscalls'] if a_result['io_syscalls'] is not None else '-', ' (ERROR)' if a_result['error'] else '')
+
+def compare(a_baseline, a_results, a_threshold):
+    """
+       Compare the results with the baseline. A metric worse by more than a_threshold percents
+       or a benchmark failing only in the new results is a regression.
+       Return the lines of the report and the number of regressions
+    """
+    baseline = dict([ ((res['benchmark'], res['size']), res) for res in a_baseline['results'] ])
+
+    lines, nb_regressions = [], 0
+    for result in a_results['results']:
+        key = (result['benchmark'], result['size'])
+        name = '%s/%d' % key
+        if key not in baseline:
+            lines.append('%-25s not in the baseline' % (name))
+            continue
+
+        base = baseline[key]
+        if result.get('error'):
+            regression = not base.get('error')
+            lines.append('%-25s fails%s' % (name, ' (REGRESSION)' if regression else ' (already in the baseline)'))
+            nb_regressions += 1 if regression else 0
+            continue
+
+        for metric, higher_is_better in METRICS:
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+
+            change = (new - old) * 100.0 / old
+            worse  = -change if higher_is_better else change
+            regression = worse > a_threshold
+            nb_regressions += 1 if regression else 0
+
+            lines.append('%-25s %-12s %14.2f -> %14.2f (%+6.1f%%)%s' % (name, metric, old, new, change, \
+                                                                       ' REGRESSION' if regression else ''))
+
+    return lines, nb_regressions
+
+def load_results(a_path):
+    """
+       Load a results file
+    """
+    the_fd = open(a_path)
+    try:
+        return json.load(the_fd)
+    finally:
+        the_fd.close()
+
+def run(a_args):
+    """
+       Run the benchmarks for all the sizes and write the results
+    """
+    results = { 'date'     : datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'host'     : platform.node(),
+                'platform' : platform.platform(),
+                'python'   : platform.python_version(),
+                'settings' : { 'latency'             : a_args.latency,
+                               'bandwidth'           : a_args.bandwidth,
+                               'connections'         : a_args.connections,
+                               'changed_ratio'       : a_args.changed_ratio,
+                               'seed'                : a_args.seed,
+                               'attachment_ratio'    : a_args.attachment_ratio,
+                               'max_attachment_size' : a_args.max_attachment_size },
+                'results'  : [] }
+
+    for size in a_args.sizes:
+        print('\n== %d emails ==' % (size))
+        results['results'].extend(BenchSuite(size, a_args).run())
+
+    the_fd = open(a_args.output, 'w')
+    json.dump(results, the_fd, indent = 2, sort_keys = True)
+    the_fd.close()
+
+    print('\nResults written in %s' % (a_args.output))
+
+    if a_args.baseline:
+        return compare_files(a_args.baseline, a_args.output, a_args.threshold)
+
+    return 0
+
+def generate(a_args):
+    """
+       Generate a synthetic gmvault-db
+    """
+    generator = vault_generator.VaultGenerator(a_args.emails, a_args.chats, a_args.seed, a_args.owner, \
+                                               a_nb_labels = a_args.labels, a_attachment_ratio = a_args.attachment_ratio, \
+                                               a_max_attachment_size = a_args.max_attachment_size)
+
+    start = time.time()
+    nb_messages, nb_bytes = vault_generator.generate_vault(a_args.db_dir, generator, a_args.encrypt, a_args.processes)
+
+    print('%d messages (%.1f MB) generated in %s in %.1f sec' % (nb_messages, nb_bytes / (1024.0 * 1024), a_args.db_dir, \
+                                                                 time.time() - start))
+    return 0
+
+def compare_files(a_baseline_path, a_results_path, a_threshold):
+    """
+       Print the comparison of two results files. Return 1 if there are regressions
+    """
+    lines, nb_regressions = compare(load_results(a_baseline_path), load_results(a_results_path), a_threshold)
+
+    print('\nComparison with %s (threshold %.1f%%):' % (a_baseline_path, a_threshold))
+    for line in lines:
+        print(line)
+    print('%d regression(s)' % (nb_regressions))
+
+    return 1 if nb_regressions else 0
+
+def parse_args(a_argv):
+    """
+       Parse the command line
+    """
+    parser = argparse.ArgumentParser(description = 'Gmvault sync and restore benchmarks against the mock Gmail server')
+    subparsers = parser.add_subparsers(dest = 'command')
+
+    run_parser = subparsers.add_parser('run', help = 'run the benchmarks')
+    run_parser.add_argument('--sizes', type = lambda val: [ int(size) for size in val.split(',') ], default = DEFAULT_SIZES, \
+                            help = 'comma separated numbers of emails of the mailboxes (default: 10000,100000,1000000)')
+    run_parser.add_argument('--benchmarks', type = lambda val: val.split(','), default = BENCHMARKS, \
+                            help = 'comma separated benchmarks among %s (default: all)' % (','.join(BENCHMARKS)))
+    run_parser.add_argument('--output', default = 'bench_results.json', help = 'results file (default: bench_results.json)')
+    run_parser.add_argument('--baseline', help = 'results file to compare the new results with')
+    run_parser.add_argument('--threshold', type = float, default = 10.0, help = 'regression threshold in percents (default: 10)')
+    run_parser.add_argument('--work-dir', dest = 'work_dir', default = '/tmp/gmvault-bench', \
+                            help = 'dir of the dbs (default: /tmp/gmvault-bench)')
+    run_parser.add_argument('--keep', action = 'store_true', default = False, help = 'keep the dbs')
+    run_parser.add_argument('--timeout', type = int, default = 0, help = 'max duration (sec) of a benchmark (default: no limit)')
+    run_parser.add_argument('--latency', type = float, default = 0, help = 'latency (sec) of each IMAP command (default: 0)')
+    run_parser.add_argument('--bandwidth', type = int, default = 0, help = 'bandwidth (bytes/sec) of each connection (default: no limit)')
+    run_parser.add_argument('--connections', type = int, default = 1, help = 'IMAP connections used in parallel (default: 1)')
+    # the mailbox of the mock server takes about the size of the db in memory: smaller attachments than generate
+    run_parser.add_argument('--attachment-ratio', dest = 'attachment_ratio', type = float, default = 0.02, \
+                            help = 'ratio of the emails with attachments (default: 0.02)')
+    run_parser.add_argument('--max-attachment-size', dest = 'max_attachment_size', type = int, default = 262144, \
+                            help = 'max size (bytes) of an attachment (default: 262144)')
+    run_parser.add_argument('--processes', type = int, default = None, \
+                            help = 'processes generating the dbs (default: one per core)')
+    run_parser.add_argument('--changed-ratio', dest = 'changed_ratio', type = float, default = 0.01, \
+                            help = 'ratio of the emails added and changed before the quick sync (default: 0.01)')
+    run_parser.add_argument('--seed', type = int, default = 0, help = 'seed of the generated mailboxes (default: 0)')
+
+    gen_parser = subparsers.add_parser('generate', help = 'generate a synthetic gmvault-db')
+    gen_parser.add_argument('db_dir', help = 'dir of the gmvault-db to create')
+    gen_parser.add_argument('--emails', type = int, default = 10000, help = 'number of emails (default: 10000)')
+    gen_parser.add_argument('--chats', type = int, default = 0, help = 'number of chats (default: 0)')
+    gen_parser.add_argument('--seed', type = int, default = 0, help = 'seed of the generated db (default: 0)')
+    gen_parser.add_argument('--owner', default = 'gmvault.test@gmail.com', help = 'email address of the account')
+    gen_parser.add_argument('--labels', type = int, default = 40, help = 'number of user labels (default: 40)')
+    gen_parser.add_argument('--attachment-ratio', dest = 'attachment_ratio', type = float, default = 0.15, \
+                            help = 'ratio of the emails with attachments (default: 0.15)')
+    gen_parser.add_argument('--max-attachment-size', dest = 'max_attachment_size', type = int, default = 10485760, \
+                            help = 'max size (bytes) of an attachment (default: 10485760)')
+    gen_parser.add_argument('--encrypt', action = 'store_true', default = False, help = 'encrypt the emails')
+    gen_parser.add_argument('--processes', type = int, default = None, help = 'number of processes (default: one per core)')
+
+    compare_parser = subparsers.add_parser('compare', help = 'compare results with a baseline')
+    compare_parser.add_argument('baseline', help = 'baseline results file')
+    compare_parser.add_argument('results', help = 'new results file')
+    compare_parser.add_argument('--threshold', type = float, default = 10.0, help = 'regression threshold in percents (default: 10)')
+
+    args = parser.parse_args(a_argv)
+
+    if args.command == 'run':
+        unknown = [ bench for bench in args.benchmarks if bench not in BENCHMARKS ]
+        if unknown:
+            parser.error('unknown benchmark(s) %s' % (','.join(unknown)))
+
+    return args
+
+def main(a_argv):
+    """
+       main
+    """
+    args = parse_args(a_argv)
+
+    if args.command == 'generate':
+        log_utils.LoggerFactory.setup_cli_app_handler()
+        return generate(args)
+
+    logbook.NullHandler().push_application()
+
+    if args.command == 'compare':
+        return compare_files(args.baseline, args.results, args.threshold)
+
+    return run(args)
+
+if __name__ == '__main__':
+
+    sys.exit(main(sys.argv[1:]))
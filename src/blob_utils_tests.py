@@ -0,0 +1,200 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import os
+import hashlib
+import email.mime.multipart
+import email.mime.text
+import email.mime.application
+
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.imap_utils as imap_utils
+import gmv.blob_utils as blob_utils
+import gmv.segment_storer as segment_storer
+
+import test_utils
+
+
+class TestBlobUtils(test_utils.DbTestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the deduplication of the attachments in the blob area
+    """
+
+    TEST_DB_DIR = "/tmp/gmvault-blob-tests"
+
+    @classmethod
+    def _create_email(cls, a_text, a_attachment):
+        """
+           Return a raw email with a text part and a pdf attachment
+        """
+        msg = email.mime.multipart.MIMEMultipart()
+        msg['Subject']    = 'report'
+        msg['Message-ID'] = '<%s@test>' % (abs(hash(a_text)))
+        msg.attach(email.mime.text.MIMEText(a_text))
+        msg.attach(email.mime.application.MIMEApplication(a_attachment, 'pdf'))
+
+        return msg.as_string()
+
+    def test_pack_unpack(self):
+        """
+           Check that the big base64 parts are stored once and that the emails are rebuilt byte for byte
+        """
+        store      = blob_utils.BlobStore('%s/blobs' % (self.test_db_dir), a_min_size = 1024)
+        attachment = os.urandom(100000)
+
+        for eol in ['\n', '\r\n']:
+            raw    = self._create_email('see the report', attachment).replace('\n', eol)
+            stored = store.pack(raw)
+
+            self.assertTrue(stored.startswith(blob_utils.BlobStore.PREFIX))
+            self.assertTrue(len(stored) < 1000)
+            self.assertEquals(raw, store.unpack(stored))
+
+        # the same attachment is stored once
+        self.assertEquals(1, len(os.listdir('%s/blobs' % (self.test_db_dir))))
+
+        # small parts and base64 texts that would not be encoded again identically stay in the email
+        raw = self._create_email('small', os.urandom(100))
+        self.assertEquals(raw, store.pack(raw))
+
+        raw = self._create_email('odd lines', attachment)
+        start = raw.index('\n\n', raw.index('base64')) + 2
+        raw = raw[:start] + raw[start:].replace('\n', '', 1)
+        self.assertEquals(raw, store.pack(raw))
+
+        # an email that looks packed is never misread
+        raw = '%s[1, 2]\nnot an email' % (blob_utils.BlobStore.PREFIX)
+        self.assertEquals(raw, store.unpack(store.pack(raw)))
+
+    def test_keyed_addresses(self):
+        """
+           Check that the blobs packed with a key are named by the HMAC-SHA256 of their content
+           and that the blobs addressed with SHA-256 are still read
+        """
+        store      = blob_utils.BlobStore('%s/blobs' % (self.test_db_dir), a_min_size = 1024)
+        attachment = os.urandom(100000)
+        raw        = self._create_email('see the report', attachment)
+        sha        = hashlib.sha256(attachment).hexdigest()
+        address    = blob_utils.BlobStore.get_address(attachment, 'the db key')
+
+        stored = store.pack(raw, a_key = 'the db key')
+        self.assertNotEquals(sha, address)
+        self.assertTrue(os.path.exists('%s/blobs/%s/%s' % (self.test_db_dir, address[:2], address)))
+        self.assertFalse(os.path.exists('%s/blobs/%s/%s' % (self.test_db_dir, sha[:2], sha)))
+        self.assertFalse(sha in stored)
+        self.assertEquals(raw, store.unpack(stored, a_key = 'the db key'))
+
+        # the key is needed to check the blob
+        self.assertRaises(IOError, store.unpack, stored)
+        self.assertRaises(IOError, store.unpack, stored, None, 'another key')
+
+        # blob packed before the keyed addresses
+        legacy = store.pack(raw)
+        self.assertTrue(os.path.exists('%s/blobs/%s/%s' % (self.test_db_dir, sha[:2], sha)))
+        self.assertEquals(raw, store.unpack(legacy, a_key = 'the db key'))
+
+    def test_storer_dedup(self):
+        """
+           Check the burying and unburying of emails sharing an attachment in an encrypted db
+        """
+        gstorer = gmvault.GmailStorer(self.test_db_dir, encrypt_data = True)
+        gstorer._dedup_attachments = True #pylint:disable-msg=W0212
+
+        attachment = os.urandom(200000)
+        a_date     = datetime.datetime(2012, 6, 1)
+        raw_emails = {}
+        for gm_id in [5001, 5002]:
+            raw_emails[gm_id] = self._create_email('report %s' % (gm_id), attachment)
+            gstorer.bury_email({ imap_utils.GIMAPFetcher.GMAIL_ID               : gm_id,
+                                 imap_utils.GIMAPFetcher.GMAIL_THREAD_ID        : gm_id,
+                                 imap_utils.GIMAPFetcher.GMAIL_LABELS           : ('reports',),
+                                 imap_utils.GIMAPFetcher.IMAP_FLAGS             : (),
+                                 imap_utils.GIMAPFetcher.IMAP_INTERNALDATE      : a_date,
+                                 imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY : 'Message-ID: <%s@test>\r\nSubject: report\r\n\r\n' % (gm_id),
+                                 imap_utils.GIMAPFetcher.EMAIL_BODY             : raw_emails[gm_id]
+                               }, local_dir = '2012-06', compress = True)
+
+        blobs = []
+        for the_dir, _, files in os.walk('%s/blobs' % (self.test_db_dir)):
+            blobs.extend([ os.path.join(the_dir, fname) for fname in files ])
+        self.assertEquals(1, len(blobs))
+        # the name of the blob does not tell which attachment it holds without the key
+        self.assertEquals('%s.crypt' % (blob_utils.BlobStore.get_address(attachment, gstorer._encryption_key)), \
+                          os.path.basename(blobs[0])) #pylint:disable-msg=W0212
+        self.assertTrue(os.path.getsize('%s/db/2012-06/5002.eml.crypt.gz' % (self.test_db_dir)) < 2000)
+
+        gstorer.flush()
+        gstorer = gmvault.GmailStorer(self.test_db_dir, encrypt_data = True)
+        self.assertEquals(raw_emails[5002], gstorer.unbury_email(5002)[1])
+
+    def test_streamed_email_and_gc(self):
+        """
+           Check that the emails streamed to disk are deduplicated and that the unused blobs are deleted
+           once no email or quarantined email references them
+        """
+        attachment = os.urandom(200000)
+        raw        = self._create_email('big report', attachment)
+
+        for storer_class in [gmvault.GmailStorer, segment_storer.SegmentStorer]:
+            gmvault_utils.delete_all_under(self.test_db_dir, delete_top_dir = True)
+            gstorer = storer_class(self.test_db_dir, encrypt_data = True)
+            gstorer._dedup_attachments = True #pylint:disable-msg=W0212
+
+            for gm_id in [6001, 6002]:
+                info = test_utils.create_email_info(gm_id, datetime.datetime(2012, 6, 1))
+                del info[imap_utils.GIMAPFetcher.EMAIL_BODY]
+
+                writer = gstorer.get_email_writer(gm_id, '2012-06', compress = True)
+                for pos in xrange(0, len(raw), 8192):
+                    writer.write(raw[pos:pos + 8192])
+                gstorer.bury_email(info, local_dir = '2012-06', compress = True, data_writer = writer)
+            gstorer.flush()
+
+            blobs = [ os.path.join(the_dir, fname) for the_dir, _, fnames in os.walk('%s/blobs' % (self.test_db_dir)) \
+                      for fname in fnames ]
+            self.assertEquals(1, len(blobs))
+            self.assertEquals(raw, gstorer.unbury_email(6002)[1])
+            self.assertEquals([], [ fname for fname in os.listdir('%s/db/2012-06' % (self.test_db_dir)) if fname.endswith('.part') ])
+
+            # recent blobs are never deleted: their emails might not be written yet
+            gstorer.delete_emails([(6001, '2012-06')], 'email')
+            gstorer.quarantine_email(6002)
+            self.assertEquals((0, 0), gstorer.gc_blobs())
+
+            old = os.path.getmtime(blobs[0]) - 2 * gstorer.BLOB_GC_DELAY
+            os.utime(blobs[0], (old, old))
+            self.assertEquals((0, 0), gstorer.gc_blobs()) # used by the quarantined email
+
+            gmvault_utils.delete_all_under('%s/quarantine' % (self.test_db_dir))
+            self.assertEquals((1, os.path.getsize(blobs[0])), gstorer.gc_blobs())
+            self.assertFalse(os.path.exists(blobs[0]))
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestBlobUtils)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,116 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import os
+
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.imap_utils as imap_utils
+import gmv.index_utils as index_utils
+import gmv.codec_utils as codec_utils
+import gmv.segment_storer as segment_storer
+
+import test_utils
+
+
+class TestCodecUtils(test_utils.DbTestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the compression codecs of the stored emails
+    """
+
+    TEST_DB_DIR = "/tmp/gmvault-codec-tests"
+
+    def __init__(self, stuff):
+        """ constructor """
+        super(TestCodecUtils, self).__init__(stuff)
+
+        self.codecs = [ codec_utils.Codec(), codec_utils.GzipCodec(1), codec_utils.Bz2Codec() ]
+        if codec_utils.lzma:
+            self.codecs.append(codec_utils.XzCodec())
+
+    def test_codecs(self):
+        """
+           Check that each codec reads back what it writes and that it is found from the file suffix and the flags
+        """
+        data = 'Subject: test\r\n\r\n%s' % ('a line of the email\r\n' * 1000)
+        os.makedirs(self.test_db_dir)
+
+        for codec in self.codecs:
+            self.assertEquals(data, codec.decompress(codec.compress(data)))
+
+            path   = '%s/1.eml.crypt%s' % (self.test_db_dir, codec.SUFFIX)
+            the_fd = codec.open(path, 'wb')
+            the_fd.write(data)
+            the_fd.close()
+
+            self.assertEquals(type(codec), codec_utils.get_codec_from_filename(path))
+            self.assertEquals(codec.FLAG | index_utils.GmailIndex.ENCRYPTED, index_utils.GmailIndex.get_flags_from_filename(path))
+            self.assertEquals(type(codec), codec_utils.get_codec_from_flags(codec.FLAG | index_utils.GmailIndex.ENCRYPTED))
+
+            # the files written by the codec are in the format of compress
+            the_fd = codec_utils.get_codec_from_filename(path)().open(path, 'rb')
+            self.assertEquals(data, codec.decompress(open(path, 'rb').read()))
+            self.assertEquals(data, the_fd.read())
+            the_fd.close()
+
+        self.assertRaises(Exception, codec_utils.get_codec, 'zip')
+
+        # 0 is a level (xz preset 0), None the default level of the codec
+        self.assertEquals(0, codec_utils.get_codec(codec_utils.GzipCodec.NAME, 0).level)
+        self.assertEquals(codec_utils.Bz2Codec.DEFAULT_LEVEL, codec_utils.get_codec(codec_utils.Bz2Codec.NAME).level)
+
+        results = codec_utils.benchmark([data, data[:100]], self.codecs)
+        self.assertEquals(len(self.codecs), len(results))
+        self.assertEquals(1.0, results[0][1]) # no compression
+        self.assertTrue(results[1][1] < 0.1)
+
+    def test_storers(self):
+        """
+           Check that both storages write the emails with the codec of the conf and read them whatever their codec
+        """
+        for storer_class in [gmvault.GmailStorer, segment_storer.SegmentStorer]:
+            gmvault_utils.delete_all_under(self.test_db_dir, delete_top_dir = True)
+            gstorer = storer_class(self.test_db_dir)
+
+            for gm_id, codec in enumerate(self.codecs):
+                gstorer._codec = codec #pylint:disable-msg=W0212
+                gstorer.bury_email(test_utils.create_email_info(gm_id, datetime.datetime(2012, 7, 1), a_nb_lines = 100), local_dir = '2012-07', compress = True)
+
+            for gm_id, codec in enumerate(self.codecs):
+                self.assertEquals(test_utils.create_email_info(gm_id, datetime.datetime(2012, 7, 1), a_nb_lines = 100)[imap_utils.GIMAPFetcher.EMAIL_BODY], gstorer.unbury_email(gm_id)[1])
+
+            gstorer.delete_emails([(2, '2012-07')], 'email')
+            gstorer.flush()
+            self.assertEquals([ gm_id for gm_id in range(len(self.codecs)) if gm_id != 2 ], gstorer.get_all_existing_gmail_ids().keys())
+
+            if storer_class == gmvault.GmailStorer:
+                self.assertEquals([], [ fname for fname in os.listdir('%s/db/2012-07' % (self.test_db_dir)) if fname.startswith('2.') ])
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCodecUtils)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
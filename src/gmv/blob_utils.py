@@ -0,0 +1,290 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the BlobStore: content-addressed storage of the big base64 parts (attachments) of the emails
+
+'''
+import os
+import re
+import json
+import base64
+import binascii
+import hmac
+import hashlib
+import tempfile
+import threading
+
+import log_utils
+import gmvault_utils
+
+LOG = log_utils.LoggerFactory.get_logger('blob_utils')
+
+class BlobStore(object):
+    """
+       Store the decoded content of the big base64 MIME parts of the emails once, in a file named by its address:
+       its SHA-256 or, in an encrypted db, its HMAC-SHA256 with the db key so the names of the blobs do not tell
+       whether the db contains a known file.
+       The email data then starts with a "GMVAULT-BLOBS <json refs>" line and each part body is replaced
+       by a short reference. A part is only moved to the blob area if encoding its content again gives
+       back exactly the same bytes, so the original email can always be rebuilt byte for byte.
+       The blobs are shared by the emails: the ones which are not referenced anymore are deleted by remove_unused.
+    """
+    PREFIX = 'GMVAULT-BLOBS '
+    REF    = '[gmvault blob %s:%s]%s'
+    SHA256 = 'sha256'
+    HMAC   = 'hmac-sha256'
+
+    # the header block of a part (or of the email) containing a base64 transfer encoding up to the blank line
+    BASE64_PART_RE  = re.compile(r'^Content-Transfer-Encoding:[ \t]*base64[ \t]*\r?\n(?:[^\r\n]+\r?\n)*?\r?\n', re.I | re.M)
+    BASE64_LINES_RE = re.compile(r'(?:[A-Za-z0-9+/=]+\r?\n)+')
+
+    def __init__(self, a_blobs_dir, a_min_size = 65536):
+        """
+           a_blobs_dir: blob area
+           a_min_size : min size of the base64 text of a part to store it in the blob area
+        """
+        self._blobs_dir = a_blobs_dir
+        self._min_size  = a_min_size
+
+        # blobs written since the last sync
+        self._unsynced      = set()
+        self._unsynced_lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+           State sent to the transform processes: without the lock and the unsynced blobs of this process
+        """
+        state = dict(self.__dict__)
+        del state['_unsynced_lock']
+        state['_unsynced'] = set()
+        return state
+
+    def __setstate__(self, a_state):
+        """
+           Rebuild the store in a transform process
+        """
+        self.__dict__.update(a_state)
+        self._unsynced_lock = threading.Lock()
+
+    def _get_blob_path(self, a_sha, a_encrypted):
+        """
+           Path of a blob (ex: blobs/3f/3f8a...[.crypt])
+        """
+        path = '%s/%s/%s' % (self._blobs_dir, a_sha[:2], a_sha)
+        return '%s.crypt' % (path) if a_encrypted else path
+
+    @classmethod
+    def get_address(cls, a_content, a_key = None):
+        """
+           Return the address of a blob: the HMAC-SHA256 of its content with a_key if a_key is not None
+           otherwise its SHA-256
+        """
+        if a_key:
+            return hmac.new(a_key, a_content, hashlib.sha256).hexdigest()
+
+        return hashlib.sha256(a_content).hexdigest()
+
+    def _put(self, a_content, a_encrypt, a_key = None):
+        """
+           Store a blob (encrypted with a_encrypt if not None) if it is not already there and return its address
+        """
+        sha  = self.get_address(a_content, a_key)
+        path = self._get_blob_path(sha, a_encrypt is not None)
+
+        if os.path.exists(path):
+            os.utime(path, None) # used again: keep it from remove_unused until the email is written
+            return sha
+
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)): # created in the meantime by another thread
+                    raise
+
+        # write in a tmp file and rename to never leave a partial blob
+        tmp_fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), prefix = '.%s' % (sha[:8]))
+        try:
+            os.write(tmp_fd, a_encrypt(a_content) if a_encrypt else a_content)
+        finally:
+            os.close(tmp_fd)
+
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(tmp_path) # rename cannot replace a file on windows. The blob is already there
+        else:
+            os.rename(tmp_path, path)
+            with self._unsynced_lock:
+                self._unsynced.add(path)
+
+        return sha
+
+    def sync(self):
+        """
+           Fsync the blobs written since the last sync
+        """
+        with self._unsynced_lock:
+            paths, self._unsynced = self._unsynced, set()
+
+        gmvault_utils.fsync_paths(paths)
+
+    def _get(self, a_sha, a_decrypt, a_key = None):
+        """
+           Return the content of a blob (decrypted with a_decrypt if it is encrypted) and check it against its address
+           (HMAC-SHA256 with a_key if a_key is not None)
+        """
+        if os.path.exists(self._get_blob_path(a_sha, True)):
+            the_fd = open(self._get_blob_path(a_sha, True), 'rb')
+            try:
+                content = a_decrypt(the_fd.read())
+            finally:
+                the_fd.close()
+        else:
+            the_fd = open(self._get_blob_path(a_sha, False), 'rb')
+            try:
+                content = the_fd.read()
+            finally:
+                the_fd.close()
+
+        if self.get_address(content, a_key) != a_sha:
+            raise IOError("Blob %s is corrupted" % (a_sha))
+
+        return content
+
+    def remove_unused(self, a_used_shas, a_before):
+        """
+           Delete the blobs (and the partial blobs) which are not in a_used_shas and have not been stored or used
+           since the time a_before (a new blob can be referenced by an email which is not written yet).
+           Return (number of deleted blobs, number of bytes reclaimed)
+        """
+        nb_blobs, nb_bytes = 0, 0
+
+        for the_dir, _, fnames in os.walk(self._blobs_dir):
+            for fname in fnames:
+                path = os.path.join(the_dir, fname)
+                if fname.split('.')[0] in a_used_shas or os.path.getmtime(path) >= a_before:
+                    continue
+
+                nb_bytes += os.path.getsize(path)
+                os.remove(path)
+                nb_blobs += 1
+
+        return nb_blobs, nb_bytes
+
+    @classmethod
+    def get_refs(cls, a_stored):
+        """
+           Return the SHA-256 of the blobs referenced by the stored data of an email
+        """
+        if not a_stored.startswith(cls.PREFIX):
+            return []
+
+        return [ ref[2] for ref in json.loads(a_stored[len(cls.PREFIX):a_stored.index('\n')]) ]
+
+    @classmethod
+    def _encode(cls, a_content, a_line_len, a_eol):
+        """
+           base64 encode a_content in lines of a_line_len chars ended by a_eol
+        """
+        encoded = base64.b64encode(a_content)
+        return ''.join([ '%s%s' % (encoded[i:i + a_line_len], a_eol) for i in xrange(0, len(encoded), a_line_len) ])
+
+    def _extract(self, a_text):
+        """
+           Return (content, line length, end of line) of a base64 part body if it can be encoded again identically,
+           otherwise None
+        """
+        eol      = '\r\n' if a_text.endswith('\r\n') else '\n'
+        line_len = a_text.find(eol)
+
+        try:
+            content = base64.b64decode(a_text)
+        except (TypeError, binascii.Error):
+            return None
+
+        if line_len <= 0 or self._encode(content, line_len, eol) != a_text:
+            return None
+
+        return content, line_len, eol
+
+    def pack(self, a_data, a_dedup = True, a_encrypt = None, a_key = None):
+        """
+           Return the data to store for an email: the big base64 parts are moved to the blob area if a_dedup is True.
+           The data is returned as it is when no part has been moved.
+           a_encrypt: function encrypting the new blobs (None to store them in clear)
+           a_key    : key of the encrypted db addressing the blobs with HMAC-SHA256 (None to address them with SHA-256)
+        """
+        refs, chunks, pos, out_len = [], [], 0, 0
+
+        if a_dedup:
+            for matched in self.BASE64_PART_RE.finditer(a_data):
+                if matched.end() < pos:
+                    continue
+
+                lines = self.BASE64_LINES_RE.match(a_data, matched.end())
+                if not lines or (lines.end() - lines.start()) < self._min_size:
+                    continue
+
+                extracted = self._extract(lines.group(0))
+                if not extracted:
+                    LOG.debug("Keep a base64 part of %d bytes in the email: it is not in canonical form." % (lines.end() - lines.start()))
+                    continue
+
+                content, line_len, eol = extracted
+                sha = self._put(content, a_encrypt, a_key)
+                ref = self.REF % (self.HMAC if a_key else self.SHA256, sha, eol)
+
+                # refs: [offset of the reference in the stored body, reference length, address, line length, end of line]
+                # followed by HMAC for the blobs addressed with the key
+                chunks.extend([a_data[pos:lines.start()], ref])
+                out_len += lines.start() - pos
+                refs.append([ out_len, len(ref), sha, line_len, eol ] + ([self.HMAC] if a_key else []))
+                out_len += len(ref)
+                pos = lines.end()
+
+        if not refs:
+            if a_data.startswith(self.PREFIX):
+                return '%s[]\n%s' % (self.PREFIX, a_data) # never read back an email as packed
+            return a_data
+
+        chunks.append(a_data[pos:])
+
+        return '%s%s\n%s' % (self.PREFIX, json.dumps(refs), ''.join(chunks))
+
+    def unpack(self, a_stored, a_decrypt = None, a_key = None):
+        """
+           Rebuild the original data of an email from the stored data
+           a_decrypt: function decrypting the encrypted blobs
+           a_key    : key of the encrypted db (needed for the blobs addressed with HMAC-SHA256)
+        """
+        if not a_stored.startswith(self.PREFIX):
+            return a_stored
+
+        header_end = a_stored.index('\n')
+        refs       = json.loads(a_stored[len(self.PREFIX):header_end])
+        body       = a_stored[header_end + 1:]
+
+        chunks, pos = [], 0
+        for ref in refs:
+            offset, ref_len, sha, line_len, eol = ref[:5]
+            if ref[5:] == [self.HMAC] and not a_key:
+                raise IOError("Blob %s is addressed with the encryption key of the db" % (sha))
+            chunks.append(body[pos:offset])
+            chunks.append(self._encode(self._get(sha, a_decrypt, a_key if ref[5:] else None), line_len, str(eol)))
+            pos = offset + ref_len
+        chunks.append(body[pos:])
+
+        return ''.join(chunks)
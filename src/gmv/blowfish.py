@@ -43,6 +43,7 @@ equivalently 8 and 56 bytes. The encryption and decryption functions operate
 on 64-bit blocks, or 8-byte strings.
 """
 import array
+import binascii
 import struct
  
 class Blowfish:
@@ -63,6 +64,8 @@ class Blowfish:
  
     # CTR constants
     _BLOCK_SIZE = 8
+    _CTR_RUN_SIZE = 65536 # bytes processed per keystream run in encryptCTR()
+    _CTR_CACHE_SIZE = 8 * 1024 * 1024 # max bytes of keystream kept by _getCTRBlocks()
  
     def __init__(self, key):
         """
@@ -380,6 +383,17 @@ class Blowfish:
                 self._s_boxes[i][j] = l
                 self._s_boxes[i][j + 1] = r
  
+        # Tables for the CTR keystream loop: plain lists are faster to index
+        # than arrays and the sum of the first two s-boxes is precomputed for
+        # the 16 upper bits of the round input
+        self._ctr_p_boxes = list(self._p_boxes)
+        (s0, s1, s2, s3) = [list(s_box) for s_box in self._s_boxes]
+        self._ctr_s_boxes = ([s0[i >> 8] + s1[i & 0xFF] for i in xrange(65536)], s2, s3)
+ 
+        # Keystream blocks computed from counter 0. Every email is encrypted
+        # from initCTR() so they are the same for all of them.
+        self._ctr_cache = ''
+ 
     def initCTR(self, iv=0):
         """
         Initializes CTR engine for encryption or decryption.
@@ -472,11 +486,43 @@ class Blowfish:
         Encrypts an arbitrary string and returns the encrypted string.
  
         This method can be called successively for multiple string blocks.
+ 
+        The keystream is generated by large runs of blocks (see
+        _calcCTRBlocks()) and xored with the data in bulk. The output and the
+        CTR state are the same as with a byte by byte processing through
+        _nextCTRByte().
         """
         if not type(data) is str:
             raise TypeError("Only 8-bit strings are supported")
  
-        return ''.join([chr(ord(ch) ^ self._nextCTRByte()) for ch in data])
+        # Use what is left of the current keystream block
+        head_len = min(len(data), self._BLOCK_SIZE - self._ctr_pos)
+        result = [self._xorStrings(data[:head_len], self._ctr_cks[self._ctr_pos:self._ctr_pos + head_len])]
+        if head_len < self._BLOCK_SIZE - self._ctr_pos:
+            self._ctr_pos += head_len
+            return result[0]
+ 
+        # The current block is used up: process the rest by runs of blocks.
+        # As in _nextCTRByte(), the block following the last used byte is
+        # always computed so the last run generates one more block.
+        pos = head_len
+        data_len = len(data)
+        while True:
+            run_len = min(data_len - pos, self._CTR_RUN_SIZE)
+            last_run = pos + run_len >= data_len
+            nb_blocks = run_len // self._BLOCK_SIZE + (1 if last_run else 0)
+            keystream = self._getCTRBlocks(self._ctr_iv, nb_blocks)
+            self._ctr_iv += nb_blocks
+ 
+            result.append(self._xorStrings(data[pos:pos + run_len], keystream[:run_len]))
+            pos += run_len
+ 
+            if last_run:
+                self._ctr_cks = keystream[-self._BLOCK_SIZE:]
+                self._ctr_pos = run_len % self._BLOCK_SIZE
+                break
+ 
+        return ''.join(result)
  
     def decryptCTR(self, data):
         """
@@ -489,10 +535,78 @@ class Blowfish:
         """
         Calculates one block of CTR keystream.
         """
-        self._ctr_cks = self.encrypt(struct.pack("Q", self._ctr_iv)) # keystream block
+        self._ctr_cks = self._getCTRBlocks(self._ctr_iv, 1) # keystream block
         self._ctr_iv += 1
         self._ctr_pos = 0
  
+    def _getCTRBlocks(self, iv, nb_blocks):
+        """
+        Returns nb_blocks blocks of CTR keystream starting at counter iv,
+        from the keystream cache when possible.
+        """
+        cache = self._ctr_cache
+        nb_cached = len(cache) // self._BLOCK_SIZE
+        end = iv + nb_blocks
+        if end > nb_cached:
+            if end * self._BLOCK_SIZE > self._CTR_CACHE_SIZE:
+                return self._calcCTRBlocks(iv, nb_blocks)
+            cache += self._calcCTRBlocks(nb_cached, end - nb_cached)
+            self._ctr_cache = cache
+        return cache[iv * self._BLOCK_SIZE:end * self._BLOCK_SIZE]
+ 
+    def _calcCTRBlocks(self, iv, nb_blocks):
+        """
+        Calculates nb_blocks blocks of CTR keystream starting at counter iv.
+ 
+        Equivalent to nb_blocks calls of encrypt(struct.pack("Q", iv)) with
+        the Feistel rounds unrolled and the s-boxes in local variables.
+        """
+        (p0, p1, p2, p3, p4, p5, p6, p7, p8, p9,
+         p10, p11, p12, p13, p14, p15, p16, p17) = self._ctr_p_boxes
+        (s01, s2, s3) = self._ctr_s_boxes
+ 
+        # The counters are packed as encrypt() receives them then read back
+        # as the (xl, xr) pairs of big-endian 32-bit words
+        nb_words = nb_blocks * 2
+        words = struct.unpack(">%dI" % nb_words, struct.pack("%dQ" % nb_blocks, *xrange(iv, iv + nb_blocks)))
+ 
+        # Same round function as _round(): the intermediate sums do not need
+        # to be reduced as only the lower 32 bits of the result are kept
+        out = [0] * nb_words
+        for i in xrange(0, nb_words, 2):
+            xl = words[i] ^ p0
+            xr = words[i + 1] ^ p1 ^ (((s01[xl >> 16] ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]) & 0xFFFFFFFF)
+            xl ^= p2 ^ (((s01[xr >> 16] ^ s2[(xr >> 8) & 0xFF]) + s3[xr & 0xFF]) & 0xFFFFFFFF)
+            xr ^= p3 ^ (((s01[xl >> 16] ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]) & 0xFFFFFFFF)
+            xl ^= p4 ^ (((s01[xr >> 16] ^ s2[(xr >> 8) & 0xFF]) + s3[xr & 0xFF]) & 0xFFFFFFFF)
+            xr ^= p5 ^ (((s01[xl >> 16] ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]) & 0xFFFFFFFF)
+            xl ^= p6 ^ (((s01[xr >> 16] ^ s2[(xr >> 8) & 0xFF]) + s3[xr & 0xFF]) & 0xFFFFFFFF)
+            xr ^= p7 ^ (((s01[xl >> 16] ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]) & 0xFFFFFFFF)
+            xl ^= p8 ^ (((s01[xr >> 16] ^ s2[(xr >> 8) & 0xFF]) + s3[xr & 0xFF]) & 0xFFFFFFFF)
+            xr ^= p9 ^ (((s01[xl >> 16] ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]) & 0xFFFFFFFF)
+            xl ^= p10 ^ (((s01[xr >> 16] ^ s2[(xr >> 8) & 0xFF]) + s3[xr & 0xFF]) & 0xFFFFFFFF)
+            xr ^= p11 ^ (((s01[xl >> 16] ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]) & 0xFFFFFFFF)
+            xl ^= p12 ^ (((s01[xr >> 16] ^ s2[(xr >> 8) & 0xFF]) + s3[xr & 0xFF]) & 0xFFFFFFFF)
+            xr ^= p13 ^ (((s01[xl >> 16] ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]) & 0xFFFFFFFF)
+            xl ^= p14 ^ (((s01[xr >> 16] ^ s2[(xr >> 8) & 0xFF]) + s3[xr & 0xFF]) & 0xFFFFFFFF)
+            xr ^= p15 ^ (((s01[xl >> 16] ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]) & 0xFFFFFFFF)
+            xl ^= p16 ^ (((s01[xr >> 16] ^ s2[(xr >> 8) & 0xFF]) + s3[xr & 0xFF]) & 0xFFFFFFFF)
+            # The halves are swapped by the last round
+            out[i] = xr ^ p17
+            out[i + 1] = xl
+ 
+        return struct.pack(">%dI" % nb_words, *out)
+ 
+    @staticmethod
+    def _xorStrings(data, keystream):
+        """
+        Xors two strings of the same length in one go through long integers.
+        """
+        if not data:
+            return ''
+        hex_len = len(data) * 2
+        return binascii.unhexlify("%0*x" % (hex_len, long(binascii.hexlify(data), 16) ^ long(binascii.hexlify(keystream), 16)))
+ 
     def _nextCTRByte(self):
         """
         Returns one byte of CTR keystream.
@@ -0,0 +1,236 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the compression codecs of the stored emails (none, gzip, bz2 and xz).
+The codec of a data file is given by its suffix (.gz, .bz2, .xz or nothing) and the codec of a record
+of the segments storage by its flags.
+
+'''
+import gzip
+import bz2
+import zlib
+import time
+
+import gmvault_utils
+
+try:
+    import lzma # python 3
+except ImportError:
+    try:
+        from backports import lzma # python 2 with backports.lzma installed
+    except ImportError:
+        lzma = None
+
+class Codec(object):
+    """
+       No compression. Base class of the codecs
+    """
+    NAME          = 'none'
+    SUFFIX        = ''
+    FLAG          = 0     # storage flag (see index_utils.GmailIndex)
+    DEFAULT_LEVEL = None
+
+    def __init__(self, a_level = None):
+        """
+           a_level: compression level (the codec default if None)
+        """
+        self.level = self.DEFAULT_LEVEL if a_level is None else a_level
+
+    def __str__(self):
+        return self.NAME if self.level is None else '%s:%s' % (self.NAME, self.level)
+
+    def open(self, a_path, a_mode):
+        """
+           Open a data file (a_mode is 'rb' or 'wb')
+        """
+        return open(a_path, a_mode)
+
+    def compress(self, a_data):
+        """
+           Return the compressed data (same format as the data files)
+        """
+        return a_data
+
+    def decompress(self, a_data):
+        """
+           Return the decompressed data
+        """
+        return a_data
+
+class GzipCodec(Codec):
+    """
+       gzip (zlib) compression
+    """
+    NAME          = 'gzip'
+    SUFFIX        = '.gz'
+    FLAG          = 1
+    DEFAULT_LEVEL = 6
+
+    def open(self, a_path, a_mode):
+        """
+           Open a data file (a_mode is 'rb' or 'wb')
+        """
+        return gzip.open(a_path, a_mode, self.level)
+
+    def compress(self, a_data):
+        """
+           Return the data in the gzip format
+        """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(a_data) + compressor.flush()
+
+    def decompress(self, a_data):
+        """
+           Return the decompressed data
+        """
+        return zlib.decompress(a_data, 16 + zlib.MAX_WBITS)
+
+class Bz2Codec(Codec):
+    """
+       bzip2 compression
+    """
+    NAME          = 'bz2'
+    SUFFIX        = '.bz2'
+    FLAG          = 4
+    DEFAULT_LEVEL = 9
+
+    def open(self, a_path, a_mode):
+        """
+           Open a data file (a_mode is 'rb' or 'wb')
+        """
+        if 'w' in a_mode:
+            return bz2.BZ2File(a_path, a_mode, compresslevel = self.level)
+        return bz2.BZ2File(a_path, a_mode)
+
+    def compress(self, a_data):
+        """
+           Return the data in the bzip2 format
+        """
+        return bz2.compress(a_data, self.level)
+
+    def decompress(self, a_data):
+        """
+           Return the decompressed data
+        """
+        return bz2.decompress(a_data)
+
+class XzCodec(Codec):
+    """
+       xz (lzma) compression. Needs the lzma module (backports.lzma with python 2)
+    """
+    NAME          = 'xz'
+    SUFFIX        = '.xz'
+    FLAG          = 8
+    DEFAULT_LEVEL = 6
+
+    def __init__(self, a_level = None):
+        """
+           a_level: compression preset (0-9)
+        """
+        if not lzma:
+            raise Exception("The xz compression needs the lzma module. Please install backports.lzma.")
+        super(XzCodec, self).__init__(a_level)
+
+    def open(self, a_path, a_mode):
+        """
+           Open a data file (a_mode is 'rb' or 'wb')
+        """
+        if 'w' in a_mode:
+            return lzma.LZMAFile(a_path, a_mode, preset = self.level)
+        return lzma.LZMAFile(a_path, a_mode)
+
+    def compress(self, a_data):
+        """
+           Return the data in the xz format
+        """
+        return lzma.compress(a_data, preset = self.level)
+
+    def decompress(self, a_data):
+        """
+           Return the decompressed data
+        """
+        return lzma.decompress(a_data)
+
+CODECS = [ GzipCodec, Bz2Codec, XzCodec, Codec ] # the suffix of Codec matches every file so it is the last one
+
+COMPRESSION_FLAGS = GzipCodec.FLAG | Bz2Codec.FLAG | XzCodec.FLAG
+
+def get_codec(a_name = None, a_level = None):
+    """
+       Return a codec from its name (none, gzip, bz2 or xz) and its level.
+       The compression and compression_level of the conf are used if they are not given
+    """
+    if a_name is None:
+        a_name  = gmvault_utils.get_conf_defaults().get("General", "compression", GzipCodec.NAME)
+        a_level = gmvault_utils.get_conf_defaults().getint("General", "compression_level", -1)
+        if a_level < 0:
+            a_level = None # default level of the codec
+
+    for codec in CODECS:
+        if codec.NAME == a_name:
+            return codec(a_level)
+
+    raise Exception("Unknown compression codec %s. Available codecs: %s" % (a_name, ', '.join([ cdc.NAME for cdc in CODECS ])))
+
+def get_codec_from_filename(a_filename):
+    """
+       Return the codec class of a data file from its suffix (ex: 12345.eml.crypt.bz2 => Bz2Codec)
+    """
+    for codec in CODECS:
+        if a_filename.endswith(codec.SUFFIX):
+            return codec
+
+def get_codec_from_flags(a_flags):
+    """
+       Return the codec class corresponding to storage flags
+    """
+    for codec in CODECS:
+        if (a_flags or 0) & COMPRESSION_FLAGS == codec.FLAG:
+            return codec
+
+    raise Exception("Invalid compression flags %s" % (a_flags))
+
+def get_data_suffixes():
+    """
+       Return the possible suffixes of a data file after .eml
+    """
+    return [ '%s%s' % (crypt, codec.SUFFIX) for crypt in ['.crypt', ''] for codec in CODECS ]
+
+def benchmark(a_samples, a_codecs):
+    """
+       Compress and decompress the samples (list of email data) with each codec.
+       Return a list of (codec, ratio, compression MB/s, decompression MB/s). The ratio is compressed size / original size
+    """
+    nb_bytes = sum([ len(sample) for sample in a_samples ])
+    results  = []
+
+    for codec in a_codecs:
+        start      = time.time()
+        compressed = [ codec.compress(sample) for sample in a_samples ]
+        comp_time  = time.time() - start
+
+        start = time.time()
+        for data in compressed:
+            codec.decompress(data)
+        decomp_time = time.time() - start
+
+        ratio = float(sum([ len(data) for data in compressed ])) / nb_bytes if nb_bytes else 1.0
+        results.append((codec, ratio, \
+                        nb_bytes / (1024.0 * 1024.0) / max(comp_time, 1e-6), \
+                        nb_bytes / (1024.0 * 1024.0) / max(decomp_time, 1e-6)))
+
+    return results
@@ -21,6 +21,7 @@ import sys
 import datetime
 import os
 import signal
+import random
 import traceback
 
 import argparse
@@ -28,6 +29,8 @@ import log_utils
 import imaplib
 import gmvault_utils
 import gmvault
+import segment_storer
+import codec_utils
 
 from cmdline_utils  import CmdLineParser
 from credential_utils import CredentialHelper
@@ -41,6 +44,9 @@ a) Get help for each of the individual commands
 #> gmvault sync -h
 #> gmvault restore --help
 #> gmvault check -h
+#> gmvault index -h
+#> gmvault pack -h
+#> gmvault compression -h
 
 """
 
@@ -117,8 +123,12 @@ class GMVaultLauncher(object):
     RESTORE_TYPES = ['full', 'quick']
     CHECK_TYPES   = ['full']
     
+    MAX_CONNECTIONS = 15 # max number of parallel connections to Gmail (Gmail limits the number of simultaneous connections)
+    
     DEFAULT_GMVAULT_DB = "%s/gmvault-db" % (os.getenv("HOME", "."))
     
+    DEFAULT_BENCH_CODECS = 'gzip:1,gzip:6,gzip:9,bz2:9,xz:6'
+    
     def __init__(self):
         """ constructor """
         super(GMVaultLauncher, self).__init__()
@@ -216,7 +226,11 @@ class GMVaultLauncher(object):
         # activate the restart mode
         sync_parser.add_argument("--no-compression", \
                                  action='store_false', dest='compression', \
-                                 default=True, help= 'disable email storage compression (gzip).')
+                                 default=True, help= 'disable email storage compression (codec defined by compression in the conf, gzip by default).')
+        
+        sync_parser.add_argument("--connections", metavar = "NB", type = int, \
+                                 action='store', help="Number of parallel connections to Gmail used to sync the emails (1 to %d). (default: 1)" % (self.MAX_CONNECTIONS),\
+                                 dest="connections", default=1)
         
         sync_parser.add_argument("--server", metavar = "HOSTNAME", \
                               action='store', help="Gmail imap server hostname. (default: imap.gmail.com)",\
@@ -281,6 +295,10 @@ class GMVaultLauncher(object):
                           help="use interactive password authentication. (not recommended)",
                           action='store_const', dest="passwd", const='empty', default='not_seen')
         
+        rest_parser.add_argument("--connections", metavar = "NB", type = int, \
+                                 action='store', help="Number of parallel connections to Gmail used to restore the emails (1 to %d). (default: 1)" % (self.MAX_CONNECTIONS),\
+                                 dest="connections", default=1)
+        
         rest_parser.add_argument("--server", metavar = "HOSTNAME", \
                               action='store', help="Gmail imap server hostname. (default: imap.gmail.com)",\
                               dest="host", default="imap.gmail.com")
@@ -333,6 +351,76 @@ class GMVaultLauncher(object):
         
         check_parser.set_defaults(verb='check')
         
+        # index command
+        index_parser = subparsers.add_parser('index', \
+                                             help='Rebuild the index of the gmvault-db disk database.')
+        
+        index_parser.add_argument("-d", "--db-dir", \
+                                  action='store', help="Database root directory. (default: ./gmvault-db)",\
+                                  dest="db_dir", default= self.DEFAULT_GMVAULT_DB)
+        
+        index_parser.add_argument("--debug", \
+                              action='store_true', help="Activate debugging info",\
+                              dest="debug", default=False)
+        
+        index_parser.set_defaults(verb='index')
+        
+        # blobs command
+        blobs_parser = subparsers.add_parser('blobs', \
+                                             help='Delete the attachments of the blob area which are not used anymore by the emails of the gmvault-db.')
+        
+        blobs_parser.add_argument("-d", "--db-dir", \
+                                  action='store', help="Database root directory. (default: ./gmvault-db)",\
+                                  dest="db_dir", default= self.DEFAULT_GMVAULT_DB)
+        
+        blobs_parser.add_argument("--debug", \
+                              action='store_true', help="Activate debugging info",\
+                              dest="debug", default=False)
+        
+        blobs_parser.set_defaults(verb='blobs')
+        
+        # pack command
+        pack_parser = subparsers.add_parser('pack', \
+                                            help='Convert the gmvault-db to the segments storage (a few append-only files per month) and compact its segments.')
+        
+        pack_parser.add_argument("-d", "--db-dir", \
+                                 action='store', help="Database root directory. (default: ./gmvault-db)",\
+                                 dest="db_dir", default= self.DEFAULT_GMVAULT_DB)
+        
+        pack_parser.add_argument("--all", \
+                                 action='store_true', help="Compact the segments of every month containing deleted emails "\
+                                 "(default: only the months above segment_compact_ratio)",\
+                                 dest="compact_all", default=False)
+        
+        pack_parser.add_argument("--debug", \
+                              action='store_true', help="Activate debugging info",\
+                              dest="debug", default=False)
+        
+        pack_parser.set_defaults(verb='pack')
+        
+        # compression command
+        comp_parser = subparsers.add_parser('compression', \
+                                            help='Compare the compression codecs and levels on a sample of the emails of the gmvault-db.')
+        
+        comp_parser.add_argument("-d", "--db-dir", \
+                                 action='store', help="Database root directory. (default: ./gmvault-db)",\
+                                 dest="db_dir", default= self.DEFAULT_GMVAULT_DB)
+        
+        comp_parser.add_argument("--sample", metavar = "NB", type = int, \
+                                 action='store', help="Number of emails randomly read from the db. (default: 200)",\
+                                 dest="sample", default=200)
+        
+        comp_parser.add_argument("--codecs", metavar = "CODECS", \
+                                 action='store', help="Comma separated list of codec:level to compare. "\
+                                 "(default: %s)" % (self.DEFAULT_BENCH_CODECS),\
+                                 dest="codecs", default=self.DEFAULT_BENCH_CODECS)
+        
+        comp_parser.add_argument("--debug", \
+                              action='store_true', help="Activate debugging info",\
+                              dest="debug", default=False)
+        
+        comp_parser.set_defaults(verb='compression')
+        
         return parser
       
     @classmethod
@@ -462,6 +550,11 @@ class GMVaultLauncher(object):
             
             #compression flag
             parsed_args['compression'] = options.compression
+            
+            #number of parallel connections
+            if options.connections < 1 or options.connections > self.MAX_CONNECTIONS:
+                parser.error('The number of connections should be between 1 and %d.' % (self.MAX_CONNECTIONS))
+            parsed_args['connections'] = options.connections
                 
                 
         elif parsed_args.get('command', '') == 'restore':
@@ -481,6 +574,11 @@ class GMVaultLauncher(object):
             parsed_args['emails_only'] = options.only_emails
             parsed_args['chats_only']  = options.only_chats
             
+            #number of parallel connections
+            if options.connections < 1 or options.connections > self.MAX_CONNECTIONS:
+                parser.error('The number of connections should be between 1 and %d.' % (self.MAX_CONNECTIONS))
+            parsed_args['connections'] = options.connections
+            
         elif parsed_args.get('command', '') == 'check':
             
             #add defaults for type
@@ -490,6 +588,36 @@ class GMVaultLauncher(object):
             # parse common arguments for sync and restore
             self._parse_common_args(options, parser, parsed_args, self.CHECK_TYPES)
     
+        elif parsed_args.get('command', '') in ['index', 'blobs']:
+            
+            parsed_args['debug']  = options.debug
+            parsed_args['db-dir'] = options.db_dir
+            
+        elif parsed_args.get('command', '') == 'pack':
+            
+            parsed_args['debug']       = options.debug
+            parsed_args['db-dir']      = options.db_dir
+            parsed_args['compact-all'] = options.compact_all
+            
+        elif parsed_args.get('command', '') == 'compression':
+            
+            parsed_args['debug']  = options.debug
+            parsed_args['db-dir'] = options.db_dir
+            
+            if options.sample < 1:
+                parser.error('The sample should contain at least one email.')
+            parsed_args['sample'] = options.sample
+            
+            parsed_args['codecs'] = []
+            for codec in options.codecs.split(','):
+                name, _, level = codec.strip().partition(':')
+                try:
+                    parsed_args['codecs'].append(codec_utils.get_codec(name, int(level) if level else None))
+                except ValueError:
+                    parser.error('Invalid compression level in %s.' % (codec))
+                except Exception, err: #pylint:disable=W0703
+                    LOG.critical("Ignore %s: %s\n" % (codec, err))
+            
         elif parsed_args.get('command', '') == 'config':
             pass
     
@@ -528,7 +656,8 @@ class GMVaultLauncher(object):
             
             #call restore
             labels = [args['label']] if args['label'] else []
-            restorer.restore(extra_labels = labels, restart = args['restart'], emails_only = args['emails_only'], chats_only = args['chats_only'])
+            restorer.restore(extra_labels = labels, restart = args['restart'], emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                             nb_connections = args['connections'])
             
         elif args.get('type', '') == 'quick':
             
@@ -542,7 +671,8 @@ class GMVaultLauncher(object):
             
             #call restore
             labels = [args['label']] if args['label'] else []
-            restorer.restore(pivot_dir = starting_dir, extra_labels = labels, restart = args['restart'], emails_only = args['emails_only'], chats_only = args['chats_only'])
+            restorer.restore(pivot_dir = starting_dir, extra_labels = labels, restart = args['restart'], emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                             nb_connections = args['connections'])
         
         else:
             raise ValueError("Unknown synchronisation mode %s. Please use full (default), quick.")
@@ -569,7 +699,8 @@ class GMVaultLauncher(object):
             #choose full sync. Ignore the request
             syncer.sync({ 'type': 'imap', 'req': 'ALL' } , compress_on_disk = args['compression'], \
                         db_cleaning = args['db-cleaning'], ownership_checking = args['ownership_control'], restart = args['restart'], \
-                        emails_only = args['emails_only'], chats_only = args['chats_only'])
+                        emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                        nb_connections = args['connections'])
             
         elif args.get('type', '') == 'quick':
             
@@ -588,7 +719,8 @@ class GMVaultLauncher(object):
                            compress_on_disk = args['compression'], \
                            db_cleaning = args['db-cleaning'], \
                            ownership_checking = args['ownership_control'], restart = args['restart'], \
-                           emails_only = args['emails_only'], chats_only = args['chats_only'])
+                           emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                           nb_connections = args['connections'])
             
         elif args.get('type', '') == 'custom':
             
@@ -603,7 +735,8 @@ class GMVaultLauncher(object):
             
             syncer.sync(args['request'], compress_on_disk = args['compression'], db_cleaning = args['db-cleaning'], \
                         ownership_checking = args['ownership_control'], restart = args['restart'], \
-                        emails_only = args['emails_only'], chats_only = args['chats_only'])
+                        emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                        nb_connections = args['connections'])
         else:
             raise ValueError("Unknown synchronisation mode %s. Please use full (default), quick or custom.")
         
@@ -623,8 +756,93 @@ class GMVaultLauncher(object):
                                    args['email'], credential, read_only_access = True)
         
         checker.check_clean_db(db_cleaning = True)
+    
+    @classmethod
+    def _rebuild_index(cls, args):
+        """
+           Rebuild the gmail id index of the DB (no connection to Gmail needed)
+        """
+        LOG.critical("Rebuild the index of the gmvault-db located in %s. It might take a bit of time ...\n" % (args['db-dir']))
+        
+        timer = gmvault_utils.Timer()
+        timer.start()
+        
+        gstorer = gmvault.get_storer(args['db-dir'])
+        
+        nb_ids = gstorer.rebuild_index()
+        
+        LOG.critical("Indexed %d emails and chats in %s.\n" % (nb_ids, timer.elapsed_human_time()))
+    
+    @classmethod
+    def _gc_blobs(cls, args):
+        """
+           Delete the unreferenced blobs of the DB (no connection to Gmail needed)
+        """
+        LOG.critical("Look for the unused attachments of the gmvault-db located in %s. It might take a bit of time ...\n" \
+                     % (args['db-dir']))
+        
+        timer = gmvault_utils.Timer()
+        timer.start()
+        
+        gstorer = gmvault.get_storer(args['db-dir'])
+        
+        nb_blobs, nb_bytes = gstorer.gc_blobs()
+        
+        LOG.critical("Deleted %d attachments (%d bytes reclaimed) in %s.\n" % (nb_blobs, nb_bytes, timer.elapsed_human_time()))
+    
+    @classmethod
+    def _pack(cls, args):
+        """
+           Convert the DB to the segments storage and compact its segments (no connection to Gmail needed)
+        """
+        timer = gmvault_utils.Timer()
+        timer.start()
+        
+        if gmvault.GmailStorer.get_storage_backend(args['db-dir']) != gmvault.GmailStorer.SEGMENTS_BACKEND:
+            LOG.critical("Convert the gmvault-db located in %s to the segments storage. It might take a bit of time ...\n" \
+                         % (args['db-dir']))
+        
+        gstorer = segment_storer.SegmentStorer(args['db-dir'])
+        
+        # always look for files: a previous conversion might have been interrupted
+        nb_emails = gstorer.convert_files()
+        if nb_emails:
+            LOG.critical("Moved %d emails and chats to the segments in %s.\n" % (nb_emails, timer.elapsed_human_time()))
+        
+        nb_dirs, nb_bytes = gstorer.compact(0 if args['compact-all'] else None)
+        
+        LOG.critical("Compacted the segments of %d directories (%d bytes reclaimed) in %s.\n" \
+                     % (nb_dirs, nb_bytes, timer.elapsed_human_time()))
             
 
+    @classmethod
+    def _bench_compression(cls, args):
+        """
+           Compress a random sample of the emails of the DB with each codec and report the ratios and speeds
+        """
+        gstorer = gmvault.get_storer(args['db-dir'])
+        
+        gmail_ids = gstorer.get_all_existing_gmail_ids().keys()
+        
+        samples = []
+        for gm_id in random.sample(gmail_ids, min(args['sample'], len(gmail_ids))):
+            try:
+                samples.append(gstorer.unbury_email(gm_id)[1])
+            except Exception, err: #pylint:disable=W0703
+                LOG.debug("Cannot read email %s: %s" % (gm_id, err))
+        
+        if not samples:
+            LOG.critical("No email to compress in %s.\n" % (args['db-dir']))
+            return
+        
+        LOG.critical("Compress %d emails (%.1f MB) from %s.\n" \
+                     % (len(samples), sum([ len(sample) for sample in samples ]) / (1024.0 * 1024.0), args['db-dir']))
+        
+        LOG.critical("%-10s %8s %14s %16s" % ("codec", "ratio", "compress MB/s", "decompress MB/s"))
+        for codec, ratio, comp_speed, decomp_speed in codec_utils.benchmark(samples, args['codecs']):
+            LOG.critical("%-10s %7.1f%% %14.1f %16.1f" % (codec, ratio * 100, comp_speed, decomp_speed))
+        LOG.critical("\nSet compression and compression_level in the conf file to change the codec of the new emails.\n")
+    
     def run(self, args): #pylint:disable=R0912
         """
            Run the grep with the given args 
@@ -634,6 +852,22 @@ class GMVaultLauncher(object):
         
         try:
             
+            if args.get('command', '') in ['index', 'blobs', 'pack', 'compression']:
+                
+                # offline operations: no credential needed
+                if args['command'] == 'index':
+                    self._rebuild_index(args)
+                elif args['command'] == 'blobs':
+                    self._gc_blobs(args)
+                elif args['command'] == 'pack':
+                    self._pack(args)
+                else:
+                    self._bench_compression(args)
+                
+                on_error = False
+                
+                return
+            
             credential = CredentialHelper.get_credential(args)
             
             if args.get('command', '') == 'sync':
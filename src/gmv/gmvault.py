@@ -16,22 +16,33 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 import json
-import gzip
 import re
 import datetime
-import os
 import time
-import itertools
+import os
 import imaplib
 import fnmatch
 import shutil
+import threading
+import Queue
+import copy
+import collections
+import functools
+import multiprocessing.pool
 
 import blowfish
+import blob_utils
+import writer_utils
+import transform_utils
+import codec_utils
 import log_utils
+import index_utils
+import journal_utils
 
 import collections_utils
 import gmvault_utils
 import imap_utils
+import rate_utils
 import credential_utils
 
 
@@ -64,6 +75,8 @@ class GmailStorer(object): #pylint:disable=R0902
     
     DB_AREA                    = 'db'
     QUARANTINE_AREA            = 'quarantine'
+    BLOBS_AREA                 = 'blobs' # content-addressed attachments (see blob_utils)
+    BLOB_GC_DELAY              = 3600 # min age in sec of the unreferenced blobs deleted by gc_blobs
     CHATS_AREA                 = 'chats'
     SUB_CHAT_AREA              = 'chats/%s'
     INFO_AREA                  = '.info'  # contains metadata concerning the database
@@ -71,6 +84,11 @@ class GmailStorer(object): #pylint:disable=R0902
     OLD_EMAIL_OWNER            = '.email_account.info' #deprecated
     EMAIL_OWNER                = '.owner_account.info'
     GMVAULTDB_VERSION          = '.gmvault_db_version.info'   
+    SYNC_STATE                 = '.sync_state.info' # folders state (HIGHESTMODSEQ) at the last complete sync
+    STORAGE_BACKEND            = '.storage_backend.info' # files (default) or segments (see segment_storer)
+    
+    FILES_BACKEND    = 'files'
+    SEGMENTS_BACKEND = 'segments'
     
     def __init__(self, a_storage_dir, encrypt_data = False):
         """
@@ -103,9 +121,36 @@ class GmailStorer(object): #pylint:disable=R0902
         
         self.fsystem_info_cache = {}
         
+        # persistent gm_id => dir index to avoid walking the db to find an email
+        self._index = index_utils.GmailIndex(self._info_dir, \
+                                             gmvault_utils.get_conf_defaults().getint("General", "index_commit_every", 500))
+        
+        # per directory manifests to load the db inventory without listing every .meta file
+        self._manifests = index_utils.DirManifests(self._info_dir, self._db_dir)
+        
+        # codec of the compressed emails (compression and compression_level of the conf)
+        self._codec = codec_utils.get_codec()
+        
         self._encrypt_data   = encrypt_data
         self._encryption_key = None
         self._cipher         = None
+        # the cipher keeps the CTR state so it cannot be shared by threads without lock
+        self._cipher_lock    = threading.RLock()
+        
+        # big base64 parts stored once in the blob area. Always created to restore the emails of a deduplicated db
+        self._dedup_attachments = gmvault_utils.get_conf_defaults().getboolean("General", "dedup_attachments", False)
+        self._blob_store        = blob_utils.BlobStore('%s/%s' % (a_storage_dir, GmailStorer.BLOBS_AREA), \
+                                                       gmvault_utils.get_conf_defaults().getint("General", "dedup_min_bytes", 65536))
+        
+        # write-behind threads of bury_email and bury_metadata (see start_writers)
+        self._writer = None
+        
+        # files written since the last sync_data
+        self._unsynced      = set()
+        self._unsynced_lock = threading.Lock()
+        
+        # processes compressing and encrypting the emails (see start_transformers)
+        self._transformer = None
         
         #add version if it is needed to migrate gmvault-db in the future
         self._create_gmvault_db_version()
@@ -206,12 +251,183 @@ class GmailStorer(object): #pylint:disable=R0902
             return list_of_owners
         
         return []
+    
+    @classmethod
+    def get_storage_backend(cls, a_storage_dir):
+        """
+           Return the storage backend of the gmvault-db in a_storage_dir (files or segments).
+           A new db uses the storage_backend defined in the conf.
+        """
+        fname = '%s/%s/%s' % (a_storage_dir, cls.INFO_AREA, cls.STORAGE_BACKEND)
+        if os.path.exists(fname):
+            the_fd = open(fname)
+            backend = the_fd.read().strip()
+            the_fd.close()
+            return backend
+        
+        if os.path.exists('%s/%s' % (a_storage_dir, cls.DB_AREA)):
+            return cls.FILES_BACKEND # existing db created before the segments storage
+        
+        return gmvault_utils.get_conf_defaults().get("General", "storage_backend", cls.FILES_BACKEND)
+    
+    def store_storage_backend(self, a_backend):
+        """
+           Record the storage backend of the gmvault-db in the .info dir
+        """
+        fname = '%s/%s' % (self._info_dir, self.STORAGE_BACKEND)
+        
+        the_fd = open(fname, "w+")
+        the_fd.write(a_backend)
+        the_fd.flush()
+        the_fd.close()
+    
+    def get_sync_state(self, email_owner, folder):
+        """
+           Return the state (uidvalidity, highestmodseq) of a folder stored after the last complete sync
+           of email_owner or None
+        """
+        fname = '%s/%s' % (self._info_dir, self.SYNC_STATE)
+        if os.path.exists(fname):
+            the_fd = open(fname)
+            states = json.load(the_fd)
+            the_fd.close()
+            return states.get(email_owner, {}).get(folder, None)
+        
+        return None
+    
+    def store_sync_state(self, email_owner, folder_state):
+        """
+           Store the state of a folder (see GIMAPFetcher.get_folder_state) once it has been completely synced
+        """
+        fname = '%s/%s' % (self._info_dir, self.SYNC_STATE)
+        
+        states = {}
+        if os.path.exists(fname):
+            the_fd = open(fname)
+            states = json.load(the_fd)
+            the_fd.close()
+        
+        states.setdefault(email_owner, {})[folder_state['folder']] = folder_state
+        
+        the_fd = open(fname, "w+")
+        json.dump(states, the_fd, ensure_ascii = False)
+        the_fd.flush()
+        the_fd.close()
    
     def get_info_dir(self):
         """
            Return the info dir of gmvault-db
         """ 
         return self._info_dir
+    
+    def get_index(self):
+        """
+           Return the gm_id => dir index of gmvault-db
+        """
+        return self._index
+    
+    def rebuild_index(self):
+        """
+           Rebuild the gm_id => dir index by scanning the whole db
+           Return the number of indexed emails
+        """
+        return self._index.rebuild(self._db_dir)
+    
+    def start_writers(self, a_nb_threads = 1, a_queue_size = 50):
+        """
+           Run bury_email and bury_metadata in a_nb_threads background threads so compression, encryption
+           and file creation do not hold the IMAP connections. At most a_queue_size emails wait to be written.
+           The emails are only on disk after flush or close.
+        """
+        if self._writer or a_nb_threads <= 0:
+            return
+        
+        self._writer = writer_utils.BackgroundWriter(a_nb_threads, a_queue_size)
+    
+    def start_transformers(self, a_nb_processes = None, a_max_inflight_bytes = 67108864):
+        """
+           Move the attachments to the blob area, encrypt and compress the data of the buried emails in a pool of
+           a_nb_processes processes (one per core if None). The writer threads only write the result.
+           At most a_max_inflight_bytes of email data are in the pool.
+        """
+        if self._transformer:
+            return
+        
+        if self._encrypt_data:
+            self.get_encryption_cipher() # load the key before the processes need it
+        
+        self._transformer = transform_utils.TransformPool(a_nb_processes, a_max_inflight_bytes)
+        
+        LOG.critical("Compress and encrypt the emails with %d processes." % (self._transformer.nb_processes))
+    
+    def _wait_writes(self):
+        """
+           Wait until the queued emails are written
+        """
+        if self._writer:
+            self._writer.flush()
+    
+    def _bury_later(self, a_func, a_id, a_args, a_kwargs, a_on_stored):
+        """
+           Call a_func (_bury_email or _bury_metadata) in the writer threads if they are started, otherwise now.
+           a_on_stored(gm_id) is called once the email is written
+        """
+        if not self._writer:
+            gm_id = a_func(*a_args, **a_kwargs)
+            if a_on_stored:
+                a_on_stored(gm_id)
+            return gm_id
+        
+        self._writer.submit(a_func, a_args, a_kwargs, a_on_stored)
+        return a_id
+    
+    def flush(self):
+        """
+           Write on disk the queued emails and the pending updates of the index and of the directory manifests
+        """
+        self._wait_writes()
+        self.sync_data()
+        self._index.flush()
+        self._manifests.flush()
+    
+    def _written(self, *paths):
+        """
+           Remember the files written until the next sync_data
+        """
+        with self._unsynced_lock:
+            self._unsynced.update(paths)
+    
+    def sync_data(self):
+        """
+           Fsync the blobs and the data and metadata files (with their directories) written since the last call.
+           Called before the journals vouching for the written emails are fsynced
+        """
+        self._blob_store.sync()
+        
+        with self._unsynced_lock:
+            paths, self._unsynced = self._unsynced, set()
+        
+        gmvault_utils.fsync_paths(paths)
+    
+    def close(self):
+        """
+           Flush and stop the writer threads and the transform processes. The next emails are written directly
+        """
+        try:
+            self.flush()
+        finally:
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+            if self._transformer:
+                self._transformer.close()
+                self._transformer = None
+    
+    def _get_index_dir(self, a_dir):
+        """
+           Return the dir as stored in the index (relative to the db dir)
+        """
+        return os.path.relpath(a_dir, self._db_dir).replace(os.sep, '/')
         
     def get_encryption_cipher(self):
         """
@@ -227,6 +443,36 @@ class GmailStorer(object): #pylint:disable=R0902
         
         return self._cipher
         
+    def _encrypt_blob(self, a_content):
+        """
+           Encrypt the content of a blob
+        """
+        # need to be done for every encryption
+        with self._cipher_lock:
+            cipher = self.get_encryption_cipher()
+            cipher.initCTR()
+            return cipher.encryptCTR(a_content)
+    
+    def _decrypt_blob(self, a_content):
+        """
+           Decrypt the content of a blob
+        """
+        with self._cipher_lock:
+            cipher = self.get_encryption_cipher()
+            cipher.initCTR()
+            return cipher.decryptCTR(a_content)
+    
+    def _get_blob_key(self):
+        """
+           Return the key of the db when the emails are encrypted (the blobs are then addressed with it) otherwise None
+        """
+        if not self._encrypt_data:
+            return None
+        
+        self.get_encryption_cipher()
+        
+        return self._encryption_key
+    
     @classmethod
     def get_encryption_key_path(cls, a_root_dir):
         """
@@ -263,12 +509,10 @@ class GmailStorer(object): #pylint:disable=R0902
         
         chat_dir = '%s/%s' % (self._db_dir, self.CHATS_AREA)
         if os.path.exists(chat_dir):
-            the_iter = gmvault_utils.ordered_dirwalk(chat_dir, "*.meta")
-        
-            #get all ids
-            for filepath in the_iter:
-                directory, fname = os.path.split(filepath)
-                gmail_ids[long(os.path.splitext(fname)[0])] = os.path.basename(directory)
+            #get all ids from the manifests of the subchats dirs
+            for the_dir in sorted(gmvault_utils.get_all_dirs_under(chat_dir)):
+                for gm_id in self._manifests.get_ids('%s/%s' % (self.CHATS_AREA, the_dir)):
+                    gmail_ids[gm_id] = the_dir
 
             #sort by key 
             #used own orderedDict to be compliant with version 2.5
@@ -286,24 +530,23 @@ class GmailStorer(object): #pylint:disable=R0902
         # beware orderedDict preserve order by insertion and not by key order
         gmail_ids = {}
         
+        # get all yy-mm dirs to list
+        dirs = gmvault_utils.get_all_dirs_under(self._db_dir, ignore_sub_dir)
+        
         if pivot_dir == None:
-            #the_iter = gmvault_utils.dirwalk(self._db_dir, "*.meta")
-            the_iter = gmvault_utils.ordered_dirwalk(self._db_dir, "*.meta", ignore_sub_dir)
-        else:
-            
-            # get all yy-mm dirs to list
-            dirs = gmvault_utils.get_all_directories_posterior_to(pivot_dir, gmvault_utils.get_all_dirs_under(self._db_dir, ignore_sub_dir))
+            dirs = sorted(dirs)
             
-            #create all iterators and chain them to keep the same interface
-            #iter_dirs = [gmvault_utils.dirwalk('%s/%s' % (self._db_dir, the_dir), "*.meta") for the_dir in dirs]
-            iter_dirs = [gmvault_utils.ordered_dirwalk('%s/%s' % (self._db_dir, the_dir), "*.meta", ignore_sub_dir) for the_dir in dirs]
-            
-            the_iter = itertools.chain.from_iterable(iter_dirs)
+            # emails stored at the root of the db (no local dir)
+            for fname in sorted(os.listdir(self._db_dir)):
+                if fname.endswith('.meta'):
+                    gmail_ids[long(os.path.splitext(fname)[0])] = os.path.basename(self._db_dir)
+        else:
+            dirs = gmvault_utils.get_all_directories_posterior_to(pivot_dir, dirs)
         
-        #get all ids
-        for filepath in the_iter:
-            directory, fname = os.path.split(filepath)
-            gmail_ids[long(os.path.splitext(fname)[0])] = os.path.basename(directory)
+        #get all ids from the manifests (a dir is only listed if its manifest is not up to date)
+        for the_dir in dirs:
+            for gm_id in self._manifests.get_ids(the_dir):
+                gmail_ids[gm_id] = the_dir
 
         #sort by key 
         #used own orderedDict to be compliant with version 2.5
@@ -311,14 +554,49 @@ class GmailStorer(object): #pylint:disable=R0902
         
         return gmail_ids
     
-    def bury_chat_metadata(self, email_info, local_dir = None):
+    def _get_metadata_obj(self, email_info, extra_labels):
+        """
+           Return the json structure of the metadata of an email
+        """
+        # parse header fields to extract subject and msgid
+        subject, msgid = self.parse_header_fields(email_info[imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY])
+        
+        # need to convert labels that are number as string
+        # come from imap_lib when label is a number
+        labels = [ str(elem) for elem in  email_info[imap_utils.GIMAPFetcher.GMAIL_LABELS] ]
+        
+        labels.extend(extra_labels) #add extra labels
+        
+        #create json structure for metadata
+        return { 
+                 self.ID_K         : email_info[imap_utils.GIMAPFetcher.GMAIL_ID],
+                 self.LABELS_K     : labels,
+                 self.FLAGS_K      : email_info[imap_utils.GIMAPFetcher.IMAP_FLAGS],
+                 self.THREAD_IDS_K : email_info[imap_utils.GIMAPFetcher.GMAIL_THREAD_ID],
+                 self.INT_DATE_K   : gmvault_utils.datetime2e(email_info[imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]),
+                 self.SUBJECT_K    : subject,
+                 self.MSGID_K      : msgid
+               }
+    
+    def bury_chat_metadata(self, email_info, local_dir = None, on_stored = None):
         """
            Like bury metadata but with an extra label gmvault-chat
         """
         extra_labels = [GmailStorer.CHAT_GM_LABEL]
-        return self.bury_metadata(email_info, local_dir, extra_labels)
+        return self.bury_metadata(email_info, local_dir, extra_labels, on_stored)
+    
+    def bury_metadata(self, email_info, local_dir = None, extra_labels = [], on_stored = None): #pylint:disable=W0102
+        """
+            Store metadata info (in the writer threads if they are started)
+            Arguments:
+             email_info: metadata info
+             local_dir : intermdiary dir (month dir)
+             on_stored : function called with the gmail id once the metadata is written
+        """
+        return self._bury_later(self._bury_metadata, email_info[imap_utils.GIMAPFetcher.GMAIL_ID], \
+                                (email_info, local_dir, extra_labels), {}, on_stored)
     
-    def bury_metadata(self, email_info, local_dir = None, extra_labels = []): #pylint:disable=W0102
+    def _bury_metadata(self, email_info, local_dir = None, extra_labels = []): #pylint:disable=W0102
         """
             Store metadata info in .meta file
             Arguments:
@@ -335,110 +613,169 @@ class GmailStorer(object): #pylint:disable=R0902
        
         meta_desc = open(meta_path, 'w')
         
-        # parse header fields to extract subject and msgid
-        subject, msgid = self.parse_header_fields(email_info[imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY])
-        
-        # need to convert labels that are number as string
-        # come from imap_lib when label is a number
-        labels = [ str(elem) for elem in  email_info[imap_utils.GIMAPFetcher.GMAIL_LABELS] ]
-        
-        labels.extend(extra_labels) #add extra labels
-        
-        #create json structure for metadata
-        meta_obj = { 
-                     self.ID_K         : email_info[imap_utils.GIMAPFetcher.GMAIL_ID],
-                     self.LABELS_K     : labels,
-                     self.FLAGS_K      : email_info[imap_utils.GIMAPFetcher.IMAP_FLAGS],
-                     self.THREAD_IDS_K : email_info[imap_utils.GIMAPFetcher.GMAIL_THREAD_ID],
-                     self.INT_DATE_K   : gmvault_utils.datetime2e(email_info[imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]),
-                     self.FLAGS_K      : email_info[imap_utils.GIMAPFetcher.IMAP_FLAGS],
-                     self.SUBJECT_K    : subject,
-                     self.MSGID_K      : msgid
-                   }
+        meta_obj = self._get_metadata_obj(email_info, extra_labels)
         
         json.dump(meta_obj, meta_desc, ensure_ascii = False)
         
         meta_desc.flush()
         meta_desc.close()
+        
+        self._written(meta_path)
+        
+        self._index.set_dir(email_info[imap_utils.GIMAPFetcher.GMAIL_ID], self._get_index_dir(the_dir))
+        self._manifests.mark_dirty(self._get_index_dir(the_dir))
          
         return email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
     
-    def bury_chat(self, chat_info, local_dir = None, compress = False):   
+    def bury_chat(self, chat_info, local_dir = None, compress = False, on_stored = None):   
         """
             Like bury email but with a special label: gmvault-chats
             Arguments:
             chat_info: the chat content
             local_dir: intermediary dir
-            compress : if compress is True, use gzip compression
+            compress : if compress is True, use the compression codec of the conf
+            on_stored: function called with the gmail id once the chat is written
         """
         extra_labels = ['gmvault-chats']
         
-        return self.bury_email(chat_info, local_dir, compress, extra_labels)
+        return self.bury_email(chat_info, local_dir, compress, extra_labels, on_stored = on_stored)
         
-    def bury_email(self, email_info, local_dir = None, compress = False, extra_labels = []): #pylint:disable=W0102
+    def _get_codec(self, compress):
         """
-           store all email info in 2 files (.meta and .eml files)
-           Arguments:
-             email_info: the email content
-             local_dir : intermdiary dir (month dir)
-             compress  : if compress is True, use gzip compression
+           Return the codec used to store an email
+        """
+        return self._codec if compress else codec_utils.Codec()
+    
+    def _get_data_path(self, the_dir, a_id, compress):
         """
+           Return the path of the data file of an email (.eml[.crypt][.gz|.bz2|.xz])
+        """
+        data_path = self.DATA_FNAME % (the_dir, a_id)
+        
+        # if the data has to be encrypted
+        if self._encrypt_data:
+            data_path = '%s.crypt' % (data_path)
         
+        return '%s%s' % (data_path, self._get_codec(compress).SUFFIX)
+    
+    def get_email_writer(self, a_id, local_dir = None, compress = False):
+        """
+           Return an EmailDataWriter to write the data of an email chunk by chunk.
+           Once written, the email is stored by passing the writer to bury_email.
+           Arguments:
+             a_id     : gmail id of the email
+             local_dir: intermdiary dir (month dir)
+             compress : if compress is True, use the compression codec of the conf
+        """
         if local_dir:
             the_dir = '%s/%s' % (self._db_dir, local_dir)
             gmvault_utils.makedirs(the_dir)
         else:
             the_dir = self._db_dir
         
-        data_path = self.DATA_FNAME % (the_dir, email_info[imap_utils.GIMAPFetcher.GMAIL_ID])
-        
-        # if the data has to be encrypted
+        cipher = None
         if self._encrypt_data:
-            data_path = '%s.crypt' % (data_path)
+            # the writer has its own CTR state to not hold the shared cipher during the whole fetch.
+            # A shallow copy shares the key schedule and the keystream cache
+            with self._cipher_lock:
+                cipher = copy.copy(self.get_encryption_cipher())
+        
+        if self._dedup_attachments:
+            # the attachments are moved to the blob area once the whole email is written (see _bury_email)
+            return EmailDataWriter('%s.part' % (self.DATA_FNAME % (the_dir, a_id)), codec_utils.Codec(), a_pack = True)
+        
+        return EmailDataWriter(self._get_data_path(the_dir, a_id, compress), self._get_codec(compress), cipher)
+    
+    def bury_email(self, email_info, local_dir = None, compress = False, extra_labels = [], data_writer = None, \
+                   on_stored = None): #pylint:disable=W0102,R0913
+        """
+           Store an email (in the writer threads if they are started)
+           Arguments:
+             email_info : the email content
+             local_dir  : intermdiary dir (month dir)
+             compress   : if compress is True, use the compression codec of the conf
+             data_writer: EmailDataWriter in which the data has already been written (email_info has no body then)
+             on_stored  : function called with the gmail id once the email is written
+        """
+        kwargs = {}
+        if self._transformer and not data_writer:
+            # the data is transformed while the email waits for a writer
+            kwargs['transformed'] = self._transformer.submit(email_info[imap_utils.GIMAPFetcher.EMAIL_BODY], \
+                                                             self._get_codec(compress), \
+                                                             self._get_blob_key(), \
+                                                             self._blob_store if self._dedup_attachments else None)
+        
+        return self._bury_later(self._bury_email, email_info[imap_utils.GIMAPFetcher.GMAIL_ID], \
+                                (email_info, local_dir, compress, extra_labels, data_writer), kwargs, on_stored)
+    
+    def _bury_email(self, email_info, local_dir = None, compress = False, extra_labels = [], data_writer = None, \
+                    transformed = None): #pylint:disable=W0102,R0913
+        """
+           store all email info in 2 files (.meta and .eml files)
+           Arguments:
+             email_info : the email content
+             local_dir  : intermdiary dir (month dir)
+             compress   : if compress is True, use the compression codec of the conf
+             data_writer: EmailDataWriter in which the data has already been written (email_info has no body then)
+             transformed: TransformResult of the data (see start_transformers)
+        """
+        # collect the transformed data first to always free its place in the transform pool
+        stored_data = transformed.get() if transformed else None
         
-        if compress:
-            data_path = '%s.gz' % (data_path)
-            data_desc = gzip.open(data_path, 'wb')
+        if local_dir:
+            the_dir = '%s/%s' % (self._db_dir, local_dir)
+            gmvault_utils.makedirs(the_dir)
         else:
-            data_desc = open(data_path, 'wb')
+            the_dir = self._db_dir
+        
+        data_desc = None
+        if data_writer and not data_writer.pack:
+            # the data has already been written chunk by chunk
+            data_path = data_writer.close()
+        elif transformed:
+            # packed, encrypted and compressed by the transform processes in the format of the codec files
+            data_path = self._get_data_path(the_dir, email_info[imap_utils.GIMAPFetcher.GMAIL_ID], compress)
             
-        if self._encrypt_data:
-            # need to be done for every encryption
-            cipher = self.get_encryption_cipher()
-            cipher.initCTR()
-            data_desc.write(cipher.encryptCTR(email_info[imap_utils.GIMAPFetcher.EMAIL_BODY]))
+            data_desc = open(data_path, 'wb')
+            data_desc.write(stored_data)
         else:
-            data_desc.write(email_info[imap_utils.GIMAPFetcher.EMAIL_BODY])
+            data_path = self._get_data_path(the_dir, email_info[imap_utils.GIMAPFetcher.GMAIL_ID], compress)
             
-        # parse header fields to extract subject and msgid
-        subject, msgid = self.parse_header_fields(email_info[imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY])
-        
-        # need to convert labels that are number as string
-        # come from imap_lib when label is a number
-        labels = [ str(elem) for elem in  email_info[imap_utils.GIMAPFetcher.GMAIL_LABELS] ]
-        
-        labels.extend(extra_labels) #add extra labels
+            # the big attachments are moved to the blob area
+            data = self._blob_store.pack(data_writer.read_and_delete() if data_writer \
+                                         else email_info[imap_utils.GIMAPFetcher.EMAIL_BODY], self._dedup_attachments, \
+                                         self._encrypt_blob if self._encrypt_data else None, self._get_blob_key())
+            
+            data_desc = self._get_codec(compress).open(data_path, 'wb')
+                
+            if self._encrypt_data:
+                # need to be done for every encryption
+                with self._cipher_lock:
+                    cipher = self.get_encryption_cipher()
+                    cipher.initCTR()
+                    encrypted = cipher.encryptCTR(data)
+                data_desc.write(encrypted)
+            else:
+                data_desc.write(data)
+            
+        meta_obj = self._get_metadata_obj(email_info, extra_labels)
         
-        #create json structure for metadata
-        meta_obj = { 
-                     self.ID_K         : email_info[imap_utils.GIMAPFetcher.GMAIL_ID],
-                     self.LABELS_K     : labels,
-                     self.FLAGS_K      : email_info[imap_utils.GIMAPFetcher.IMAP_FLAGS],
-                     self.THREAD_IDS_K : email_info[imap_utils.GIMAPFetcher.GMAIL_THREAD_ID],
-                     self.INT_DATE_K   : gmvault_utils.datetime2e(email_info[imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]),
-                     self.SUBJECT_K    : subject,
-                     self.MSGID_K      : msgid
-                   }
-        
-        meta_desc = open(self.METADATA_FNAME % (the_dir, email_info[imap_utils.GIMAPFetcher.GMAIL_ID]), 'w')
+        meta_path = self.METADATA_FNAME % (the_dir, email_info[imap_utils.GIMAPFetcher.GMAIL_ID])
+        meta_desc = open(meta_path, 'w')
         
         json.dump(meta_obj, meta_desc, ensure_ascii = False)
         
         meta_desc.flush()
         meta_desc.close()
         
-        data_desc.flush()
-        data_desc.close()
+        if data_desc:
+            data_desc.close() # close flushes (the bz2 and xz files have no flush)
+        
+        self._written(data_path, meta_path)
+        
+        self._index.add(email_info[imap_utils.GIMAPFetcher.GMAIL_ID], self._get_index_dir(the_dir), \
+                        index_utils.GmailIndex.get_flags_from_filename(data_path), os.path.getsize(data_path))
+        self._manifests.mark_dirty(self._get_index_dir(the_dir))
         
         return email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
     
@@ -458,36 +795,63 @@ class GmailStorer(object): #pylint:disable=R0902
             else:
                 return None
         
-        # first look in cache
+        # first look in the index (check the file as the index might be stale)
+        entry = self._index.get(a_id)
+        if entry:
+            the_dir = '%s/%s' % (self._db_dir, entry[0])
+            if os.path.exists(self.METADATA_FNAME % (the_dir, a_id)):
+                return the_dir
+        
+        # then look in cache
         for the_dir in self.fsystem_info_cache:
             if filename in self.fsystem_info_cache[the_dir]:
+                self._index.set_dir(a_id, self._get_index_dir(the_dir))
                 return the_dir
         
         #walk the filesystem
         for the_dir, _, files in os.walk(os.path.abspath(self._db_dir)):
             self.fsystem_info_cache[the_dir] = files
             for filename in fnmatch.filter(files, filename):
+                self._index.set_dir(a_id, self._get_index_dir(the_dir))
                 return the_dir
         
+        # not in the db anymore
+        if entry:
+            self._index.remove(a_id)
+        
+        return None
+    
+    def _find_data_file(self, a_dir, a_id):
+        """
+           Return the path of the data file of an email whatever its encryption and codec or None
+        """
+        data_p = self.DATA_FNAME % (a_dir, a_id)
+        
+        # the index gives the suffix of the file
+        entry = self._index.get(a_id)
+        if entry and entry[1] is not None and entry[0] == self._get_index_dir(a_dir):
+            crypt = '.crypt' if entry[1] & index_utils.GmailIndex.ENCRYPTED else ''
+            path  = '%s%s%s' % (data_p, crypt, codec_utils.get_codec_from_flags(entry[1]).SUFFIX)
+            if os.path.exists(path):
+                return path
+        
+        for suffix in codec_utils.get_data_suffixes():
+            if os.path.exists('%s%s' % (data_p, suffix)):
+                return '%s%s' % (data_p, suffix)
+        
         return None
     
     def _get_data_file_from_id(self, a_dir, a_id):
         """
            Return data file from the id
         """
-        data_p = self.DATA_FNAME % (a_dir, a_id)
+        data_p = self._find_data_file(a_dir, a_id)
         
-        # check if encrypted and compressed or not
-        if os.path.exists('%s.crypt.gz' % (data_p)):
-            data_fd = gzip.open('%s.crypt.gz' % (data_p), 'r')
-        elif os.path.exists('%s.gz' % (data_p)):
-            data_fd = gzip.open('%s.gz' % (data_p), 'r')
-        elif os.path.exists('%s.crypt' % (data_p)):
-            data_fd = open('%s.crypt' % (data_p), 'r')
-        else:
-            data_fd = open(data_p)
+        if not data_p:
+            return open(self.DATA_FNAME % (a_dir, a_id)) # raise the IOError
         
-        return data_fd
+        # the suffix gives the codec
+        return codec_utils.get_codec_from_filename(data_p)().open(data_p, 'rb')
     
     def _get_metadata_file_from_id(self, a_dir, a_id):
         """
@@ -504,15 +868,8 @@ class GmailStorer(object): #pylint:disable=R0902
         #get the dir where the email is stored
         the_dir = self.get_directory_from_id(a_id)
         
-        data = self.DATA_FNAME % (the_dir, a_id)
-        
         # check if encrypted and compressed or not
-        if os.path.exists('%s.crypt.gz' % (data)):
-            data = '%s.crypt.gz' % (data)
-        elif os.path.exists('%s.gz' % (data)):
-            data = '%s.gz' % (data)
-        elif os.path.exists('%s.crypt' % (data)):
-            data = '%s.crypt' % (data)
+        data = self._find_data_file(the_dir, a_id) or self.DATA_FNAME % (the_dir, a_id)
         
         meta = self.METADATA_FNAME % (the_dir, a_id)
 
@@ -529,6 +886,9 @@ class GmailStorer(object): #pylint:disable=R0902
         shutil.move(data, self._quarantine_dir)
         shutil.move(meta, self._quarantine_dir)
         
+        self._index.remove(a_id)
+        self._manifests.mark_dirty(self._get_index_dir(the_dir))
+        
     def email_encrypted(self, a_email_fn):
         """
            True is filename contains .crypt otherwise False
@@ -539,25 +899,62 @@ class GmailStorer(object): #pylint:disable=R0902
         else:
             return False
         
+    def _read_data_file(self, a_data_fd):
+        """
+           Read, decompress and decrypt an open data file and close it
+        """
+        try:
+            # read (and decompress) out of the cipher lock so several threads can unbury emails at once
+            data = a_data_fd.read()
+        finally:
+            a_data_fd.close()
+        
+        if self.email_encrypted(a_data_fd.name):
+            LOG.debug("Restore encrypted email %s" % (a_data_fd.name))
+            # need to be done for every encryption
+            with self._cipher_lock:
+                cipher = self.get_encryption_cipher()
+                cipher.initCTR()
+                data = cipher.decryptCTR(data)
+        
+        return data
+    
+    def _unbury_data(self, a_id, a_dir = None):
+        """
+           Return the stored data of an email: decompressed and decrypted but still referencing its blobs
+        """
+        return self._read_data_file(self._get_data_file_from_id(a_dir or self.get_directory_from_id(a_id), a_id))
+    
     def unbury_email(self, a_id):
         """
            Restore email info from info stored on disk
            Return a tuple (meta, data)
         """
         the_dir = self.get_directory_from_id(a_id)
+        data    = self._unbury_data(a_id, the_dir)
         
-        data_fd = self._get_data_file_from_id(the_dir, a_id)
+        # the key addressing the blobs of an encrypted email has been read to decrypt its data
+        return (self.unbury_metadata(a_id, the_dir), self._blob_store.unpack(data, self._decrypt_blob, self._encryption_key))
+    
+    def gc_blobs(self):
+        """
+           Delete the blobs which are not referenced anymore by the emails, the chats and the quarantined emails of the db.
+           The blobs stored or used less than BLOB_GC_DELAY seconds ago are kept: their emails may not be written yet.
+           Return (number of deleted blobs, number of bytes reclaimed)
+        """
+        before = time.time() - self.BLOB_GC_DELAY
+        used   = set()
         
-        if self.email_encrypted(data_fd.name):
-            LOG.debug("Restore encrypted email %s" % (a_id))
-            # need to be done for every encryption
-            cipher = self.get_encryption_cipher()
-            cipher.initCTR()
-            data = cipher.decryptCTR(data_fd.read())
-        else:
-            data = data_fd.read()
+        for gm_id in self.get_all_existing_gmail_ids().keys() + self.get_all_chats_gmail_ids().keys():
+            used.update(self._blob_store.get_refs(self._unbury_data(gm_id)))
         
-        return (self.unbury_metadata(a_id, the_dir), data)
+        # a quarantined email can still be restored by hand
+        for fname in os.listdir(self._quarantine_dir):
+            if '.eml' in fname:
+                path = os.path.join(self._quarantine_dir, fname)
+                used.update(self._blob_store.get_refs(self._read_data_file(codec_utils.get_codec_from_filename(path)().open(path, 'rb'))))
+        
+        return self._blob_store.remove_unused(used, before)
     
     def unbury_metadata(self, a_id, a_id_dir = None):
         """
@@ -568,16 +965,54 @@ class GmailStorer(object): #pylint:disable=R0902
         
         meta_fd = self._get_metadata_file_from_id(a_id_dir, a_id)
     
-        metadata = json.load(meta_fd)
-        
-        metadata[self.INT_DATE_K] =  gmvault_utils.e2datetime(metadata[self.INT_DATE_K])
+        return self._decode_metadata(json.load(meta_fd))
+    
+    @classmethod
+    def _decode_metadata(cls, metadata):
+        """
+           Convert the stored json metadata of an email
+        """
+        metadata[cls.INT_DATE_K] =  gmvault_utils.e2datetime(metadata[cls.INT_DATE_K])
         
         # force convertion of labels as string because IMAPClient
         # returns a num when the label is a number (ie. '00000')
-        metadata[self.LABELS_K] = [ str(elem) for elem in  metadata[self.LABELS_K] ]
+        metadata[cls.LABELS_K] = [ str(elem) for elem in  metadata[cls.LABELS_K] ]
         
         return metadata
     
+    def get_dir_gmail_ids(self, a_dir):
+        """
+           Return the sorted gmail ids stored in a_dir (relative to the db dir, ex: 2012-03)
+        """
+        if not os.path.isdir('%s/%s' % (self._db_dir, a_dir)):
+            return []
+        
+        return self._manifests.get_ids(a_dir)
+    
+    def read_metadata_records(self, a_dir, a_ids):
+        """
+           Read the .meta files of a_ids in a_dir (relative to the db dir) and return 
+           { gm_id : (flags, labels, thread_id) }. Files that cannot be read are skipped.
+        """
+        the_dir = '%s/%s' % (self._db_dir, a_dir)
+        
+        records = {}
+        for a_id in a_ids:
+            try:
+                meta_fd = open(self.METADATA_FNAME % (the_dir, a_id))
+                try:
+                    metadata = json.load(meta_fd)
+                finally:
+                    meta_fd.close()
+                
+                # same label conversion as in unbury_metadata
+                records[a_id] = (tuple(metadata[self.FLAGS_K]), tuple([ str(elem) for elem in metadata[self.LABELS_K] ]), \
+                                 metadata.get(self.THREAD_IDS_K))
+            except (IOError, ValueError, KeyError), error:
+                LOG.debug("Cannot read metadata of %s in %s: %s" % (a_id, a_dir, error))
+        
+        return records
+    
     def delete_emails(self, emails_info, msg_type):
         """
            Delete all emails and metadata with ids
@@ -591,37 +1026,263 @@ class GmailStorer(object): #pylint:disable=R0902
             
             the_dir = '%s/%s' % (db_dir, date_dir)
             
-            data_p      = self.DATA_FNAME % (the_dir, a_id)
-            comp_data_p = '%s.gz' % (data_p)
-            cryp_comp_data_p = '%s.crypt.gz' % (data_p)
+            data_p      = self._find_data_file(the_dir, a_id)
             
             metadata_p  = self.METADATA_FNAME % (the_dir, a_id)
             
             #delete files if they exists
-            if os.path.exists(data_p):
+            if data_p:
                 os.remove(data_p)
-            elif os.path.exists(comp_data_p):
-                os.remove(comp_data_p)
-            elif os.path.exists(cryp_comp_data_p):
-                os.remove(cryp_comp_data_p)   
             
             if os.path.exists(metadata_p):
                 os.remove(metadata_p)
+            
+            self._index.remove(a_id)
+            self._manifests.mark_dirty(self._get_index_dir(the_dir))
    
-class GMVaulter(object):
+def get_storer(a_storage_dir, encrypt_data = False):
     """
-       Main object operating over gmail
-    """ 
-    NB_GRP_OF_ITEMS         = 1400
-    EMAIL_RESTORE_PROGRESS  = 'email_last_id.restore'
-    CHAT_RESTORE_PROGRESS   = 'chat_last_id.restore'
-    EMAIL_SYNC_PROGRESS     = 'email_last_id.sync'
-    CHAT_SYNC_PROGRESS      = 'chat_last_id.sync'
-    
-    OP_EMAIL_RESTORE = "EM_RESTORE"
-    OP_EMAIL_SYNC    = "EM_SYNC"
-    OP_CHAT_RESTORE  = "CH_RESTORE"
-    OP_CHAT_SYNC    = "CH_SYNC"
+       Return the storer of the gmvault-db in a_storage_dir: a GmailStorer (one .meta and one .eml file per email)
+       or a SegmentStorer if the db uses the segments storage
+    """
+    if GmailStorer.get_storage_backend(a_storage_dir) == GmailStorer.SEGMENTS_BACKEND:
+        import segment_storer # segment_storer depends on this module
+        return segment_storer.SegmentStorer(a_storage_dir, encrypt_data)
+    
+    return GmailStorer(a_storage_dir, encrypt_data)
+   
+class MetadataSnapshot(object):
+    """
+       In memory table of the metadata (flags, labels, thread id) stored in the month dirs touched by a sync.
+       The dirs are loaded on demand by a pool of threads reading the .meta files so the sync can check
+       if an email has changed without opening and parsing its .meta file.
+    """
+    NB_IDS_PER_TASK = 250 # .meta files read by a thread in one go
+    
+    def __init__(self, a_gstorer, a_nb_threads = 4):
+        """
+           a_gstorer   : the GmailStorer of the db
+           a_nb_threads: number of threads reading the .meta files
+        """
+        self._gstorer    = a_gstorer
+        self._nb_threads = max(1, a_nb_threads)
+        self._records    = {} # gm_id => (flags, labels, thread_id, dir)
+        self._dirs       = set()
+        
+        # the syncing workers share the snapshot
+        self._lock = threading.Lock()
+        
+    def _read_task(self, task):
+        """
+           Read the metadata of a list of ids in a dir (run by the pool)
+        """
+        a_dir, a_ids = task
+        return a_dir, self._gstorer.read_metadata_records(a_dir, a_ids)
+        
+    def load(self, a_dirs):
+        """
+           Load the metadata of the dirs that have not been loaded yet
+        """
+        with self._lock:
+            new_dirs = [ the_dir for the_dir in set(a_dirs) if the_dir not in self._dirs ]
+            if not new_dirs:
+                return
+            
+            tasks = []
+            for the_dir in new_dirs:
+                tasks.extend([ (the_dir, ids) for ids in gmvault_utils.chunker(self._gstorer.get_dir_gmail_ids(the_dir), \
+                                                                             self.NB_IDS_PER_TASK) ])
+            
+            if len(tasks) > 1 and self._nb_threads > 1:
+                pool = multiprocessing.pool.ThreadPool(min(self._nb_threads, len(tasks)))
+                try:
+                    results = pool.map(self._read_task, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [ self._read_task(task) for task in tasks ]
+            
+            for the_dir, records in results:
+                for gm_id, (flags, labels, thread_id) in records.iteritems():
+                    self._records[gm_id] = (flags, labels, thread_id, the_dir)
+            
+            self._dirs.update(new_dirs)
+            
+            LOG.debug("Metadata snapshot: loaded dirs %s (%d records)." % (new_dirs, len(self._records)))
+    
+    def get(self, a_id, a_dir):
+        """
+           Return (flags, labels, thread_id) of a gmail id stored in a_dir or None if not in the snapshot
+        """
+        record = self._records.get(a_id)
+        if record and record[3] == a_dir:
+            return record[:3]
+        
+        return None
+
+class EmailPrefetcher(object):
+    """
+       Iterator returning (gm_id, meta, data) for a list of gmail ids, in order.
+       The emails are unburied (read, decompressed, decrypted) by a pool of threads ahead of the consumer.
+       At most a_window emails are read ahead so the memory used is bounded.
+    """
+    def __init__(self, a_gstorer, a_ids, a_nb_threads = 4, a_window = 16):
+        """
+           a_gstorer   : the GmailStorer of the db
+           a_ids       : gmail ids to read
+           a_nb_threads: number of threads unburying the emails
+           a_window    : max number of emails read ahead
+        """
+        self._gstorer = a_gstorer
+        self._ids     = iter(a_ids)
+        self._window  = max(1, a_window)
+        self._pool    = multiprocessing.pool.ThreadPool(max(1, a_nb_threads))
+        self._pending = collections.deque() # (gm_id, AsyncResult) in the order of a_ids
+        
+        # id of the last returned email (or of the email that could not be read)
+        self.current_id = None
+        
+    def __iter__(self):
+        return self
+    
+    def _fill(self):
+        """
+           Start reading the next emails up to the window
+        """
+        while len(self._pending) < self._window:
+            try:
+                gm_id = self._ids.next()
+            except StopIteration:
+                return
+            self._pending.append((gm_id, self._pool.apply_async(self._gstorer.unbury_email, (gm_id,))))
+    
+    def next(self):
+        """
+           Return (gm_id, meta, data) of the next email. Raise the error of its unbury if it failed
+        """
+        self._fill()
+        if not self._pending:
+            raise StopIteration
+        
+        self.current_id, result = self._pending.popleft()
+        self._fill() # keep the window full while waiting
+        
+        while not result.ready():
+            result.wait(1) # use a timeout to not block CTRL^C
+        
+        email_meta, email_data = result.get()
+        
+        return self.current_id, email_meta, email_data
+    
+    def close(self):
+        """
+           Wait for the emails being read and stop the threads
+        """
+        self._pending.clear()
+        self._pool.close()
+        self._pool.join()
+
+class EmailDataWriter(object):
+    """
+       Write the data of an email chunk by chunk in its data file (encrypted and/or compressed on the fly).
+       It is the sink in which the IMAP layer streams the body of a big email (see GIMAPFetcher.fetch_to_sink)
+    """
+    def __init__(self, a_path, a_codec, a_cipher = None, a_pack = False):
+        """
+           a_path    : data file path
+           a_codec   : compression codec (codec_utils.Codec to not compress)
+           a_cipher  : Blowfish cipher if the data has to be encrypted
+           a_pack    : if True the data is written as it is in a temporary file to be packed (see BlobStore.pack)
+                       and stored by the storer once complete
+        """
+        self.path      = a_path
+        self.pack      = a_pack
+        self.nb_bytes  = 0 # nb of bytes written (before compression)
+        self._codec    = a_codec
+        self._cipher   = a_cipher
+        self._desc     = None
+        
+    def reset(self):
+        """
+           Start again from an empty data file (called before each fetch try)
+        """
+        if self._desc:
+            self._desc.close()
+        
+        self._desc = self._codec.open(self.path, 'wb')
+        
+        if self._cipher:
+            # need to be done for every encryption
+            self._cipher.initCTR()
+        
+        self.nb_bytes = 0
+        
+    def write(self, data):
+        """
+           Write a chunk of data
+        """
+        if not self._desc:
+            self.reset()
+        
+        self.nb_bytes += len(data)
+        
+        if self._cipher:
+            data = self._cipher.encryptCTR(data)
+        
+        self._desc.write(data)
+        
+    def close(self):
+        """
+           Close the data file and return its path
+        """
+        if not self._desc:
+            self.reset() # empty email
+        
+        self._desc.close()
+        self._desc = None
+        
+        return self.path
+    
+    def read_and_delete(self):
+        """
+           Close the data file and return its content. The file is deleted
+        """
+        path = self.close()
+        try:
+            the_fd = open(path, 'rb')
+            try:
+                return the_fd.read()
+            finally:
+                the_fd.close()
+        finally:
+            os.remove(path)
+    
+    def abort(self):
+        """
+           Close and delete the data file (the email could not be fetched)
+        """
+        if self._desc:
+            self._desc.close()
+            self._desc = None
+        
+        if os.path.exists(self.path):
+            os.remove(self.path)
+   
+class GMVaulter(object):
+    """
+       Main object operating over gmail
+    """ 
+    NB_UIDS_PER_RANGE_FETCH = 50000 # imap ids covered by one UID FETCH when getting all the gmail ids
+    EMAIL_RESTORE_PROGRESS  = 'email_last_id.restore'
+    CHAT_RESTORE_PROGRESS   = 'chat_last_id.restore'
+    EMAIL_SYNC_PROGRESS     = 'email_last_id.sync'
+    CHAT_SYNC_PROGRESS      = 'chat_last_id.sync'
+    
+    OP_EMAIL_RESTORE = "EM_RESTORE"
+    OP_EMAIL_SYNC    = "EM_SYNC"
+    OP_CHAT_RESTORE  = "CH_RESTORE"
+    OP_CHAT_SYNC    = "CH_SYNC"
     
     OP_TO_FILENAME = { OP_EMAIL_RESTORE : EMAIL_RESTORE_PROGRESS,
                        OP_EMAIL_SYNC    : EMAIL_SYNC_PROGRESS,
@@ -629,10 +1290,23 @@ class GMVaulter(object):
                        OP_CHAT_SYNC     : CHAT_SYNC_PROGRESS
                      }
     
+    # journals of the completed ids for resuming
+    OP_TO_JOURNAL = { OP_EMAIL_RESTORE : 'email_restore.journal',
+                      OP_EMAIL_SYNC    : 'email_sync.journal',
+                      OP_CHAT_RESTORE  : 'chat_restore.journal',
+                      OP_CHAT_SYNC     : 'chat_sync.journal'
+                    }
+    
+    # labels existing on Gmail after the label pre-pass of a restore, reused when resuming
+    OP_TO_LABELS_CACHE = { OP_EMAIL_RESTORE : 'email_restore.labels',
+                           OP_CHAT_RESTORE  : 'chat_restore.labels'
+                         }
+    
     
-    def __init__(self, db_root_dir, host, port, login, credential, read_only_access = True, use_encryption = False): #pylint:disable-msg=R0913
+    def __init__(self, db_root_dir, host, port, login, credential, read_only_access = True, use_encryption = False, use_ssl = True): #pylint:disable-msg=R0913
         """
            constructor
+           use_ssl: False to connect to a local IMAP server without SSL (mock Gmail server of the tests and benchmarks)
         """   
         self.db_root_dir = db_root_dir
         
@@ -641,9 +1315,23 @@ class GMVaulter(object):
         
         #keep track of login email
         self.login = login
+        
+        # keep connection info to be able to open more connections (parallel sync and restore)
+        self.host             = host
+        self.port             = port
+        self.credential       = credential
+        self.read_only_access = read_only_access
+        self.use_ssl          = use_ssl
             
+        # adapts the batches and the connections to the limits of Gmail (shared by all the connections)
+        self.rate_controller = rate_utils.RateController(gmvault_utils.get_conf_defaults().getint("General", "rate_increase_every", 20), \
+                                                         gmvault_utils.get_conf_defaults().getfloat("General", "rate_min_batch_ratio", 0.1), \
+                                                         gmvault_utils.get_conf_defaults().getint("General", "rate_min_delay", 2), \
+                                                         gmvault_utils.get_conf_defaults().getint("General", "rate_max_delay", 300))
+        
         # create source and try to connect
-        self.src = imap_utils.GIMAPFetcher(host, port, login, credential, readonly_folder = read_only_access)
+        self.src = imap_utils.GIMAPFetcher(host, port, login, credential, readonly_folder = read_only_access, \
+                                           rate_controller = self.rate_controller, use_ssl = use_ssl)
         
         self.src.connect()
         
@@ -653,14 +1341,25 @@ class GMVaulter(object):
         self.error_report = { 'empty' : [] ,
                               'cannot_be_fetched'  : [],
                               'emails_in_quarantine' : [],
+                              'pushed_without_labels' : [],
                               'reconnections' : 0}
         
         #instantiate gstorer
-        self.gstorer =  GmailStorer(self.db_root_dir, self.use_encryption)
+        self.gstorer =  get_storer(self.db_root_dir, self.use_encryption)
         
         #timer used to mesure time spent in the different values
         self.timer = gmvault_utils.Timer()
         
+        #labels already created on Gmail during the restore (shared by all the connections)
+        self._existing_labels = set()
+        self._labels_lock     = threading.Lock()
+        
+        #journal of the emails synced by the current email sync
+        self._sync_journal = None
+        
+        #metadata of the months touched by the current email sync
+        self._metadata_snapshot = None
+        
     @classmethod
     def get_imap_request_btw_2_dates(cls, begin_date, end_date):
         """
@@ -677,11 +1376,13 @@ class GMVaulter(object):
         the_str = "\n================================================================\n"\
               "Number of reconnections: %d.\nNumber of emails quarantined: %d.\n" \
               "Number of emails that could not be fetched: %d.\n" \
-              "Number of emails that were returned empty by gmail: %d\n================================================================" \
+              "Number of emails that were returned empty by gmail: %d\n" \
+              "Number of emails restored without their labels: %d\n================================================================" \
               % (self.error_report['reconnections'], \
                  len(self.error_report['emails_in_quarantine']), \
                  len(self.error_report['cannot_be_fetched']), \
-                 len(self.error_report['empty'])
+                 len(self.error_report['empty']), \
+                 len(self.error_report['pushed_without_labels'])
                 )
         
         return the_str
@@ -691,7 +1392,7 @@ class GMVaulter(object):
            sync between 2 dates
         """
         #create storer
-        gstorer = GmailStorer(storage_dir, self.use_encryption)
+        gstorer = get_storer(storage_dir, self.use_encryption)
         
         #search before the next month
         imap_req = self.get_imap_request_btw_2_dates(begin_date, end_date)
@@ -744,11 +1445,18 @@ class GMVaulter(object):
         """
         if curr_metadata[GmailStorer.ID_K] != new_metadata['X-GM-MSGID']:
             raise Exception("Gmail id has changed for %s" % (curr_metadata['id']))
-                
+        
+        return cls._flags_or_labels_changed(curr_metadata['flags'], curr_metadata['labels'], new_metadata, chat_metadata)
+    
+    @classmethod
+    def _flags_or_labels_changed(cls, curr_flags, curr_labels, new_metadata, chat_metadata = False):
+        """
+           True if the stored flags or labels are different from the ones of new_metadata
+        """
         #check flags   
         prev_set = set(new_metadata['FLAGS'])    
         
-        for flag in curr_metadata['flags']:
+        for flag in curr_flags:
             if flag not in prev_set:
                 return True
             else:
@@ -764,7 +1472,7 @@ class GMVaulter(object):
             prev_labels.add(GmailStorer.CHAT_GM_LABEL)
             
         
-        for label in curr_metadata['labels']:
+        for label in curr_labels:
             if label not in prev_labels:
                 return True
             else:
@@ -819,14 +1527,20 @@ class GMVaulter(object):
             
             # check if there is a restart
             if restart:
-                LOG.critical("Restart mode activated. Need to find information in Gmail, be patient ...")
+                LOG.critical("Restart mode activated for chats.")
                 imap_ids = self.get_gmails_ids_left_to_sync(self.OP_CHAT_SYNC, imap_ids)
             
             total_nb_chats_to_process = len(imap_ids) # total number of emails to get
             
             LOG.critical("%d chat messages to be fetched." % (total_nb_chats_to_process))
             
+            self._start_transformers(total_nb_chats_to_process)
+            
             nb_chats_processed = 0
+            
+            # a new sync forgets the chats synced by the previous one
+            journal = self._get_journal(self.OP_CHAT_SYNC)
+            journal.open(a_truncate = not restart, a_validity = self.src.get_uidvalidity())
     
             try:
                 #loop over all ids, get email store email
@@ -861,11 +1575,15 @@ class GMVaulter(object):
                                     LOG.debug("Chat with imap id %s and gmail id %s has changed. Updated it." % (the_id, gid))
                                     
                                     #restore everything at the moment
-                                    gid  = self.gstorer.bury_chat_metadata(new_data[the_id], local_dir = the_dir)
+                                    gid  = self.gstorer.bury_chat_metadata(new_data[the_id], local_dir = the_dir, \
+                                                                           on_stored = functools.partial(journal.record, the_id))
                                     
                                     #update local index id gid => index per directory to be thought out
                                 else:
                                     LOG.debug("The metadata for chat %s already exists and is identical to the one on GMail." % (gid))
+                                    
+                                    # record the synced chat to skip it when resuming (the stored ones are recorded once written)
+                                    journal.record(the_id, gid)
                             else:  
                                 
                                 #get the data
@@ -874,7 +1592,8 @@ class GMVaulter(object):
                                 new_data[the_id][imap_utils.GIMAPFetcher.EMAIL_BODY] = email_data[the_id][imap_utils.GIMAPFetcher.EMAIL_BODY]
                                 
                                 # store data on disk within year month dir 
-                                gid  = self.gstorer.bury_chat(new_data[the_id], local_dir = the_dir, compress = compress)
+                                gid  = self.gstorer.bury_chat(new_data[the_id], local_dir = the_dir, compress = compress, \
+                                                              on_stored = functools.partial(journal.record, the_id))
                                 
                                 #update local index id gid => index per directory to be thought out
                                 LOG.debug("Create and store chat with imap id %s, gmail id %s." % (the_id, gid))   
@@ -891,15 +1610,12 @@ class GMVaulter(object):
                         
                         if (nb_chats_processed % 50) == 0 and (left_emails > 0):
                             elapsed = self.timer.elapsed() #elapsed time in seconds
-                            LOG.critical("\n== Processed %d emails in %s. %d left to be stored (time estimate %s).==\n" % \
+                            LOG.critical("\n== Processed %d emails in %s. %d left to be stored (time estimate %s).==\n" \
+                                         "== Gmail rate: %s.==\n" % \
                                          (nb_chats_processed,  self.timer.seconds_to_human_time(elapsed), \
                                           left_emails, \
-                                          self.timer.estimate_time_left(nb_chats_processed, elapsed, left_emails)))
-                        
-                        # save id every 10 restored emails
-                        if (nb_chats_processed % 10) == 0:
-                            if gid:
-                                self.save_lastid(self.OP_CHAT_SYNC, gid)
+                                          self.timer.estimate_time_left(nb_chats_processed, elapsed, left_emails), \
+                                          self.rate_controller.get_status()))
                         
                     except imaplib.IMAP4.abort, _:
                         # imap abort error 
@@ -915,11 +1631,10 @@ class GMVaulter(object):
                         except Exception, _: #pylint:disable-msg=W0703
                             curr = None
                             LOG.critical("Error when trying to get gmail id for message with imap id %s." % (the_id))
-                            LOG.critical("Disconnect, wait for 20 sec then reconnect.")
+                            LOG.critical("Disconnect, wait then reconnect.")
                             self.src.disconnect()
-                            #could not fetch the gm_id so disconnect and sleep
-                            #sleep 10 sec
-                            time.sleep(10)
+                            #could not fetch the gm_id so disconnect and wait (longer after each error)
+                            self.rate_controller.backoff()
                             LOG.critical("Reconnecting ...")
                             self.src.connect()
                             
@@ -964,244 +1679,676 @@ class GMVaulter(object):
                             raise error #rethrow error
             finally:
                 self.src.select_all_mail_folder() #always reselect all mail folder
+                try:
+                    self.gstorer.flush() # the written chats are recorded before the journal is closed
+                finally:
+                    journal.close()
         else:
             imap_ids = []    
         return imap_ids
     
     
-    def _sync_emails(self, imap_req, compress, restart):
+    def _handle_abort_on_fetch(self, the_id, src = None):
         """
-           First part of the double pass strategy: 
-           - create and update emails in db
-           
+           An IMAP abort happened while fetching the message with imap id the_id.
+           Try to get its gmail id, report it as cannot_be_fetched and ignore it.
+           src: the GIMAPFetcher used to fetch (self.src by default)
         """
-        # get all imap ids in All Mail
-        imap_ids = self.src.search(imap_req)
+        src = src or self.src
         
-        # check if there is a restart
-        if restart:
-            LOG.critical("Restart mode activated for emails. Need to find information in Gmail, be patient ...")
-            imap_ids = self.get_gmails_ids_left_to_sync(self.OP_EMAIL_SYNC, imap_ids)
+        LOG.critical("Error while fetching message with imap id %s." % (the_id))
+        LOG.critical("\n=== Exception traceback ===\n")
+        LOG.critical(gmvault_utils.get_exception_traceback())
+        LOG.critical("=== End of Exception traceback ===\n")
+        try:
+            #try to get the gmail_id
+            curr = src.fetch(the_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID) 
+        except Exception, _: #pylint:disable-msg=W0703
+            curr = None
+            LOG.critical("Error when trying to get gmail id for message with imap id %s." % (the_id))
+            LOG.critical("Disconnect, wait then reconnect.")
+            src.disconnect()
+            #could not fetch the gm_id so disconnect and wait (longer after each error)
+            self.rate_controller.backoff()
+            LOG.critical("Reconnecting ...")
+            src.connect()
+            
+        if curr:
+            gmail_id = curr[the_id][imap_utils.GIMAPFetcher.GMAIL_ID]
+        else:
+            gmail_id = None
+            
+        #add ignored id
+        self.error_report['cannot_be_fetched'].append((the_id, gmail_id))
         
-        total_nb_emails_to_process = len(imap_ids) # total number of emails to get
+        LOG.critical("Forced to ignore message with imap id %s, (gmail id %s)." % (the_id, (gmail_id if gmail_id else "cannot be read")))
+    
+    def _handle_error_on_fetch(self, the_id, error, src = None):
+        """
+           An IMAP error happened while fetching the message with imap id the_id.
+           If gmail cannot fetch it, report it as cannot_be_fetched and ignore it otherwise rethrow the error.
+           src: the GIMAPFetcher used to fetch (self.src by default)
+        """
+        src = src or self.src
         
-        LOG.critical("%d emails to be fetched." % (total_nb_emails_to_process))
+        # check if this is a cannot be fetched error 
+        # I do not like to do string guessing within an exception but I do not have any choice here
+        LOG.critical("Error while fetching message with imap id %s." % (the_id))
+        LOG.critical("\n=== Exception traceback ===\n")
+        LOG.critical(gmvault_utils.get_exception_traceback())
+        LOG.critical("=== End of Exception traceback ===\n")
+         
+        #quarantine emails that have raised an abort error
+        if str(error).find("'Some messages could not be FETCHed (Failure)'") >= 0:
+            try:
+                #try to get the gmail_id
+                LOG.critical("One more attempt. Trying to fetch the Gmail ID for %s" % (the_id) )
+                curr = src.fetch(the_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID) 
+            except Exception, _: #pylint:disable-msg=W0703
+                curr = None
+            
+            if curr:
+                gmail_id = curr[the_id][imap_utils.GIMAPFetcher.GMAIL_ID]
+            else:
+                gmail_id = None
+            
+            #add ignored id
+            self.error_report['cannot_be_fetched'].append((the_id, gmail_id))
+            
+            LOG.critical("Ignore message with imap id %s, (gmail id %s)" % (the_id, (gmail_id if gmail_id else "cannot be read")))
         
-        nb_emails_processed = 0
+        else:
+            raise error #rethrow error
+    
+    def _sync_emails_one_by_one(self, group_imap_ids, compress, src = None):
+        """
+           Sync a group of emails one by one to report precisely the ones causing errors
+           Return the last stored gmail id of the group or None
+        """
+        last_gid = None
+        for the_id in group_imap_ids:
+            last_gid = self._sync_email_group([the_id], compress, src) or last_gid
+        return last_gid
+    
+    def _sync_email_group(self, group_imap_ids, compress, src = None):
+        """
+           Sync a group of emails:
+           - get the metadata of all the emails of the group in one IMAP request
+           - diff them against the metadata on disk and update it if necessary 
+           - fetch the data of the new emails 
+           src: the GIMAPFetcher to use (self.src by default)
+           Return the last stored gmail id of the group or None
+        """
+        src = src or self.src
+        
+        try:
+            #get everything but data
+            new_data = src.fetch(group_imap_ids, imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA)
+        except imaplib.IMAP4.abort, _:
+            if len(group_imap_ids) == 1:
+                self._handle_abort_on_fetch(group_imap_ids[0], src)
+                return None
+            LOG.critical("Error while fetching metadata for %d messages. Fetch them one by one." % (len(group_imap_ids)))
+            return self._sync_emails_one_by_one(group_imap_ids, compress, src)
+        except imaplib.IMAP4.error, error:
+            if len(group_imap_ids) == 1:
+                self._handle_error_on_fetch(group_imap_ids[0], error, src)
+                return None
+            LOG.critical("Error while fetching metadata for %d messages. Fetch them one by one." % (len(group_imap_ids)))
+            return self._sync_emails_one_by_one(group_imap_ids, compress, src)
+        
+        last_gid = None
         
-        for the_id in imap_ids:
+        to_fetch = [] # new emails for which the data has to be fetched
+        
+        if self._metadata_snapshot:
+            # load the stored metadata of all the months of the group at once
+            self._metadata_snapshot.load([ gmvault_utils.get_ym_from_datetime(new_data[the_id][imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]) \
+                                           for the_id in group_imap_ids if new_data.get(the_id, None) ])
+        
+        for the_id in group_imap_ids:
             
-            try:
-                
-                gid = None
-                
-                LOG.debug("\nProcess imap id %s" % ( the_id ))
+            if not new_data.get(the_id, None):
+                # case when gmail IMAP server returns OK without any data whatsoever
+                # eg. imap uid 142221L ignore it
+                self.error_report['empty'].append((the_id, None))
+                continue
+            
+            gid = new_data[the_id][imap_utils.GIMAPFetcher.GMAIL_ID]
+            
+            the_dir = gmvault_utils.get_ym_from_datetime(new_data[the_id][imap_utils.GIMAPFetcher.IMAP_INTERNALDATE])
+            
+            LOG.debug("\nProcess imap id %s (gmail id %s) from %s." % (the_id, gid, the_dir))
+            
+            record = self._metadata_snapshot.get(gid, the_dir) if self._metadata_snapshot else None
+            
+            if record:
+                #stored metadata found in the snapshot
+                curr_metadata = None
+                needs_update  = self._flags_or_labels_changed(record[0], record[1], new_data[the_id])
+            else:
+                #pass the dir and the ID
+                curr_metadata = GMVaulter.check_email_on_disk( self.gstorer , gid, the_dir)
+                needs_update  = curr_metadata and self._metadata_needs_update(curr_metadata, new_data[the_id])
+            
+            #if on disk check that the data is not different
+            if record or curr_metadata:
                 
-                #get everything but data
-                new_data = self.src.fetch(the_id, imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA )
+                LOG.debug("metadata for %s already exists. Check if different." % (gid))
                 
-                if new_data.get(the_id, None):
+                if needs_update:
                     
-                    gid = new_data[the_id][imap_utils.GIMAPFetcher.GMAIL_ID]
+                    LOG.debug("Email with imap id %s and gmail id %s has changed. Updated it." % (the_id, gid))
                     
-                    the_dir      = gmvault_utils.get_ym_from_datetime(new_data[the_id][imap_utils.GIMAPFetcher.IMAP_INTERNALDATE])
-                    
-                    LOG.critical("Process email num %d (imap_id:%s) from %s." % (nb_emails_processed, the_id, the_dir))
-                
-                    #pass the dir and the ID
-                    curr_metadata = GMVaulter.check_email_on_disk( self.gstorer , \
-                                                                   new_data[the_id][imap_utils.GIMAPFetcher.GMAIL_ID], \
-                                                                   the_dir)
-                    
-                    #if on disk check that the data is not different
-                    if curr_metadata:
-                        
-                        LOG.debug("metadata for %s already exists. Check if different." % (gid))
-                        
-                        if self._metadata_needs_update(curr_metadata, new_data[the_id]):
-                            
-                            LOG.debug("Chat with imap id %s and gmail id %s has changed. Updated it." % (the_id, gid))
-                            
-                            #restore everything at the moment
-                            gid  = self.gstorer.bury_metadata(new_data[the_id], local_dir = the_dir)
-                            
-                            #update local index id gid => index per directory to be thought out
-                        else:
-                            LOG.debug("On disk metadata for %s is up to date." % (gid))
-                    else:  
-                        
-                        #get the data
-                        email_data = self.src.fetch(the_id, imap_utils.GIMAPFetcher.GET_DATA_ONLY )
-                        
-                        new_data[the_id][imap_utils.GIMAPFetcher.EMAIL_BODY] = email_data[the_id][imap_utils.GIMAPFetcher.EMAIL_BODY]
-                        
-                        # store data on disk within year month dir 
-                        gid  = self.gstorer.bury_email(new_data[the_id], local_dir = the_dir, compress = compress)
-                        
-                        #update local index id gid => index per directory to be thought out
-                        LOG.debug("Create and store email with imap id %s, gmail id %s." % (the_id, gid))   
+                    #restore everything at the moment
+                    last_gid = self.gstorer.bury_metadata(new_data[the_id], local_dir = the_dir, \
+                                                          on_stored = self._get_synced_email_recorder(the_id))
+                else:
+                    LOG.debug("On disk metadata for %s is up to date." % (gid))
+                    last_gid = gid
                     
+                    self._record_synced_email(the_id, gid)
+            else:
+                to_fetch.append((the_id, the_dir))
+        
+        return self._fetch_and_bury_emails(to_fetch, new_data, compress, src) or last_gid
+    
+    @classmethod
+    def _get_body_batches(cls, to_fetch, new_data, rate_controller = None):
+        """
+           Split the emails to fetch in batches bounded by a number of emails (body_batch_size)
+           and by a number of bytes (body_batch_bytes) computed from the RFC822.SIZE of each email.
+           An email bigger than body_batch_bytes or than stream_body_bytes (streamed to disk) is fetched alone.
+           rate_controller: if not None, the bounds are the batch sizes given by the controller
+        """
+        max_nb    = max(1, gmvault_utils.get_conf_defaults().getint("Sync", "body_batch_size", 50))
+        max_bytes = gmvault_utils.get_conf_defaults().getint("Sync", "body_batch_bytes", 10485760)
+        
+        if rate_controller:
+            max_nb, max_bytes = rate_controller.get_batch_size(max_nb), rate_controller.get_batch_size(max_bytes)
+        
+        batch, batch_bytes = [], 0
+        for the_id, the_dir in to_fetch:
+            size = new_data[the_id].get(imap_utils.GIMAPFetcher.IMAP_SIZE, 0)
+            
+            if cls._stream_body(new_data[the_id]):
+                if batch:
+                    yield batch
+                    batch, batch_bytes = [], 0
+                yield [(the_id, the_dir)]
+                continue
+            
+            if batch and (len(batch) >= max_nb or batch_bytes + size > max_bytes):
+                yield batch
+                batch, batch_bytes = [], 0
+            
+            batch.append((the_id, the_dir))
+            batch_bytes += size
+        
+        if batch:
+            yield batch
+    
+    @classmethod
+    def _stream_body(cls, email_info):
+        """
+           True if the body of the email is big enough (RFC822.SIZE >= stream_body_bytes) to be 
+           streamed from the socket to its data file instead of being read in memory
+        """
+        threshold = gmvault_utils.get_conf_defaults().getint("Sync", "stream_body_bytes", 4194304)
+        
+        return threshold > 0 and email_info.get(imap_utils.GIMAPFetcher.IMAP_SIZE, 0) >= threshold
+    
+    def _fetch_and_bury_emails(self, to_fetch, new_data, compress, src = None):
+        """
+           Fetch the data of the new emails by batches and store each email as soon as its batch is received.
+           to_fetch: list of (imap_id, yy-mm dir) to fetch
+           new_data: metadata of the emails to fetch
+           src     : the GIMAPFetcher to use (self.src by default)
+           Return the last stored gmail id or None
+        """
+        src = src or self.src
+        
+        last_gid = None
+        
+        for batch in self._get_body_batches(to_fetch, new_data, self.rate_controller):
+            
+            batch_ids = [ the_id for the_id, _ in batch ]
+            
+            writer = None
+            if len(batch) == 1 and self._stream_body(new_data[batch_ids[0]]):
+                # big email: write the body directly in its data file
+                writer = self.gstorer.get_email_writer(new_data[batch_ids[0]][imap_utils.GIMAPFetcher.GMAIL_ID], \
+                                                       local_dir = batch[0][1], compress = compress)
+            
+            try:
+                #get the data
+                if writer:
+                    email_data = src.fetch_to_sink(batch_ids[0], imap_utils.GIMAPFetcher.GET_DATA_ONLY, writer)
                 else:
-                    # case when gmail IMAP server returns OK without any data whatsoever
-                    # eg. imap uid 142221L ignore it
-                    self.error_report['empty'].append((the_id, None))
+                    email_data = src.fetch(batch_ids, imap_utils.GIMAPFetcher.GET_DATA_ONLY )
+            except (imaplib.IMAP4.abort, imaplib.IMAP4.error), error:
+                if writer:
+                    writer.abort()
                 
-                nb_emails_processed += 1
-                
-                #indicate every 50 messages the number of messages left to process
-                left_emails = (total_nb_emails_to_process - nb_emails_processed)
+                if len(batch) == 1:
+                    if isinstance(error, imaplib.IMAP4.abort):
+                        self._handle_abort_on_fetch(batch_ids[0], src)
+                    else:
+                        self._handle_error_on_fetch(batch_ids[0], error, src)
+                else:
+                    # fetch them one by one to report precisely the ones causing errors
+                    LOG.critical("Error while fetching data for %d messages. Fetch them one by one." % (len(batch)))
+                    for elem in batch:
+                        last_gid = self._fetch_and_bury_emails([elem], new_data, compress, src) or last_gid
                 
-                if (nb_emails_processed % 50) == 0 and (left_emails > 0):
-                    elapsed = self.timer.elapsed() #elapsed time in seconds
-                    LOG.critical("\n== Processed %d emails in %s. %d left to be stored (time estimate %s).==\n" % \
-                                 (nb_emails_processed,  \
-                                  self.timer.seconds_to_human_time(elapsed), left_emails, \
-                                  self.timer.estimate_time_left(nb_emails_processed, elapsed, left_emails)))
+                for the_id in batch_ids:
+                    new_data.pop(the_id, None)
+                continue
+            
+            for the_id, the_dir in batch:
                 
-                # save id every 10 restored emails
-                if (nb_emails_processed % 10) == 0:
-                    if gid:
-                        self.save_lastid(self.OP_EMAIL_SYNC, gid)
+                # pop them to free the memory as soon as the email is stored
+                data = email_data.pop(the_id, None)
                 
-            except imaplib.IMAP4.abort, _:
-                # imap abort error 
-                # ignore it 
-                # will have to do something with these ignored messages
-                LOG.critical("Error while fetching message with imap id %s." % (the_id))
-                LOG.critical("\n=== Exception traceback ===\n")
-                LOG.critical(gmvault_utils.get_exception_traceback())
-                LOG.critical("=== End of Exception traceback ===\n")
-                try:
-                    #try to get the gmail_id
-                    curr = self.src.fetch(the_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID) 
-                except Exception, _: #pylint:disable-msg=W0703
-                    curr = None
-                    LOG.critical("Error when trying to get gmail id for message with imap id %s." % (the_id))
-                    LOG.critical("Disconnect, wait for 20 sec then reconnect.")
-                    self.src.disconnect()
-                    #could not fetch the gm_id so disconnect and sleep
-                    #sleep 20 sec
-                    time.sleep(20)
-                    LOG.critical("Reconnecting ...")
-                    self.src.connect()
+                if not data or (imap_utils.GIMAPFetcher.EMAIL_BODY not in data):
+                    # Gmail returned OK without the data
+                    self.error_report['empty'].append((the_id, new_data[the_id][imap_utils.GIMAPFetcher.GMAIL_ID]))
+                    if writer:
+                        writer.abort()
+                elif writer:
+                    LOG.debug("Body of email with imap id %s streamed to disk (%d bytes)." % (the_id, writer.nb_bytes))
                     
-                if curr:
-                    gmail_id = curr[the_id][imap_utils.GIMAPFetcher.GMAIL_ID]
+                    last_gid  = self.gstorer.bury_email(new_data[the_id], local_dir = the_dir, compress = compress, \
+                                                        data_writer = writer, on_stored = self._get_synced_email_recorder(the_id))
                 else:
-                    gmail_id = None
-                    
-                #add ignored id
-                self.error_report['cannot_be_fetched'].append((the_id, gmail_id))
-                
-                LOG.critical("Forced to ignore message with imap id %s, (gmail id %s)." % (the_id, (gmail_id if gmail_id else "cannot be read")))
-                
-            except imaplib.IMAP4.error, error:
-                # check if this is a cannot be fetched error 
-                # I do not like to do string guessing within an exception but I do not have any choice here
-                LOG.critical("Error while fetching message with imap id %s." % (the_id))
-                LOG.critical("\n=== Exception traceback ===\n")
-                LOG.critical(gmvault_utils.get_exception_traceback())
-                LOG.critical("=== End of Exception traceback ===\n")
-                 
-                #quarantine emails that have raised an abort error
-                if str(error).find("'Some messages could not be FETCHed (Failure)'") >= 0:
-                    try:
-                        #try to get the gmail_id
-                        LOG.critical("One more attempt. Trying to fetch the Gmail ID for %s" % (the_id) )
-                        curr = self.src.fetch(the_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID) 
-                    except Exception, _: #pylint:disable-msg=W0703
-                        curr = None
-                    
-                    if curr:
-                        gmail_id = curr[the_id][imap_utils.GIMAPFetcher.GMAIL_ID]
-                    else:
-                        gmail_id = None
+                    new_data[the_id][imap_utils.GIMAPFetcher.EMAIL_BODY] = data[imap_utils.GIMAPFetcher.EMAIL_BODY]
                     
-                    #add ignored id
-                    self.error_report['cannot_be_fetched'].append((the_id, gmail_id))
+                    # store data on disk within year month dir 
+                    last_gid  = self.gstorer.bury_email(new_data[the_id], local_dir = the_dir, compress = compress, \
+                                                        on_stored = self._get_synced_email_recorder(the_id))
                     
-                    LOG.critical("Ignore message with imap id %s, (gmail id %s)" % (the_id, (gmail_id if gmail_id else "cannot be read")))
+                    LOG.debug("Create and store email with imap id %s, gmail id %s." % (the_id, last_gid))   
                 
-                else:
-                    raise error #rethrow error
-        return imap_ids
+                del new_data[the_id]
+                
+        return last_gid
     
-    def sync(self, imap_req = imap_utils.GIMAPFetcher.IMAP_ALL, compress_on_disk = True, db_cleaning = False, ownership_checking = True, \
-            restart = False, emails_only = False, chats_only = False):
+    def _get_journal(self, op_type):
         """
-           sync mode 
+           Return the journal of the ids completed by the operation op_type
         """
-        #check ownership to have one email per db unless user wants different
-        #save the owner if new
-        self._check_email_db_ownership(ownership_checking)
-                
-        if not compress_on_disk:
-            LOG.critical("Disable compression when storing emails.")
-            
-        if self.use_encryption:
-            LOG.critical("Encryption activated. All emails will be encrypted before to be stored.")
-            LOG.critical("Please take care of the encryption key stored in (%s) or all"\
-                         " your stored emails will become unreadable." % (GmailStorer.get_encryption_key_path(self.db_root_dir)))
+        filename = self.OP_TO_JOURNAL.get(op_type, None)
         
-        self.timer.start() #start syncing emails
+        if not filename:
+            raise Exception("Bad Operation (%s) in _get_journal. This should not happen, send the error to the software developers." % (op_type))
         
-        if not chats_only:
-            # backup emails
-            LOG.critical("Start emails synchronization.\n")
-            self._sync_emails(imap_req, compress = compress_on_disk, restart = restart)
-        else:
-            LOG.critical("Skip emails synchronization.\n")
+        # the synced ids vouch for the emails written by the storer: they are fsynced first
+        return journal_utils.OperationJournal('%s/%s_%s' % (self.gstorer.get_info_dir(), self.login, filename), \
+                                              gmvault_utils.get_conf_defaults().getint("General", "journal_fsync_every", 100), \
+                                              self.gstorer.sync_data if op_type in (self.OP_EMAIL_SYNC, self.OP_CHAT_SYNC) else None)
+    
+    def _record_synced_email(self, imap_id, gm_id):
+        """
+           Record in the journal of the current email sync that imap_id is synced
+        """
+        if self._sync_journal:
+            self._sync_journal.record(imap_id, gm_id)
+    
+    def _start_transformers(self, nb_to_fetch):
+        """
+           Compress and encrypt the emails in a pool of processes for the big syncs (initial full syncs)
+           of at least transform_min_emails emails. The pool is stopped when the sync closes the storer
+        """
+        min_emails = gmvault_utils.get_conf_defaults().getint("Sync", "transform_min_emails", 1000)
         
-        if not emails_only:
-            # backup chats
-            LOG.critical("Start chats synchronization.\n")
-            self._sync_chats(imap_req, compress = compress_on_disk, restart = restart)
-        else:
-            LOG.critical("\nSkip chats synchronization.\n")
+        if min_emails <= 0 or nb_to_fetch < min_emails:
+            return
         
-        #delete supress emails from DB since last sync
-        if len(self.gstorer.get_db_owners()) <= 1:
-            self.check_clean_db(db_cleaning)
-        else:
-            LOG.critical("Deactivate database cleaning on a multi-owners Gmvault db.")
+        self.gstorer.start_transformers(gmvault_utils.get_conf_defaults().getint("Sync", "transform_processes", 0) or None, \
+                                        gmvault_utils.get_conf_defaults().getint("Sync", "transform_inflight_bytes", 67108864))
+    
+    def _get_synced_email_recorder(self, imap_id):
+        """
+           Return the function recording imap_id in the email sync journal once the storer has written the email.
+           The journal is never ahead of the data on disk when the storer writes in background threads
+        """
+        sync_journal = self._sync_journal
         
-        LOG.critical("Synchronisation operation performed in %s.\n" \
-                     % (self.timer.seconds_to_human_time(self.timer.elapsed())))
+        def on_stored(gm_id):
+            """ record the written email """
+            if sync_journal:
+                sync_journal.record(imap_id, gm_id)
         
-        return self.error_report
-
+        return on_stored
     
-    def _delete_sync(self, imap_ids, db_gmail_ids, db_gmail_ids_info, msg_type):
+    def _create_fetcher(self):
         """
-           Delete emails from the database if necessary
-           imap_ids      : all remote imap_ids to check
-           db_gmail_ids_info : info read from metadata
-           msg_type : email or chat
+           Create and connect a new GIMAPFetcher on the same account as self.src
         """
+        src = imap_utils.GIMAPFetcher(self.host, self.port, self.login, dict(self.credential), \
+                                      readonly_folder = self.read_only_access, rate_controller = self.rate_controller, \
+                                      use_ssl = self.use_ssl)
+        src.connect()
         
-        # optimize nb of items
-        nb_items = self.NB_GRP_OF_ITEMS if len(imap_ids) >= self.NB_GRP_OF_ITEMS else len(imap_ids)
-        
-        LOG.critical("Call Gmail to check the stored %ss against the Gmail %ss ids and see which ones have been deleted.\n\n"\
-                     "This might take a few minutes ...\n" % (msg_type, msg_type)) 
-         
-        #calculate the list elements to delete
-        #query nb_items items in one query to minimise number of imap queries
-        for group_imap_id in itertools.izip_longest(fillvalue=None, *[iter(imap_ids)]*nb_items):
-            
-            # if None in list remove it
-            if None in group_imap_id: 
-                group_imap_id = [ im_id for im_id in group_imap_id if im_id != None ]
-            
-            #LOG.debug("Interrogate Gmail Server for %s" % (str(group_imap_id)))
-            data = self.src.fetch(group_imap_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID)
+        return src
+    
+    def _email_sync_worker(self, work_queue, result_queue, compress, worker):
+        """
+           Parallel sync worker number worker: sync the groups of emails taken from work_queue until it is empty
+           (when the rate controller lets it send commands). The first worker uses the current connection and
+           the other ones open their own connection to Gmail.
+           Post (index, nb_of_emails, last_gid, error) in result_queue for each group and (None, 0, None, None)
+           when it stops.
+        """
+        src = self.src if worker == 0 else None
+        try:
+            if not src:
+                try:
+                    src = self._create_fetcher()
+                except Exception, err: #pylint:disable-msg=W0703
+                    LOG.critical("Cannot open a new connection to Gmail (%s). Continue with less connections." % (err))
+                    LOG.debug(gmvault_utils.get_exception_traceback())
+                    return
+            
+            while True:
+                self.rate_controller.wait(worker)
+                
+                try:
+                    index, group_imap_ids = work_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                
+                try:
+                    gid = self._sync_email_group(group_imap_ids, compress, src)
+                except Exception, err: #pylint:disable-msg=W0703
+                    LOG.critical(gmvault_utils.get_exception_traceback())
+                    result_queue.put((index, len(group_imap_ids), None, err))
+                    break
+                
+                result_queue.put((index, len(group_imap_ids), gid, None))
+        finally:
+            self.rate_controller.worker_done(worker)
+            if src and src is not self.src:
+                self.error_report['reconnections'] += src.total_nb_reconns
+                src.disconnect()
+            result_queue.put((None, 0, None, None))
+    
+    def _sync_email_groups_in_parallel(self, groups, compress, nb_connections, total_nb_emails_to_process):
+        """
+           Sync the groups of emails with nb_connections workers, each one using its own connection to Gmail
+           (the current connection is one of them: Gmail limits the number of simultaneous connections).
+           Progress and errors are aggregated here. 
+           The synced emails are recorded in the journal by the workers so groups can complete in any order.
+        """
+        work_queue   = Queue.Queue()
+        result_queue = Queue.Queue()
+        
+        for index, group_imap_ids in enumerate(groups):
+            work_queue.put((index, group_imap_ids))
+        
+        nb_workers = min(nb_connections, len(groups))
+        
+        LOG.critical("Sync emails with %d connections to Gmail." % (nb_workers))
+        
+        self.rate_controller.set_workers(nb_workers)
+        
+        for worker_nb in xrange(nb_workers):
+            worker = threading.Thread(target = self._email_sync_worker, args = (work_queue, result_queue, compress, worker_nb))
+            worker.daemon = True
+            worker.start()
+        
+        nb_groups_done      = 0
+        nb_emails_processed = 0
+        error               = None
+        
+        while nb_workers > 0:
+            try:
+                index, nb_emails, _, err = result_queue.get(True, 1) # use a timeout to not block CTRL^C
+            except Queue.Empty:
+                continue
+            
+            if index is None:
+                # a worker has stopped
+                nb_workers -= 1
+                continue
+            
+            if err:
+                # stop distributing work and wait for the running groups
+                error = err
+                while True:
+                    try:
+                        work_queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                continue
+                
+            nb_groups_done      += 1
+            nb_emails_processed += nb_emails
+            
+            left_emails = (total_nb_emails_to_process - nb_emails_processed)
+            
+            if left_emails > 0:
+                elapsed = self.timer.elapsed() #elapsed time in seconds
+                LOG.critical("\n== Processed %d emails in %s. %d left to be stored (time estimate %s).==\n" \
+                             "== Gmail rate: %s.==\n" % \
+                             (nb_emails_processed,  \
+                              self.timer.seconds_to_human_time(elapsed), left_emails, \
+                              self.timer.estimate_time_left(nb_emails_processed, elapsed, left_emails), \
+                              self.rate_controller.get_status()))
+        
+        if error:
+            raise error
+        
+        if nb_groups_done < len(groups):
+            raise Exception("No connection to Gmail left to sync the emails. %d emails have not been synced." \
+                            % (total_nb_emails_to_process - nb_emails_processed))
+    
+    def _sync_emails(self, imap_req, compress, restart, nb_connections = 1):
+        """
+           First part of the double pass strategy: 
+           - create and update emails in db
+           
+           The emails are processed by groups of metadata_batch_size imap ids
+           If nb_connections > 1, the groups are processed in parallel by nb_connections workers
+           Each synced email is recorded in the email sync journal to be skipped when resuming
+        """
+        # get all imap ids in All Mail (only the changed ones if possible)
+        imap_ids, folder_state = self._search_changed_emails(imap_req)
+        
+        # check if there is a restart
+        if restart:
+            LOG.critical("Restart mode activated for emails.")
+            imap_ids = self.get_gmails_ids_left_to_sync(self.OP_EMAIL_SYNC, imap_ids)
+        
+        total_nb_emails_to_process = len(imap_ids) # total number of emails to get
+        
+        LOG.critical("%d emails to be fetched." % (total_nb_emails_to_process))
+        
+        self._start_transformers(total_nb_emails_to_process)
+        
+        batch_size = max(1, gmvault_utils.get_conf_defaults().getint("Sync", "metadata_batch_size", 500))
+        
+        # a new sync forgets the emails synced by the previous one
+        self._sync_journal = self._get_journal(self.OP_EMAIL_SYNC)
+        self._sync_journal.open(a_truncate = not restart, a_validity = self.src.get_uidvalidity())
+        
+        self._metadata_snapshot = MetadataSnapshot(self.gstorer, \
+                                                   gmvault_utils.get_conf_defaults().getint("Sync", "metadata_reader_threads", 4))
+        
+        nb_fetch_errors = len(self.error_report['cannot_be_fetched'])
+        
+        try:
+            if nb_connections > 1 and total_nb_emails_to_process > batch_size:
+                self._sync_email_groups_in_parallel(list(gmvault_utils.chunker(imap_ids, batch_size)), \
+                                                    compress, nb_connections, total_nb_emails_to_process)
+            else:
+                nb_emails_processed = 0
+                
+                for group_imap_ids in gmvault_utils.chunker(imap_ids, batch_size):
+                    
+                    LOG.critical("Process emails %d to %d (imap ids %s to %s)." % (nb_emails_processed, \
+                                                                                 nb_emails_processed + len(group_imap_ids) - 1, \
+                                                                                 group_imap_ids[0], group_imap_ids[-1]))
+                    
+                    self._sync_email_group(group_imap_ids, compress)
+                    
+                    nb_emails_processed += len(group_imap_ids)
+                    
+                    #indicate after each group the number of messages left to process
+                    left_emails = (total_nb_emails_to_process - nb_emails_processed)
+                    
+                    if left_emails > 0:
+                        elapsed = self.timer.elapsed() #elapsed time in seconds
+                        LOG.critical("\n== Processed %d emails in %s. %d left to be stored (time estimate %s).==\n" \
+                                     "== Gmail rate: %s.==\n" % \
+                                     (nb_emails_processed,  \
+                                      self.timer.seconds_to_human_time(elapsed), left_emails, \
+                                      self.timer.estimate_time_left(nb_emails_processed, elapsed, left_emails), \
+                                      self.rate_controller.get_status()))
+        finally:
+            try:
+                self.gstorer.flush() # the written emails are recorded before the journal is closed
+            finally:
+                self._sync_journal.close()
+                self._sync_journal = None
+                self._metadata_snapshot = None
+        
+        # the next syncs will only look at the emails changed from now on 
+        # unless some emails could not be fetched (they have to be retried)
+        if folder_state and len(self.error_report['cannot_be_fetched']) == nb_fetch_errors:
+            self.gstorer.store_sync_state(self.login, folder_state)
+        
+        return imap_ids
+    
+    def _search_changed_emails(self, imap_req):
+        """
+           Search the emails to sync in the selected folder.
+           When CONDSTORE is enabled and the folder has already been completely synced (same UIDVALIDITY), 
+           an imap request is restricted to the emails changed or added since the HIGHESTMODSEQ of the last sync.
+           Return the imap ids and the folder state to store once synced (None if the request doesn't cover the whole folder)
+        """
+        folder_state = self.src.get_folder_state()
+        
+        if not folder_state or imap_req.get('type', '') != 'imap' or \
+           not gmvault_utils.get_conf_defaults().getboolean("Sync", "use_modseq", True):
+            return self.src.search(imap_req), None
+        
+        last_state = self.gstorer.get_sync_state(self.login, folder_state['folder'])
+        
+        if last_state and last_state['uidvalidity'] == folder_state['uidvalidity']:
+            LOG.critical("Only get the emails changed since the last sync (modseq %s, now %s)." \
+                         % (last_state['highestmodseq'], folder_state['highestmodseq']))
+            imap_ids = self.src.search_changed_since(imap_req, last_state['highestmodseq'])
+        else:
+            imap_ids = self.src.search(imap_req)
+        
+        # a state can only be stored once all the emails of the folder have been synced
+        if imap_req.get('req', '') != imap_utils.GIMAPFetcher.IMAP_ALL['req']:
+            folder_state = None
+        
+        return imap_ids, folder_state
+    
+    def sync(self, imap_req = imap_utils.GIMAPFetcher.IMAP_ALL, compress_on_disk = True, db_cleaning = False, ownership_checking = True, \
+            restart = False, emails_only = False, chats_only = False, nb_connections = 1):
+        """
+           sync mode 
+           nb_connections: number of connections to Gmail used in parallel to sync the emails
+        """
+        #check ownership to have one email per db unless user wants different
+        #save the owner if new
+        self._check_email_db_ownership(ownership_checking)
+                
+        if not compress_on_disk:
+            LOG.critical("Disable compression when storing emails.")
+            
+        if self.use_encryption:
+            LOG.critical("Encryption activated. All emails will be encrypted before to be stored.")
+            LOG.critical("Please take care of the encryption key stored in (%s) or all"\
+                         " your stored emails will become unreadable." % (GmailStorer.get_encryption_key_path(self.db_root_dir)))
+        
+        self.timer.start() #start syncing emails
+        
+        # compress, encrypt and write the emails in background threads while the connections fetch the next ones
+        self.gstorer.start_writers(gmvault_utils.get_conf_defaults().getint("Sync", "writer_threads", 2), \
+                                   gmvault_utils.get_conf_defaults().getint("Sync", "writer_queue_size", 50))
+        try:
+            if not chats_only:
+                # backup emails
+                LOG.critical("Start emails synchronization.\n")
+                self._sync_emails(imap_req, compress = compress_on_disk, restart = restart, nb_connections = nb_connections)
+            else:
+                LOG.critical("Skip emails synchronization.\n")
             
-            # syntax for 2.7 set comprehension { data[key][imap_utils.GIMAPFetcher.GMAIL_ID] for key in data }
-            # need to create a list for 2.6
-            db_gmail_ids.difference_update([data[key][imap_utils.GIMAPFetcher.GMAIL_ID] for key in data ])
+            if not emails_only:
+                # backup chats
+                LOG.critical("Start chats synchronization.\n")
+                self._sync_chats(imap_req, compress = compress_on_disk, restart = restart)
+            else:
+                LOG.critical("\nSkip chats synchronization.\n")
             
-            if len(db_gmail_ids) == 0:
-                break
+            #delete supress emails from DB since last sync
+            if len(self.gstorer.get_db_owners()) <= 1:
+                self.check_clean_db(db_cleaning)
+            else:
+                LOG.critical("Deactivate database cleaning on a multi-owners Gmvault db.")
+        finally:
+            self.gstorer.close()
+        
+        LOG.critical("Synchronisation operation performed in %s.\n" \
+                     % (self.timer.seconds_to_human_time(self.timer.elapsed())))
+        
+        return self.error_report
+
+    
+    def _get_remote_gmail_ids(self, imap_ids):
+        """
+           Return the sorted list of the gmail ids of imap_ids.
+           They are fetched by big uid ranges (first:last) to keep the FETCH commands short
+        """
+        gm_ids = []
+        
+        for group_imap_ids in gmvault_utils.chunker(sorted(imap_ids), self.NB_UIDS_PER_RANGE_FETCH):
+            gm_ids.extend(self.src.fetch_gmail_ids(group_imap_ids[0], group_imap_ids[-1]))
+        
+        gm_ids.sort()
+        
+        return gm_ids
+    
+    @classmethod
+    def _get_deleted_ids(cls, db_gmail_ids, remote_gmail_ids):
+        """
+           Return the ids of db_gmail_ids that are not in remote_gmail_ids. 
+           Sorted merge of the 2 sorted lists
+        """
+        deleted = []
+        
+        nb_remote, pos = len(remote_gmail_ids), 0
+        for gm_id in db_gmail_ids:
+            while pos < nb_remote and remote_gmail_ids[pos] < gm_id:
+                pos += 1
+            
+            if pos == nb_remote or remote_gmail_ids[pos] != gm_id:
+                deleted.append(gm_id)
+        
+        return deleted
+    
+    def _delete_sync(self, imap_ids, db_gmail_ids_info, msg_type):
+        """
+           Delete emails from the database if necessary
+           imap_ids      : all remote imap_ids to check
+           db_gmail_ids_info : info read from metadata (sorted by gmail id)
+           msg_type : email or chat
+        """
+        LOG.critical("Call Gmail to check the stored %ss against the Gmail %ss ids and see which ones have been deleted.\n\n"\
+                     "This might take a few minutes ...\n" % (msg_type, msg_type)) 
+        
+        remote_gmail_ids = self._get_remote_gmail_ids(imap_ids) if imap_ids else []
+        
+        if imap_ids and not remote_gmail_ids:
+            # never delete the whole db because of an unexpected answer
+            raise Exception("Gmail returned no gmail ids for %d %s(s). Do not delete anything." % (len(imap_ids), msg_type))
+        
+        db_gmail_ids = self._get_deleted_ids(sorted(db_gmail_ids_info.keys()), remote_gmail_ids)
         
         LOG.critical("Will delete %s %s(s) from gmvault db.\n" % (len(db_gmail_ids), msg_type) )
         for gm_id in db_gmail_ids:
@@ -1213,6 +2360,25 @@ class GMVaulter(object):
            Get the ids that still needs to be sync
            Return a list of ids
         """
+        journal = self._get_journal(op_type)
+        
+        # the journal records imap ids: they are only valid with the same UIDVALIDITY
+        if journal.exists() and journal.get_validity() != self.src.get_uidvalidity():
+            LOG.critical("The UIDVALIDITY of the folder changed since the interrupted sync (%s instead of %s)."\
+                         " Ignore journal %s and sync the full list of emails." \
+                         % (self.src.get_uidvalidity(), journal.get_validity(), journal.path))
+            journal.remove()
+            return imap_ids
+        
+        if journal.exists():
+            done_ids = journal.load()
+            
+            LOG.critical("Resume from journal %s: %d ids already synced." % (journal.path, len(done_ids)))
+            
+            return [ the_id for the_id in imap_ids if the_id not in done_ids ]
+        
+        # no journal: operation interrupted by a previous version of gmvault. Use its last_id file
+        LOG.critical("Need to find information in Gmail, be patient ...")
         
         filename = self.OP_TO_FILENAME.get(op_type, None)
         
@@ -1272,9 +2438,6 @@ class GMVaulter(object):
             db_gmail_ids_info = self.gstorer.get_all_existing_gmail_ids()
         
             LOG.critical("Found %s email(s) in the Gmvault db.\n" % (len(db_gmail_ids_info)) )
-        
-            #create a set of keys
-            db_gmail_ids = set(db_gmail_ids_info.keys())
             
             # get all imap ids in All Mail
             imap_ids = self.src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
@@ -1282,7 +2445,7 @@ class GMVaulter(object):
             LOG.debug("Got %s emails imap_id(s) from the Gmail Server." % (len(imap_ids)))
             
             #delete supress emails from DB since last sync
-            self._delete_sync(imap_ids, db_gmail_ids, db_gmail_ids_info, 'email')
+            self._delete_sync(imap_ids, db_gmail_ids_info, 'email')
             
             # get all chats ids
             try:
@@ -1295,17 +2458,17 @@ class GMVaulter(object):
 
                 if chat_dir:
                     chat_ids = self.src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
-                    db_chat_ids = set(db_gmail_ids_info.keys())
                 
                     LOG.debug("Got %s chat imap_ids from the Gmail Server." % (len(chat_ids)))
             
                     #delete supress emails from DB since last sync
-                    self._delete_sync(chat_ids, db_chat_ids, db_gmail_ids_info , 'chat')
+                    self._delete_sync(chat_ids, db_gmail_ids_info , 'chat')
                 else:
                     LOG.critical("Chats IMAP Directory not visible on Gmail. Ignore deletion of chats.")
                 
             finally:
                 self.src.select_all_mail_folder()
+                self.gstorer.flush()
             
             LOG.critical("\nDeletion checkup done in %s." % (timer.elapsed_human_time()))
             
@@ -1318,33 +2481,26 @@ class GMVaulter(object):
         pass
         
     
-    def save_lastid(self, op_type, gm_id):
-        """
-           Save the passed gmid in last_id.restore
-           For the moment reopen the file every time
-        """
-        
-        filename = self.OP_TO_FILENAME.get(op_type, None)
-        
-        if not filename:
-            raise Exception("Bad Operation (%s) in save_last_id. This should not happen, send the error to the software developers." % (op_type))
-        
-        #filepath = '%s/%s_%s' % (gmvault_utils.get_home_dir_path(), self.login, filename)  
-        filepath = '%s/%s_%s' % (self.gstorer.get_info_dir(), self.login, filename)  
-        
-        the_fd = open(filepath, 'w')
-        
-        json.dump({
-                    'last_id' : gm_id  
-                  }, the_fd)
-        
-        the_fd.close()
-        
     def get_gmails_ids_left_to_restore(self, op_type, db_gmail_ids_info):
         """
            Get the ids that still needs to be restored
            Return a dict key = gm_id, val = directory
         """
+        journal = self._get_journal(op_type)
+        
+        if journal.exists():
+            done_ids = journal.load()
+            
+            LOG.critical("Resume from journal %s: %d ids already restored." % (journal.path, len(done_ids)))
+            
+            new_gmail_ids_info = collections_utils.OrderedDict()
+            for key in db_gmail_ids_info:
+                if key not in done_ids:
+                    new_gmail_ids_info[key] = db_gmail_ids_info[key]
+            
+            return new_gmail_ids_info
+        
+        # no journal: operation interrupted by a previous version of gmvault. Use its last_id file
         filename = self.OP_TO_FILENAME.get(op_type, None)
         
         if not filename:
@@ -1380,9 +2536,10 @@ class GMVaulter(object):
             
         return new_gmail_ids_info 
            
-    def restore(self, pivot_dir = None, extra_labels = [], restart = False, emails_only = False, chats_only = False): #pylint:disable=W0102
+    def restore(self, pivot_dir = None, extra_labels = [], restart = False, emails_only = False, chats_only = False, nb_connections = 1): #pylint:disable=W0102
         """
            Restore emails in a gmail account
+           nb_connections: number of connections to Gmail used in parallel to push the emails
         """
         self.timer.start() #start restoring
         
@@ -1393,23 +2550,309 @@ class GMVaulter(object):
             if pivot_dir:
                 LOG.critical("Quick mode activated. Will only restore all emails since %s.\n" % (pivot_dir))
             
-            self.restore_emails(pivot_dir, extra_labels, restart)
+            self.restore_emails(pivot_dir, extra_labels, restart, nb_connections)
         else:
             LOG.critical("Skip emails restoration.\n")
         
         if not emails_only:
             # backup chats
             LOG.critical("Start chats restoration.\n")
-            self.restore_chats(extra_labels, restart)
+            self.restore_chats(extra_labels, restart, nb_connections)
         else:
             LOG.critical("Skip chats restoration.\n")
         
+        self.gstorer.flush()
+        
         LOG.critical("Restore operation performed in %s.\n" \
                      % (self.timer.seconds_to_human_time(self.timer.elapsed())))
-       
-    def common_restore(self, the_type, db_gmail_ids_info, extra_labels = [], restart = False): #pylint:disable=W0102
+    
+    def _get_labels_cache_path(self, gstorer, op_type):
+        """
+           Return the path of the labels cache of a restore operation
+        """
+        return '%s/%s_%s' % (gstorer.get_info_dir(), self.login, self.OP_TO_LABELS_CACHE[op_type])
+    
+    def _save_labels_cache(self, gstorer, op_type):
+        """
+           Save the existing labels in the labels cache of the restore operation
+        """
+        with self._labels_lock:
+            folders = sorted(self._existing_labels)
+        
+        the_fd = open(self._get_labels_cache_path(gstorer, op_type), 'w')
+        try:
+            json.dump(folders, the_fd, ensure_ascii = False)
+        finally:
+            the_fd.close()
+    
+    def _prepare_labels(self, gstorer, op_type, db_gmail_ids_info, extra_labels, restart):
         """
-           common_restore 
+           Label pre-pass of a restore: read the labels of all the emails to restore and create the missing ones
+           with a single listing of the Gmail folders (instead of one listing per email with a new label).
+           The existing labels are cached in .info and reused when the restore is resumed.
+        """
+        cache_path = self._get_labels_cache_path(gstorer, op_type)
+        
+        if restart and os.path.exists(cache_path):
+            try:
+                the_fd = open(cache_path)
+                try:
+                    folders = json.load(the_fd)
+                finally:
+                    the_fd.close()
+                
+                with self._labels_lock:
+                    self._existing_labels = self._existing_labels.union(folders)
+                
+                LOG.critical("Use the %d labels created by the interrupted restore (%s)." % (len(folders), cache_path))
+                return
+            except (IOError, ValueError), error:
+                LOG.critical("Cannot read the labels cache %s (%s). Look for the labels again." % (cache_path, error))
+        
+        # ids of each dir (relative to the db dir) to read their metadata by dir
+        dirs = {}
+        for gm_id, the_dir in db_gmail_ids_info.iteritems():
+            if op_type == self.OP_CHAT_RESTORE:
+                the_dir = '%s/%s' % (gstorer.CHATS_AREA, the_dir)
+            dirs.setdefault(the_dir, []).append(gm_id)
+        
+        labels = set(extra_labels)
+        for the_dir, ids in dirs.iteritems():
+            for _, email_labels, _ in gstorer.read_metadata_records(the_dir, ids).itervalues():
+                labels.update(email_labels)
+        
+        LOG.critical("%d distinct labels in the emails to restore. Create the missing ones." % (len(labels)))
+        
+        self._create_labels(self.src, sorted(labels))
+        
+        self._save_labels_cache(gstorer, op_type)
+    
+    def _create_labels(self, src, labels):
+        """
+           Create on Gmail the labels that do not exist yet.
+           The existing labels are shared by all the connections and created only once.
+        """
+        with self._labels_lock:
+            # the existing labels are lower case dirs (Gmail labels are case insensitive)
+            labels_to_create = imap_utils.GIMAPFetcher.get_missing_labels(labels, self._existing_labels)
+            
+            #create the non existing labels
+            if len(labels_to_create) > 0:
+                LOG.debug("Labels creation tentative for %s." % (labels_to_create))
+                self._existing_labels = src.create_gmail_labels(labels_to_create, self._existing_labels)
+    
+    def _push_email(self, src, gstorer, msg, gm_id, a_dir, email_meta, email_data, labels): #pylint:disable=R0913
+        """
+           Push an email with src. 
+           The email is quarantined if Gmail cannot restore it otherwise the error is rethrown.
+           An email pushed without its labels is reported (it is in Gmail so it is not quarantined)
+        """
+        try:
+            #restore email
+            _, labelled = src.push_email(email_data, \
+                                         email_meta[gstorer.FLAGS_K] , \
+                                         email_meta[gstorer.INT_DATE_K], \
+                                         labels)
+            
+            if not labelled:
+                self._report_unlabelled(msg, gm_id, a_dir, labels)
+            
+            LOG.debug("Pushed %s with id %s." % (msg, gm_id))
+                
+        except imaplib.IMAP4.abort, abort:
+            
+            # if this is a Gmvault SSL Socket error quarantine the email and continue the restore
+            if str(abort).find("=> Gmvault ssl socket error: EOF") >= 0:
+                LOG.critical("Quarantine %s with gm id %s from %s. GMAIL IMAP cannot restore it:"\
+                             " err={%s}" % (msg, gm_id, a_dir, str(abort)))
+                gstorer.quarantine_email(gm_id)
+                self.error_report['emails_in_quarantine'].append(gm_id)
+                LOG.critical("Disconnecting and reconnecting to restart cleanly.")
+                src.reconnect() #reconnect
+            else:
+                raise abort
+    
+        except imaplib.IMAP4.error, err:
+            
+            LOG.error("Catched IMAP Error %s" % (str(err)))
+            LOG.exception(err)
+            
+            #When the email cannot be read from Database because it was empty when returned by gmail imap
+            #quarantine it.
+            if str(err) == "APPEND command error: BAD ['Invalid Arguments: Unable to parse message']":
+                LOG.critical("Quarantine %s with gm id %s from %s. GMAIL IMAP cannot restore it:"\
+                             " err={%s}" % (msg, gm_id, a_dir, str(err)))
+                gstorer.quarantine_email(gm_id)
+                self.error_report['emails_in_quarantine'].append(gm_id) 
+            else:
+                raise err
+        except imap_utils.PushEmailError, p_err:
+            LOG.error("Catch the following exception %s" % (str(p_err)))
+            LOG.exception(p_err)
+            
+            if p_err.quarantined():
+                LOG.critical("Quarantine %s with gm id %s from %s. GMAIL IMAP cannot restore it:"\
+                             " err={%s}" % (msg, gm_id, a_dir, str(p_err)))
+                gstorer.quarantine_email(gm_id)
+                self.error_report['emails_in_quarantine'].append(gm_id) 
+            else:
+                raise p_err          
+        except Exception, err:
+            LOG.error("Catch the following exception %s" % (str(err)))
+            LOG.exception(err)
+            raise err
+    
+    def _push_emails(self, src, gstorer, msg, batch):
+        """
+           Push a batch of emails from the restore queue with src in a few commands (see GIMAPFetcher.push_emails).
+           Return the number of emails of the batch pushed: the next ones have to be pushed one by one.
+           The emails pushed without their labels are reported (they are in Gmail so they are not quarantined)
+        """
+        uids, unlabelled = src.push_emails([ (email_data, email_meta[gstorer.FLAGS_K], email_meta[gstorer.INT_DATE_K], labels) \
+                                             for _, _, _, email_meta, email_data, labels in batch ])
+        
+        for index in unlabelled:
+            _, gm_id, a_dir, _, _, labels = batch[index]
+            self._report_unlabelled(msg, gm_id, a_dir, labels)
+        
+        return len(uids)
+    
+    def _report_unlabelled(self, msg, gm_id, a_dir, labels):
+        """
+           Report an email restored without its labels
+        """
+        LOG.critical("Restored %s with gm id %s from %s without its labels %s." % (msg, gm_id, a_dir, sorted(labels)))
+        self.error_report['pushed_without_labels'].append(gm_id)
+    
+    @classmethod
+    def _put_until_stopped(cls, a_queue, item, stop_event):
+        """
+           Put item in the bounded a_queue unless stop_event is set while waiting.
+           Return True if the item has been put
+        """
+        while not stop_event.is_set():
+            try:
+                a_queue.put(item, True, 1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+    
+    def _restore_reader(self, gstorer, db_gmail_ids_info, extra_labels, work_queue, result_queue, stop_event, nb_pushers): #pylint:disable=R0913
+        """
+           Reader stage of the restore: unbury (and decrypt) the emails ahead of the pushers with an EmailPrefetcher
+           and feed them in work_queue. Post (None, gm_id, error) in result_queue if an email cannot be read.
+        """
+        prefetcher = EmailPrefetcher(gstorer, db_gmail_ids_info.keys(), \
+                                     gmvault_utils.get_conf_defaults().getint("Restore", "reader_threads", 4), \
+                                     gmvault_utils.get_conf_defaults().getint("Restore", "prefetch_emails", 16))
+        try:
+            for index, (gm_id, email_meta, email_data) in enumerate(prefetcher):
+                
+                #labels for this email => real_labels U extra_labels
+                labels = set(email_meta[gstorer.LABELS_K])
+                labels = labels.union(extra_labels)
+                
+                if not self._put_until_stopped(work_queue, (index, gm_id, db_gmail_ids_info[gm_id], email_meta, email_data, labels), stop_event):
+                    return
+        except Exception, err: #pylint:disable-msg=W0703
+            LOG.critical("Cannot read email with id %s from the Gmvault db." % (prefetcher.current_id))
+            LOG.critical(gmvault_utils.get_exception_traceback())
+            result_queue.put((None, prefetcher.current_id, err))
+        finally:
+            prefetcher.close()
+            # one end marker per pusher
+            for _ in xrange(nb_pushers):
+                self._put_until_stopped(work_queue, None, stop_event)
+    
+    def _restore_pusher(self, src, gstorer, msg, work_queue, result_queue, stop_event, worker = 0): #pylint:disable=R0913
+        """
+           Pusher stage of the restore: push the emails taken from work_queue with its own connection src
+           (pusher number worker, waiting while the rate controller does not let it send commands).
+           The small emails waiting in work_queue are pushed by batches (Restore push_batch_size and push_batch_bytes).
+           A batch throttled by Gmail is pushed again once the rate controller lets the pusher send commands.
+           Post (index, gm_id, error) in result_queue for each email and (None, None, None) when it stops.
+        """
+        batch_size  = gmvault_utils.get_conf_defaults().getint("Restore", "push_batch_size", 10)
+        batch_bytes = gmvault_utils.get_conf_defaults().getint("Restore", "push_batch_bytes", 1048576)
+        
+        pending = [] # items taken from work_queue and not pushed yet (in their order)
+        try:
+            while not stop_event.is_set():
+                self.rate_controller.wait(worker)
+                
+                if pending:
+                    item = pending.pop(0)
+                else:
+                    try:
+                        item = work_queue.get(True, 1)
+                    except Queue.Empty:
+                        continue
+                
+                if item is None:
+                    break
+                
+                # small emails already waiting are pushed together
+                max_nb, max_bytes = self.rate_controller.get_batch_size(batch_size), self.rate_controller.get_batch_size(batch_bytes)
+                
+                batch, nb_bytes = [item], len(item[4])
+                while len(batch) < max_nb and nb_bytes < max_bytes:
+                    if pending:
+                        item = pending.pop(0)
+                    else:
+                        try:
+                            item = work_queue.get_nowait()
+                        except Queue.Empty:
+                            break
+                    
+                    if item is None or nb_bytes + len(item[4]) > max_bytes:
+                        pending.insert(0, item)
+                        break
+                    
+                    batch.append(item)
+                    nb_bytes += len(item[4])
+                
+                nb_done = 0
+                try:
+                    self._create_labels(src, set().union(*[ labels for _, _, _, _, _, labels in batch ]))
+                    
+                    if len(batch) > 1:
+                        LOG.critical("Restore %d %s with ids %s." % (len(batch), msg, [ gm_id for _, gm_id, _, _, _, _ in batch ]))
+                        try:
+                            nb_pushed = self._push_emails(src, gstorer, msg, batch)
+                        except imaplib.IMAP4.error, err:
+                            if not rate_utils.get_throttle_code(err):
+                                raise err
+                            # nothing has been pushed: wait for the end of the pause and push it again (in smaller batches)
+                            LOG.critical("Gmail throttles the restore (%s). Restore these %d %s again later." % (err, len(batch), msg))
+                            pending[:0] = batch
+                            continue
+                        
+                        for index, gm_id, _, _, _, _ in batch[:nb_pushed]:
+                            result_queue.put((index, gm_id, None))
+                            nb_done += 1
+                    
+                    # push the emails that could not be pushed with the batch one by one
+                    for index, gm_id, a_dir, email_meta, email_data, labels in batch[nb_done:]:
+                        LOG.critical("Restore %s with id %s." % (msg, gm_id))
+                        
+                        self._push_email(src, gstorer, msg, gm_id, a_dir, email_meta, email_data, labels)
+                        
+                        result_queue.put((index, gm_id, None))
+                        nb_done += 1
+                except Exception, err: #pylint:disable-msg=W0703
+                    result_queue.put((batch[nb_done][0], batch[nb_done][1], err))
+                    break
+        finally:
+            self.rate_controller.worker_done(worker)
+            result_queue.put((None, None, None))
+    
+    def common_restore(self, the_type, gstorer, db_gmail_ids_info, extra_labels = [], restart = False, nb_connections = 1): #pylint:disable=W0102,R0913
+        """
+           Restore emails or chats.
+           A reader thread unburies the emails ahead of time (with a pool of threads) in a bounded queue drained by nb_connections
+           pusher threads, each one with its own connection to Gmail.
+           Each restored email is recorded in the restore journal to be skipped when resuming.
         """
         if the_type == "chats":
             msg = "chats"
@@ -1418,10 +2861,6 @@ class GMVaulter(object):
             msg = "emails"
             op  = self.OP_EMAIL_RESTORE
         
-        LOG.critical("Restore %s in gmail account %s." % (msg, self.login) ) 
-        
-        LOG.critical("Read %s info from %s gmvault-db." % (msg, self.db_root_dir))
-        
         LOG.critical("Total number of %s to restore %s." % (msg, len(db_gmail_ids_info.keys())))
         
         if restart:
@@ -1430,109 +2869,114 @@ class GMVaulter(object):
         total_nb_emails_to_restore = len(db_gmail_ids_info)
         LOG.critical("Got all %s id left to restore. Still %s %s to do.\n" % (msg, total_nb_emails_to_restore, msg) )
         
-        existing_labels = set() #set of existing labels to not call create_gmail_labels all the time
+        # a new restore forgets the emails restored by the previous one
+        journal = self._get_journal(op)
+        journal.open(a_truncate = not restart)
+        
+        if total_nb_emails_to_restore == 0:
+            journal.close()
+            return self.error_report
+        
+        try:
+            self._prepare_labels(gstorer, op, db_gmail_ids_info, extra_labels, restart)
+        except:
+            journal.close()
+            raise
+        
+        # the first pusher uses the current connection
+        srcs = [self.src]
+        for _ in xrange(min(nb_connections, total_nb_emails_to_restore) - 1):
+            try:
+                srcs.append(self._create_fetcher())
+            except Exception, err: #pylint:disable-msg=W0703
+                LOG.critical("Cannot open a new connection to Gmail (%s). Continue with %d connections." % (err, len(srcs)))
+                LOG.debug(gmvault_utils.get_exception_traceback())
+                break
+        
+        if len(srcs) > 1:
+            LOG.critical("Restore %s with %d connections to Gmail." % (msg, len(srcs)))
+        
+        queue_size   = max(len(srcs), gmvault_utils.get_conf_defaults().getint("Restore", "reader_queue_size", 20))
+        work_queue   = Queue.Queue(queue_size)
+        result_queue = Queue.Queue()
+        stop_event   = threading.Event()
+        
+        self.rate_controller.set_workers(len(srcs))
+        
+        threads = [ threading.Thread(target = self._restore_reader, \
+                                     args = (gstorer, db_gmail_ids_info, extra_labels, work_queue, result_queue, stop_event, len(srcs))) ]
+        for worker, src in enumerate(srcs):
+            threads.append(threading.Thread(target = self._restore_pusher, \
+                                            args = (src, gstorer, msg, work_queue, result_queue, stop_event, worker)))
+        
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        
+        nb_running         = len(srcs)
         nb_emails_restored = 0 #to count nb of emails restored
+        error              = None
+        
         timer = gmvault_utils.Timer() # needed for enhancing the user information
         timer.start()
         
-        for gm_id in db_gmail_ids_info:
-            
-            LOG.critical("Restore %s with id %s." % (msg, gm_id))
-            
-            email_meta, email_data = self.unbury_email(gm_id)
-            
-            LOG.debug("Unburied %s with id %s." % (msg, gm_id))
-            
-            #labels for this email => real_labels U extra_labels
-            labels = set(email_meta[self.gstorer.LABELS_K])
-            labels = labels.union(extra_labels)
-            
-            # get list of labels to create 
-            labels_to_create = [ label for label in labels if label not in existing_labels]
-            
-            #create the non existing labels
-            if len(labels_to_create) > 0:
-                LOG.debug("Labels creation tentative for %s with id %s." % (msg, gm_id))
-                existing_labels = self.src.create_gmail_labels(labels_to_create, existing_labels)
-            
-            try:
-                #restore email
-                self.src.push_email(email_data, \
-                                    email_meta[self.gstorer.FLAGS_K] , \
-                                    email_meta[self.gstorer.INT_DATE_K], \
-                                    labels)
+        try:
+            while nb_running > 0:
+                try:
+                    index, gm_id, err = result_queue.get(True, 1) # use a timeout to not block CTRL^C
+                except Queue.Empty:
+                    continue
                 
-                LOG.debug("Pushed %s with id %s." % (msg, gm_id))
+                if err:
+                    # stop everything and wait for the pushers to finish their current email
+                    error = error or err
+                    stop_event.set()
+                    continue
+                elif index is None:
+                    # a pusher has stopped
+                    nb_running -= 1
+                    continue
                 
                 nb_emails_restored += 1
                 
-                #indicate every 10 messages the number of messages left to process
+                # restored or quarantined: skip it when resuming
+                journal.record(gm_id)
+                
+                #indicate every 50 messages the number of messages left to process
                 left_emails = (total_nb_emails_to_restore - nb_emails_restored)
                 
                 if (nb_emails_restored % 50) == 0 and (left_emails > 0): 
                     elapsed = timer.elapsed() #elapsed time in seconds
-                    LOG.critical("\n== Processed %d %s in %s. %d left to be restored (time estimate %s).==\n" % \
+                    LOG.critical("\n== Processed %d %s in %s. %d left to be restored (time estimate %s).==\n" \
+                                 "== Gmail rate: %s.==\n" % \
                                  (nb_emails_restored, msg, timer.seconds_to_human_time(elapsed), \
-                                  left_emails, timer.estimate_time_left(nb_emails_restored, elapsed, left_emails)))
-                
-                # save id every 20 restored emails
-                if (nb_emails_restored % 10) == 0:
-                    self.save_lastid(self.OP_CHAT_RESTORE, gm_id)
-                    
-            except imaplib.IMAP4.abort, abort:
-                
-                # if this is a Gmvault SSL Socket error quarantine the email and continue the restore
-                if str(abort).find("=> Gmvault ssl socket error: EOF") >= 0:
-                    LOG.critical("Quarantine %s with gm id %s from %s. "\
-                                 "GMAIL IMAP cannot restore it: err={%s}" % (msg, gm_id, db_gmail_ids_info[gm_id], str(abort)))
-                    self.gstorer.quarantine_email(gm_id)
-                    self.error_report['emails_in_quarantine'].append(gm_id)
-                    LOG.critical("Disconnecting and reconnecting to restart cleanly.")
-                    self.src.reconnect() #reconnect
-                else:
-                    raise abort
+                                  left_emails, timer.estimate_time_left(nb_emails_restored, elapsed, left_emails), \
+                                  self.rate_controller.get_status()))
+        finally:
+            stop_event.set()
+            journal.close()
+            # keep the labels created by the pushers for a resumed restore
+            self._save_labels_cache(gstorer, op)
+            for src in srcs[1:]:
+                self.error_report['reconnections'] += src.total_nb_reconns
+                try:
+                    src.disconnect()
+                except Exception, err: #pylint:disable-msg=W0703
+                    LOG.debug("Error when disconnecting: %s" % (err))
         
-            except imaplib.IMAP4.error, err:
-                
-                LOG.error("Catched IMAP Error %s" % (str(err)))
-                LOG.exception(err)
-                
-                #When the email cannot be read from Database because it was empty when returned by gmail imap
-                #quarantine it.
-                if str(err) == "APPEND command error: BAD ['Invalid Arguments: Unable to parse message']":
-                    LOG.critical("Quarantine %s with gm id %s from %s. GMAIL IMAP cannot restore it:"\
-                                 " err={%s}" % (msg, gm_id, db_gmail_ids_info[gm_id], str(err)))
-                    self.gstorer.quarantine_email(gm_id)
-                    self.error_report['emails_in_quarantine'].append(gm_id) 
-                else:
-                    raise err
-            except imap_utils.PushEmailError, p_err:
-                LOG.error("Catch the following exception %s" % (str(p_err)))
-                LOG.exception(p_err)
-                
-                if p_err.quarantined():
-                    LOG.critical("Quarantine %s with gm id %s from %s. GMAIL IMAP cannot restore it:"\
-                                 " err={%s}" % (msg, gm_id, db_gmail_ids_info[gm_id], str(p_err)))
-                    self.gstorer.quarantine_email(gm_id)
-                    self.error_report['emails_in_quarantine'].append(gm_id) 
-                else:
-                    raise p_err          
-            except Exception, err:
-                LOG.error("Catch the following exception %s" % (str(err)))
-                LOG.exception(err)
-                raise err
-            
+        if error:
+            raise error
             
-        return self.error_report 
+        return self.error_report
         
-    def restore_chats(self, extra_labels = [], restart = False): #pylint:disable=W0102
+    def restore_chats(self, extra_labels = [], restart = False, nb_connections = 1): #pylint:disable=W0102
         """
            restore chats
         """
         LOG.critical("Restore chats in gmail account %s." % (self.login) ) 
                 
         #crack email database
-        gstorer = GmailStorer(self.db_root_dir, self.use_encryption)
+        gstorer = get_storer(self.db_root_dir, self.use_encryption)
         
         LOG.critical("Read chats info from %s gmvault-db." % (self.db_root_dir))
         
@@ -1541,229 +2985,20 @@ class GMVaulter(object):
         #get gmail_ids from db
         db_gmail_ids_info = gstorer.get_all_chats_gmail_ids()
         
-        LOG.critical("Total number of chats to restore %s." % (len(db_gmail_ids_info.keys())))
-        
-        if restart:
-            db_gmail_ids_info = self.get_gmails_ids_left_to_restore(self.OP_CHAT_RESTORE, db_gmail_ids_info)
-        
-        total_nb_emails_to_restore = len(db_gmail_ids_info)
-        LOG.critical("Got all chats id left to restore. Still %s chats to do.\n" % (total_nb_emails_to_restore) )
-        
-        existing_labels = set() #set of existing labels to not call create_gmail_labels all the time
-        nb_emails_restored = 0 #to count nb of emails restored
-        timer = gmvault_utils.Timer() # needed for enhancing the user information
-        timer.start()
-        
-        for gm_id in db_gmail_ids_info:
-            
-            LOG.critical("Restore chat with id %s." % (gm_id))
-            
-            email_meta, email_data = gstorer.unbury_email(gm_id)
-            
-            LOG.debug("Unburied chat with id %s." % (gm_id))
-            
-            #labels for this email => real_labels U extra_labels
-            labels = set(email_meta[gstorer.LABELS_K])
-            labels = labels.union(extra_labels)
-            
-            # get list of labels to create 
-            labels_to_create = [ label for label in labels if label not in existing_labels]
-            
-            #create the non existing labels
-            if len(labels_to_create) > 0:
-                LOG.debug("Labels creation tentative for chat with id %s." % (gm_id))
-                existing_labels = self.src.create_gmail_labels(labels_to_create, existing_labels)
-            
-            try:
-                #restore email
-                self.src.push_email(email_data, \
-                                    email_meta[gstorer.FLAGS_K] , \
-                                    email_meta[gstorer.INT_DATE_K], \
-                                    labels)
-                
-                LOG.debug("Pushed chat with id %s." % (gm_id))
-                
-                nb_emails_restored += 1
-                
-                #indicate every 10 messages the number of messages left to process
-                left_emails = (total_nb_emails_to_restore - nb_emails_restored)
-                
-                if (nb_emails_restored % 50) == 0 and (left_emails > 0): 
-                    elapsed = timer.elapsed() #elapsed time in seconds
-                    LOG.critical("\n== Processed %d chats in %s. %d left to be restored (time estimate %s).==\n" % \
-                                 (nb_emails_restored, timer.seconds_to_human_time(elapsed), \
-                                  left_emails, timer.estimate_time_left(nb_emails_restored, elapsed, left_emails)))
-                
-                # save id every 20 restored emails
-                if (nb_emails_restored % 10) == 0:
-                    self.save_lastid(self.OP_CHAT_RESTORE, gm_id)
-                    
-            except imaplib.IMAP4.abort, abort:
-                
-                # if this is a Gmvault SSL Socket error quarantine the email and continue the restore
-                if str(abort).find("=> Gmvault ssl socket error: EOF") >= 0:
-                    LOG.critical("Quarantine email with gm id %s from %s. "\
-                                 "GMAIL IMAP cannot restore it: err={%s}" % (gm_id, db_gmail_ids_info[gm_id], str(abort)))
-                    gstorer.quarantine_email(gm_id)
-                    self.error_report['emails_in_quarantine'].append(gm_id)
-                    LOG.critical("Disconnecting and reconnecting to restart cleanly.")
-                    self.src.reconnect() #reconnect
-                else:
-                    raise abort
-        
-            except imaplib.IMAP4.error, err:
-                
-                LOG.error("Catched IMAP Error %s" % (str(err)))
-                LOG.exception(err)
-                
-                #When the email cannot be read from Database because it was empty when returned by gmail imap
-                #quarantine it.
-                if str(err) == "APPEND command error: BAD ['Invalid Arguments: Unable to parse message']":
-                    LOG.critical("Quarantine email with gm id %s from %s. GMAIL IMAP cannot restore it:"\
-                                 " err={%s}" % (gm_id, db_gmail_ids_info[gm_id], str(err)))
-                    gstorer.quarantine_email(gm_id)
-                    self.error_report['emails_in_quarantine'].append(gm_id) 
-                else:
-                    raise err
-            except imap_utils.PushEmailError, p_err:
-                LOG.error("Catch the following exception %s" % (str(p_err)))
-                LOG.exception(p_err)
-                
-                if p_err.quarantined():
-                    LOG.critical("Quarantine email with gm id %s from %s. GMAIL IMAP cannot restore it:"\
-                                 " err={%s}" % (gm_id, db_gmail_ids_info[gm_id], str(p_err)))
-                    gstorer.quarantine_email(gm_id)
-                    self.error_report['emails_in_quarantine'].append(gm_id) 
-                else:
-                    raise p_err          
-            except Exception, err:
-                LOG.error("Catch the following exception %s" % (str(err)))
-                LOG.exception(err)
-                raise err
-            
-            
-        return self.error_report
-        
+        return self.common_restore("chats", gstorer, db_gmail_ids_info, extra_labels, restart, nb_connections)
         
-    def restore_emails(self, pivot_dir = None, extra_labels = [], restart = False):
+    def restore_emails(self, pivot_dir = None, extra_labels = [], restart = False, nb_connections = 1): #pylint:disable=W0102
         """
            restore emails in a gmail account
         """
         LOG.critical("Restore emails in gmail account %s." % (self.login) ) 
         
         #crack email database
-        gstorer = GmailStorer(self.db_root_dir, self.use_encryption)
+        gstorer = get_storer(self.db_root_dir, self.use_encryption)
         
         LOG.critical("Read email info from %s gmvault-db." % (self.db_root_dir))
         
         #get gmail_ids from db
         db_gmail_ids_info = gstorer.get_all_existing_gmail_ids(pivot_dir)
         
-        LOG.critical("Total number of elements to restore %s." % (len(db_gmail_ids_info.keys())))
-        
-        if restart:
-            db_gmail_ids_info = self.get_gmails_ids_left_to_restore(self.OP_EMAIL_RESTORE, db_gmail_ids_info)
-        
-        total_nb_emails_to_restore = len(db_gmail_ids_info)
-        LOG.critical("Got all emails id left to restore. Still %s emails to do.\n" % (total_nb_emails_to_restore) )
-        
-        existing_labels = set() #set of existing labels to not call create_gmail_labels all the time
-        nb_emails_restored = 0 #to count nb of emails restored
-        
-        timer = gmvault_utils.Timer() # local timer for restore emails
-        timer.start()
-        
-        for gm_id in db_gmail_ids_info:
-            
-            LOG.critical("Restore email with id %s." % (gm_id))
-            
-            email_meta, email_data = gstorer.unbury_email(gm_id)
-            
-            LOG.debug("Unburied email with id %s." % (gm_id))
-            
-            #labels for this email => real_labels U extra_labels
-            labels = set(email_meta[gstorer.LABELS_K])
-            labels = labels.union(extra_labels)
-            
-            # get list of labels to create 
-            labels_to_create = [ label for label in labels if label not in existing_labels]
-            
-            #create the non existing labels
-            if len(labels_to_create) > 0:
-                LOG.debug("Labels creation tentative for email with id %s." % (gm_id))
-                existing_labels = self.src.create_gmail_labels(labels_to_create, existing_labels)
-            
-            try:
-                #restore email
-                self.src.push_email(email_data, \
-                                    email_meta[gstorer.FLAGS_K] , \
-                                    email_meta[gstorer.INT_DATE_K], \
-                                    labels)
-                
-                LOG.debug("Pushed email with id %s." % (gm_id))
-                
-                nb_emails_restored += 1
-                
-                #indicate every 10 messages the number of messages left to process
-                left_emails = (total_nb_emails_to_restore - nb_emails_restored)
-                
-                if (nb_emails_restored % 50) == 0 and (left_emails > 0): 
-                    elapsed = timer.elapsed() #elapsed time in seconds
-                    LOG.critical("\n== Processed %d emails in %s. %d left to be restored "\
-                                 "(time estimate %s).==\n" % \
-                                 (nb_emails_restored, timer.seconds_to_human_time(elapsed), \
-                                  left_emails, timer.estimate_time_left(nb_emails_restored, elapsed, left_emails)))
-                
-                # save id every 20 restored emails
-                if (nb_emails_restored % 10) == 0:
-                    self.save_lastid(self.OP_EMAIL_RESTORE, gm_id)
-                    
-            except imaplib.IMAP4.abort, abort:
-                
-                # if this is a Gmvault SSL Socket error quarantine the email and continue the restore
-                if str(abort).find("=> Gmvault ssl socket error: EOF") >= 0:
-                    LOG.critical("Quarantine email with gm id %s from %s. GMAIL IMAP cannot restore it:"\
-                                 " err={%s}" % (gm_id, db_gmail_ids_info[gm_id], str(abort)))
-                    gstorer.quarantine_email(gm_id)
-                    self.error_report['emails_in_quarantine'].append(gm_id)
-                    LOG.critical("Disconnecting and reconnecting to restart cleanly.")
-                    self.src.reconnect() #reconnect
-                else:
-                    raise abort
-        
-            except imaplib.IMAP4.error, err:
-                
-                LOG.error("Catched IMAP Error %s" % (str(err)))
-                LOG.exception(err)
-                
-                #When the email cannot be read from Database because it was empty when returned by gmail imap
-                #quarantine it.
-                if str(err) == "APPEND command error: BAD ['Invalid Arguments: Unable to parse message']":
-                    LOG.critical("Quarantine email with gm id %s from %s. GMAIL IMAP cannot restore it:"\
-                                 " err={%s}" % (gm_id, db_gmail_ids_info[gm_id], str(err)))
-                    gstorer.quarantine_email(gm_id)
-                    self.error_report['emails_in_quarantine'].append(gm_id) 
-                else:
-                    raise err
-            except imap_utils.PushEmailError, p_err:
-                LOG.error("Catch the following exception %s" % (str(p_err)))
-                LOG.exception(p_err)
-                
-                if p_err.quarantined():
-                    LOG.critical("Quarantine email with gm id %s from %s. GMAIL IMAP cannot restore it:"\
-                                 " err={%s}" % (gm_id, db_gmail_ids_info[gm_id], str(p_err)))
-                    gstorer.quarantine_email(gm_id)
-                    self.error_report['emails_in_quarantine'].append(gm_id) 
-                else:
-                    raise p_err          
-            except Exception, err:
-                LOG.error("Catch the following exception %s" % (str(err)))
-                LOG.exception(err)
-                raise err
-            
-            
-        return self.error_report
-            
-            
-        
-    
+        return self.common_restore("emails", gstorer, db_gmail_ids_info, extra_labels, restart, nb_connections)
@@ -17,6 +17,7 @@
 '''
 
 import os
+import errno
 
 import re
 import datetime
@@ -368,8 +369,42 @@ def makedirs(aPath):
         return
     elif os.path.isfile(aPath):
         raise OSError("a file with the same name as the desired dir, '%s', already exists."%(aPath))
+    
+    try:
+        os.makedirs(aPath)
+    except OSError, err:
+        # the dir might have been created in the meantime by another thread
+        if err.errno != errno.EEXIST or not os.path.isdir(aPath):
+            raise
 
-    os.makedirs(aPath)
+def fsync_paths(a_paths):
+    """
+       Fsync the files then the directories containing them so their data and their creation survive a crash.
+       The files deleted in the meantime are ignored. The directories cannot be fsynced on windows
+    """
+    dirs = set()
+    for path in a_paths:
+        try:
+            the_fd = os.open(path, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+        except OSError, err:
+            if err.errno == errno.ENOENT:
+                continue
+            raise
+        try:
+            os.fsync(the_fd)
+        finally:
+            os.close(the_fd)
+        dirs.add(os.path.dirname(path))
+    
+    if os.name == 'nt':
+        return
+    
+    for the_dir in dirs:
+        the_fd = os.open(the_dir, os.O_RDONLY)
+        try:
+            os.fsync(the_fd)
+        finally:
+            os.close(the_fd)
 
 def __rmgeneric(path, __func__):
     """ private function that is part of delete_all_under """
@@ -427,6 +462,14 @@ def ordered_dirwalk(a_dir, a_file_wildcards= '*', a_dir_ignore_list = [], sort_f
         else:
             LOG.debug("Ignore subdir %s" % (sub_dir))
   
+def chunker(a_seq, a_size):
+    """
+       Iterate over a sequence by slices of a_size elements.
+       The last slice can be smaller
+    """
+    for pos in xrange(0, len(a_seq), a_size):
+        yield a_seq[pos:pos + a_size]
+
 def dirwalk(a_dir, a_wildcards= '*'):
     """
        return all files and dirs in a directory
@@ -483,15 +526,74 @@ DEFAULT_CONF_FILE = """#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 [Sync]
 quick_days=10
+# number of emails for which the metadata is requested in one IMAP FETCH
+metadata_batch_size=500
+# max number of emails and max number of bytes for which the data is requested in one IMAP FETCH
+body_batch_size=50
+body_batch_bytes=10485760
+# number of threads reading the stored metadata of the months touched by a sync
+metadata_reader_threads=4
+# only look at the emails changed since the last complete sync when the server supports CONDSTORE
+use_modseq=True
+# emails bigger than that (in bytes) are streamed from the socket to their data file instead of being read in memory (0 to disable)
+stream_body_bytes=4194304
+# number of threads compressing, encrypting and writing the synced emails (0 to write them in the syncing threads)
+writer_threads=2
+# max number of synced emails waiting to be written
+writer_queue_size=50
+# number of processes compressing and encrypting the emails of the big syncs (0 for one per core)
+transform_processes=0
+# min number of emails to fetch to use these processes (0 to never use them)
+transform_min_emails=1000
+# max number of bytes of email data waiting in these processes
+transform_inflight_bytes=67108864
 
 [Restore]
 # it is 10 days but currently it will always be the current month or the last 2 months
 # the notion of days is not yet apparent in restore (only months).
 quick_days=10
+# max number of emails read from the db ahead of the connections pushing them
+reader_queue_size=20
+# number of threads reading, decompressing and decrypting the emails to restore
+reader_threads=4
+# max number of emails read ahead by these threads
+prefetch_emails=16
+# max number of small emails pushed together by a connection (one MULTIAPPEND if supported and one STORE per set of labels). 1 to push them one by one
+push_batch_size=10
+# max number of bytes of the emails pushed together. Bigger emails are pushed alone
+push_batch_bytes=1048576
 
 [General]
 limit_per_chat_dir=2000
 errors_if_chat_not_visible=False
+# number of updates of the gmail id index (.info/gmvault_index.sqlite) committed at once
+index_commit_every=500
+# number of completed ids written in the resume journals (.info/*.journal) between two fsyncs. The emails written
+# by a sync are fsynced before the journal recording them
+journal_fsync_every=100
+# codec of the stored emails: gzip, bz2, xz (needs the lzma module) or none. Run gmvault compression to compare them on your db
+compression=gzip
+# compression level (gzip and bz2: 1-9, xz: 0-9). -1 for the default level of the codec (gzip: 6, bz2: 9, xz: 6)
+compression_level=-1
+# storage of a new gmvault-db: files (one .meta and one .eml file per email) or segments (a few append-only files per month)
+storage_backend=files
+# max size in bytes of a segment file (segments storage)
+segment_max_bytes=268435456
+# min fraction of deleted or overwritten records in the segments of a dir to compact them (gmvault pack)
+segment_compact_ratio=0.3
+# store the big base64 parts (attachments) of the emails once in the blob area of the db (gmvault-db/blobs).
+# The attachments of the deleted emails are removed by gmvault blobs. In an encrypted db the blobs are named by the
+# HMAC-SHA256 of their content with the db key (by their SHA-256 otherwise)
+dedup_attachments=False
+# min size in bytes of the base64 text of a part to move it to the blob area
+dedup_min_bytes=65536
+# adaptation to the limits of Gmail: every rate_increase_every successful IMAP commands the batches grow of 10% and one more
+# connection is used. A throttled response or a connection error halves the batches (down to rate_min_batch_ratio of their
+# configured size) and a throttled response halves the connections and pauses them from rate_min_delay to rate_max_delay sec
+rate_increase_every=20
+rate_min_batch_ratio=0.1
+rate_min_delay=2
+rate_max_delay=300
 
 #Do not touch any parameters below as it could force an overwrite of this file
 [VERSION]
@@ -29,6 +29,7 @@ import imaplib
 
 import log_utils
 import credential_utils
+import rate_utils
 
 import gmvault_utils
 import mod_imap as mimap
@@ -78,9 +79,10 @@ def retry(a_nb_tries=3, a_sleep_time=1, a_backoff=1):
             LOG.critical("Disconnecting from Gmail Server and sleeping ...")
             the_self.disconnect()            
             
-            # add X sec of wait
+            # add X sec of wait (and wait for the end of a pause asked by Gmail)
             time.sleep(rec_sleep_time[0])
             rec_sleep_time[0] *= a_backoff #increase sleep time for next time
+            the_self.rate_controller.wait()
             
             rec_nb_tries[0] += 1
             
@@ -99,6 +101,7 @@ def retry(a_nb_tries=3, a_sleep_time=1, a_backoff=1):
             except Exception, ignored:
                 # catch all errors and try as long as we have tries left
                 LOG.exception(ignored)
+                the_self.rate_controller.on_error(ignored)
         else:
             #cascade error
             raise rec_error
@@ -109,7 +112,8 @@ def retry(a_nb_tries=3, a_sleep_time=1, a_backoff=1):
             m_sleep_time = [a_sleep_time]  #make it mutable in reconnect
             while True:
                 try:
-                    return the_func(*args, **kwargs)
+                    # measured by the rate controller of the fetcher
+                    return args[0].rate_controller.call(the_func.__name__, the_func, *args, **kwargs)
                 except PushEmailError, p_err:
                     
                     LOG.debug("error message = %s. traceback:%s" % (p_err, gmvault_utils.get_exception_traceback()))
@@ -160,6 +164,8 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
     IMAP Class reading the information
     '''
     GMAIL_EXTENSION     = 'X-GM-EXT-1'  # GMAIL capability
+    CONDSTORE           = 'CONDSTORE'   # mod-sequences capability (RFC 7162)
+    MULTIAPPEND         = 'MULTIAPPEND' # several messages per APPEND capability (RFC 3502)
     GMAIL_ALL           = '[Gmail]/All Mail' #GMAIL All Mail mailbox
     GENERIC_GMAIL_ALL   = u'\\AllMail' # unlocalised GMAIL ALL
     GENERIC_GMAIL_CHATS = u'[Gmail]/Chats' # unlocalised Chats
@@ -169,6 +175,7 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
     
     IMAP_INTERNALDATE = 'INTERNALDATE'
     IMAP_FLAGS        = 'FLAGS'
+    IMAP_SIZE         = 'RFC822.SIZE'
     IMAP_ALL          = {'type':'imap', 'req':'ALL'}
     
     EMAIL_BODY        = 'BODY[]'
@@ -187,9 +194,17 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
     
     APPENDUID_RE      = re.compile(APPENDUID)
     
+    #uid set of the emails appended by a MULTIAPPEND
+    APPENDUIDS        = r'^\[APPENDUID [0-9]+ ([0-9:,]+)\] \(Success\)$'
+    
+    APPENDUIDS_RE     = re.compile(APPENDUIDS)
+    
+    #Message-ID field of the header of an email
+    MESSAGE_ID_RE     = re.compile(r'^Message-ID:[ \t]*(<[^>\r\n]*>)', re.IGNORECASE | re.MULTILINE)
+    
     GET_ALL_INFO      = [ GMAIL_ID, GMAIL_THREAD_ID, GMAIL_LABELS, IMAP_INTERNALDATE, IMAP_BODY_PEEK, IMAP_FLAGS, IMAP_HEADER_PEEK_FIELDS]
 
-    GET_ALL_BUT_DATA  = [ GMAIL_ID, GMAIL_THREAD_ID, GMAIL_LABELS, IMAP_INTERNALDATE, IMAP_FLAGS, IMAP_HEADER_PEEK_FIELDS]
+    GET_ALL_BUT_DATA  = [ GMAIL_ID, GMAIL_THREAD_ID, GMAIL_LABELS, IMAP_INTERNALDATE, IMAP_FLAGS, IMAP_SIZE, IMAP_HEADER_PEEK_FIELDS]
     
     GET_DATA_ONLY     = [GMAIL_ID, IMAP_BODY_PEEK]
  
@@ -197,23 +212,29 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
     
     GET_GMAIL_ID_DATE = [ GMAIL_ID,  IMAP_INTERNALDATE]
 
-    def __init__(self, host, port, login, credential, readonly_folder = True): #pylint:disable-msg=R0913
+    def __init__(self, host, port, login, credential, readonly_folder = True, rate_controller = None, use_ssl = True): #pylint:disable-msg=R0913
         '''
             Constructor
+            rate_controller: RateController shared with the other connections (one per fetcher by default)
+            use_ssl        : False to connect without SSL (local IMAP server such as the mock Gmail server)
         '''
         self.host                   = host
         self.port                   = port
         self.login                  = login
         self.once_connected         = False
         self.credential             = credential
-        self.ssl                    = True
+        self.ssl                    = use_ssl
         self.use_uid                = True
         self.readonly_folder        = readonly_folder
         self._all_mail_folder       = None
         self.server                 = None
         self.go_to_all_folder       = True
         self.total_nb_reconns       = 0
+        self.condstore              = False # True when CONDSTORE is enabled
+        self.multiappend            = False # True when the server supports MULTIAPPEND
+        self._selected_folder       = None  # (name, SELECT response) of the selected folder
         self.printed_chat_error_msg = False #true when the chat error message has been printed already
+        self.rate_controller        = rate_controller or rate_utils.RateController()
         
         self._in_chat_dir = False #use in case of reconnect and when being in chat mode
     
@@ -242,6 +263,12 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
         # check gmailness
         self.check_gmailness()
         
+        # to get the HIGHESTMODSEQ when selecting a folder
+        self.enable_condstore()
+        
+        # to push several emails per APPEND when restoring
+        self.multiappend = GIMAPFetcher.MULTIAPPEND in self.get_capabilities()
+        
         self._all_mail_folder = None
         
         #find the all mail folder
@@ -252,7 +279,7 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
             LOG.debug("in chats folder\n")
         # set to GMAIL_ALL dir by default and in readonly
         elif go_to_all_folder:
-            self.server.select_folder(self._all_mail_folder, readonly = self.readonly_folder)
+            self._select_folder(self._all_mail_folder, self.readonly_folder)
             LOG.debug("[All Mail] folder = %s\n" % (self._all_mail_folder))
          
         #enable compression
@@ -283,6 +310,49 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
         """
         self.server.enable_compression()
     
+    def enable_condstore(self):
+        """
+           Enable CONDSTORE if the server supports it
+        """
+        self.condstore = False
+        if GIMAPFetcher.CONDSTORE in self.get_capabilities():
+            try:
+                self.condstore = self.server.enable_condstore()
+            except imaplib.IMAP4.error, err:
+                LOG.debug("Cannot enable CONDSTORE: %s\n" % (err))
+            LOG.debug("CONDSTORE enabled = %s\n" % (self.condstore))
+    
+    def _select_folder(self, a_folder, a_readonly):
+        """
+           Select a folder and keep its SELECT response
+        """
+        self._selected_folder = (a_folder, self.server.select_folder(a_folder, readonly = a_readonly))
+    
+    def get_uidvalidity(self):
+        """
+           Return the UIDVALIDITY of the selected folder or None if it is not known
+        """
+        if not self._selected_folder:
+            return None
+        
+        return self._selected_folder[1].get('UIDVALIDITY')
+    
+    def get_folder_state(self):
+        """
+           Return the state of the selected folder as a dict (folder, uidvalidity, highestmodseq)
+           or None if CONDSTORE is not enabled
+        """
+        if not self.condstore or not self._selected_folder:
+            return None
+        
+        folder, response = self._selected_folder
+        if 'HIGHESTMODSEQ' not in response:
+            return None
+        
+        return { 'folder'        : folder,
+                 'uidvalidity'   : response.get('UIDVALIDITY'),
+                 'highestmodseq' : response['HIGHESTMODSEQ'] }
+    
     @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
     def find_all_mail_folder(self):
         """
@@ -320,7 +390,7 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
             if GIMAPFetcher.GENERIC_GMAIL_CHATS in the_dir:
                 LOG.debug("Chat folder = %s\n" % (the_dir))
                 #select it in read only mode
-                self.server.select_folder(the_dir, True)
+                self._select_folder(the_dir, True)
                 self._in_chat_dir = True
                 return the_dir
 
@@ -338,7 +408,7 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
         """
             Select ALL Mail folder
         """
-        self.server.select_folder(self._all_mail_folder, readonly = self.readonly_folder)
+        self._select_folder(self._all_mail_folder, self.readonly_folder)
         self._in_chat_dir = False
     
     @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
@@ -375,12 +445,83 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
         """
         return self.server.search(a_criteria)
     
+    @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
+    def search_changed_since(self, a_criteria, a_modseq):
+        """
+           Return the ids corresponding to the imap search whose flags or labels changed 
+           (or that were added) since a_modseq. CONDSTORE has to be enabled
+        """
+        if a_criteria.get('type', '') != 'imap':
+            raise Exception("Only imap requests can be restricted to the changed messages (request type %s)" % (a_criteria.get('type','no request type passed')))
+        
+        return self.server.search_changed_since(a_criteria.get('req', ''), a_modseq)
+    
     @retry(4,1,2) # try 4 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 8 sec
     def fetch(self, a_ids, a_attributes):
         """
            Return all attributes associated to each message
         """
+        if isinstance(a_ids, (list, tuple)) and len(a_ids) > 1:
+            a_ids = self.build_sequence_set(a_ids)
+            
         return self.server.fetch(a_ids, a_attributes)
+    
+    @retry(4,1,2) # try 4 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 8 sec
+    def fetch_to_sink(self, a_id, a_attributes, a_sink):
+        """
+           Return the attributes of one message but write its body in a_sink (see GmailStorer.get_email_writer)
+           instead of returning it. The sink is reset before each try.
+        """
+        a_sink.reset()
+        
+        return self.server.fetch_to_sink(a_id, a_attributes, a_sink)
+    
+    @retry(4,1,2) # try 4 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 8 sec
+    def fetch_gmail_ids(self, a_first_uid, a_last_uid):
+        """
+           Return the gmail ids of all the messages in the uid range a_first_uid:a_last_uid
+        """
+        return self.server.fetch_gmail_ids(a_first_uid, a_last_uid)
+    
+    @classmethod
+    def build_sequence_set(cls, a_ids):
+        """
+           Create an IMAP sequence set from a list of ids.
+           Consecutive ids are merged in ranges (ex: [1,2,3,5,7,8] => '1:3,5,7:8')
+           in order to keep the FETCH command short
+        """
+        ranges = []
+        
+        the_ids = sorted(a_ids)
+        
+        start = prev = the_ids[0]
+        for the_id in the_ids[1:]:
+            if the_id == prev + 1:
+                prev = the_id
+                continue
+            
+            ranges.append('%d:%d' % (start, prev) if start != prev else '%d' % (start))
+            start = prev = the_id
+        
+        ranges.append('%d:%d' % (start, prev) if start != prev else '%d' % (start))
+        
+        return ','.join(ranges)
+    
+    @classmethod
+    def parse_uid_set(cls, a_uid_set):
+        """
+           Return the list of uids of an IMAP uid set in their order (ex: '5:7,9' => [5,6,7,9])
+        """
+        uids = []
+        for a_range in a_uid_set.split(','):
+            if ':' in a_range:
+                first, last = [ int(uid) for uid in a_range.split(':') ]
+                step = 1 if first <= last else -1
+                uids.extend(range(first, last + step, step))
+            else:
+                uids.append(int(a_range))
+        
+        return uids
                 
     
     @classmethod
@@ -425,6 +566,21 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
         
         return dirs
     
+    @classmethod
+    def get_missing_labels(cls, labels, existing_folders):
+        """
+           Return the labels for which a directory of the hierarchy is not in existing_folders (lower case dirs)
+        """
+        missing = []
+        for lab in labels:
+            for directory in cls._get_dir_from_labels(lab):
+                low_directory = directory.lower()
+                if (low_directory not in existing_folders) and (low_directory not in cls.GMAIL_SPECIAL_DIRS_LOWER):
+                    missing.append(lab)
+                    break
+        
+        return missing
+    
     def create_gmail_labels(self, labels, existing_folders):
         """
            Create folders and subfolders on Gmail in order
@@ -495,15 +651,10 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
                         LOG.debug(gmvault_utils.get_exception_traceback())
                     
          
-    @retry(4,1,2) # try 4 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 8 sec
-    def push_email(self, a_body, a_flags, a_internal_time, a_labels):
+    def _append_email(self, a_body, a_flags, a_internal_time):
         """
-           Push a complete email body 
+           Append an email in the All Mail folder and return its uid (None when it is unknown)
         """
-        #protection against myself
-        if self.login == 'guillaume.aubert@gmail.com':
-            raise Exception("Cannot push to this account")
-    
         LOG.debug("Before to Append email contents")
         res = self.server.append(self._all_mail_folder, a_body, a_flags, a_internal_time)
     
@@ -515,26 +666,168 @@ class GIMAPFetcher(object): #pylint:disable-msg=R0902
         
         match = GIMAPFetcher.APPENDUID_RE.match(res)
         if match:
-            result_uid = int(match.group(1))
-        else:
-            # do not quarantine it because it seems to be done by Google Mail to forbid data uploading.
-            raise PushEmailError("No email id returned by IMAP APPEND command. Quarantine this email.", quarantined = True)
+            return int(match.group(1))
         
-        labels_str = self._build_labels_str(a_labels)
+        # the email is in All Mail: do not quarantine it nor append it again
+        LOG.warning("No email id returned by IMAP APPEND command (%s). Search it with its Message-ID." % (res))
+        return self._find_appended_uids([(a_body, a_flags, a_internal_time, None)])[0]
+    
+    def _multiappend_emails(self, a_emails):
+        """
+           Append emails (body, flags, internal_time, labels) in the All Mail folder with one MULTIAPPEND command
+           and return their uids
+        """
+        LOG.debug("Before to MultiAppend %d emails" % (len(a_emails)))
+        res = self.server.multiappend(self._all_mail_folder, \
+                                      [ (body, flags, internal_time) for body, flags, internal_time, _ in a_emails ])
         
-        if labels_str:  
-            #has labels so update email  
-            LOG.debug("Before to store")
-            ret_code, data = self.server._imap.uid('STORE', result_uid, '+X-GM-LABELS', labels_str)
-            
-            
-            LOG.debug("Stored Labels %s in gm_id %s" % (labels_str, result_uid))
+        LOG.debug("MultiAppended %d emails" % (len(a_emails)))
+        
+        if '(Success)' not in res:
+            raise PushEmailError("GIMAPFetcher cannot restore emails in %s account." %(self.login))
+        
+        match = GIMAPFetcher.APPENDUIDS_RE.match(res)
+        uids  = self.parse_uid_set(match.group(1)) if match else []
+        if len(uids) != len(a_emails):
+            # the emails are in All Mail: do not quarantine them
+            LOG.warning("No email ids returned by IMAP MULTIAPPEND command (%s). Search them with their Message-IDs." % (res))
+            return self._find_appended_uids(a_emails)
+        
+        return uids
+    
+    def _find_appended_uids(self, a_emails):
+        """
+           Return the uids of the emails (body, flags, internal_time, labels) appended without APPENDUID
+           by searching their Message-ID in All Mail (the last appended one when several emails have it).
+           The uid is None when the email cannot be found
+        """
+        uids = []
+        for body, _, _, _ in a_emails:
+            match = GIMAPFetcher.MESSAGE_ID_RE.search(re.split(r'\r?\n\r?\n', body, 1)[0])
+            uid   = None
+            if match:
+                try:
+                    ret_code, data = self.server._imap.uid('SEARCH', 'HEADER', 'Message-ID', '"%s"' % (match.group(1)))
+                    found = [ int(the_uid) for the_uid in (data[0] or '').split() ] if ret_code == 'OK' else []
+                    uid   = max(found) if found else None
+                except imaplib.IMAP4.error, err:
+                    LOG.debug("Cannot search email with Message-ID %s (%s)." % (match.group(1), err))
+                    if isinstance(err, imaplib.IMAP4.abort):
+                        self.reconnect()
+            uids.append(uid)
+        
+        return uids
+    
+    def _store_labels(self, a_uids, a_labels_str):
+        """
+           Add the labels a_labels_str to the emails a_uids with one UID STORE
+        """
+        LOG.debug("Before to store")
+        ret_code, data = self.server._imap.uid('STORE', self.build_sequence_set(a_uids), '+X-GM-LABELS', a_labels_str)
+        
+        LOG.debug("Stored Labels %s in uids %s" % (a_labels_str, a_uids))
         
-            # check if it is ok otherwise exception
-            if ret_code != 'OK':
-                raise PushEmailError("Cannot add Labels %s to email with uid %d. Error:%s" % (labels_str, result_uid, data))
+        # check if it is ok otherwise exception
+        if ret_code != 'OK':
+            raise PushEmailError("Cannot add Labels %s to emails with uids %s. Error:%s" % (a_labels_str, a_uids, data))
+    
+    @retry(4,1,2) # try 4 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 8 sec
+    def append_email(self, a_body, a_flags, a_internal_time):
+        """
+           Append an email in the All Mail folder and return its uid (None when it is unknown).
+           Retried until the server accepts the email
+        """
+        return self._append_email(a_body, a_flags, a_internal_time)
+    
+    def _label_emails(self, a_uids, a_emails):
+        """
+           Add their labels to the appended emails a_uids (a_emails are (body, flags, internal_time, labels))
+           with one UID STORE per distinct set of labels.
+           Return the indexes of the emails whose labels could not be added (the errors are logged)
+        """
+        unlabelled     = []
+        uids_by_labels = {}
+        for index, (uid, (_, _, _, labels)) in enumerate(zip(a_uids, a_emails)):
+            labels_str = self._build_labels_str(sorted(labels))
+            if not labels_str:
+                continue
+            if uid is None:
+                LOG.warning("Email %d of %d has been pushed without its labels %s: its uid is unknown." % (index + 1, len(a_emails), labels_str))
+                unlabelled.append(index)
+            else:
+                uids_by_labels.setdefault(labels_str, []).append((index, uid))
+        
+        for labels_str, indexes_and_uids in uids_by_labels.iteritems():
+            try:
+                self.rate_controller.call('_store_labels', self._store_labels, [ uid for _, uid in indexes_and_uids ], labels_str)
+            except Exception, err: #pylint:disable-msg=W0703
+                LOG.warning("Emails with uids %s have been pushed without their labels %s (%s)." \
+                            % ([ uid for _, uid in indexes_and_uids ], labels_str, err))
+                unlabelled.extend([ index for index, _ in indexes_and_uids ])
+                if isinstance(err, imaplib.IMAP4.abort):
+                    self.reconnect()
+        
+        return sorted(unlabelled)
+    
+    def push_email(self, a_body, a_flags, a_internal_time, a_labels):
+        """
+           Push a complete email body.
+           Return its uid (None when it is unknown) and False if its labels could not be added.
+           Only the APPEND is retried: an email accepted by the server is never appended twice
+        """
+        #protection against myself
+        if self.login == 'guillaume.aubert@gmail.com':
+            raise Exception("Cannot push to this account")
+        
+        result_uid = self.append_email(a_body, a_flags, a_internal_time)
+        
+        return result_uid, not self._label_emails([result_uid], [(a_body, a_flags, a_internal_time, a_labels)])
+    
+    def push_emails(self, a_emails):
+        """
+           Push a batch of emails given as (body, flags, internal_time, labels).
+           Return the uids of the pushed ones (None when the uid of a pushed email is unknown) and the indexes
+           of the pushed emails whose labels could not be added.
+           The emails are appended with one MULTIAPPEND command when the server supports it (one APPEND per email
+           otherwise) then labelled with one UID STORE per distinct set of labels.
+           The appends stop at the first email that cannot be appended: only the emails before it are pushed and
+           the next ones have to be pushed with push_email.
+           Each command is measured by the rate controller. When Gmail throttles the first append, nothing has been
+           pushed and the error is raised: the batch has to be pushed again once the pause is over.
+           No retry here (it would append the batch twice): the errors of the label STOREs are logged and
+           the emails are still reported as pushed.
+        """
+        #protection against myself
+        if self.login == 'guillaume.aubert@gmail.com':
+            raise Exception("Cannot push to this account")
+        
+        uids = None
+        if self.multiappend and len(a_emails) > 1:
+            try:
+                uids = self.rate_controller.call('_multiappend_emails', self._multiappend_emails, a_emails)
+            except imaplib.IMAP4.error, err:
+                # nothing has been appended (all or nothing)
+                if isinstance(err, imaplib.IMAP4.abort):
+                    self.reconnect()
+                if rate_utils.get_throttle_code(err):
+                    raise err
+                LOG.debug("Cannot push %d emails with MULTIAPPEND (%s). Append them one by one." % (len(a_emails), err))
+        
+        if uids is None:
+            uids = []
+            for body, flags, internal_time, _ in a_emails:
+                try:
+                    uids.append(self.rate_controller.call('_append_email', self._append_email, body, flags, internal_time))
+                except Exception, err: #pylint:disable-msg=W0703
+                    if isinstance(err, imaplib.IMAP4.abort):
+                        self.reconnect()
+                    if rate_utils.get_throttle_code(err) and not uids:
+                        raise err
+                    # the caller pushes it again with push_email to handle the error (after the pause if throttled)
+                    LOG.debug("Cannot append email %d of %d (%s). Stop the batch." % (len(uids) + 1, len(a_emails), err))
+                    break
         
-        return result_uid
+        return uids, self._label_emails(uids, a_emails)
     
     def fetch_with_gmid(self, a_gm_id):
         """
@@ -0,0 +1,310 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the indexes of a gmvault-db:
+ - GmailIndex: a persistent gmail id => directory index
+ - DirManifests: the list of the gmail ids stored in each directory
+
+'''
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import log_utils
+import codec_utils
+
+LOG = log_utils.LoggerFactory.get_logger('index_utils')
+
+class GmailIndex(object):
+    """
+       sqlite index mapping each gmail id stored in the db to its directory (relative to the db dir),
+       its storage flags (compressed, encrypted) and the size of its data file.
+       The index is only a cache: an entry can be missing or stale and the caller has to fallback
+       on the filesystem in that case.
+    """
+    INDEX_FILENAME = 'gmvault_index.sqlite'
+
+    COMPRESSED = 1 # gzip. The flags of the other codecs are defined in codec_utils
+    ENCRYPTED  = 2
+
+    CREATE_TABLE = "CREATE TABLE IF NOT EXISTS emails (gm_id INTEGER PRIMARY KEY, dir TEXT NOT NULL, flags INTEGER, size INTEGER)"
+
+    def __init__(self, a_info_dir, a_commit_every = 500):
+        """
+           Open or create the index in the info dir
+           a_commit_every: number of updates after which the pending updates are committed
+        """
+        self.path          = '%s/%s' % (a_info_dir, self.INDEX_FILENAME)
+        self._commit_every = a_commit_every
+        self._nb_pending   = 0
+
+        # the storer is used by several threads when syncing in parallel
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, check_same_thread = False)
+        self._conn.text_factory = str
+        self._conn.execute(self.CREATE_TABLE)
+        self._conn.commit()
+
+    @classmethod
+    def get_flags_from_filename(cls, a_filename):
+        """
+           Return the storage flags corresponding to a data file name (ex: 12345.eml.crypt.gz)
+        """
+        flags = codec_utils.get_codec_from_filename(a_filename).FLAG
+        if '.crypt' in a_filename:
+            flags |= cls.ENCRYPTED
+        return flags
+
+    def _updated(self):
+        """
+           Commit if enough updates are pending. To be called with the lock
+        """
+        self._nb_pending += 1
+        if self._nb_pending >= self._commit_every:
+            self._conn.commit()
+            self._nb_pending = 0
+
+    def get(self, a_id):
+        """
+           Return (dir, flags, size) for a gmail id or None if the id is not indexed.
+           flags and size are None when they are not known.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT dir, flags, size FROM emails WHERE gm_id = ?", (long(a_id),)).fetchone()
+
+    def add(self, a_id, a_dir, a_flags, a_size):
+        """
+           Add or replace the entry of a gmail id
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO emails (gm_id, dir, flags, size) VALUES (?, ?, ?, ?)", \
+                               (long(a_id), a_dir, a_flags, a_size))
+            self._updated()
+
+    def add_all(self, a_rows):
+        """
+           Add or replace the entries of a list of (gm_id, dir, flags, size) and commit
+        """
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO emails (gm_id, dir, flags, size) VALUES (?, ?, ?, ?)", \
+                                   [ (long(the_id), the_dir, flags, size) for the_id, the_dir, flags, size in a_rows ])
+            self._conn.commit()
+            self._nb_pending = 0
+
+    def set_dir(self, a_id, a_dir):
+        """
+           Set the dir of a gmail id. Keep flags and size if the id is already indexed in the same dir
+        """
+        with self._lock:
+            cursor = self._conn.execute("UPDATE emails SET dir = ? WHERE gm_id = ? AND dir = ?", (a_dir, long(a_id), a_dir))
+            if cursor.rowcount == 0:
+                self._conn.execute("INSERT OR REPLACE INTO emails (gm_id, dir, flags, size) VALUES (?, ?, NULL, NULL)", \
+                                   (long(a_id), a_dir))
+            self._updated()
+
+    def remove(self, a_id):
+        """
+           Remove a gmail id from the index
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM emails WHERE gm_id = ?", (long(a_id),))
+            self._updated()
+
+    def count(self):
+        """
+           Number of indexed gmail ids
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+
+    def flush(self):
+        """
+           Commit the pending updates
+        """
+        with self._lock:
+            if self._nb_pending:
+                self._conn.commit()
+                self._nb_pending = 0
+
+    def close(self):
+        """
+           Commit and close the index
+        """
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def rebuild(self, a_db_dir):
+        """
+           Recreate the index from scratch by scanning all the .meta files under a_db_dir
+           Return the number of indexed gmail ids
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM emails")
+
+            nb_ids = 0
+            for the_dir, _, files in os.walk(a_db_dir):
+                rel_dir = os.path.relpath(the_dir, a_db_dir).replace(os.sep, '/')
+
+                # index data files by gmail id to get their flags and size
+                data_files = {}
+                for fname in files:
+                    if '.eml' in fname:
+                        data_files[fname.split('.', 1)[0]] = fname
+
+                rows = []
+                for fname in files:
+                    if not fname.endswith('.meta'):
+                        continue
+
+                    str_id = fname[:-len('.meta')]
+                    try:
+                        the_id = long(str_id)
+                    except ValueError:
+                        LOG.debug("Ignore %s/%s while rebuilding the index.\n" % (the_dir, fname))
+                        continue
+
+                    data_fname = data_files.get(str_id)
+                    if data_fname:
+                        rows.append((the_id, rel_dir, self.get_flags_from_filename(data_fname), \
+                                     os.path.getsize(os.path.join(the_dir, data_fname))))
+                    else:
+                        rows.append((the_id, rel_dir, None, None))
+
+                self._conn.executemany("INSERT OR REPLACE INTO emails (gm_id, dir, flags, size) VALUES (?, ?, ?, ?)", rows)
+                nb_ids += len(rows)
+
+            self._conn.commit()
+            self._nb_pending = 0
+
+            return nb_ids
+
+class DirManifests(object):
+    """
+       One manifest file per db directory (month dir or chats sub dir) listing the gmail ids stored in it
+       with the directory mtime. The inventory of the db can then be loaded by reading one small file per
+       directory instead of listing and matching every .meta file.
+       A manifest is only trusted if the directory mtime is the recorded one and if it has been written
+       long enough after that mtime (a file added in the same second would not change the mtime).
+       Otherwise the directory is scanned and its manifest rewritten.
+    """
+    MANIFESTS_AREA = 'manifests'
+    RACY_DELAY     = 2 # seconds
+
+    def __init__(self, a_info_dir, a_db_dir):
+        """
+           a_info_dir: info dir of the db where the manifests are stored
+           a_db_dir  : db dir containing the directories described by the manifests
+        """
+        self._manifests_dir = '%s/%s' % (a_info_dir, self.MANIFESTS_AREA)
+        self._db_dir        = a_db_dir
+
+        if not os.path.isdir(self._manifests_dir):
+            os.makedirs(self._manifests_dir)
+
+        # directories (relative to the db dir) modified since the last flush
+        self._dirty_dirs = set()
+        self._lock       = threading.Lock()
+
+    def _get_manifest_path(self, a_rel_dir):
+        """
+           Manifest path of a directory (ex: chats/subchats-1 => .info/manifests/chats_subchats-1)
+        """
+        return '%s/%s' % (self._manifests_dir, a_rel_dir.replace('/', '_'))
+
+    def mark_dirty(self, a_rel_dir):
+        """
+           Signal that files have been added or removed in a_rel_dir
+        """
+        if a_rel_dir == '.':
+            return # no manifest for the root of the db, it is always listed
+
+        with self._lock:
+            self._dirty_dirs.add(a_rel_dir)
+
+    def flush(self):
+        """
+           Rewrite the manifests of the modified directories
+        """
+        with self._lock:
+            dirty_dirs, self._dirty_dirs = self._dirty_dirs, set()
+
+        for rel_dir in dirty_dirs:
+            if os.path.isdir('%s/%s' % (self._db_dir, rel_dir)):
+                self._scan(rel_dir)
+            elif os.path.exists(self._get_manifest_path(rel_dir)):
+                os.remove(self._get_manifest_path(rel_dir))
+
+    def _scan(self, a_rel_dir):
+        """
+           List the .meta files of a directory and write its manifest
+           Return the list of gmail ids
+        """
+        the_dir = '%s/%s' % (self._db_dir, a_rel_dir)
+
+        # mtime before the listing so a concurrent change makes the manifest stale
+        mtime = os.stat(the_dir).st_mtime
+
+        ids = []
+        for fname in os.listdir(the_dir):
+            if fname.endswith('.meta'):
+                try:
+                    ids.append(long(fname[:-len('.meta')]))
+                except ValueError:
+                    LOG.debug("Ignore %s/%s in the manifest." % (the_dir, fname))
+        ids.sort()
+
+        # write in a tmp file and rename to never leave a partial manifest
+        path     = self._get_manifest_path(a_rel_dir)
+        tmp_path = '%s.tmp' % (path)
+        the_fd = open(tmp_path, 'w')
+        try:
+            json.dump({ 'mtime' : mtime, 'generated' : time.time(), 'ids' : ids }, the_fd)
+        finally:
+            the_fd.close()
+
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path) # rename cannot replace a file on windows
+        os.rename(tmp_path, path)
+
+        return ids
+
+    def get_ids(self, a_rel_dir):
+        """
+           Return the sorted list of the gmail ids stored in a directory of the db
+        """
+        path = self._get_manifest_path(a_rel_dir)
+
+        if os.path.exists(path):
+            try:
+                the_fd = open(path, 'r')
+                try:
+                    manifest = json.load(the_fd)
+                finally:
+                    the_fd.close()
+
+                mtime = os.stat('%s/%s' % (self._db_dir, a_rel_dir)).st_mtime
+                if manifest['mtime'] == mtime and (manifest['generated'] - mtime) >= self.RACY_DELAY:
+                    return manifest['ids']
+
+                LOG.debug("Manifest of %s is not up to date. Rescan the directory." % (a_rel_dir))
+            except (ValueError, KeyError), err:
+                LOG.critical("Invalid manifest %s (%s). Rescan the directory." % (path, err))
+
+        return self._scan(a_rel_dir)
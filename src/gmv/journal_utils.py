@@ -0,0 +1,164 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the OperationJournal object: an append-only journal of the ids completed by a sync or a restore
+
+'''
+import os
+import threading
+
+import log_utils
+
+LOG = log_utils.LoggerFactory.get_logger('journal_utils')
+
+class OperationJournal(object):
+    """
+       Append-only journal of the ids completed by an operation (one line per id).
+       A line can carry extra values after the id (ex: "imap_id gm_id").
+       The journal can start with a validity value ("# validity <value>", ex: the UIDVALIDITY of the synced
+       folder): the recorded ids are only meaningful with this value.
+       The journal is fsynced every fsync_every recorded ids and when closed, after calling before_sync
+       (ex: fsync of the written emails the ids vouch for) so a durable id never points to lost data.
+    """
+    COMMENT  = '#'
+    VALIDITY = 'validity'
+
+    def __init__(self, a_path, a_fsync_every = 100, a_before_sync = None):
+        """
+           a_path: journal file path
+           a_fsync_every: number of ids recorded between two fsyncs
+           a_before_sync: function called before each fsync of the journal (None for nothing)
+        """
+        self.path          = a_path
+        self._fsync_every  = a_fsync_every
+        self._before_sync  = a_before_sync
+        self._nb_unsynced  = 0
+        self._fd           = None
+
+        # ids can be recorded by several threads
+        self._lock = threading.Lock()
+
+    def exists(self):
+        """
+           True if the journal file exists
+        """
+        return os.path.exists(self.path)
+
+    def get_validity(self):
+        """
+           Return the validity value recorded when the journal was created or None
+        """
+        if not self.exists():
+            return None
+
+        the_fd = open(self.path, 'r')
+        try:
+            fields = the_fd.readline().split()
+        finally:
+            the_fd.close()
+
+        if len(fields) == 3 and fields[:2] == [self.COMMENT, self.VALIDITY]:
+            return long(fields[2])
+
+        return None
+
+    def remove(self):
+        """
+           Delete the journal file
+        """
+        if self.exists():
+            os.remove(self.path)
+
+    def load(self):
+        """
+           Return the set of the ids recorded in the journal.
+           An incomplete last line (interrupted write) is ignored.
+        """
+        done_ids = set()
+
+        if not self.exists():
+            return done_ids
+
+        the_fd = open(self.path, 'r')
+        try:
+            for line in the_fd:
+                if not line.endswith('\n'):
+                    LOG.debug("Ignore incomplete line %r at the end of journal %s." % (line, self.path))
+                    break
+
+                fields = line.split()
+                if fields and fields[0] != self.COMMENT:
+                    done_ids.add(long(fields[0]))
+        finally:
+            the_fd.close()
+
+        return done_ids
+
+    def open(self, a_truncate = False, a_validity = None):
+        """
+           Open the journal to record ids.
+           a_truncate: if True forget the previously recorded ids (new operation)
+           a_validity: validity value written at the start of a new journal (see get_validity)
+        """
+        with self._lock:
+            is_new = a_truncate or not self.exists()
+            self._fd = open(self.path, 'w' if a_truncate else 'a')
+            self._nb_unsynced = 0
+
+            if is_new and a_validity is not None:
+                self._fd.write('%s %s %s\n' % (self.COMMENT, self.VALIDITY, a_validity))
+
+    def record(self, a_id, *values):
+        """
+           Record a completed id with optional values
+        """
+        line = ' '.join([str(a_id)] + [str(val) for val in values])
+
+        with self._lock:
+            self._fd.write('%s\n' % (line))
+            self._nb_unsynced += 1
+            if self._nb_unsynced >= self._fsync_every:
+                self._sync()
+
+    def _sync(self):
+        """
+           Flush and fsync the journal. To be called with the lock
+        """
+        if self._before_sync:
+            self._before_sync()
+
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        self._nb_unsynced = 0
+
+    def sync(self):
+        """
+           Flush and fsync the recorded ids
+        """
+        with self._lock:
+            if self._fd and self._nb_unsynced:
+                self._sync()
+
+    def close(self):
+        """
+           Fsync and close the journal
+        """
+        with self._lock:
+            if self._fd:
+                self._sync()
+                self._fd.close()
+                self._fd = None
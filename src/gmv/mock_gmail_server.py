@@ -0,0 +1,1309 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing a fake Gmail IMAP server running in the process for the tests and the benchmarks that cannot
+use a Gmail account. It implements the part of IMAP4rev1 and of the Gmail extensions used by GIMAPFetcher and
+MonkeyIMAPClient: XLIST, X-GM-MSGID, X-GM-THRID, X-GM-LABELS, X-GM-RAW, UIDPLUS (APPENDUID), MULTIAPPEND,
+COMPRESS=DEFLATE and CONDSTORE.
+The mailbox is generated (MockMailbox.generate) or loaded from an existing gmvault-db (MockMailbox.from_gmvault_db)
+and a latency per command and a bandwidth per connection can be set to behave like a remote server.
+
+    server = MockGmailServer(MockMailbox.generate(1000), a_latency = 0.05).start()
+    syncer = gmvault.GMVaulter(db_dir, server.host, server.port, server.mailbox.login, \
+                               { 'type' : 'passwd', 'value' : 'secret' }, use_ssl = False)
+    ...
+    server.stop()
+
+'''
+import re
+import time
+import random
+import bisect
+import socket
+import ssl
+import zlib
+import datetime
+import threading
+import SocketServer
+
+import log_utils
+import collections_utils
+
+LOG = log_utils.LoggerFactory.get_logger('mock_gmail_server')
+
+MONTHS   = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+MON2NUM  = dict([ (month.upper(), num) for num, month in enumerate(MONTHS, 1) ])
+
+# literal at the end of a command line ({size} or non synchronizing {size+})
+LITERAL_RE     = re.compile(r'\{(?P<size>[0-9]+)(?P<plus>\+?)\}$')
+
+# date of the SEARCH criteria and date-time of the APPEND command
+SEARCH_DATE_RE = re.compile(r'^(?P<day>[0-9]{1,2})-(?P<mon>[A-Za-z]{3})-(?P<year>[0-9]{4})$')
+DATE_TIME_RE   = re.compile(r'^ ?(?P<day>[0-9]{1,2})-(?P<mon>[A-Za-z]{3})-(?P<year>[0-9]{4}) '
+                            r'(?P<hour>[0-9]{2}):(?P<min>[0-9]{2}):(?P<sec>[0-9]{2}) (?P<zonen>[-+])(?P<zoneh>[0-9]{2})(?P<zonem>[0-9]{2})$')
+
+# date of the Gmail search operators after: and before:
+GMAIL_DATE_RE  = re.compile(r'^(?P<year>[0-9]{4})/(?P<mon>[0-9]{1,2})/(?P<day>[0-9]{1,2})$')
+
+ATOM_SPECIALS  = re.compile(r'[\s()"\\{%*\]]')
+
+WORDS = ['gmail', 'backup', 'restore', 'vault', 'imap', 'label', 'thread', 'meeting', 'report', 'invoice', 'project', \
+         'holiday', 'budget', 'review', 'release', 'server', 'family', 'photos', 'weekend', 'contract', 'planning', \
+         'question', 'answer', 'update', 'status', 'schedule', 'ticket', 'travel', 'order', 'receipt', 'newsletter']
+
+class IMAPCommandError(Exception):
+    """
+       Command refused (NO) or not understood (BAD) by the server
+    """
+    def __init__(self, a_msg, a_type = 'BAD'):
+        """
+           a_type: NO or BAD
+        """
+        super(IMAPCommandError, self).__init__(a_msg)
+        self.type = a_type
+
+class Literal(str):
+    """
+       String sent as a literal in a command (and not as an atom or a quoted string)
+    """
+    pass
+
+def parse_args(a_parts):
+    """
+       Parse the arguments of a command. a_parts alternates the text of the command lines and the literals.
+       Return the list of the arguments: atoms and strings as str, literals as Literal and
+       parenthesized lists as lists
+    """
+    stack = [[]]
+    for index, part in enumerate(a_parts):
+        if index % 2:
+            stack[-1].append(Literal(part))
+            continue
+
+        pos = 0
+        while pos < len(part):
+            char = part[pos]
+            if char == ' ':
+                pos += 1
+            elif char == '(':
+                stack.append([])
+                pos += 1
+            elif char == ')':
+                if len(stack) == 1:
+                    raise IMAPCommandError('Unbalanced parenthesis')
+                sub_list = stack.pop()
+                stack[-1].append(sub_list)
+                pos += 1
+            elif char == '"':
+                end, chars = pos + 1, []
+                while end < len(part) and part[end] != '"':
+                    if part[end] == '\\':
+                        end += 1
+                    chars.append(part[end:end + 1])
+                    end += 1
+                if end >= len(part):
+                    raise IMAPCommandError('Unterminated quoted string')
+                stack[-1].append(''.join(chars))
+                pos = end + 1
+            else:
+                # atom: the brackets of the fetch items (BODY.PEEK[HEADER.FIELDS (...)]) can contain spaces
+                end, depth = pos, 0
+                while end < len(part):
+                    if part[end] == '[':
+                        depth += 1
+                    elif part[end] == ']':
+                        depth -= 1
+                    elif depth == 0 and part[end] in ' ()':
+                        break
+                    end += 1
+                stack[-1].append(part[pos:end])
+                pos = end
+
+    if len(stack) != 1:
+        raise IMAPCommandError('Unbalanced parenthesis')
+
+    return stack[0]
+
+def quote(a_str):
+    """
+       Return a_str as an IMAP atom if possible otherwise as a quoted string
+    """
+    if a_str and not ATOM_SPECIALS.search(a_str):
+        return a_str
+    return '"%s"' % (a_str.replace('\\', '\\\\').replace('"', '\\"'))
+
+def to_list(a_arg):
+    """
+       Return the argument a_arg (an atom or a parenthesized list) as a list
+    """
+    return a_arg if isinstance(a_arg, list) else [a_arg]
+
+def imap_date_time(a_date):
+    """
+       Format the datetime a_date (in UTC) as an IMAP date-time
+    """
+    return '%02d-%s-%04d %02d:%02d:%02d +0000' % (a_date.day, MONTHS[a_date.month - 1], a_date.year, \
+                                                  a_date.hour, a_date.minute, a_date.second)
+
+def parse_search_date(a_date):
+    """
+       Parse an IMAP date (1-Feb-2012)
+    """
+    matched = SEARCH_DATE_RE.match(a_date)
+    if not matched or matched.group('mon').upper() not in MON2NUM:
+        raise IMAPCommandError('Invalid date %s' % (a_date))
+    return datetime.date(int(matched.group('year')), MON2NUM[matched.group('mon').upper()], int(matched.group('day')))
+
+def parse_date_time(a_date):
+    """
+       Parse an IMAP date-time (01-Feb-2012 10:12:03 +0100) and return it in UTC
+    """
+    matched = DATE_TIME_RE.match(a_date)
+    if not matched or matched.group('mon').upper() not in MON2NUM:
+        raise IMAPCommandError('Invalid date-time %s' % (a_date))
+
+    the_date = datetime.datetime(int(matched.group('year')), MON2NUM[matched.group('mon').upper()], int(matched.group('day')), \
+                                 int(matched.group('hour')), int(matched.group('min')), int(matched.group('sec')))
+    offset   = datetime.timedelta(hours = int(matched.group('zoneh')), minutes = int(matched.group('zonem')))
+
+    return the_date - offset if matched.group('zonen') == '+' else the_date + offset
+
+def get_header_fields(a_body, a_names):
+    """
+       Return the header fields a_names (upper case) of the email a_body followed by an empty line
+       like BODY[HEADER.FIELDS (...)]
+    """
+    fields, keep = [], False
+    for line in re.split(r'\r?\n', get_header(a_body)):
+        if line[:1] in (' ', '\t'):
+            # folded field
+            if keep:
+                fields.append(line)
+            continue
+        keep = line.split(':', 1)[0].strip().upper() in a_names
+        if keep:
+            fields.append(line)
+
+    return ''.join([ '%s\r\n' % (field) for field in fields ]) + '\r\n'
+
+def get_header(a_body):
+    """
+       Return the header of the email a_body (without the empty line ending it)
+    """
+    matched = re.search(r'\r?\n\r?\n', a_body)
+    return a_body[:matched.start()] if matched else a_body
+
+def build_email(a_rand, a_num, a_date, a_size, a_thread_num = None):
+    """
+       Build a fake email of about a_size bytes with the random generator a_rand.
+       The emails of a thread (a_thread_num) have the same subject
+    """
+    thread_num = a_num if a_thread_num is None else a_thread_num
+    subject    = 'Re: %s %s %d' % (WORDS[thread_num % len(WORDS)], WORDS[(thread_num / len(WORDS)) % len(WORDS)], thread_num) \
+                 if thread_num != a_num else '%s %s %d' % (WORDS[thread_num % len(WORDS)], \
+                                                           WORDS[(thread_num / len(WORDS)) % len(WORDS)], thread_num)
+    header = 'From: Sender %d <sender%d@example.com>\r\n' \
+             'To: Gmvault Test <gmvault.test@gmail.com>\r\n' \
+             'Subject: %s\r\n' \
+             'Date: %s\r\n' \
+             'Message-ID: <%d.%d@mock.gmvault.org>\r\n' \
+             'Content-Type: text/plain; charset=us-ascii\r\n\r\n' % (a_num % 97, a_num % 97, subject, \
+                                                                    a_date.strftime('%a, %d %b %Y %H:%M:%S +0000'), a_num, thread_num)
+    lines, size = [], len(header)
+    while size < a_size:
+        line = ' '.join([ a_rand.choice(WORDS) for _ in xrange(10) ]) + '\r\n'
+        lines.append(line)
+        size += len(line)
+
+    return header + ''.join(lines)
+
+class MockMessage(object): #pylint:disable-msg=R0903
+    """
+       An email (or a chat) of the mock account
+    """
+    # millions of them in the benchmark mailboxes
+    __slots__ = ('uid', 'gm_id', 'thread_id', 'body', 'labels', 'flags', 'internal_date', 'modseq')
+
+    def __init__(self, a_uid, a_gm_id, a_thread_id, a_body, a_labels, a_flags, a_internal_date, a_modseq): #pylint:disable-msg=R0913
+        """
+           a_internal_date: datetime in UTC
+        """
+        self.uid           = a_uid
+        self.gm_id         = a_gm_id
+        self.thread_id     = a_thread_id
+        self.body          = a_body
+        self.labels        = list(a_labels)
+        self.flags         = list(a_flags)
+        self.internal_date = a_internal_date
+        self.modseq        = a_modseq
+
+class MockFolder(object):
+    """
+       Folder of the mock account: the messages sorted by uid
+    """
+    def __init__(self, a_name, a_uidvalidity, a_special_flag = None):
+        """
+           a_special_flag: XLIST flag of the folder (\\AllMail)
+        """
+        self.name         = a_name
+        self.uidvalidity  = a_uidvalidity
+        self.special_flag = a_special_flag
+        self.next_uid     = 1
+        self.uids         = []
+        self.messages     = {}
+
+    def add(self, a_message):
+        """
+           Add a_message with the next uid
+        """
+        a_message.uid = self.next_uid
+        self.next_uid += 1
+        self.uids.append(a_message.uid)
+        self.messages[a_message.uid] = a_message
+
+    def remove(self, a_uid):
+        """
+           Remove the message a_uid and return its sequence number
+        """
+        index = bisect.bisect_left(self.uids, a_uid)
+        del self.uids[index]
+        del self.messages[a_uid]
+        return index + 1
+
+    def get_range(self, a_first, a_last, a_use_uid = True):
+        """
+           Return the (sequence number, message) of the range a_first:a_last (uids or sequence numbers)
+        """
+        first, last = min(a_first, a_last), max(a_first, a_last)
+        if a_use_uid:
+            start, end = bisect.bisect_left(self.uids, first), bisect.bisect_right(self.uids, last)
+        else:
+            start, end = max(0, first - 1), min(len(self.uids), last)
+
+        return [ (index + 1, self.messages[self.uids[index]]) for index in xrange(start, end) ]
+
+    def get_set(self, a_set, a_use_uid = True):
+        """
+           Return the (sequence number, message) of the sequence set a_set (1:3,5,7:*) sorted by sequence number
+        """
+        star     = (self.uids[-1] if a_use_uid else len(self.uids)) if self.uids else 0
+        selected = {}
+        for elem in a_set.split(','):
+            try:
+                bounds = [ star if bound == '*' else int(bound) for bound in elem.split(':') ]
+            except ValueError:
+                raise IMAPCommandError('Invalid sequence set %s' % (a_set))
+            if len(bounds) not in (1, 2):
+                raise IMAPCommandError('Invalid sequence set %s' % (a_set))
+
+            for seq, message in self.get_range(bounds[0], bounds[-1], a_use_uid):
+                selected[seq] = message
+
+        return sorted(selected.items())
+
+class MockMailbox(object):
+    """
+       The mock Gmail account: the All Mail and Chats folders, the labels and the mod-sequence
+    """
+    ALL_MAIL = '[Gmail]/All Mail'
+    CHATS    = '[Gmail]/Chats'
+    GMAIL    = '[Gmail]'
+
+    SYSTEM_LABELS = ['\\Inbox', '\\Important', '\\Starred', '\\Sent', '\\Draft']
+
+    def __init__(self, a_login = 'gmvault.test@gmail.com', a_password = None):
+        """
+           a_password: password accepted by LOGIN (any password if None)
+        """
+        self.login         = a_login
+        self.password      = a_password
+        self.lock          = threading.RLock()
+        self.folders       = collections_utils.OrderedDict()
+        self.folders[self.ALL_MAIL] = MockFolder(self.ALL_MAIL, 1, '\\AllMail')
+        self.folders[self.CHATS]    = MockFolder(self.CHATS, 2)
+        self.labels        = set()
+        self.highestmodseq = 1
+        self._next_gm_id   = 1400000000000000000
+
+    def next_modseq(self):
+        """
+           Return a new mod-sequence
+        """
+        self.highestmodseq += 1
+        return self.highestmodseq
+
+    def add_labels(self, a_labels):
+        """
+           Create the labels of a_labels that do not exist (and their parents) like Gmail does for STORE +X-GM-LABELS
+        """
+        with self.lock:
+            for label in a_labels:
+                if label.startswith('\\') or label.lower() in [ folder.lower() for folder in self.folders ]:
+                    continue
+                path = label.split('/')
+                for index in xrange(1, len(path) + 1):
+                    self.labels.add('/'.join(path[:index]))
+
+    def get_label(self, a_name):
+        """
+           Return the name of the existing label a_name (case insensitive) or None
+        """
+        with self.lock:
+            for label in self.labels:
+                if label.lower() == a_name.lower():
+                    return label
+        return None
+
+    def add_email(self, a_body, a_labels = (), a_flags = (), a_internal_date = None, a_gm_id = None, a_thread_id = None, \
+                  a_folder = ALL_MAIL): #pylint:disable-msg=R0913
+        """
+           Add an email (or a chat with a_folder = CHATS) and return it
+        """
+        with self.lock:
+            if a_gm_id is None:
+                a_gm_id = self._next_gm_id
+            self._next_gm_id = max(self._next_gm_id, a_gm_id) + 1
+
+            self.add_labels(a_labels)
+
+            message = MockMessage(None, a_gm_id, a_thread_id or a_gm_id, a_body, a_labels, a_flags, \
+                                  a_internal_date or datetime.datetime.utcnow().replace(microsecond = 0), self.next_modseq())
+            self.folders[a_folder].add(message)
+
+        return message
+
+    def get_emails(self, a_folder = ALL_MAIL):
+        """
+           Return the messages of a_folder sorted by uid
+        """
+        with self.lock:
+            folder = self.folders[a_folder]
+            return [ folder.messages[uid] for uid in folder.uids ]
+
+    @classmethod
+    def generate(cls, a_nb_emails, a_nb_chats = 0, a_body_size = 2048, a_nb_labels = 10, a_seed = 0, \
+                 a_start_date = datetime.datetime(2010, 1, 1)): #pylint:disable-msg=R0913
+        """
+           Generate a mailbox of a_nb_emails emails of about a_body_size bytes and a_nb_chats chats
+           with the labels label-0 to label-<a_nb_labels - 1>, one email per hour from a_start_date.
+           The same a_seed gives the same mailbox
+        """
+        rand    = random.Random(a_seed)
+        mailbox = cls()
+        labels  = [ 'label-%d' % (num) for num in xrange(a_nb_labels) ]
+
+        for num in xrange(a_nb_emails + a_nb_chats):
+            the_date = a_start_date + datetime.timedelta(hours = num)
+            if num >= a_nb_emails:
+                mailbox.add_email(build_email(rand, num, the_date, a_body_size / 4), a_internal_date = the_date, \
+                                  a_folder = cls.CHATS)
+                continue
+
+            # one email out of three answers one of the previous emails
+            thread_num = rand.randint(max(0, num - 20), num) if num and rand.random() < 0.33 else num
+            email_labels = rand.sample(labels, rand.randint(0, min(2, len(labels))))
+            if rand.random() < 0.5:
+                email_labels.append('\\Inbox')
+            if rand.random() < 0.1:
+                email_labels.append('\\Starred')
+            flags = ['\\Seen'] if rand.random() < 0.8 else []
+
+            body     = build_email(rand, num, the_date, rand.randint(a_body_size / 2, a_body_size * 3 / 2), thread_num)
+            emails   = mailbox.folders[cls.ALL_MAIL].messages
+            thread   = emails[thread_num + 1].gm_id if thread_num != num else None
+            mailbox.add_email(body, email_labels, flags, the_date, a_thread_id = thread)
+
+        return mailbox
+
+    @classmethod
+    def from_gmvault_db(cls, a_db_dir, a_use_encryption = False):
+        """
+           Create a mailbox with the emails and the chats of the gmvault-db a_db_dir
+        """
+        import gmvault # gmvault does not depend on this module
+
+        gstorer = gmvault.get_storer(a_db_dir, a_use_encryption)
+        mailbox = cls()
+
+        for folder, gm_ids in [(cls.ALL_MAIL, gstorer.get_all_existing_gmail_ids()), \
+                               (cls.CHATS, gstorer.get_all_chats_gmail_ids())]:
+            for gm_id in gm_ids:
+                metadata, body = gstorer.unbury_email(gm_id)
+                mailbox.add_email(body, metadata[gstorer.LABELS_K], metadata[gstorer.FLAGS_K], \
+                                  metadata[gstorer.INT_DATE_K], gm_id, metadata[gstorer.THREAD_IDS_K], folder)
+
+        gstorer.flush()
+
+        return mailbox
+
+class GmailQuery(object): #pylint:disable-msg=R0903
+    """
+       Subset of the Gmail search syntax (X-GM-RAW): label:, in:, is:, after:, before:, subject:, from:,
+       rfc822msgid:, negation with - and free text
+    """
+    TERM_RE = re.compile(r'(-?)(?:([a-z0-9]+):)?("[^"]*"|\S+)', re.IGNORECASE)
+
+    def __init__(self, a_query):
+        """
+           constructor
+        """
+        self.terms = [ (neg == '-', (operator or '').lower(), value.strip('"').lower()) \
+                       for neg, operator, value in self.TERM_RE.findall(a_query) ]
+
+    @classmethod
+    def _label_matches(cls, a_label, a_labels):
+        """
+           Gmail searches the labels with - in place of the spaces and the /
+        """
+        normalized = a_label.replace(' ', '-').replace('/', '-')
+        return normalized in [ label.lower().replace(' ', '-').replace('/', '-') for label in a_labels ]
+
+    @classmethod
+    def _parse_date(cls, a_value):
+        """
+           Parse the date of after: and before: (2012/02/01)
+        """
+        matched = GMAIL_DATE_RE.match(a_value)
+        if not matched:
+            raise IMAPCommandError('Invalid date %s' % (a_value))
+        return datetime.date(int(matched.group('year')), int(matched.group('mon')), int(matched.group('day')))
+
+    def _term_matches(self, a_operator, a_value, a_message): #pylint:disable-msg=R0911
+        """
+           Check one term of the query
+        """
+        if a_operator == 'label':
+            return self._label_matches(a_value, a_message.labels)
+        elif a_operator == 'in':
+            return a_value in ('anywhere', 'all') or self._label_matches('\\%s' % (a_value), a_message.labels) \
+                   or self._label_matches(a_value, a_message.labels)
+        elif a_operator == 'is':
+            if a_value in ('read', 'unread'):
+                return ('\\Seen' in a_message.flags) == (a_value == 'read')
+            return self._label_matches('\\%s' % (a_value), a_message.labels)
+        elif a_operator == 'after':
+            return a_message.internal_date.date() >= self._parse_date(a_value)
+        elif a_operator == 'before':
+            return a_message.internal_date.date() < self._parse_date(a_value)
+        elif a_operator in ('subject', 'from', 'to'):
+            return a_value in get_header_fields(a_message.body, [a_operator.upper()]).lower()
+        elif a_operator == 'rfc822msgid':
+            return a_value in get_header_fields(a_message.body, ['MESSAGE-ID']).lower()
+
+        return a_value in a_message.body.lower()
+
+    def matches(self, a_message):
+        """
+           Check if a_message matches all the terms of the query
+        """
+        for negated, operator, value in self.terms:
+            if self._term_matches(operator, value, a_message) == negated:
+                return False
+        return True
+
+class IMAPSession(SocketServer.BaseRequestHandler):
+    """
+       One connection to the mock Gmail server
+    """
+    READ_CHUNK_SIZE = 16384
+
+    FLAGS = '(\\Answered \\Flagged \\Draft \\Deleted \\Seen $NotPhishing $Phishing)'
+
+    def setup(self):
+        """
+           Initialize the state of the connection
+        """
+        # the continuation requests and the tagged responses are small: do not delay them
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if self.server.certfile:
+            self.request = ssl.wrap_socket(self.request, server_side = True, certfile = self.server.certfile)
+
+        self.mailbox       = self.server.mailbox
+        self.authenticated = False
+        self.folder        = None
+        self.readonly      = True
+        self.compressor    = None
+        self.decompressor  = None
+        self._rbuf         = ''
+        self._search_modseq = False
+
+        self.server.count('connections')
+        self.server.sessions.add(self)
+
+    def finish(self):
+        """
+           End of the connection
+        """
+        self.server.sessions.discard(self)
+
+    def handle(self):
+        """
+           Read and answer the commands until LOGOUT or the end of the connection
+        """
+        try:
+            self.send('* OK Gimap ready for requests from %s mock\r\n' % (self.client_address[0]))
+
+            while True:
+                parts = self.read_command()
+                if parts is None:
+                    return
+
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+
+                if not self.answer(parts):
+                    return
+        except (socket.error, ssl.SSLError, zlib.error), err:
+            LOG.debug("Mock Gmail connection closed: %s\n" % (err))
+
+    def answer(self, a_parts):
+        """
+           Run the command a_parts and send its responses.
+           Return False when the connection has to be closed
+        """
+        tag, _, line = a_parts[0].partition(' ')
+        name, _, args = line.partition(' ')
+        name = name.upper()
+
+        self.server.count('commands')
+
+        responses = []
+        try:
+            if not tag or not name:
+                raise IMAPCommandError('Missing command')
+
+            handler = getattr(self, '_cmd_%s' % (name.lower()), None)
+            if not handler:
+                raise IMAPCommandError('Unknown command %s' % (name))
+
+            if not self.authenticated and name not in ('CAPABILITY', 'NOOP', 'LOGOUT', 'LOGIN', 'AUTHENTICATE'):
+                raise IMAPCommandError('Command received in Invalid state.')
+
+            result = handler(parse_args([args] + a_parts[1:]), responses)
+            responses.append('%s OK %s\r\n' % (tag, result))
+        except IMAPCommandError, err:
+            responses.append('%s %s %s\r\n' % (tag, err.type, err))
+        except (ValueError, IndexError), err:
+            responses.append('%s BAD Invalid Arguments: %s\r\n' % (tag, err))
+
+        self.send(''.join(responses))
+
+        if name == 'COMPRESS' and responses[-1].startswith('%s OK' % (tag)):
+            self._activate_compression()
+
+        return name != 'LOGOUT'
+
+    def _activate_compression(self):
+        """
+           Compress the connection (RFC 4978). Bytes already received are compressed ones
+        """
+        self.decompressor = zlib.decompressobj(-15)
+        self.compressor   = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+        pending, self._rbuf = self._rbuf, ''
+        if pending:
+            self._rbuf = self.decompressor.decompress(pending)
+
+    def _throttle(self, a_nb_bytes):
+        """
+           Wait the time needed to transfer a_nb_bytes with the bandwidth of the server
+        """
+        if self.server.bandwidth:
+            time.sleep(float(a_nb_bytes) / self.server.bandwidth)
+
+    def send(self, a_data):
+        """
+           Send a_data (compressed if the compression is active)
+        """
+        self._throttle(len(a_data))
+        self.server.count('bytes_sent', len(a_data))
+
+        if self.compressor:
+            a_data = self.compressor.compress(a_data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        self.request.sendall(a_data)
+
+    def _fill_buffer(self):
+        """
+           Read one chunk. Return False at the end of the connection
+        """
+        data = self.request.recv(self.READ_CHUNK_SIZE)
+        if not data:
+            return False
+
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+
+        self._throttle(len(data))
+        self.server.count('bytes_received', len(data))
+
+        self._rbuf += data
+        return True
+
+    def readline(self):
+        """
+           Read a line (without its CRLF). Return None at the end of the connection
+        """
+        while '\n' not in self._rbuf:
+            if not self._fill_buffer():
+                return None
+
+        line, self._rbuf = self._rbuf.split('\n', 1)
+        return line.rstrip('\r')
+
+    def read(self, a_size):
+        """
+           Read a literal of a_size bytes. Return None at the end of the connection
+        """
+        while len(self._rbuf) < a_size:
+            if not self._fill_buffer():
+                return None
+
+        data, self._rbuf = self._rbuf[:a_size], self._rbuf[a_size:]
+        return data
+
+    def read_command(self):
+        """
+           Read a command with its literals.
+           Return the text of its lines alternated with its literals or None at the end of the connection
+        """
+        parts = []
+        line  = self.readline()
+        while line is not None:
+            matched = LITERAL_RE.search(line)
+            if not matched:
+                parts.append(line)
+                return parts
+
+            parts.append(line[:matched.start()])
+            if not matched.group('plus'):
+                self.send('+ go ahead\r\n')
+
+            literal = self.read(int(matched.group('size')))
+            if literal is None:
+                return None
+            parts.append(literal)
+
+            line = self.readline()
+
+        return None
+
+    def _get_folder(self):
+        """
+           Return the selected folder
+        """
+        if not self.folder:
+            raise IMAPCommandError('Command received in Invalid state.')
+        return self.mailbox.folders[self.folder]
+
+    #
+    # Commands: _cmd_<name>(args, responses) appends the untagged responses in responses
+    # and returns the text of the tagged OK or raises an IMAPCommandError
+    #
+
+    def _cmd_capability(self, _, a_responses):
+        """
+           CAPABILITY
+        """
+        a_responses.append('* CAPABILITY %s\r\n' % (' '.join(self.server.capabilities)))
+        return 'Thats all she wrote! (Success)'
+
+    def _cmd_noop(self, _, a_responses):
+        """
+           NOOP: send the number of messages of the selected folder
+        """
+        if self.folder:
+            with self.mailbox.lock:
+                a_responses.append('* %d EXISTS\r\n' % (len(self._get_folder().uids)))
+        return 'Success'
+
+    def _cmd_logout(self, _, a_responses):
+        """
+           LOGOUT
+        """
+        a_responses.append('* BYE LOGOUT Requested\r\n')
+        return '73 good day (Success)'
+
+    def _authenticated(self, a_login, a_responses):
+        """
+           Authentication succeeded: send the capabilities
+        """
+        self.authenticated = True
+        self._cmd_capability(None, a_responses)
+        return '%s authenticated (Success)' % (a_login)
+
+    def _cmd_login(self, a_args, a_responses):
+        """
+           LOGIN user password
+        """
+        if len(a_args) != 2:
+            raise IMAPCommandError('Invalid Arguments')
+
+        login, password = a_args
+        if login.lower() != self.mailbox.login.lower() or \
+           (self.mailbox.password is not None and password != self.mailbox.password):
+            raise IMAPCommandError('[AUTHENTICATIONFAILED] Invalid credentials (Failure)', 'NO')
+
+        return self._authenticated(login, a_responses)
+
+    def _cmd_authenticate(self, a_args, a_responses):
+        """
+           AUTHENTICATE XOAUTH|XOAUTH2|PLAIN: the token is not checked
+        """
+        if not a_args or a_args[0].upper() not in ('XOAUTH', 'XOAUTH2', 'PLAIN'):
+            raise IMAPCommandError('Unsupported authentication mechanism', 'NO')
+
+        self.send('+ \r\n')
+        token = self.readline()
+        if not token or token == '*':
+            raise IMAPCommandError('[AUTHENTICATIONFAILED] Invalid credentials (Failure)', 'NO')
+
+        return self._authenticated(self.mailbox.login, a_responses)
+
+    def _cmd_enable(self, a_args, a_responses):
+        """
+           ENABLE CONDSTORE (the mod-sequences are always sent)
+        """
+        enabled = [ arg.upper() for arg in a_args if arg.upper() in ('CONDSTORE',) ]
+        a_responses.append('* ENABLED %s\r\n' % (' '.join(enabled)))
+        return 'Success'
+
+    def _cmd_compress(self, a_args, _):
+        """
+           COMPRESS DEFLATE
+        """
+        if self.compressor:
+            raise IMAPCommandError('[COMPRESSIONACTIVE] DEFLATE active via COMPRESS', 'NO')
+        if not a_args or a_args[0].upper() != 'DEFLATE':
+            raise IMAPCommandError('Unsupported compression mechanism')
+        return 'Success'
+
+    def _list(self, a_command, a_args, a_responses):
+        """
+           LIST and XLIST (with the special folder flags)
+        """
+        if len(a_args) != 2:
+            raise IMAPCommandError('Invalid Arguments')
+
+        pattern = a_args[0] + a_args[1]
+        if not a_args[1]:
+            a_responses.append('* %s (\\Noselect) "/" ""\r\n' % (a_command))
+            return 'Success'
+
+        pattern_re = re.compile('^%s$' % (''.join([ '.*' if char == '*' else '[^/]*' if char == '%' else re.escape(char) \
+                                                      for char in pattern ])))
+        with self.mailbox.lock:
+            names = [self.mailbox.GMAIL] + list(self.mailbox.folders) + sorted(self.mailbox.labels)
+            for name in names:
+                if not pattern_re.match(name):
+                    continue
+
+                has_children = [ other for other in names if other.startswith('%s/' % (name)) ]
+                flags = ['\\HasChildren' if has_children else '\\HasNoChildren']
+                if name == self.mailbox.GMAIL:
+                    flags.insert(0, '\\Noselect')
+                elif a_command == 'XLIST' and name in self.mailbox.folders and self.mailbox.folders[name].special_flag:
+                    flags.append(self.mailbox.folders[name].special_flag)
+
+                a_responses.append('* %s (%s) "/" %s\r\n' % (a_command, ' '.join(flags), quote(name)))
+
+        return 'Success'
+
+    def _cmd_list(self, a_args, a_responses):
+        """
+           LIST reference pattern
+        """
+        return self._list('LIST', a_args, a_responses)
+
+    def _cmd_xlist(self, a_args, a_responses):
+        """
+           XLIST reference pattern
+        """
+        return self._list('XLIST', a_args, a_responses)
+
+    def _select(self, a_args, a_responses, a_readonly):
+        """
+           SELECT and EXAMINE: only the All Mail and Chats folders can be selected
+        """
+        if len(a_args) < 1:
+            raise IMAPCommandError('Invalid Arguments')
+
+        self.folder = None
+        with self.mailbox.lock:
+            if a_args[0] not in self.mailbox.folders:
+                raise IMAPCommandError('[NONEXISTENT] Unknown Mailbox: %s (Failure)' % (a_args[0]), 'NO')
+
+            folder = self.mailbox.folders[a_args[0]]
+            a_responses.append('* FLAGS %s\r\n' % (self.FLAGS))
+            a_responses.append('* OK [PERMANENTFLAGS %s] Flags permitted.\r\n' % \
+                               ('()' if a_readonly else self.FLAGS.replace(')', ' \\*)')))
+            a_responses.append('* OK [UIDVALIDITY %d] UIDs valid.\r\n' % (folder.uidvalidity))
+            a_responses.append('* %d EXISTS\r\n' % (len(folder.uids)))
+            a_responses.append('* 0 RECENT\r\n')
+            a_responses.append('* OK [UIDNEXT %d] Predicted next UID.\r\n' % (folder.next_uid))
+            a_responses.append('* OK [HIGHESTMODSEQ %d]\r\n' % (self.mailbox.highestmodseq))
+
+        self.folder, self.readonly = folder.name, a_readonly
+
+        return '[%s] %s selected. (Success)' % ('READ-ONLY' if a_readonly else 'READ-WRITE', folder.name)
+
+    def _cmd_select(self, a_args, a_responses):
+        """
+           SELECT folder
+        """
+        return self._select(a_args, a_responses, False)
+
+    def _cmd_examine(self, a_args, a_responses):
+        """
+           EXAMINE folder
+        """
+        return self._select(a_args, a_responses, True)
+
+    def _cmd_close(self, _, a_responses):
+        """
+           CLOSE: expunge and unselect
+        """
+        if not self.readonly:
+            self._cmd_expunge(None, [])
+        return self._cmd_unselect(None, a_responses)
+
+    def _cmd_unselect(self, _, a_responses): #pylint:disable-msg=W0613
+        """
+           UNSELECT
+        """
+        self._get_folder()
+        self.folder = None
+        return 'Returned to authenticated state. (Success)'
+
+    def _cmd_expunge(self, _, a_responses):
+        """
+           EXPUNGE: remove the messages flagged \\Deleted
+        """
+        if self.readonly:
+            raise IMAPCommandError('EXPUNGE attempt on READ-ONLY folder (Failure)', 'NO')
+
+        with self.mailbox.lock:
+            folder = self._get_folder()
+            for uid in list(folder.uids):
+                if '\\Deleted' in folder.messages[uid].flags:
+                    a_responses.append('* %d EXPUNGE\r\n' % (folder.remove(uid)))
+            self.mailbox.next_modseq()
+
+        return 'Success'
+
+    def _cmd_create(self, a_args, _):
+        """
+           CREATE label
+        """
+        if len(a_args) != 1 or not a_args[0]:
+            raise IMAPCommandError('Invalid Arguments')
+
+        with self.mailbox.lock:
+            if self.mailbox.get_label(a_args[0]) or a_args[0].lower() in [ name.lower() for name in self.mailbox.folders ] \
+               or a_args[0].lower() in ('inbox', self.mailbox.GMAIL.lower()):
+                raise IMAPCommandError('[ALREADYEXISTS] Duplicate folder name %s (Failure)' % (a_args[0]), 'NO')
+            self.mailbox.add_labels([a_args[0].rstrip('/')])
+
+        return 'Success'
+
+    def _cmd_delete(self, a_args, _):
+        """
+           DELETE label: the label is removed from the messages
+        """
+        if len(a_args) != 1:
+            raise IMAPCommandError('Invalid Arguments')
+
+        with self.mailbox.lock:
+            label = self.mailbox.get_label(a_args[0])
+            if not label:
+                raise IMAPCommandError('[NONEXISTENT] Unknown Mailbox: %s (Failure)' % (a_args[0]), 'NO')
+
+            self.mailbox.labels.discard(label)
+            modseq = self.mailbox.next_modseq()
+            for folder in self.mailbox.folders.values():
+                for message in folder.messages.itervalues():
+                    if label in message.labels:
+                        message.labels.remove(label)
+                        message.modseq = modseq
+
+        return 'Success'
+
+    def _cmd_append(self, a_args, _):
+        """
+           APPEND folder (flags) date-time {literal} [(flags) date-time {literal} ...] (MULTIAPPEND)
+           Return the uids with the APPENDUID response code
+        """
+        if len(a_args) < 2:
+            raise IMAPCommandError('Invalid Arguments')
+
+        emails, args = [], a_args[1:]
+        while args:
+            flags, date_time = [], None
+            if isinstance(args[0], list):
+                flags = args.pop(0)
+            if args and not isinstance(args[0], Literal):
+                date_time = parse_date_time(args.pop(0))
+            if not args or not isinstance(args[0], Literal) or not args[0]:
+                raise IMAPCommandError('Invalid Arguments: Unable to parse message')
+            emails.append((flags, date_time, args.pop(0)))
+
+        if len(emails) > 1 and 'MULTIAPPEND' not in self.server.capabilities:
+            raise IMAPCommandError('Invalid Arguments: Unable to parse message')
+
+        with self.mailbox.lock:
+            # appending to a label folder labels the messages
+            label = self.mailbox.get_label(a_args[0])
+            if a_args[0] != self.mailbox.ALL_MAIL and not label:
+                raise IMAPCommandError("[TRYCREATE] Folder doesn't exist. (Failure)", 'NO')
+
+            uids = [ self.mailbox.add_email(body, [label] if label else [], flags, date_time).uid \
+                     for flags, date_time, body in emails ]
+            uidvalidity = self.mailbox.folders[self.mailbox.ALL_MAIL].uidvalidity
+
+        if not self.server.appenduid:
+            return '(Success)'
+
+        return '[APPENDUID %d %s] (Success)' % (uidvalidity, str(uids[0]) if len(uids) == 1 else '%d:%d' % (uids[0], uids[-1]))
+
+    def _cmd_uid(self, a_args, a_responses):
+        """
+           UID FETCH, UID SEARCH and UID STORE
+        """
+        if not a_args or not isinstance(a_args[0], str):
+            raise IMAPCommandError('Invalid Arguments')
+
+        command = a_args[0].upper()
+        if command not in ('FETCH', 'SEARCH', 'STORE'):
+            raise IMAPCommandError('Unknown command UID %s' % (command))
+
+        return getattr(self, '_%s' % (command.lower()))(a_args[1:], a_responses, True)
+
+    def _cmd_fetch(self, a_args, a_responses):
+        """
+           FETCH with sequence numbers
+        """
+        return self._fetch(a_args, a_responses, False)
+
+    def _cmd_search(self, a_args, a_responses):
+        """
+           SEARCH with sequence numbers
+        """
+        return self._search(a_args, a_responses, False)
+
+    def _cmd_store(self, a_args, a_responses):
+        """
+           STORE with sequence numbers
+        """
+        return self._store(a_args, a_responses, False)
+
+    def _get_fetch_item(self, a_item, a_message): #pylint:disable-msg=R0911,R0912
+        """
+           Return the FETCH response of a_item for a_message
+        """
+        item = a_item.upper()
+        if item == 'UID':
+            return 'UID %d' % (a_message.uid)
+        elif item == 'FLAGS':
+            return 'FLAGS (%s)' % (' '.join(a_message.flags))
+        elif item == 'INTERNALDATE':
+            return 'INTERNALDATE "%s"' % (imap_date_time(a_message.internal_date))
+        elif item == 'RFC822.SIZE':
+            return 'RFC822.SIZE %d' % (len(a_message.body))
+        elif item == 'X-GM-MSGID':
+            return 'X-GM-MSGID %d' % (a_message.gm_id)
+        elif item == 'X-GM-THRID':
+            return 'X-GM-THRID %d' % (a_message.thread_id)
+        elif item == 'X-GM-LABELS':
+            return 'X-GM-LABELS (%s)' % (' '.join([ quote(label) for label in a_message.labels ]))
+        elif item == 'MODSEQ':
+            return 'MODSEQ (%d)' % (a_message.modseq)
+        elif item in ('RFC822', 'RFC822.HEADER'):
+            data = a_message.body if item == 'RFC822' else get_header(a_message.body) + '\r\n\r\n'
+            return '%s {%d}\r\n%s' % (item, len(data), data)
+        elif item.startswith('BODY[') or item.startswith('BODY.PEEK['):
+            section = a_item[a_item.index('[') + 1:a_item.rindex(']')]
+            if not section:
+                data = a_message.body
+            elif section.upper() == 'HEADER':
+                data = get_header(a_message.body) + '\r\n\r\n'
+            elif section.upper() == 'TEXT':
+                data = a_message.body[len(get_header(a_message.body)):].lstrip('\r\n')
+            elif section.upper().startswith('HEADER.FIELDS ('):
+                data = get_header_fields(a_message.body, section[len('HEADER.FIELDS ('):-1].upper().split())
+            else:
+                raise IMAPCommandError('Unsupported section %s' % (section))
+            return 'BODY[%s] {%d}\r\n%s' % (section, len(data), data)
+
+        raise IMAPCommandError('Unknown fetch item %s' % (a_item))
+
+    def _fetch(self, a_args, a_responses, a_use_uid):
+        """
+           [UID] FETCH set (items) [(CHANGEDSINCE modseq)]
+        """
+        if len(a_args) < 2:
+            raise IMAPCommandError('Invalid Arguments')
+
+        items = [ item for item in to_list(a_args[1]) ]
+        if [ item for item in items if not isinstance(item, str) ]:
+            raise IMAPCommandError('Invalid fetch items')
+        if [ item for item in items if item.upper() == 'FAST' ]:
+            items = ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE']
+        if a_use_uid and 'UID' not in [ item.upper() for item in items ]:
+            items.append('UID')
+
+        changed_since = None
+        if len(a_args) > 2:
+            modifiers = to_list(a_args[2])
+            if len(modifiers) != 2 or modifiers[0].upper() != 'CHANGEDSINCE':
+                raise IMAPCommandError('Invalid fetch modifiers')
+            changed_since = int(modifiers[1])
+            items.append('MODSEQ')
+
+        with self.mailbox.lock:
+            for seq, message in self._get_folder().get_set(a_args[0], a_use_uid):
+                if changed_since is not None and message.modseq <= changed_since:
+                    continue
+
+                # fetching the body without PEEK sets \Seen
+                if not self.readonly and '\\Seen' not in message.flags and \
+                   [ item for item in items if item.upper().startswith('BODY[') or item.upper() == 'RFC822' ]:
+                    message.flags.append('\\Seen')
+                    message.modseq = self.mailbox.next_modseq()
+
+                a_responses.append('* %d FETCH (%s)\r\n' % (seq, ' '.join([ self._get_fetch_item(item, message) \
+                                                                             for item in items ])))
+
+        return 'Success'
+
+    def _store(self, a_args, a_responses, a_use_uid):
+        """
+           [UID] STORE set [+-]FLAGS[.SILENT]|[+-]X-GM-LABELS[.SILENT] values
+        """
+        if len(a_args) != 3 or not isinstance(a_args[1], str):
+            raise IMAPCommandError('Invalid Arguments')
+        if self.readonly:
+            raise IMAPCommandError('STORE attempt on READ-ONLY folder (Failure)', 'NO')
+
+        item   = a_args[1].upper()
+        silent = item.endswith('.SILENT')
+        item   = item[:-len('.SILENT')] if silent else item
+        action = item[0] if item[0] in '+-' else ''
+        attr   = item.lstrip('+-')
+        if attr not in ('FLAGS', 'X-GM-LABELS'):
+            raise IMAPCommandError('Invalid STORE item %s' % (a_args[1]))
+        values = to_list(a_args[2])
+
+        with self.mailbox.lock:
+            if attr == 'X-GM-LABELS' and action != '-':
+                self.mailbox.add_labels(values)
+                values = [ value if value.startswith('\\') else self.mailbox.get_label(value) for value in values ]
+
+            for seq, message in self._get_folder().get_set(a_args[0], a_use_uid):
+                current = message.flags if attr == 'FLAGS' else message.labels
+                if action == '+':
+                    current.extend([ value for value in values if value not in current ])
+                elif action == '-':
+                    current[:] = [ value for value in current if value.lower() not in [ val.lower() for val in values ] ]
+                else:
+                    current[:] = values
+                message.modseq = self.mailbox.next_modseq()
+
+                if not silent:
+                    a_responses.append('* %d FETCH (%s UID %d MODSEQ (%d))\r\n' % (seq, self._get_fetch_item(attr, message), \
+                                                                                   message.uid, message.modseq))
+
+        return 'Success'
+
+    def _parse_search_key(self, a_args, a_folder, a_use_uid): #pylint:disable-msg=R0911,R0912
+        """
+           Pop the first search key of a_args and return its predicate (seq, message) => bool
+        """
+        if not a_args:
+            raise IMAPCommandError('Invalid search criteria')
+
+        arg = a_args.pop(0)
+        if isinstance(arg, list):
+            predicates = self._parse_search_keys(list(arg), a_folder, a_use_uid)
+            return lambda seq, msg: all([ pred(seq, msg) for pred in predicates ])
+
+        key = arg.upper()
+        if key == 'ALL':
+            return lambda seq, msg: True
+        elif key == 'NOT':
+            pred = self._parse_search_key(a_args, a_folder, a_use_uid)
+            return lambda seq, msg: not pred(seq, msg)
+        elif key == 'OR':
+            first, second = self._parse_search_key(a_args, a_folder, a_use_uid), self._parse_search_key(a_args, a_folder, a_use_uid)
+            return lambda seq, msg: first(seq, msg) or second(seq, msg)
+        elif key in ('SEEN', 'UNSEEN', 'DELETED', 'UNDELETED', 'FLAGGED', 'UNFLAGGED'):
+            flag = '\\%s' % (key[2:] if key.startswith('UN') else key).capitalize()
+            return lambda seq, msg: (flag in msg.flags) != key.startswith('UN')
+        elif key == 'UID':
+            uids = set([ msg.uid for _, msg in a_folder.get_set(a_args.pop(0), True) ])
+            return lambda seq, msg: msg.uid in uids
+        elif re.match(r'^[0-9*][0-9:,*]*$', arg):
+            # sequence set (sequence numbers in SEARCH, uids in UID SEARCH)
+            seqs = set([ seq for seq, _ in a_folder.get_set(arg, False) ])
+            return lambda seq, msg: seq in seqs
+
+        if not a_args:
+            raise IMAPCommandError('Missing value for %s' % (key))
+        value = a_args.pop(0)
+
+        if key in ('SINCE', 'BEFORE', 'ON'):
+            the_date = parse_search_date(value)
+            return { 'SINCE'  : lambda seq, msg: msg.internal_date.date() >= the_date,
+                     'BEFORE' : lambda seq, msg: msg.internal_date.date() < the_date,
+                     'ON'     : lambda seq, msg: msg.internal_date.date() == the_date }[key]
+        elif key in ('X-GM-MSGID', 'X-GM-THRID'):
+            the_id = long(value)
+            return lambda seq, msg: (msg.gm_id if key == 'X-GM-MSGID' else msg.thread_id) == the_id
+        elif key == 'X-GM-LABELS':
+            return lambda seq, msg: value.lower() in [ label.lower() for label in msg.labels ]
+        elif key == 'X-GM-RAW':
+            query = GmailQuery(value)
+            return lambda seq, msg: query.matches(msg)
+        elif key == 'MODSEQ':
+            # MODSEQ [entry-name entry-type-req] modseq
+            if not value.isdigit() and len(a_args) >= 2:
+                a_args.pop(0)
+                value = a_args.pop(0)
+            modseq = long(value)
+            self._search_modseq = True
+            return lambda seq, msg: msg.modseq >= modseq
+        elif key in ('SUBJECT', 'FROM', 'TO'):
+            return lambda seq, msg: value.lower() in get_header_fields(msg.body, [key]).lower()
+        elif key == 'HEADER':
+            # HEADER field-name string
+            if not a_args:
+                raise IMAPCommandError('Missing value for %s %s' % (key, value))
+            field, the_str = value.upper(), a_args.pop(0)
+            return lambda seq, msg: the_str.lower() in get_header_fields(msg.body, [field]).lower()
+
+        raise IMAPCommandError('Unsupported search key %s' % (arg))
+
+    def _parse_search_keys(self, a_args, a_folder, a_use_uid):
+        """
+           Return the predicates of all the search keys of a_args
+        """
+        predicates = []
+        while a_args:
+            predicates.append(self._parse_search_key(a_args, a_folder, a_use_uid))
+        return predicates
+
+    def _search(self, a_args, a_responses, a_use_uid):
+        """
+           [UID] SEARCH [CHARSET charset] criteria
+        """
+        args = list(a_args)
+        if args and isinstance(args[0], str) and args[0].upper() == 'CHARSET':
+            args = args[2:]
+        if not args:
+            raise IMAPCommandError('Invalid search criteria')
+
+        with self.mailbox.lock:
+            folder     = self._get_folder()
+            # the response ends with the highest mod-sequence when MODSEQ is used
+            self._search_modseq = False
+            predicates = self._parse_search_keys(args, folder, a_use_uid)
+
+            matched = []
+            for index, uid in enumerate(folder.uids):
+                message = folder.messages[uid]
+                if all([ pred(index + 1, message) for pred in predicates ]):
+                    matched.append((index + 1, message))
+
+        result = ' '.join([ str(message.uid if a_use_uid else seq) for seq, message in matched ])
+        if self._search_modseq and matched:
+            result += ' (MODSEQ %d)' % (max([ message.modseq for _, message in matched ]))
+
+        a_responses.append('* SEARCH%s\r\n' % (' %s' % (result) if result else ''))
+
+        return 'SEARCH completed (Success)'
+
+class MockGmailServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+       Fake Gmail IMAP server listening on a_host:a_port (a free port by default) in a thread of the process.
+       - a_latency  : time (sec) added to each command
+       - a_bandwidth: bytes/sec sent and received by each connection (0 for no limit)
+       - a_multiappend: support MULTIAPPEND (RFC 3502)
+       - a_appenduid: return the APPENDUID response code of the APPEND commands (Gmail does not always return it)
+       - a_certfile : certificate and key (pem) to use SSL
+    """
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    CAPABILITIES = ['IMAP4rev1', 'UNSELECT', 'IDLE', 'NAMESPACE', 'QUOTA', 'ID', 'XLIST', 'CHILDREN', 'X-GM-EXT-1', \
+                    'UIDPLUS', 'COMPRESS=DEFLATE', 'ENABLE', 'CONDSTORE', 'AUTH=XOAUTH', 'AUTH=XOAUTH2']
+
+    def __init__(self, a_mailbox = None, a_host = '127.0.0.1', a_port = 0, a_latency = 0, a_bandwidth = 0, \
+                 a_multiappend = True, a_certfile = None, a_appenduid = True): #pylint:disable-msg=R0913
+        """
+           constructor
+        """
+        SocketServer.TCPServer.__init__(self, (a_host, a_port), IMAPSession)
+
+        self.host, self.port = self.server_address
+
+        self.mailbox      = a_mailbox or MockMailbox()
+        self.latency      = a_latency
+        self.bandwidth    = a_bandwidth
+        self.certfile     = a_certfile
+        self.capabilities = self.CAPABILITIES + (['MULTIAPPEND'] if a_multiappend else [])
+        self.appenduid    = a_appenduid
+
+        self._stats_lock  = threading.Lock()
+        self.stats        = { 'connections' : 0, 'commands' : 0, 'bytes_sent' : 0, 'bytes_received' : 0 }
+        self.sessions     = set()
+        self._thread      = None
+
+    def count(self, a_stat, a_value = 1):
+        """
+           Increment the stat a_stat (connections, commands, bytes_sent, bytes_received)
+        """
+        with self._stats_lock:
+            self.stats[a_stat] += a_value
+
+    def start(self):
+        """
+           Serve in a daemon thread. Return the server
+        """
+        self._thread = threading.Thread(target = self.serve_forever, kwargs = { 'poll_interval' : 0.1 })
+        self._thread.daemon = True
+        self._thread.start()
+
+        LOG.debug("Mock Gmail server listening on %s:%d\n" % (self.host, self.port))
+
+        return self
+
+    def stop(self):
+        """
+           Stop serving, close the open connections and the listening socket
+        """
+        if self._thread:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+
+        for session in list(self.sessions):
+            try:
+                session.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass # already closed
+
+        self.server_close()
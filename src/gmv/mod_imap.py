@@ -24,7 +24,6 @@ import datetime
 import re
 import socket
 import ssl
-import cStringIO
 
 import imaplib  #for the exception
 import imapclient
@@ -74,9 +73,23 @@ imapclient.response_parser._convert_INTERNALDATE = mod_convert_INTERNALDATE
 #monkey patching add compress in COMMANDS of imap
 imaplib.Commands['COMPRESS'] = ('AUTH', 'SELECTED')
 
+#monkey patching add enable (RFC 5161) in COMMANDS of imap
+imaplib.Commands['ENABLE'] = ('AUTH', 'SELECTED')
+
+# end of a SEARCH response when the MODSEQ criteria is used (RFC 7162)
+SEARCH_MODSEQ_RE = re.compile(r'\(MODSEQ [0-9]+\)')
+
+# gmail id in a FETCH response
+GMAIL_ID_RE = re.compile(r'X-GM-MSGID (?P<gm_id>[0-9]+)')
+
 class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable-msg=R0904
 
     SOCK_TIMEOUT = 70 # set a socket timeout of 70 sec to avoid for ever blockage in ssl.read
+    
+    READ_CHUNK_SIZE   = 16384 # never ask more than 16384 bytes to the ssl layer or the decompressor
+    MAX_BUFFER_WASTE  = 65536 # compact the receive buffer when more than that has been consumed
+    
+    literal_sink = None # when set, the literals are written in it instead of being returned by read (see MonkeyIMAPClient.fetch_to_sink)
 
     """
        Add support for compression inspired by inspired by http://www.janeelix.com/piers/python/py2html.cgi/piers/python/imaplib2
@@ -88,8 +101,18 @@ class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable-msg=R0904
         self.compressor = None
         self.decompressor = None
         
+        self._reset_buffer()
+        
         imaplib.IMAP4_SSL.__init__(self, host, port, keyfile, certfile)
         
+    def _reset_buffer(self):
+        """
+           Empty the receive buffer.
+           _rbuf holds the bytes received and not yet consumed from _rpos
+        """
+        self._rbuf = bytearray()
+        self._rpos = 0
+        
     def activate_compression(self):
         """
            activate_compressing()
@@ -99,6 +122,14 @@ class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable-msg=R0904
         self.decompressor = zlib.decompressobj(-15)
         self.compressor   = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
         
+        # bytes already buffered after the COMPRESS answer are compressed ones
+        if self._rpos < len(self._rbuf):
+            pending = str(self._rbuf[self._rpos:])
+            self._reset_buffer()
+            self._rbuf.extend(self.decompressor.decompress(pending))
+        else:
+            self._reset_buffer()
+        
     def open(self, host = '', port = imaplib.IMAP4_SSL_PORT): 
             """Setup connection to remote server on "host:port".
                 (default: localhost:standard IMAP4 SSL port).
@@ -109,30 +140,89 @@ class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable-msg=R0904
             self.port   = port
             
             self.sock   = socket.create_connection((host, port), self.SOCK_TIMEOUT) #add so_timeout  
+            # imaplib sends the literals and the end of the commands separately (APPEND): do not wait for the acks
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
             self.sslobj = ssl.wrap_socket(self.sock, self.keyfile, self.certfile)
             
-            # This is the last correction added to avoid memory fragmentation in imaplib
-            # makefile creates a file object that makes use of cStringIO to avoid mem fragmentation
-            # it could be used without the compression 
-            # (maybe make 2 set of methods without compression and with compression)
-            #self.file   = self.sslobj.makefile('rb')
+            # reads are done through our own receive buffer (see read and readline)
+            # instead of self.sslobj.makefile('rb') in order to handle the compression
+            self._reset_buffer()
+    
+    def _fill_buffer(self):
+        """
+           Read one chunk from remote and append it to the receive buffer.
+           Compact the buffer first if too many bytes have already been consumed.
+        """
+        if self._rpos >= len(self._rbuf):
+            self._reset_buffer()
+        elif self._rpos > self.MAX_BUFFER_WASTE:
+            del self._rbuf[:self._rpos]
+            self._rpos = 0
+        
+        data = self._intern_read(self.READ_CHUNK_SIZE)
+        if not data: 
+            raise self.abort('Gmvault ssl socket error: EOF') #to avoid infinite looping due to empty string returned
+        
+        self._rbuf.extend(data)
     
     def read(self, size):
         """
             Read 'size' bytes from remote.
-            Call _intern_read that takes care of the compression
+            Serve them from the receive buffer that is filled by _intern_read 
+            (that takes care of the compression)
+        """
+        if self.literal_sink is not None:
+            return self._read_to_sink(size)
+        
+        if size > self.READ_CHUNK_SIZE:
+            return self._read_big(size)
+        
+        while len(self._rbuf) - self._rpos < size:
+            self._fill_buffer()
+        
+        rpos = self._rpos
+        self._rpos = rpos + size
+        return str(self._rbuf[rpos:self._rpos])
+    
+    def _read_big(self, size):
+        """
+            Read 'size' bytes (a big literal) from remote.
+            Empty the receive buffer and read the rest directly to avoid
+            copying the literal in the buffer
         """
+        avail  = len(self._rbuf) - self._rpos
+        chunks = [ str(self._rbuf[self._rpos:]) ] if avail > 0 else []
+        self._reset_buffer()
         
-        chunks = cStringIO.StringIO() #use cStringIO.cStringIO to avoir too much fragmentation
-        read = 0
+        read = avail
         while read < size:
-            data = self._intern_read(min(size-read, 16384)) #never ask more than 16384 because imaplib can do it
+            data = self._intern_read(min(size-read, self.READ_CHUNK_SIZE)) 
             if not data: raise self.abort('Gmvault ssl socket error: EOF') #to avoid infinite looping due to empty string returned
             read += len(data)
-            chunks.write(data)
+            chunks.append(data)
         
-        return chunks.getvalue() #return the cStringIO content
+        return ''.join(chunks)
+    
+    def _read_to_sink(self, size):
+        """
+            Read 'size' bytes (a literal) from remote and write them in the literal sink
+            chunk by chunk so the literal is never entirely in memory.
+            Return an empty string in place of the literal
+        """
+        avail = len(self._rbuf) - self._rpos
+        if avail > 0:
+            self.literal_sink.write(str(self._rbuf[self._rpos:self._rpos + min(avail, size)]))
+            self._rpos += min(avail, size)
+        
+        read = min(avail, size)
+        while read < size:
+            data = self._intern_read(min(size-read, self.READ_CHUNK_SIZE)) 
+            if not data: raise self.abort('Gmvault ssl socket error: EOF') #to avoid infinite looping due to empty string returned
+            read += len(data)
+            self.literal_sink.write(data)
+        
+        return ''
   
     def _intern_read(self, size):
         """
@@ -141,24 +231,35 @@ class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable-msg=R0904
         """
         if self.decompressor is None:
             return self.sslobj.read(size)
-
-        if self.decompressor.unconsumed_tail:
-            data = self.decompressor.unconsumed_tail
-        else:
-            data = self.sslobj.read(8192) #maybe change to 16384
-
-        return self.decompressor.decompress(data, size)
+        
+        while True:
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.unconsumed_tail
+            else:
+                data = self.sslobj.read(8192) #maybe change to 16384
+                if not data:
+                    return data
+            
+            data = self.decompressor.decompress(data, size)
+            # a deflate block can be split over several ssl records
+            # in that case nothing is decompressed so read more
+            if data:
+                return data
         
     def readline(self):
         """Read line from remote."""
-        line = cStringIO.StringIO() #use cStringIO to avoid memory fragmentation
+        start = self._rpos
         while 1:
-            #make use of read that takes care of the compression
-            #it could be simplified without compression
-            char = self.read(1) 
-            line.write(char)
-            if char in ("\n", ""): 
-                return line.getvalue()
+            idx = self._rbuf.find('\n', start)
+            if idx >= 0:
+                line = str(self._rbuf[self._rpos:idx+1])
+                self._rpos = idx + 1
+                return line
+            
+            # no newline in what is buffered: remember where to restart the search
+            start = len(self._rbuf) - self._rpos
+            self._fill_buffer()
+            start += self._rpos
     
     def shutdown(self):
         """Close I/O established in "open"."""
@@ -173,6 +274,52 @@ class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable-msg=R0904
             data = self.compressor.compress(data)
             data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
         self.sslobj.sendall(data)
+
+class PlainSocketObj(object): #pylint:disable-msg=R0903
+    """
+       Give to a plain socket the read and sendall methods of an ssl socket
+    """
+    def __init__(self, sock):
+        """
+           constructor
+        """
+        self.sock = sock
+    
+    def read(self, size):
+        """
+           Read at most size bytes
+        """
+        return self.sock.recv(size)
+    
+    def sendall(self, data):
+        """
+           Send all the data
+        """
+        self.sock.sendall(data)
+
+class IMAP4COMP(IMAP4COMPSSL): #pylint:disable-msg=R0904
+    """
+       IMAP4COMPSSL without SSL (compression and literal sink included) to talk to a local IMAP server
+       such as the mock Gmail server of the tests and benchmarks
+    """
+    def __init__(self, host = '', port = imaplib.IMAP4_PORT):
+        """
+           constructor
+        """
+        IMAP4COMPSSL.__init__(self, host, port)
+    
+    def open(self, host = '', port = imaplib.IMAP4_PORT):
+        """Setup connection to remote server on "host:port" without SSL."""
+        self.host   = host
+        self.port   = port
+        
+        self.sock   = socket.create_connection((host, port), self.SOCK_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
+        # the reads and writes of IMAP4COMPSSL go through sslobj
+        self.sslobj = PlainSocketObj(self.sock)
+        
+        self._reset_buffer()
        
 def seq_to_parenlist(flags):
     """Convert a sequence of strings into parenthised list string for
@@ -198,11 +345,33 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable-msg=R0903
     
     def _create_IMAP4(self): #pylint:disable-msg=C0103
         """
-           Factory method creating an IMAPCOMPSSL or a standard IMAP4 Class
+           Factory method creating an IMAPCOMPSSL or an IMAP4COMP Class
         """
-        ImapClass = self.ssl and IMAP4COMPSSL or imaplib.IMAP4
+        ImapClass = self.ssl and IMAP4COMPSSL or IMAP4COMP
         return ImapClass(self.host, self.port)
     
+    def fetch_to_sink(self, messages, parts, sink):
+        """
+           Like fetch but the literals of the response (the email bodies) are written in sink 
+           (object with a write method) and replaced by empty strings in the result.
+           Fetch one email at a time otherwise the bodies will be concatenated in the sink.
+        """
+        if not hasattr(self._imap, 'literal_sink'):
+            # standard imaplib class: the literals cannot be streamed 
+            response = self.fetch(messages, parts)
+            for data in response.values():
+                for key, val in data.items():
+                    if key.startswith('BODY[') and isinstance(val, str):
+                        sink.write(val)
+                        data[key] = ''
+            return response
+        
+        self._imap.literal_sink = sink
+        try:
+            return self.fetch(messages, parts)
+        finally:
+            self._imap.literal_sink = None
+    
     def xoauth_login(self, xoauth_cred ):
         """
            Connect with xoauth
@@ -240,6 +409,41 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable-msg=R0903
 
         return [ long(i) for i in data[0].split() ]
     
+    def search_changed_since(self, criteria, modseq):
+        """
+           Perform a imap search restricted to the messages whose mod-sequence
+           is greater than modseq (CONDSTORE has to be enabled)
+        """
+        typ, data = self._imap.uid('SEARCH', '(%s)' % (criteria), 'MODSEQ', '%d' % (modseq + 1))
+        
+        self._checkok('search', typ, data)
+        if data == [None]: # no untagged responses...
+            return [ ]
+        
+        # the ids are followed by the highest mod-sequence of the matched messages
+        return [ long(i) for i in SEARCH_MODSEQ_RE.sub('', data[0]).split() ]
+    
+    def fetch_gmail_ids(self, first_uid, last_uid):
+        """
+           Return the gmail ids of the messages of the uid range first_uid:last_uid.
+           The FETCH responses are parsed directly instead of going through the generic response parser
+        """
+        typ, data = self._imap.uid('FETCH', '%d:%d' % (first_uid, last_uid), '(X-GM-MSGID)')
+        
+        self._checkok('fetch', typ, data)
+        if data == [None]: # no untagged responses...
+            return [ ]
+        
+        gm_ids = []
+        for item in data:
+            matched = GMAIL_ID_RE.search(item) if isinstance(item, str) else None
+            if matched:
+                gm_ids.append(long(matched.group('gm_id')))
+            elif 'X-GM-MSGID' in str(item):
+                raise imaplib.IMAP4.error('Cannot parse the FETCH response %r' % (item,))
+        
+        return gm_ids
+    
     def append(self, folder, msg, flags=(), msg_time=None):
         """Append a message to *folder*.
 
@@ -269,7 +473,58 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable-msg=R0903
         self._checkok('append', typ, data)
 
         return data[0]
-    
+
+    def multiappend(self, folder, msgs):
+        """Append several messages to *folder* with a single APPEND
+        command (MULTIAPPEND extension, RFC 3502).
+
+        *msgs* is a sequence of (msg, flags, msg_time) as taken by
+        append. The server appends all the messages or none of them.
+
+        Returns the APPEND response as returned by the server.
+        """
+        imap = self._imap
+
+        for typ in ('OK', 'NO', 'BAD'):
+            if typ in imap.untagged_responses:
+                del imap.untagged_responses[typ]
+
+        # one "(flags) date {size}" header per message followed by its literal
+        parts = []
+        for msg, flags, msg_time in msgs:
+            literal = imaplib.MapCRLF.sub(imaplib.CRLF, msg)
+            if msg_time:
+                date = ' %s' % imaplib.Time2Internaldate(time.mktime(msg_time.timetuple()))
+            else:
+                date = ''
+            parts.append(('%s%s {%d}' % (seq_to_parenlist(flags), date, len(literal)), literal))
+
+        tag  = imap._new_tag()
+        line = '%s APPEND %s' % (tag, imap._checkquote(self._encode_folder_name(folder)))
+        try:
+            for header, literal in parts:
+                imap.send('%s %s%s' % (line, header, imaplib.CRLF))
+                line = ''
+
+                # wait for the continuation response
+                while imap._get_response():
+                    if imap.tagged_commands[tag]: # BAD/NO?
+                        break
+                if imap.tagged_commands[tag]:
+                    break
+
+                imap.send(literal)
+            else:
+                # end of the command
+                imap.send(imaplib.CRLF)
+        except (socket.error, OSError), val:
+            raise imap.abort('socket error: %s' % val)
+
+        typ, data = imap._command_complete('APPEND', tag)
+        self._checkok('append', typ, data)
+
+        return data[0]
+
     def enable_compression(self):
         """
         enable_compression()
@@ -284,5 +539,14 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable-msg=R0903
         else:
             #no errors for the moment
             pass
+    
+    def enable_condstore(self):
+        """
+           Ask the server to enable CONDSTORE (RFC 7162). The SELECT responses then
+           contain the HIGHESTMODSEQ of the folder.
+           Return True if enabled
+        """
+        ret_code, _ = self._imap._simple_command('ENABLE', 'CONDSTORE')
+        return ret_code == 'OK'
 
         
@@ -0,0 +1,229 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the RateController shared by the connections to Gmail: it measures the latency and the errors
+of the IMAP commands and adapts the size of the batches and the number of active connections with AIMD
+(additive increase, multiplicative decrease). A throttled response of Gmail pauses all the connections.
+
+'''
+import re
+import time
+import socket
+import imaplib
+import threading
+
+import log_utils
+
+LOG = log_utils.LoggerFactory.get_logger('rate_utils')
+
+# response codes (RFC 5530) and messages of Gmail when it limits an account
+THROTTLED_RE = re.compile(r'\[(THROTTLED|UNAVAILABLE)\]|too many simultaneous connections|bandwidth limit', re.IGNORECASE)
+
+def get_throttle_code(a_error):
+    """
+       Return THROTTLED or UNAVAILABLE if a_error is a throttled response of Gmail otherwise None.
+       The too many simultaneous connections and bandwidth limits errors are THROTTLED
+    """
+    match = THROTTLED_RE.search(str(a_error))
+    if not match:
+        return None
+
+    return match.group(1).upper() if match.group(1) else RateController.THROTTLED
+
+class RateController(object):
+    """
+       AIMD controller of the IMAP exchanges of all the connections.
+       - each command is run with call (or measured with on_success/on_error)
+       - a throttled response or a connection error halves the batch ratio (get_batch_size), a throttled response
+         also halves the number of connections sending commands (wait) and pauses all of them.
+         The pause doubles with each error (up to a_max_delay)
+       - every a_increase_every successful commands, if their latency is not increasing, the batch ratio grows of
+         one tenth and one more connection can send commands
+    """
+    THROTTLED   = 'THROTTLED'
+    UNAVAILABLE = 'UNAVAILABLE'
+
+    ALPHA          = 0.2  # weight of the last measure in the moving averages
+    LATENCY_FACTOR = 2    # latency over LATENCY_FACTOR x its baseline => no increase
+    MIN_LATENCY    = 0.05 # latencies under it (sec) are not significant
+
+    def __init__(self, a_increase_every = 20, a_min_batch_ratio = 0.1, a_min_delay = 2, a_max_delay = 300):
+        """
+           a_increase_every : number of successful commands between two increases
+           a_min_batch_ratio: min ratio of the configured batch sizes
+           a_min_delay      : pause (sec) after a first error
+           a_max_delay      : max pause (sec)
+        """
+        self._lock           = threading.Lock()
+        self._increase_every = max(1, a_increase_every)
+        self._min_ratio      = a_min_batch_ratio
+        self._min_delay      = a_min_delay
+        self._max_delay      = a_max_delay
+
+        self.batch_ratio     = 1.0  # ratio of the configured batch sizes used
+        self.concurrency     = 1    # number of connections allowed to send commands
+        self.max_concurrency = 1
+        self.latency         = None # moving average of the latency of the commands (sec)
+        self.error_rate      = 0.0  # moving average of the failed commands
+        self.nb_throttled    = 0
+
+        self._workers        = set() # connections used in parallel and still running
+        self._latencies      = {}    # command => (moving average, baseline)
+        self._nb_successes   = 0
+        self._delay          = 0
+        self._pause_until    = 0
+
+    def set_workers(self, a_nb_workers):
+        """
+           Set the number of connections used in parallel (workers 0 to a_nb_workers - 1).
+           Once throttled, the number of active connections restarts from the current one
+        """
+        with self._lock:
+            self._workers        = set(xrange(a_nb_workers))
+            self.max_concurrency = max(1, a_nb_workers)
+            if self.nb_throttled:
+                self.concurrency = min(self.concurrency, self.max_concurrency)
+            else:
+                self.concurrency = self.max_concurrency
+
+    def get_batch_size(self, a_size):
+        """
+           Return the size to use for a batch configured to a_size
+        """
+        return max(1, int(round(a_size * self.batch_ratio)))
+
+    def worker_done(self, a_worker):
+        """
+           The worker a_worker has stopped: the next one can send commands in its place
+        """
+        with self._lock:
+            self._workers.discard(a_worker)
+
+    def wait(self, a_worker = 0):
+        """
+           Wait for the end of the pause and until the worker a_worker can send commands:
+           only the concurrency first running workers send commands
+        """
+        while True:
+            with self._lock:
+                remaining = self._pause_until - time.time()
+                allowed   = len([ worker for worker in self._workers if worker < a_worker ]) < self.concurrency
+
+            if remaining <= 0 and allowed:
+                return
+
+            time.sleep(min(1, remaining) if remaining > 0 else 1) # use a timeout to not block CTRL^C
+
+    def backoff(self):
+        """
+           Wait for the current pause (at least a_min_delay sec) before to reconnect after an error
+        """
+        with self._lock:
+            self._pause_until = max(self._pause_until, time.time() + max(self._delay, self._min_delay))
+
+        self.wait()
+
+    def call(self, a_name, a_func, *args, **kwargs):
+        """
+           Run the IMAP command a_func(*args, **kwargs) once the connections are not paused and measure it
+        """
+        self.wait()
+
+        start = time.time()
+        try:
+            result = a_func(*args, **kwargs)
+        except Exception, err:
+            self.on_error(err)
+            raise
+
+        self.on_success(a_name, time.time() - start)
+
+        return result
+
+    def on_success(self, a_name, a_latency):
+        """
+           Record a successful command with its latency
+        """
+        with self._lock:
+            average, baseline = self._latencies.get(a_name, (a_latency, a_latency))
+            average  = (1 - self.ALPHA) * average + self.ALPHA * a_latency
+            # the baseline follows slowly a latency increasing with the batch sizes
+            baseline = min(a_latency, baseline * 1.05)
+            self._latencies[a_name] = (average, baseline)
+
+            self.latency    = a_latency if self.latency is None else (1 - self.ALPHA) * self.latency + self.ALPHA * a_latency
+            self.error_rate = (1 - self.ALPHA) * self.error_rate
+
+            if average > self.LATENCY_FACTOR * max(baseline, self.MIN_LATENCY):
+                # Gmail slows down: do not ask for more
+                self._nb_successes = 0
+                return
+
+            self._nb_successes += 1
+            if self._nb_successes >= self._increase_every:
+                self._nb_successes = 0
+                self.batch_ratio   = min(1.0, self.batch_ratio + 0.1)
+                self.concurrency   = min(self.max_concurrency, self.concurrency + 1)
+                self._delay        = self._delay / 2 if self._delay / 2 >= self._min_delay else 0
+
+    def on_error(self, a_error):
+        """
+           Record a failed command.
+           Return the throttle code of a_error (None if a_error is not a throttled response)
+        """
+        code = get_throttle_code(a_error)
+
+        with self._lock:
+            self.error_rate    = (1 - self.ALPHA) * self.error_rate + self.ALPHA
+            self._nb_successes = 0
+
+            if not code and not isinstance(a_error, (imaplib.IMAP4.abort, socket.error)):
+                # error of a command (not of the connection)
+                return None
+
+            self.batch_ratio = max(self._min_ratio, self.batch_ratio / 2)
+            self._delay      = min(self._max_delay, max(self._min_delay, self._delay * 2))
+
+            if code:
+                self.nb_throttled += 1
+                self.concurrency   = max(1, self.concurrency / 2)
+                # the server is unavailable: wait longer
+                delay = self._delay if code == self.THROTTLED else min(self._max_delay, self._delay * 2)
+                self._pause_until = max(self._pause_until, time.time() + delay)
+
+                LOG.critical("Gmail limits the account (%s). Pause %d sec then continue with %d connection(s) " \
+                             "and %d%% of the batch sizes." % (code, delay, self.concurrency, round(self.batch_ratio * 100)))
+
+        return code
+
+    def get_status(self):
+        """
+           Return a description of the state of the controller for the progress output
+        """
+        with self._lock:
+            status = "batches at %d%%, %d/%d connection(s), latency %s, errors %.1f%%" % \
+                     (round(self.batch_ratio * 100), self.concurrency, self.max_concurrency, \
+                      "%.2fs" % (self.latency) if self.latency is not None else "n/a", self.error_rate * 100)
+
+            if self.nb_throttled:
+                status += ", throttled %d time(s)" % (self.nb_throttled)
+
+            remaining = self._pause_until - time.time()
+            if remaining > 0:
+                status += ", paused for %d sec" % (remaining)
+
+        return status
@@ -0,0 +1,944 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the segments storage of a gmvault-db:
+ - SegmentIndex: sqlite index of the records stored in the segment files
+ - SegmentStorer: a GmailStorer keeping the emails of each directory in a few append-only segment files
+
+A segment file (db/<dir>/000001.seg) is a sequence of records. Each record is a header line
+"GMVR1 <type> <gm_id> <flags> <meta_len> <data_len>\\n" followed by the json metadata and the data
+of the email exactly as they would be stored in the .meta and .eml[.crypt][.gz] files.
+Record types: E (email: metadata and data), M (metadata only), D (tombstone of a deleted email).
+
+'''
+import os
+import json
+import shutil
+import sqlite3
+import threading
+
+import log_utils
+import collections_utils
+import gmvault_utils
+import imap_utils
+import index_utils
+import codec_utils
+import gmvault
+
+LOG = log_utils.LoggerFactory.get_logger('segment_storer')
+
+class SegmentIndex(object):
+    """
+       sqlite index of the segment files: gm_id => directory, location of its last metadata and of its data.
+       It also records for each segment the size up to which it has been indexed so the records appended
+       after the last commit (interrupted run) can be replayed when the db is opened.
+    """
+    INDEX_FILENAME = 'gmvault_segments.sqlite'
+
+    CREATE_TABLES = [ "CREATE TABLE IF NOT EXISTS records (gm_id INTEGER PRIMARY KEY, dir TEXT NOT NULL, " \
+                      "meta_seg TEXT, meta_offset INTEGER, meta_len INTEGER, " \
+                      "data_seg TEXT, data_offset INTEGER, data_len INTEGER, flags INTEGER)",
+                      "CREATE INDEX IF NOT EXISTS records_dir ON records (dir)",
+                      "CREATE TABLE IF NOT EXISTS segments (seg TEXT PRIMARY KEY, indexed_size INTEGER)" ]
+
+    COLUMNS = "dir, meta_seg, meta_offset, meta_len, data_seg, data_offset, data_len, flags"
+
+    def __init__(self, a_info_dir):
+        """
+           Open or create the index in the info dir
+        """
+        self.path = '%s/%s' % (a_info_dir, self.INDEX_FILENAME)
+
+        # the storer is used by several threads when syncing in parallel
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, check_same_thread = False)
+        self._conn.text_factory = str
+        for statement in self.CREATE_TABLES:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+    def get(self, a_id):
+        """
+           Return (dir, meta_seg, meta_offset, meta_len, data_seg, data_offset, data_len, flags) for a gmail id
+           or None if the id is not stored. The data columns are None for an email without data.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT %s FROM records WHERE gm_id = ?" % (self.COLUMNS), (long(a_id),)).fetchone()
+
+    def get_dir_records(self, a_dir):
+        """
+           Return the (gm_id, meta_seg, meta_offset, meta_len, data_seg, data_offset, data_len, flags) of the ids
+           stored in a_dir sorted by gmail id
+        """
+        with self._lock:
+            return self._conn.execute("SELECT gm_id, meta_seg, meta_offset, meta_len, data_seg, data_offset, data_len, flags " \
+                                      "FROM records WHERE dir = ? ORDER BY gm_id", (a_dir,)).fetchall()
+
+    def get_all_ids(self):
+        """
+           Return the (gm_id, dir) of all the stored ids sorted by gmail id
+        """
+        with self._lock:
+            return self._conn.execute("SELECT gm_id, dir FROM records ORDER BY gm_id").fetchall()
+
+    def set_email(self, a_id, a_dir, a_meta_loc, a_data_loc, a_flags):
+        """
+           Add or replace the entry of a gmail id.
+           a_meta_loc and a_data_loc are (segment, offset, length) tuples. a_data_loc can be (None, None, None)
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO records (gm_id, %s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)" % (self.COLUMNS), \
+                               (long(a_id), a_dir) + tuple(a_meta_loc) + tuple(a_data_loc) + (a_flags,))
+
+    def set_metadata(self, a_id, a_dir, a_meta_loc):
+        """
+           Point the entry of a gmail id to new metadata. Keep its data if it is already stored in the same dir
+        """
+        with self._lock:
+            cursor = self._conn.execute("UPDATE records SET meta_seg = ?, meta_offset = ?, meta_len = ? WHERE gm_id = ? AND dir = ?", \
+                                        tuple(a_meta_loc) + (long(a_id), a_dir))
+            if cursor.rowcount == 0:
+                self.set_email(a_id, a_dir, a_meta_loc, (None, None, None), None)
+
+    def remove(self, a_id, a_dir = None):
+        """
+           Remove a gmail id from the index (only if it is stored in a_dir when a_dir is given)
+        """
+        with self._lock:
+            if a_dir is None:
+                self._conn.execute("DELETE FROM records WHERE gm_id = ?", (long(a_id),))
+            else:
+                self._conn.execute("DELETE FROM records WHERE gm_id = ? AND dir = ?", (long(a_id), a_dir))
+
+    def count(self):
+        """
+           Number of stored gmail ids
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def get_indexed_size(self, a_seg):
+        """
+           Size up to which a segment has been indexed (0 for an unknown segment)
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT indexed_size FROM segments WHERE seg = ?", (a_seg,)).fetchone()
+            return row[0] if row else 0
+
+    def set_indexed_size(self, a_seg, a_size):
+        """
+           Record the size up to which a segment has been indexed
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO segments (seg, indexed_size) VALUES (?, ?)", (a_seg, a_size))
+
+    def remove_segment(self, a_seg):
+        """
+           Forget a deleted segment
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM segments WHERE seg = ?", (a_seg,))
+
+    def clear(self):
+        """
+           Remove all the entries
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM records")
+            self._conn.execute("DELETE FROM segments")
+
+    def commit(self):
+        """
+           Commit the pending updates
+        """
+        with self._lock:
+            self._conn.commit()
+
+class SegmentStorer(gmvault.GmailStorer): #pylint:disable=R0904
+    """
+       Store the emails of each directory of the db (month dir or chats sub dir) in a few append-only
+       segment files instead of one .meta and one .eml file per email.
+       An email is never modified in place: new metadata, new data or a tombstone are appended and the
+       SegmentIndex points to the last record of each gmail id. The space of the overwritten and deleted
+       records is reclaimed by compact().
+       The data of a record is the one of the .eml file (encrypted then compressed if requested)
+       so an existing db can be converted by copying its files (see convert_files).
+    """
+    SEGMENT_FNAME    = '%06d.seg'
+    SEGMENT_EXT      = '.seg'
+    RECORD_MAGIC     = 'GMVR1'
+    EMAIL_RECORD     = 'E'
+    METADATA_RECORD  = 'M'
+    TOMBSTONE_RECORD = 'D'
+    MAX_HEADER_LEN   = 128
+
+    def __init__(self, a_storage_dir, encrypt_data = False):
+        """
+           Open or create a segments gmvault-db
+           args:
+              a_storage_dir: Storage directory
+              encrypt_data : if True encrypt the data of the emails
+        """
+        super(SegmentStorer, self).__init__(a_storage_dir, encrypt_data)
+
+        self._segment_max_bytes = gmvault_utils.get_conf_defaults().getint("General", "segment_max_bytes", 268435456)
+        self._commit_every      = gmvault_utils.get_conf_defaults().getint("General", "index_commit_every", 500)
+        self._nb_pending        = 0
+
+        self._seg_index = SegmentIndex(self._info_dir)
+
+        # dir => [segment number, append fd, segment size] of the segment receiving the new records
+        self._appenders = {}
+        self._seg_lock  = threading.RLock()
+
+        self.store_storage_backend(self.SEGMENTS_BACKEND)
+
+        # index the records appended after the last commit
+        self._replay_segments()
+
+    def _get_dir(self, local_dir):
+        """
+           Return the absolute dir of local_dir and create it if needed
+        """
+        if local_dir:
+            the_dir = '%s/%s' % (self._db_dir, local_dir)
+            gmvault_utils.makedirs(the_dir)
+        else:
+            the_dir = self._db_dir
+
+        return the_dir
+
+    def _get_flags(self, compress):
+        """
+           Storage flags of a new email
+        """
+        flags = self._get_codec(compress).FLAG
+        if self._encrypt_data:
+            flags |= index_utils.GmailIndex.ENCRYPTED
+        return flags
+
+    def _list_segments(self, a_dir):
+        """
+           Return the sorted (number, segment) of the segments of a dir (relative to the db dir)
+        """
+        the_dir = '%s/%s' % (self._db_dir, a_dir)
+        if not os.path.isdir(the_dir):
+            return []
+
+        segments = []
+        for fname in os.listdir(the_dir):
+            if fname.endswith(self.SEGMENT_EXT):
+                try:
+                    segments.append((int(fname[:-len(self.SEGMENT_EXT)]), '%s/%s' % (a_dir, fname)))
+                except ValueError:
+                    LOG.debug("Ignore %s/%s: not a segment." % (the_dir, fname))
+        segments.sort()
+
+        return segments
+
+    def _get_segment_dirs(self):
+        """
+           Return the dirs (relative to the db dir) containing segments
+        """
+        seg_dirs = []
+        for the_dir, _, files in os.walk(self._db_dir):
+            if [ fname for fname in files if fname.endswith(self.SEGMENT_EXT) ]:
+                seg_dirs.append(os.path.relpath(the_dir, self._db_dir).replace(os.sep, '/'))
+        return sorted(seg_dirs)
+
+    def _get_segment_path(self, a_seg):
+        """
+           Absolute path of a segment
+        """
+        return '%s/%s' % (self._db_dir, a_seg)
+
+    def _close_appender(self, a_dir):
+        """
+           Close the segment receiving the records of a dir. To be called with the lock
+        """
+        appender = self._appenders.pop(a_dir, None)
+        if appender:
+            # a full segment is not fsynced anymore by the next commits
+            appender[1].flush()
+            os.fsync(appender[1].fileno())
+            appender[1].close()
+
+    def _get_appender(self, a_dir):
+        """
+           Return the [segment number, append fd, size] of the segment receiving the records of a dir.
+           Start a new segment when the current one is full. To be called with the lock
+        """
+        appender = self._appenders.get(a_dir)
+
+        if appender and appender[2] >= self._segment_max_bytes:
+            self._close_appender(a_dir)
+            appender = [appender[0] + 1, None, 0]
+        elif not appender:
+            segments = self._list_segments(a_dir)
+            seg_nb   = segments[-1][0] if segments else 1
+            seg_size = os.path.getsize(self._get_segment_path(segments[-1][1])) if segments else 0
+            if seg_size >= self._segment_max_bytes:
+                seg_nb, seg_size = seg_nb + 1, 0
+            appender = [seg_nb, None, seg_size]
+
+        if not appender[1]:
+            appender[1] = open(self._get_segment_path('%s/%s' % (a_dir, self.SEGMENT_FNAME % (appender[0]))), 'ab')
+            self._appenders[a_dir] = appender
+
+        return appender
+
+    @classmethod
+    def _get_header(cls, a_type, a_id, a_flags, a_meta_len, a_data_len):
+        """
+           Return the header line of a record
+        """
+        return '%s %s %d %d %d %d\n' % (cls.RECORD_MAGIC, a_type, long(a_id), a_flags or 0, a_meta_len, a_data_len)
+
+    def _append(self, a_dir, a_type, a_id, a_flags, a_meta = '', a_data = '', a_data_path = None):
+        """
+           Append a record to the current segment of a dir.
+           The data is either passed as a string or copied from the file a_data_path.
+           Return (segment, meta location, data location) where a location is (segment, offset, length)
+        """
+        data_len = os.path.getsize(a_data_path) if a_data_path else len(a_data)
+        header   = self._get_header(a_type, a_id, a_flags, len(a_meta), data_len)
+
+        with self._seg_lock:
+            seg_nb, seg_fd, seg_size = self._get_appender(a_dir)
+            seg = '%s/%s' % (a_dir, self.SEGMENT_FNAME % (seg_nb))
+
+            seg_fd.write(header)
+            seg_fd.write(a_meta)
+            if a_data_path:
+                data_fd = open(a_data_path, 'rb')
+                try:
+                    shutil.copyfileobj(data_fd, seg_fd)
+                finally:
+                    data_fd.close()
+            else:
+                seg_fd.write(a_data)
+
+            meta_offset = seg_size + len(header)
+            new_size    = meta_offset + len(a_meta) + data_len
+            self._appenders[a_dir][2] = new_size
+
+            self._seg_index.set_indexed_size(seg, new_size)
+
+        return seg, (seg, meta_offset, len(a_meta)), (seg, meta_offset + len(a_meta), data_len)
+
+    def _updated(self):
+        """
+           Commit the index if enough updates are pending. The segments are flushed first
+           so the index never points after the end of a segment
+        """
+        with self._seg_lock:
+            self._nb_pending += 1
+            if self._nb_pending >= self._commit_every:
+                self._commit(a_fsync = False)
+
+    def _commit(self, a_fsync):
+        """
+           Flush the segments and commit the index. To be called with the lock
+        """
+        for _, seg_fd, _ in self._appenders.values():
+            seg_fd.flush()
+            if a_fsync:
+                os.fsync(seg_fd.fileno())
+
+        self._seg_index.commit()
+        self._nb_pending = 0
+
+    def flush(self):
+        """
+           Write on disk the appended records and commit the index
+        """
+        self._wait_writes()
+        self.sync_data()
+
+    def sync_data(self):
+        """
+           Fsync the blobs and the segments (with their directories) written since the last call and commit the index.
+           Called before the journals vouching for the written emails are fsynced
+        """
+        self._blob_store.sync()
+        with self._seg_lock:
+            self._commit(a_fsync = True)
+            seg_paths = [ self._get_segment_path('%s/%s' % (a_dir, self.SEGMENT_FNAME % (appender[0]))) \
+                          for a_dir, appender in self._appenders.items() ]
+
+        # the new segments are listed in their directories
+        gmvault_utils.fsync_paths(seg_paths)
+
+    def _read(self, a_loc, a_fds = None):
+        """
+           Read the bytes at a location (segment, offset, length).
+           a_fds: optional dict of open segment fds reused between reads
+        """
+        seg, offset, length = a_loc
+
+        with self._seg_lock:
+            # make sure that a record appended by this storer is readable
+            appender = self._appenders.get(os.path.dirname(seg))
+            if appender:
+                appender[1].flush()
+
+        if a_fds is not None and seg in a_fds:
+            the_fd = a_fds[seg]
+        else:
+            the_fd = open(self._get_segment_path(seg), 'rb')
+            if a_fds is not None:
+                a_fds[seg] = the_fd
+
+        try:
+            the_fd.seek(offset)
+            data = the_fd.read(length)
+        finally:
+            if a_fds is None:
+                the_fd.close()
+
+        if len(data) != length:
+            raise IOError("Truncated record in segment %s at offset %d" % (seg, offset))
+
+        return data
+
+    @classmethod
+    def _read_records(cls, a_fd, a_offset):
+        """
+           Iterate over the records of a segment starting at a_offset.
+           Yield (type, gm_id, flags, meta location, data location, end offset) where a location is (offset, length).
+           Stop at the first incomplete or invalid record (interrupted write).
+        """
+        offset = a_offset
+        a_fd.seek(0, 2)
+        size = a_fd.tell()
+
+        while offset < size:
+            a_fd.seek(offset)
+            header = a_fd.readline(cls.MAX_HEADER_LEN)
+            fields = header.split()
+            if not header.endswith('\n') or len(fields) != 6 or fields[0] != cls.RECORD_MAGIC:
+                return
+
+            try:
+                r_type, gm_id, flags, meta_len, data_len = fields[1], long(fields[2]), int(fields[3]), int(fields[4]), int(fields[5])
+            except ValueError:
+                return
+
+            meta_offset = offset + len(header)
+            end         = meta_offset + meta_len + data_len
+            if end > size:
+                return
+
+            yield r_type, gm_id, flags, (meta_offset, meta_len), (meta_offset + meta_len, data_len), end
+            offset = end
+
+    def _get_dead_ids(self, a_segs):
+        """
+           Return the ids whose last record in the segments of a dir (list of (segment, offset)) is a tombstone.
+           Their previous records in the dir are not indexed: the email has been deleted or moved to another dir
+           and must not shadow its records in the other dir whatever the order in which the dirs are indexed
+        """
+        last_types = {}
+        for seg, offset in a_segs:
+            seg_fd = open(self._get_segment_path(seg), 'rb')
+            try:
+                for r_type, gm_id, _, _, _, _ in self._read_records(seg_fd, offset):
+                    last_types[gm_id] = r_type
+            finally:
+                seg_fd.close()
+
+        return set([ gm_id for gm_id, r_type in last_types.iteritems() if r_type == self.TOMBSTONE_RECORD ])
+
+    def _index_segment(self, a_dir, a_seg, a_offset, a_dead_ids = frozenset()):
+        """
+           Apply the records of a segment starting at a_offset to the index.
+           The records of a_dead_ids other than the tombstones are skipped (see _get_dead_ids).
+           An incomplete record at the end of the segment (interrupted write) is truncated.
+           Return the number of records
+        """
+        path   = self._get_segment_path(a_seg)
+        seg_fd = open(path, 'r+b')
+        try:
+            nb_records, end = 0, a_offset
+            for r_type, gm_id, flags, (m_off, m_len), (d_off, d_len), end in self._read_records(seg_fd, a_offset):
+                if gm_id in a_dead_ids and r_type != self.TOMBSTONE_RECORD:
+                    pass
+                elif r_type == self.EMAIL_RECORD:
+                    self._seg_index.set_email(gm_id, a_dir, (a_seg, m_off, m_len), (a_seg, d_off, d_len), flags)
+                elif r_type == self.METADATA_RECORD:
+                    self._seg_index.set_metadata(gm_id, a_dir, (a_seg, m_off, m_len))
+                elif r_type == self.TOMBSTONE_RECORD:
+                    self._seg_index.remove(gm_id, a_dir)
+                nb_records += 1
+
+            seg_fd.seek(0, 2)
+            if seg_fd.tell() > end:
+                LOG.critical("Truncate the incomplete record at the end of segment %s (offset %d)." % (path, end))
+                seg_fd.truncate(end)
+        finally:
+            seg_fd.close()
+
+        self._seg_index.set_indexed_size(a_seg, end)
+
+        return nb_records
+
+    def _replay_segments(self):
+        """
+           Index the records appended to the segments after the last commit of the index
+        """
+        nb_records = 0
+        for a_dir in self._get_segment_dirs():
+            to_index = []
+            for _, seg in self._list_segments(a_dir):
+                indexed_size = self._seg_index.get_indexed_size(seg)
+                seg_size     = os.path.getsize(self._get_segment_path(seg))
+                if seg_size < indexed_size:
+                    LOG.critical("Segment %s is smaller than indexed. Rebuild the segments index." % (seg))
+                    self.rebuild_index()
+                    return
+                elif seg_size > indexed_size:
+                    to_index.append((seg, indexed_size))
+
+            dead_ids = self._get_dead_ids(to_index)
+            for seg, indexed_size in to_index:
+                nb_records += self._index_segment(a_dir, seg, indexed_size, dead_ids)
+
+        if nb_records:
+            LOG.critical("Indexed %d records appended to the segments after the last commit.\n" % (nb_records))
+        self._seg_index.commit()
+
+    def get_index(self):
+        """
+           Return the index of the segments
+        """
+        return self._seg_index
+
+    def rebuild_index(self):
+        """
+           Rebuild the index of the segments by reading all the records
+           Return the number of indexed emails
+        """
+        with self._seg_lock:
+            self._seg_index.clear()
+            for a_dir in self._get_segment_dirs():
+                segs     = [ (seg, 0) for _, seg in self._list_segments(a_dir) ]
+                dead_ids = self._get_dead_ids(segs)
+                for seg, _ in segs:
+                    self._index_segment(a_dir, seg, 0, dead_ids)
+            self._commit(a_fsync = False)
+
+        return self._seg_index.count()
+
+    def _init_sub_chats_dir(self):
+        """
+           get info from existing sub chats
+        """
+        super(SegmentStorer, self)._init_sub_chats_dir()
+
+        # the sub chats dirs do not contain one file per chat
+        if self._sub_chats_dir:
+            self._sub_chats_nb = len(self.get_dir_gmail_ids(self._sub_chats_dir))
+
+    def get_all_chats_gmail_ids(self):
+        """
+           Get only chats dirs
+        """
+        prefix = '%s/' % (self.CHATS_AREA)
+
+        return collections_utils.OrderedDict([ (gm_id, the_dir[len(prefix):]) for gm_id, the_dir in self._seg_index.get_all_ids() \
+                                               if the_dir.startswith(prefix) ])
+
+    def get_all_existing_gmail_ids(self, pivot_dir = None, ignore_sub_dir = ['chats']): #pylint:disable=W0102
+        """
+           get all existing gmail_ids from the database within the passed month
+           and all posterior months
+        """
+        rows = [ (gm_id, the_dir) for gm_id, the_dir in self._seg_index.get_all_ids() if the_dir.split('/')[0] not in ignore_sub_dir ]
+
+        if pivot_dir == None:
+            db_name = os.path.basename(self._db_dir)
+            # emails stored at the root of the db (no local dir)
+            return collections_utils.OrderedDict([ (gm_id, db_name if the_dir == '.' else the_dir) for gm_id, the_dir in rows ])
+
+        dirs = set(gmvault_utils.get_all_directories_posterior_to(pivot_dir, set([ the_dir for _, the_dir in rows if the_dir != '.' ])))
+
+        return collections_utils.OrderedDict([ (gm_id, the_dir) for gm_id, the_dir in rows if the_dir in dirs ])
+
+    def get_dir_gmail_ids(self, a_dir):
+        """
+           Return the sorted gmail ids stored in a_dir (relative to the db dir, ex: 2012-03)
+        """
+        return [ row[0] for row in self._seg_index.get_dir_records(a_dir) ]
+
+    def read_metadata_records(self, a_dir, a_ids):
+        """
+           Read the metadata of a_ids in a_dir (relative to the db dir) and return
+           { gm_id : (flags, labels, thread_id) }. Records that cannot be read are skipped.
+        """
+        records = {}
+        seg_fds = {}
+        try:
+            for a_id in a_ids:
+                entry = self._seg_index.get(a_id)
+                if not entry or entry[0] != a_dir:
+                    continue
+                try:
+                    metadata = json.loads(self._read(entry[1:4], seg_fds))
+
+                    # same label conversion as in unbury_metadata
+                    records[a_id] = (tuple(metadata[self.FLAGS_K]), tuple([ str(elem) for elem in metadata[self.LABELS_K] ]), \
+                                     metadata.get(self.THREAD_IDS_K))
+                except (IOError, ValueError, KeyError), error:
+                    LOG.debug("Cannot read metadata of %s in %s: %s" % (a_id, a_dir, error))
+        finally:
+            for seg_fd in seg_fds.values():
+                seg_fd.close()
+
+        return records
+
+    def get_directory_from_id(self, a_id, a_local_dir = None):
+        """
+           If a_local_dir (yy_mm dir) is passed, check that the email is stored in it and return dir
+           Return the directory path if id located.
+           Return None if not found
+        """
+        entry = self._seg_index.get(a_id)
+        if not entry or (a_local_dir and entry[0] != a_local_dir):
+            return None
+
+        return self._get_dir(entry[0] if entry[0] != '.' else None)
+
+    def _dump_metadata(self, email_info, extra_labels):
+        """
+           Return the json metadata of an email as stored in a record
+        """
+        meta = json.dumps(self._get_metadata_obj(email_info, extra_labels), ensure_ascii = False)
+        if isinstance(meta, unicode):
+            meta = meta.encode('utf-8')
+        return meta
+
+    def _bury_metadata(self, email_info, local_dir = None, extra_labels = []): #pylint:disable=W0102
+        """
+            Append a metadata record
+            Arguments:
+             email_info: metadata info
+             local_dir : intermdiary dir (month dir)
+        """
+        gm_id  = email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
+        a_dir  = self._get_index_dir(self._get_dir(local_dir))
+        meta   = self._dump_metadata(email_info, extra_labels)
+        entry  = self._seg_index.get(gm_id)
+
+        if entry and entry[0] != a_dir and entry[4]:
+            # the records of an email are always in the segments of its dir: move the data along
+            _, meta_loc, data_loc = self._append(a_dir, self.EMAIL_RECORD, gm_id, entry[7], meta, self._read(entry[4:7]))
+            self._seg_index.set_email(gm_id, a_dir, meta_loc, data_loc, entry[7])
+        else:
+            _, meta_loc, _ = self._append(a_dir, self.METADATA_RECORD, gm_id, 0, meta)
+            self._seg_index.set_metadata(gm_id, a_dir, meta_loc)
+
+        self._moved(gm_id, entry, a_dir)
+        self._updated()
+
+        return gm_id
+
+    def get_email_writer(self, a_id, local_dir = None, compress = False):
+        """
+           Return an EmailDataWriter to write the data of an email chunk by chunk in a temporary file.
+           Once written, the email is appended to its segment by passing the writer to bury_email.
+        """
+        writer = super(SegmentStorer, self).get_email_writer(a_id, local_dir, compress)
+        if not writer.pack:
+            writer.path = '%s.part' % (writer.path)
+
+        return writer
+
+    def _bury_email(self, email_info, local_dir = None, compress = False, extra_labels = [], data_writer = None, \
+                    transformed = None): #pylint:disable=W0102,R0913
+        """
+           Append an email record (metadata and data)
+           Arguments:
+             email_info : the email content
+             local_dir  : intermdiary dir (month dir)
+             compress   : if compress is True, use the compression codec of the conf
+             data_writer: EmailDataWriter in which the data has already been written (email_info has no body then)
+             transformed: TransformResult of the data (see start_transformers)
+        """
+        # collect the transformed data first to always free its place in the transform pool
+        stored_data = transformed.get() if transformed else None
+
+        gm_id = email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
+        a_dir = self._get_index_dir(self._get_dir(local_dir))
+        meta  = self._dump_metadata(email_info, extra_labels)
+        flags = self._get_flags(compress)
+
+        if data_writer and not data_writer.pack:
+            # the data has already been written chunk by chunk in a temporary file
+            data_path = data_writer.close()
+            try:
+                _, meta_loc, data_loc = self._append(a_dir, self.EMAIL_RECORD, gm_id, flags, meta, a_data_path = data_path)
+            finally:
+                os.remove(data_path)
+        elif transformed:
+            # packed, encrypted and compressed by the transform processes
+            _, meta_loc, data_loc = self._append(a_dir, self.EMAIL_RECORD, gm_id, flags, meta, stored_data)
+        else:
+            # the big attachments are moved to the blob area
+            data = self._blob_store.pack(data_writer.read_and_delete() if data_writer \
+                                         else email_info[imap_utils.GIMAPFetcher.EMAIL_BODY], self._dedup_attachments, \
+                                         self._encrypt_blob if self._encrypt_data else None, self._get_blob_key())
+
+            if self._encrypt_data:
+                # need to be done for every encryption
+                with self._cipher_lock:
+                    cipher = self.get_encryption_cipher()
+                    cipher.initCTR()
+                    data = cipher.encryptCTR(data)
+
+            # same format as the data files
+            data = self._get_codec(compress).compress(data)
+
+            _, meta_loc, data_loc = self._append(a_dir, self.EMAIL_RECORD, gm_id, flags, meta, data)
+
+        entry = self._seg_index.get(gm_id)
+        self._seg_index.set_email(gm_id, a_dir, meta_loc, data_loc, flags)
+        self._moved(gm_id, entry, a_dir)
+        self._updated()
+
+        return gm_id
+
+    def unbury_email(self, a_id):
+        """
+           Restore email info from info stored on disk
+           Return a tuple (meta, data)
+        """
+        entry = self._seg_index.get(a_id)
+        if not entry or not entry[4]:
+            raise IOError("No data for email %s in the segments of %s" % (a_id, self._db_dir))
+
+        data = self._unbury_data(a_id)
+
+        # the key addressing the blobs of an encrypted email has been read to decrypt its data
+        return (self._decode_metadata(json.loads(self._read(entry[1:4]))), \
+                self._blob_store.unpack(data, self._decrypt_blob, self._encryption_key))
+
+    def _unbury_data(self, a_id, a_dir = None):
+        """
+           Return the stored data of an email: decompressed and decrypted but still referencing its blobs
+        """
+        entry = self._seg_index.get(a_id)
+        if not entry or not entry[4]:
+            raise IOError("No data for email %s in the segments of %s" % (a_id, self._db_dir))
+
+        data = codec_utils.get_codec_from_flags(entry[7])().decompress(self._read(entry[4:7]))
+
+        if entry[7] & index_utils.GmailIndex.ENCRYPTED:
+            LOG.debug("Restore encrypted email %s" % (a_id))
+            # need to be done for every encryption
+            with self._cipher_lock:
+                cipher = self.get_encryption_cipher()
+                cipher.initCTR()
+                data = cipher.decryptCTR(data)
+
+        return data
+
+    def unbury_metadata(self, a_id, a_id_dir = None):
+        """
+           Get metadata info from DB
+        """
+        entry = self._seg_index.get(a_id)
+        if not entry:
+            raise IOError("No metadata for email %s in the segments of %s" % (a_id, self._db_dir))
+
+        return self._decode_metadata(json.loads(self._read(entry[1:4])))
+
+    def _moved(self, a_id, a_entry, a_dir):
+        """
+           Append a tombstone in the previous dir of a gmail id (index entry a_entry) if it is now stored in a_dir.
+           The tombstone comes after the new record: an interruption can leave the email in both dirs but never in none
+        """
+        if a_entry and a_entry[0] != a_dir:
+            self._append(a_entry[0], self.TOMBSTONE_RECORD, a_id, 0)
+
+    def _remove(self, a_id, a_dir):
+        """
+           Append a tombstone for a gmail id stored in a_dir and remove it from the index
+        """
+        self._append(a_dir, self.TOMBSTONE_RECORD, a_id, 0)
+        self._seg_index.remove(a_id, a_dir)
+        self._updated()
+
+    def quarantine_email(self, a_id):
+        """
+           Quarantine the email: write its .meta and data files in the quarantine dir
+        """
+        entry = self._seg_index.get(a_id)
+        if not entry:
+            return
+
+        data_path = self.DATA_FNAME % (self._quarantine_dir, a_id)
+        if entry[7] & index_utils.GmailIndex.ENCRYPTED:
+            data_path = '%s.crypt' % (data_path)
+        data_path = '%s%s' % (data_path, codec_utils.get_codec_from_flags(entry[7]).SUFFIX)
+
+        for path, loc in [(self.METADATA_FNAME % (self._quarantine_dir, a_id), entry[1:4]), (data_path, entry[4:7])]:
+            if loc[0]:
+                the_fd = open(path, 'wb')
+                try:
+                    the_fd.write(self._read(loc))
+                finally:
+                    the_fd.close()
+
+        self._remove(a_id, entry[0])
+
+    def delete_emails(self, emails_info, msg_type):
+        """
+           Delete all emails and metadata with ids (append tombstones)
+        """
+        for (a_id, date_dir) in emails_info:
+
+            if msg_type == 'email':
+                a_dir = date_dir
+            else:
+                a_dir = '%s/%s' % (self.CHATS_AREA, date_dir)
+
+            if date_dir == os.path.basename(self._db_dir):
+                a_dir = '.' # emails stored at the root of the db
+
+            entry = self._seg_index.get(a_id)
+            if entry and entry[0] == a_dir:
+                self._remove(a_id, a_dir)
+
+    def compact(self, a_min_dead_ratio = None):
+        """
+           Rewrite the segments of the dirs in which the deleted and overwritten records take at least
+           a_min_dead_ratio of the space (every dir containing dead records if 0).
+           Return (number of compacted dirs, number of reclaimed bytes)
+        """
+        if a_min_dead_ratio is None:
+            a_min_dead_ratio = gmvault_utils.get_conf_defaults().getfloat("General", "segment_compact_ratio", 0.3)
+
+        nb_dirs, nb_reclaimed = 0, 0
+
+        with self._seg_lock:
+            for a_dir in self._get_segment_dirs():
+                old_segs = self._list_segments(a_dir)
+                old_size = sum([ os.path.getsize(self._get_segment_path(seg)) for _, seg in old_segs ])
+                records  = self._seg_index.get_dir_records(a_dir)
+
+                # size of the live records once rewritten
+                new_size = 0
+                for gm_id, _, _, meta_len, data_seg, _, data_len, flags in records:
+                    r_type = self.EMAIL_RECORD if data_seg else self.METADATA_RECORD
+                    new_size += len(self._get_header(r_type, gm_id, flags if data_seg else 0, meta_len, data_len or 0)) + \
+                                meta_len + (data_len or 0)
+
+                dead_size = old_size - new_size
+                if dead_size <= 0 or float(dead_size) / old_size < a_min_dead_ratio:
+                    continue
+
+                LOG.debug("Compact the %d segments of %s (%d records, %d bytes)." % (len(old_segs), a_dir, len(records), old_size))
+
+                # append the live records to new segments
+                self._close_appender(a_dir)
+                self._appenders[a_dir] = [old_segs[-1][0] + 1, None, 0]
+                self._get_appender(a_dir)
+
+                seg_fds = {}
+                try:
+                    for gm_id, meta_seg, meta_off, meta_len, data_seg, data_off, data_len, flags in records:
+                        meta = self._read((meta_seg, meta_off, meta_len), seg_fds)
+                        if data_seg:
+                            data = self._read((data_seg, data_off, data_len), seg_fds)
+                            _, meta_loc, data_loc = self._append(a_dir, self.EMAIL_RECORD, gm_id, flags, meta, data)
+                            self._seg_index.set_email(gm_id, a_dir, meta_loc, data_loc, flags)
+                        else:
+                            _, meta_loc, _ = self._append(a_dir, self.METADATA_RECORD, gm_id, 0, meta)
+                            self._seg_index.set_metadata(gm_id, a_dir, meta_loc)
+                finally:
+                    for seg_fd in seg_fds.values():
+                        seg_fd.close()
+
+                # the new segments are on disk and indexed before the old ones are deleted
+                self._commit(a_fsync = True)
+
+                for _, seg in old_segs:
+                    os.remove(self._get_segment_path(seg))
+                    self._seg_index.remove_segment(seg)
+                self._seg_index.commit()
+
+                nb_dirs      += 1
+                nb_reclaimed += dead_size
+
+        return nb_dirs, nb_reclaimed
+
+    def convert_files(self):
+        """
+           Move the emails stored as .meta and .eml files (files storage) in the segments of their dir.
+           The data is copied as it is (no decryption). The files of a dir are deleted once its segments are on disk
+           so an interrupted conversion can be run again.
+           Return the number of converted emails
+        """
+        nb_emails = 0
+
+        for the_dir, _, files in os.walk(self._db_dir):
+            a_dir = os.path.relpath(the_dir, self._db_dir).replace(os.sep, '/')
+
+            converted, nb_dir_emails = [], 0
+            for fname in sorted(files):
+                if not fname.endswith('.meta'):
+                    continue
+
+                try:
+                    gm_id = long(fname[:-len('.meta')])
+                except ValueError:
+                    LOG.debug("Ignore %s/%s while converting to segments." % (the_dir, fname))
+                    continue
+
+                meta_path = self.METADATA_FNAME % (the_dir, gm_id)
+                meta_fd   = open(meta_path, 'rb')
+                try:
+                    meta = meta_fd.read()
+                finally:
+                    meta_fd.close()
+
+                try:
+                    json.loads(meta)
+                except ValueError, error:
+                    LOG.critical("Cannot read %s (%s). Leave it in the files storage." % (meta_path, error))
+                    continue
+
+                data_path = self._find_data_file(the_dir, gm_id)
+                if data_path:
+                    flags = index_utils.GmailIndex.get_flags_from_filename(data_path)
+                    _, meta_loc, data_loc = self._append(a_dir, self.EMAIL_RECORD, gm_id, flags, meta, a_data_path = data_path)
+                    self._seg_index.set_email(gm_id, a_dir, meta_loc, data_loc, flags)
+                else:
+                    _, meta_loc, _ = self._append(a_dir, self.METADATA_RECORD, gm_id, 0, meta)
+                    self._seg_index.set_metadata(gm_id, a_dir, meta_loc)
+
+                converted.extend([ path for path in [meta_path, data_path] if path ])
+                nb_dir_emails += 1
+
+            if converted:
+                self.flush()
+                for path in converted:
+                    os.remove(path)
+                LOG.critical("Converted %d emails of %s to segments." % (nb_dir_emails, a_dir))
+                nb_emails += nb_dir_emails
+
+        return nb_emails
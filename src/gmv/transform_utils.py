@@ -0,0 +1,138 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the TransformPool: processes transforming the data of the emails into their stored form
+(attachments moved to the blob area, encryption and compression) on all the cores
+
+'''
+import signal
+import threading
+import multiprocessing
+
+import blowfish
+import codec_utils
+
+# ciphers of a worker process by key (the key schedule is computed once)
+_CIPHERS = {}
+
+def _init_worker():
+    """
+       Let the main process handle CTRL^C
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _encrypt(a_data, a_key):
+    """
+       Blowfish CTR encryption as done by the storer
+    """
+    cipher = _CIPHERS.get(a_key)
+    if not cipher:
+        cipher = _CIPHERS[a_key] = blowfish.Blowfish(a_key)
+
+    cipher.initCTR()
+    return cipher.encryptCTR(a_data)
+
+def transform_data(a_data, a_codec_name, a_codec_level, a_key = None, a_blob_store = None):
+    """
+       Return the data of an email as stored: the big attachments are moved to a_blob_store (if not None),
+       the data is encrypted with a_key (if not None) and compressed with the codec
+    """
+    encrypt = (lambda content: _encrypt(content, a_key)) if a_key else None
+
+    if a_blob_store:
+        a_data = a_blob_store.pack(a_data, True, encrypt, a_key)
+        # the storer of the parent process does not know the blobs written here
+        a_blob_store.sync()
+
+    if encrypt:
+        a_data = encrypt(a_data)
+
+    return codec_utils.get_codec(a_codec_name, a_codec_level).compress(a_data)
+
+class TransformResult(object):
+    """
+       Pending result of a transform
+    """
+    def __init__(self, a_pool, a_async_result, a_nb_bytes):
+        self._pool         = a_pool
+        self._async_result = a_async_result
+        self._nb_bytes     = a_nb_bytes
+
+    def get(self):
+        """
+           Wait for the transformed data and return it
+        """
+        try:
+            while not self._async_result.ready():
+                self._async_result.wait(1) # use a timeout to not block CTRL^C
+            return self._async_result.get()
+        finally:
+            self._pool.release(self._nb_bytes)
+            self._nb_bytes = 0
+
+class TransformPool(object):
+    """
+       Pool of processes running transform_data.
+       submit blocks while the data submitted and not yet collected is over a_max_inflight_bytes
+    """
+    def __init__(self, a_nb_processes = None, a_max_inflight_bytes = 67108864):
+        """
+           a_nb_processes      : number of processes (one per core if None)
+           a_max_inflight_bytes: max number of bytes of data in the pool
+        """
+        self.nb_processes = a_nb_processes or multiprocessing.cpu_count()
+
+        self._pool      = multiprocessing.Pool(self.nb_processes, _init_worker)
+        self._max_bytes = a_max_inflight_bytes
+        self._nb_bytes  = 0
+        self._cond      = threading.Condition()
+
+    def submit(self, a_data, a_codec, a_key = None, a_blob_store = None):
+        """
+           Transform a_data in a worker process and return a TransformResult.
+           The result has to be collected with get to free its place in the pool
+        """
+        nb_bytes = len(a_data)
+
+        with self._cond:
+            # a data bigger than the limit goes when the pool is empty
+            while self._nb_bytes and self._nb_bytes + nb_bytes > self._max_bytes:
+                self._cond.wait(1) # use a timeout to not block CTRL^C
+            self._nb_bytes += nb_bytes
+
+        try:
+            async_result = self._pool.apply_async(transform_data, (a_data, a_codec.NAME, a_codec.level, a_key, a_blob_store))
+        except:
+            self.release(nb_bytes)
+            raise
+
+        return TransformResult(self, async_result, nb_bytes)
+
+    def release(self, a_nb_bytes):
+        """
+           Free the place of a collected result
+        """
+        with self._cond:
+            self._nb_bytes -= a_nb_bytes
+            self._cond.notify_all()
+
+    def close(self):
+        """
+           Stop the worker processes
+        """
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,528 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module generating synthetic gmvault-dbs to test the storage at scale (see bench_suite.py generate).
+The emails and the chats are stored with the layout of the GmailStorer files backend:
+ - db/<yyyy-mm>/<gm_id>.meta (bury_metadata format) and <gm_id>.eml[.crypt]<codec suffix>
+ - db/chats/subchats-<n>/ (limit_per_chat_dir chats per dir)
+ - the gm_id index and the directory manifests of the .info dir
+
+The subjects, threads, labels, flags, bodies and attachments follow the distributions of real mailboxes
+(log-normal sizes, a few popular labels and contacts, attachments forwarded several times).
+Each message is generated from the seed and its number only, so a seed gives the same db whatever the number
+of processes. Each month dir (or chats sub dir) is written by one process of the pool.
+
+'''
+import os
+import json
+import math
+import random
+import calendar
+import datetime
+import binascii
+import multiprocessing
+import signal
+
+import log_utils
+import gmvault_utils
+import codec_utils
+import blob_utils
+import index_utils
+import transform_utils
+import gmvault
+
+LOG = log_utils.LoggerFactory.get_logger('vault_generator')
+
+WORDS = ['the', 'to', 'and', 'of', 'a', 'in', 'for', 'is', 'on', 'that', 'with', 'you', 'this', 'it', 'be', 'are', \
+         'we', 'at', 'as', 'your', 'will', 'have', 'from', 'can', 'or', 'not', 'please', 'meeting', 'project', 'thanks', \
+         'update', 'report', 'next', 'week', 'team', 'review', 'attached', 'call', 'today', 'tomorrow', 'monday', \
+         'friday', 'question', 'about', 'new', 'plan', 'budget', 'draft', 'version', 'release', 'schedule', 'order', \
+         'invoice', 'payment', 'account', 'customer', 'support', 'issue', 'fix', 'bug', 'server', 'data', 'notes', \
+         'minutes', 'agenda', 'proposal', 'contract', 'travel', 'hotel', 'flight', 'dinner', 'lunch', 'party', \
+         'family', 'photos', 'weekend', 'holiday', 'birthday', 'newsletter', 'offer', 'sale', 'confirmation', \
+         'reminder', 'status', 'feedback', 'document', 'presentation', 'slides', 'office', 'room', 'time', 'date', \
+         'change', 'request', 'approval', 'deadline', 'quarter', 'results', 'numbers', 'sales', 'marketing', \
+         'design', 'code', 'test', 'build', 'launch', 'support', 'ticket', 'price', 'quote', 'delivery', 'shipping']
+
+FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'David', 'Emma', 'Frank', 'Grace', 'Henry', 'Isabel', 'Jack', 'Karen', 'Louis', \
+               'Maria', 'Nathan', 'Olivia', 'Paul', 'Quentin', 'Rachel', 'Samuel', 'Tina', 'Victor', 'Wendy', 'Yann', 'Zoe']
+
+LAST_NAMES  = ['Martin', 'Smith', 'Garcia', 'Muller', 'Rossi', 'Dubois', 'Brown', 'Jones', 'Silva', 'Kowalski', \
+               'Nielsen', 'Tanaka', 'Novak', 'Lopez', 'Bernard', 'Weber', 'Wilson', 'Moreau', 'Costa', 'Fischer']
+
+DOMAINS     = ['gmail.com', 'example.com', 'example.org', 'example.net', 'mail.example.com', 'lists.example.org']
+
+# (content type, extension) of the attachments
+ATTACHMENT_TYPES = [('application/pdf', 'pdf'), ('image/jpeg', 'jpg'), ('image/png', 'png'), ('application/zip', 'zip'), \
+                    ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'docx'), \
+                    ('application/vnd.ms-excel', 'xls'), ('text/calendar', 'ics')]
+
+EMAIL, CHAT = 0, 1
+
+# random generators of a message (see get_rand)
+SUBJECT_RAND, THREAD_RAND, DATE_RAND, CONTENT_RAND = range(4)
+
+def get_rand(a_seed, a_kind, a_num, a_what):
+    """
+       Return the random generator of a part (a_what) of the message a_num (email or chat).
+       It only depends on the seed so the messages can be generated in any order and in any process
+    """
+    return random.Random((((long(a_seed) << 1 | a_kind) << 40 | a_num) << 2) | a_what)
+
+def lognormal(a_rand, a_median, a_sigma, a_min, a_max):
+    """
+       Return an integer of a log-normal distribution (a_median, a_sigma) bounded to [a_min, a_max]
+    """
+    return int(min(a_max, max(a_min, a_rand.lognormvariate(math.log(a_median), a_sigma))))
+
+def skewed_choice(a_rand, a_list, a_skew = 3):
+    """
+       Return an element of a_list, the first ones being much more frequent (a_skew = 1 is uniform)
+    """
+    return a_list[int(len(a_list) * a_rand.random() ** a_skew)]
+
+# blocks shared by the messages generated in a process (see get_text_lines and get_base64_block)
+_TEXT_LINES   = []
+_BASE64_BLOCK = []
+
+BASE64_LINE_BYTES = 57       # bytes encoded in a base64 line of 76 characters
+BASE64_BLOCK_SIZE = 16777216 # bytes
+
+def get_text_lines():
+    """
+       Return 4096 lines of text of at most 76 characters (the same in all the processes).
+       The texts of the messages are made of these lines
+    """
+    if not _TEXT_LINES:
+        rand = random.Random(0)
+        for _ in xrange(4096):
+            line = []
+            while len(line) < 2 or len(' '.join(line)) < rand.randint(40, 76):
+                line.append(skewed_choice(rand, WORDS, 2))
+            _TEXT_LINES.append(' '.join(line)[:76])
+
+    return _TEXT_LINES
+
+def get_base64_block():
+    """
+       Return BASE64_BLOCK_SIZE random bytes (the same in all the processes) in base64 lines of 76 characters.
+       The attachments are slices of it: they are incompressible like the images or the archives
+    """
+    if not _BASE64_BLOCK:
+        data = binascii.unhexlify('%0*x' % (BASE64_BLOCK_SIZE * 2, random.Random(0).getrandbits(BASE64_BLOCK_SIZE * 8)))
+        _BASE64_BLOCK.append(''.join([ binascii.b2a_base64(data[index:index + BASE64_LINE_BYTES])[:-1] + '\r\n' \
+                                       for index in xrange(0, len(data), BASE64_LINE_BYTES) ]))
+
+    return _BASE64_BLOCK[0]
+
+def _init_worker():
+    """
+       Let the main process handle CTRL^C
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class VaultGenerator(object): #pylint:disable-msg=R0902
+    """
+       Generate the emails and the chats of a synthetic gmail account.
+       The emails are spread from a_start_date to a_end_date (a db of 1 million emails has about 8000 emails
+       per month dir with the default dates) and their gmail ids grow with their dates like in Gmail.
+    """
+    ATTACHMENT_POOL = 50   # attachments forwarded in several emails (about 10% of the attachments)
+    TEXT_MEDIAN     = 1500 # bytes
+    SUBJECT_MEDIAN  = 5    # words
+
+    def __init__(self, a_nb_emails, a_nb_chats = 0, a_seed = 0, a_owner = 'gmvault.test@gmail.com', \
+                 a_start_date = datetime.datetime(2008, 1, 1), a_end_date = datetime.datetime(2018, 1, 1), \
+                 a_nb_labels = 40, a_attachment_ratio = 0.15, a_max_attachment_size = 10485760): #pylint:disable-msg=R0913
+        """
+           a_nb_emails, a_nb_chats: number of emails and chats
+           a_owner                : address of the account
+           a_start_date/end_date  : period of the messages (UTC)
+           a_nb_labels            : number of user labels (some of them nested)
+           a_attachment_ratio     : ratio of the emails with attachments
+           a_max_attachment_size  : max size (bytes) of an attachment
+        """
+        self.nb_emails            = a_nb_emails
+        self.nb_chats             = a_nb_chats
+        self.seed                 = a_seed
+        self.owner                = a_owner
+        self.attachment_ratio     = a_attachment_ratio
+        self.max_attachment_size  = a_max_attachment_size
+
+        self._start = calendar.timegm(a_start_date.timetuple())
+        self._span  = calendar.timegm(a_end_date.timetuple()) - self._start
+
+        rand = random.Random(a_seed)
+
+        self.labels = []
+        while len(self.labels) < a_nb_labels:
+            label = rand.choice(WORDS).capitalize()
+            if self.labels and rand.random() < 0.3:
+                label = '%s/%s' % (rand.choice(self.labels).split('/')[0], label)
+            if label not in self.labels:
+                self.labels.append(label)
+
+        self.contacts = [ ('%s %s' % (rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES)), \
+                           '%s.%d@%s' % (rand.choice(FIRST_NAMES).lower(), num, rand.choice(DOMAINS))) for num in xrange(500) ]
+
+    def _get_slot(self, a_kind):
+        """
+           Seconds between two messages
+        """
+        return float(self._span) / max(1, self.nb_emails if a_kind == EMAIL else self.nb_chats)
+
+    def get_date(self, a_kind, a_num):
+        """
+           Return the internal date (epoch) of a message. The message a_num is in the a_num th slot of the period
+        """
+        return int(self._start + self._get_slot(a_kind) * (a_num + get_rand(self.seed, a_kind, a_num, DATE_RAND).random()))
+
+    def get_gm_id(self, a_kind, a_num):
+        """
+           Return the gmail id of a message: its date in ms followed by 20 bits like the gmail ids
+        """
+        return (self.get_date(a_kind, a_num) * 1000L << 20) | (a_kind << 19) | (a_num & 0x7FFFF)
+
+    def get_message_id(self, a_kind, a_num):
+        """
+           Return the Message-ID header of a message
+        """
+        return '<gen.%d.%d.%d@mail.gmail.com>' % (self.seed, a_kind, a_num)
+
+    def get_subject(self, a_num):
+        """
+           Return the subject of the first email of a thread
+        """
+        rand  = get_rand(self.seed, EMAIL, a_num, SUBJECT_RAND)
+        words = [ skewed_choice(rand, WORDS, 2) for _ in xrange(lognormal(rand, self.SUBJECT_MEDIAN, 0.5, 1, 25)) ]
+        subject = ' '.join(words).capitalize()
+        if rand.random() < 0.1:
+            subject = '[%s] %s' % (skewed_choice(rand, self.labels).split('/')[-1].lower(), subject) # mailing list
+
+        return subject
+
+    def get_thread(self, a_num):
+        """
+           Return (parent, root) of an email: about one email out of three answers a previous email.
+           parent is None for the first email of a thread
+        """
+        parent, num = None, a_num
+        while True:
+            rand = get_rand(self.seed, EMAIL, num, THREAD_RAND)
+            if num == 0 or rand.random() >= 0.35:
+                return parent, num
+            # the answers come mostly a few emails after
+            num = num - lognormal(rand, 10, 1.5, 1, num)
+            if parent is None:
+                parent = num
+
+    def _build_text(self, a_rand, a_size):
+        """
+           Return a text of about a_size bytes in lines of at most 76 characters
+        """
+        text_lines = get_text_lines()
+
+        lines, size = [], 0
+        while size < a_size:
+            line = text_lines[a_rand.randint(0, len(text_lines) - 1)]
+            lines.append(line)
+            size += len(line) + 2
+            if a_rand.random() < 0.15:
+                lines.append('') # new paragraph
+
+        return '\r\n'.join(lines) + '\r\n'
+
+    def _get_attachment(self, a_rand):
+        """
+           Return (content type, filename, content in base64) of an attachment
+        """
+        if a_rand.random() < 0.1:
+            # the same file forwarded or sent to several people
+            pool_num = int(self.ATTACHMENT_POOL * a_rand.random() ** 2)
+            a_rand   = random.Random((long(self.seed) << 16) | pool_num)
+            name     = 'shared-%d' % (pool_num)
+        else:
+            name     = '%s-%d' % (skewed_choice(a_rand, WORDS, 2), a_rand.randint(1, 999))
+
+        content_type, ext = skewed_choice(a_rand, ATTACHMENT_TYPES, 2)
+        size = lognormal(a_rand, 60000, 1.4, 500, min(self.max_attachment_size, BASE64_BLOCK_SIZE))
+
+        block    = get_base64_block()
+        nb_lines = max(1, size / BASE64_LINE_BYTES)
+        start    = a_rand.randint(0, len(block) / 78 - nb_lines) # 76 characters + CRLF per line
+
+        return content_type, '%s.%s' % (name, ext), block[start * 78:(start + nb_lines) * 78]
+
+    def _get_labels(self, a_rand, a_sent):
+        """
+           Return the labels of an email: a few system labels and 0 to 4 user labels (a few are very popular)
+        """
+        labels = []
+        if a_sent:
+            labels.append('\\Sent')
+        elif a_rand.random() < 0.3:
+            labels.append('\\Inbox')
+        if a_rand.random() < 0.35:
+            labels.append('\\Important')
+        if a_rand.random() < 0.05:
+            labels.append('\\Starred')
+
+        nb_labels = skewed_choice(a_rand, [0, 0, 0, 0, 0, 1, 1, 1, 2, 2, 3, 4], 1)
+        while nb_labels and len(labels) < 8:
+            label = skewed_choice(a_rand, self.labels)
+            if label not in labels:
+                labels.append(label)
+                nb_labels -= 1
+
+        return labels
+
+    def build_email(self, a_num):
+        """
+           Return (body, subject, labels, flags) of the email a_num
+        """
+        rand         = get_rand(self.seed, EMAIL, a_num, CONTENT_RAND)
+        parent, root = self.get_thread(a_num)
+        subject      = self.get_subject(root)
+        contact      = skewed_choice(rand, self.contacts)
+        sent         = rand.random() < 0.2
+
+        if parent is not None:
+            subject = 'Re: %s' % (subject)
+
+        sender     = ('Gmvault Test', self.owner) if sent else contact
+        recipients = [contact if sent else ('Gmvault Test', self.owner)]
+        for _ in xrange(skewed_choice(rand, [0, 0, 0, 1, 1, 2, 5], 1)):
+            recipients.append(skewed_choice(rand, self.contacts))
+
+        the_date = datetime.datetime.utcfromtimestamp(self.get_date(EMAIL, a_num))
+        headers  = [ 'Delivered-To: %s' % (self.owner) ] if not sent else []
+        headers += [ 'Received: by 10.%d.%d.%d with SMTP id %x;\r\n        %s' % (rand.randint(0, 255), rand.randint(0, 255), \
+                     rand.randint(0, 255), rand.getrandbits(48), the_date.strftime('%a, %d %b %Y %H:%M:%S -0000')) \
+                     for _ in xrange(rand.randint(1, 3)) ]
+        headers += [ 'Message-ID: %s' % (self.get_message_id(EMAIL, a_num)),
+                     'Subject: %s' % (subject),
+                     'From: %s <%s>' % sender,
+                     'To: %s' % (', '.join([ '%s <%s>' % recipient for recipient in recipients ])),
+                     'Date: %s' % (the_date.strftime('%a, %d %b %Y %H:%M:%S +0000')) ]
+        if parent is not None:
+            headers += [ 'In-Reply-To: %s' % (self.get_message_id(EMAIL, parent)),
+                         'References: %s' % (self.get_message_id(EMAIL, root)) ]
+        headers.append('MIME-Version: 1.0')
+
+        text = self._build_text(rand, lognormal(rand, self.TEXT_MEDIAN, 1.0, 60, 200000))
+        part = 'Content-Type: text/plain; charset=UTF-8\r\n\r\n%s' % (text)
+        if rand.random() < 0.6:
+            # text and html versions
+            boundary = '%032x' % (rand.getrandbits(128))
+            html = '<div dir="ltr">%s</div>\r\n' % ('<br>\r\n'.join(text.split('\r\n')))
+            part = 'Content-Type: multipart/alternative; boundary=%s\r\n\r\n--%s\r\n%s\r\n--%s\r\n' \
+                   'Content-Type: text/html; charset=UTF-8\r\n\r\n%s\r\n--%s--\r\n' % (boundary, boundary, part, boundary, html, boundary)
+
+        if rand.random() < self.attachment_ratio:
+            boundary = '%032x' % (rand.getrandbits(128))
+            parts    = [part]
+            for _ in xrange(skewed_choice(rand, [1, 1, 1, 1, 1, 1, 1, 2, 2, 3], 1)):
+                content_type, filename, content = self._get_attachment(rand)
+                parts.append('Content-Type: %s; name="%s"\r\nContent-Disposition: attachment; filename="%s"\r\n' \
+                             'Content-Transfer-Encoding: base64\r\n\r\n%s' % (content_type, filename, filename, content))
+            part = 'Content-Type: multipart/mixed; boundary=%s\r\n\r\n%s\r\n--%s--\r\n' % \
+                   (boundary, ''.join([ '--%s\r\n%s\r\n' % (boundary, a_part) for a_part in parts ]), boundary)
+
+        flags = []
+        if sent or rand.random() < 0.85:
+            flags.append('\\Seen')
+        if not sent and rand.random() < 0.1:
+            flags.append('\\Answered')
+        labels = self._get_labels(rand, sent)
+        if '\\Starred' in labels:
+            flags.append('\\Flagged')
+
+        return '%s\r\n%s' % ('\r\n'.join(headers), part), subject, labels, flags
+
+    def build_chat(self, a_num):
+        """
+           Return (body, subject, labels, flags) of the chat a_num
+        """
+        rand     = get_rand(self.seed, CHAT, a_num, CONTENT_RAND)
+        contact  = skewed_choice(rand, self.contacts)
+        the_date = datetime.datetime.utcfromtimestamp(self.get_date(CHAT, a_num))
+
+        lines = []
+        for _ in xrange(lognormal(rand, 8, 1.0, 1, 500)):
+            name = contact[0].split()[0] if rand.random() < 0.5 else 'me'
+            lines.append('%s: %s' % (name, ' '.join([ skewed_choice(rand, WORDS, 2) for _ in xrange(rand.randint(1, 15)) ])))
+
+        subject = 'Chat with %s' % (contact[0])
+        body    = 'Message-ID: %s\r\nSubject: %s\r\nFrom: %s <%s>\r\nTo: %s\r\nDate: %s\r\n' \
+                  'Content-Type: text/plain; charset=UTF-8\r\n\r\n%s\r\n' % (self.get_message_id(CHAT, a_num), subject, \
+                  contact[0], contact[1], self.owner, the_date.strftime('%a, %d %b %Y %H:%M:%S +0000'), '\r\n'.join(lines))
+
+        return body, subject, [], ['\\Seen']
+
+    def get_metadata(self, a_kind, a_num, a_subject, a_labels, a_flags):
+        """
+           Return the metadata of a message as written by GmailStorer.bury_metadata
+        """
+        # parsed like the header fields fetched by the sync
+        header_fields  = 'Message-ID: %s\r\nSubject: %s\r\n\r\n' % (self.get_message_id(a_kind, a_num), a_subject)
+        subject, msgid = gmvault.GmailStorer.parse_header_fields(header_fields)
+
+        if a_kind == EMAIL:
+            thread_id = self.get_gm_id(EMAIL, self.get_thread(a_num)[1])
+            labels    = list(a_labels)
+        else:
+            thread_id = self.get_gm_id(CHAT, a_num)
+            labels    = list(a_labels) + [gmvault.GmailStorer.CHAT_GM_LABEL]
+
+        return { gmvault.GmailStorer.ID_K         : self.get_gm_id(a_kind, a_num),
+                 gmvault.GmailStorer.LABELS_K     : labels,
+                 gmvault.GmailStorer.FLAGS_K      : list(a_flags),
+                 gmvault.GmailStorer.THREAD_IDS_K : thread_id,
+                 gmvault.GmailStorer.INT_DATE_K   : self.get_date(a_kind, a_num),
+                 gmvault.GmailStorer.SUBJECT_K    : subject,
+                 gmvault.GmailStorer.MSGID_K      : msgid }
+
+    def get_units(self, a_limit_per_chat_dir):
+        """
+           Return the dirs to write as (kind, dir relative to the db dir, first message, last message + 1)
+        """
+        units, first = [], 0
+        while first < self.nb_emails:
+            month = gmvault_utils.get_ym_from_datetime(datetime.datetime.utcfromtimestamp(self.get_date(EMAIL, first)))
+
+            # the message in the slot of the first second of the next month is the first or the last one of the month
+            year, mon = int(month[:4]), int(month[5:])
+            next_month = calendar.timegm((year + mon / 12, mon % 12 + 1, 1, 0, 0, 0))
+            last = min(self.nb_emails, max(first + 1, int((next_month - self._start) / self._get_slot(EMAIL))))
+            while last < self.nb_emails and self.get_date(EMAIL, last) < next_month:
+                last += 1
+            while last > first + 1 and self.get_date(EMAIL, last - 1) >= next_month:
+                last -= 1
+
+            units.append((EMAIL, month, first, last))
+            first = last
+
+        for first in xrange(0, self.nb_chats, a_limit_per_chat_dir):
+            units.append((CHAT, gmvault.GmailStorer.SUB_CHAT_AREA % ('subchats-%d' % (first / a_limit_per_chat_dir + 1)), \
+                          first, min(self.nb_chats, first + a_limit_per_chat_dir)))
+
+        return units
+
+    def write_dir(self, a_storage, a_unit):
+        """
+           Write the messages of a unit (see get_units) with the storage settings a_storage (see generate_vault).
+           Return the index rows (gm_id, dir, flags, size) of the messages
+        """
+        kind, rel_dir, first, last = a_unit
+        the_dir = '%s/%s' % (a_storage['db_dir'], rel_dir)
+        gmvault_utils.makedirs(the_dir)
+
+        rows = []
+        for num in xrange(first, last):
+            body, subject, labels, flags = self.build_email(num) if kind == EMAIL else self.build_chat(num)
+            gm_id = self.get_gm_id(kind, num)
+
+            data_path = '%s%s%s' % (gmvault.GmailStorer.DATA_FNAME % (the_dir, gm_id), '.crypt' if a_storage['key'] else '', \
+                                    codec_utils.get_codec(a_storage['codec'], a_storage['level']).SUFFIX)
+            data = transform_utils.transform_data(body, a_storage['codec'], a_storage['level'], a_storage['key'], \
+                                                  a_storage['blob_store'])
+            the_fd = open(data_path, 'wb')
+            the_fd.write(data)
+            the_fd.close()
+
+            the_fd = open(gmvault.GmailStorer.METADATA_FNAME % (the_dir, gm_id), 'w')
+            json.dump(self.get_metadata(kind, num, subject, labels, flags), the_fd, ensure_ascii = False)
+            the_fd.close()
+
+            rows.append((gm_id, rel_dir, index_utils.GmailIndex.get_flags_from_filename(data_path), len(data)))
+
+        # an old dir (its manifest is trusted right away)
+        last_date = self.get_date(kind, last - 1)
+        os.utime(the_dir, (last_date, last_date))
+
+        manifests = index_utils.DirManifests(a_storage['info_dir'], a_storage['db_dir'])
+        manifests.mark_dirty(rel_dir)
+        manifests.flush()
+
+        return rows
+
+def _write_dir(a_args):
+    """
+       Function of the pool processes
+    """
+    generator, storage, unit = a_args
+    return generator.write_dir(storage, unit)
+
+def generate_vault(a_db_dir, a_generator, a_use_encryption = False, a_nb_processes = None):
+    """
+       Write the messages of a_generator in the gmvault-db a_db_dir with a pool of a_nb_processes processes
+       (one per core if None). The compression and the attachments deduplication of the conf are used.
+       Return the number of messages and the size of their data files
+    """
+    gstorer = gmvault.GmailStorer(a_db_dir, a_use_encryption)
+    if a_generator.owner:
+        gstorer.store_db_owner(a_generator.owner)
+
+    codec = codec_utils.get_codec()
+    conf  = gmvault_utils.get_conf_defaults()
+
+    storage = { 'db_dir'     : '%s/%s' % (a_db_dir, gmvault.GmailStorer.DB_AREA),
+                'info_dir'   : gstorer.get_info_dir(),
+                'codec'      : codec.NAME,
+                'level'      : codec.level,
+                # the key is created before the processes need it
+                'key'        : gmvault.GmailStorer.get_encryption_key(gstorer.get_info_dir()) if a_use_encryption else None,
+                'blob_store' : blob_utils.BlobStore('%s/%s' % (a_db_dir, gmvault.GmailStorer.BLOBS_AREA), \
+                                                    conf.getint("General", "dedup_min_bytes", 65536)) \
+                               if conf.getboolean("General", "dedup_attachments", False) else None }
+
+    units = a_generator.get_units(conf.getint("General", "limit_per_chat_dir", 1500))
+    total = a_generator.nb_emails + a_generator.nb_chats
+
+    nb_processes = a_nb_processes or multiprocessing.cpu_count()
+    LOG.critical("Generate %d emails and %d chats in %d dirs with %d processes.\n" % \
+                 (a_generator.nb_emails, a_generator.nb_chats, len(units), nb_processes))
+
+    nb_messages, nb_bytes = 0, 0
+    pool = multiprocessing.Pool(nb_processes, _init_worker)
+    try:
+        results = pool.imap_unordered(_write_dir, [ (a_generator, storage, unit) for unit in units ])
+        for _ in xrange(len(units)):
+            while True:
+                try:
+                    rows = results.next(1) # use a timeout to not block CTRL^C
+                    break
+                except multiprocessing.TimeoutError:
+                    continue
+
+            gstorer.get_index().add_all(rows)
+            nb_messages += len(rows)
+            nb_bytes    += sum([ row[3] for row in rows ])
+
+            if (nb_messages * 10) / total != ((nb_messages - len(rows)) * 10) / total:
+                LOG.critical("Generated %d/%d messages." % (nb_messages, total))
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    gstorer.flush()
+
+    return nb_messages, nb_bytes
@@ -0,0 +1,125 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the BackgroundWriter: threads running the disk writes (compression, encryption, file creation)
+of the storer while the sync keeps reading from the IMAP connections
+
+'''
+import threading
+import Queue
+
+import log_utils
+import gmvault_utils
+
+LOG = log_utils.LoggerFactory.get_logger('writer_utils')
+
+class BackgroundWriter(object):
+    """
+       Bounded queue of write tasks run by writer threads.
+       A task is a function called with its arguments followed by an optional on_done(result) called once the
+       function has returned. on_done is not called when the function fails: the error is kept and raised
+       by the next submit or flush.
+    """
+    STOP = None
+
+    def __init__(self, a_nb_threads = 1, a_queue_size = 50):
+        """
+           a_nb_threads: number of writer threads
+           a_queue_size: max number of queued tasks. submit blocks when the queue is full
+        """
+        self._queue   = Queue.Queue(max(1, a_queue_size))
+        self._error   = None
+        self._lock    = threading.Lock()
+        self._threads = []
+
+        for _ in xrange(max(1, a_nb_threads)):
+            thread = threading.Thread(target = self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        """
+           Writer thread loop
+        """
+        while True:
+            task = self._queue.get()
+            try:
+                if task is self.STOP:
+                    return
+
+                func, args, kwargs, on_done = task
+                try:
+                    result = func(*args, **kwargs)
+                except Exception, err: #pylint:disable-msg=W0703
+                    LOG.critical("Error while writing in the db: %s" % (err))
+                    LOG.debug(gmvault_utils.get_exception_traceback())
+                    with self._lock:
+                        self._error = self._error or err
+                    continue
+
+                if on_done:
+                    on_done(result)
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        """
+           Raise the first error of the writer threads (once)
+        """
+        with self._lock:
+            error, self._error = self._error, None
+
+        if error:
+            raise error #pylint:disable-msg=E0702
+
+    def submit(self, a_func, a_args, a_kwargs = None, a_on_done = None):
+        """
+           Queue the call a_func(*a_args, **a_kwargs). Block while the queue is full
+        """
+        self._raise_error()
+
+        task = (a_func, a_args, a_kwargs or {}, a_on_done)
+        while True:
+            try:
+                self._queue.put(task, True, 1) # use a timeout to not block CTRL^C
+                return
+            except Queue.Full:
+                continue
+
+    def flush(self):
+        """
+           Wait until all the queued tasks have been run
+        """
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                self._queue.all_tasks_done.wait(1) # use a timeout to not block CTRL^C
+
+        self._raise_error()
+
+    def close(self):
+        """
+           Run the queued tasks and stop the writer threads
+        """
+        try:
+            self.flush()
+        finally:
+            for _ in self._threads:
+                self._queue.put(self.STOP)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
@@ -483,9 +483,9 @@ class TestGMVault(unittest.TestCase): #pylint:disable-msg=R0904
             
         #source_email[the_id][gsource.IMAP_INTERNALDATE] = source_email[the_id][gsource.IMAP_INTERNALDATE].replace(tzinfo= gmvault_utils.UTC_TZ)
             
-        dest_id = gdestination.push_email(source_email[the_id][gsource.EMAIL_BODY], \
-                                           source_email[the_id][gsource.IMAP_FLAGS] , \
-                                           source_email[the_id][gsource.IMAP_INTERNALDATE], test_labels)
+        dest_id, _ = gdestination.push_email(source_email[the_id][gsource.EMAIL_BODY], \
+                                              source_email[the_id][gsource.IMAP_FLAGS] , \
+                                              source_email[the_id][gsource.IMAP_INTERNALDATE], test_labels)
         
         dest_email = gdestination.fetch(dest_id, gsource.GET_ALL_INFO)
         
@@ -528,9 +528,9 @@ class TestGMVault(unittest.TestCase): #pylint:disable-msg=R0904
             for elem in existing_labels:
                 test_labels.append(elem)
                 
-            dest_id = gdestination.push_email(source_email[the_id][gsource.EMAIL_BODY], \
-                                               source_email[the_id][gsource.IMAP_FLAGS] , \
-                                               source_email[the_id][gsource.IMAP_INTERNALDATE], test_labels)
+            dest_id, _ = gdestination.push_email(source_email[the_id][gsource.EMAIL_BODY], \
+                                                  source_email[the_id][gsource.IMAP_FLAGS] , \
+                                                  source_email[the_id][gsource.IMAP_INTERNALDATE], test_labels)
             
             #retrieve email from destination email account
             dest_email = gdestination.fetch(dest_id, gsource.GET_ALL_INFO)
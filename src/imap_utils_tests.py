@@ -0,0 +1,294 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import threading
+import imaplib
+import Queue
+
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.imap_utils as imap_utils
+import gmv.mod_imap as mod_imap
+import gmv.rate_utils as rate_utils
+
+
+class TestIMAPUtils(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Tests that do not need a connection to a Gmail server
+    """
+
+    def __init__(self, stuff):
+        """ constructor """
+        super(TestIMAPUtils, self).__init__(stuff)
+    
+    def test_build_sequence_set(self):
+        """
+           Check that consecutive ids are merged in ranges
+        """
+        self.assertEquals('1:3,5,7:8', imap_utils.GIMAPFetcher.build_sequence_set([1, 2, 3, 5, 7, 8]))
+        self.assertEquals('4', imap_utils.GIMAPFetcher.build_sequence_set([4]))
+        self.assertEquals('1:3,10', imap_utils.GIMAPFetcher.build_sequence_set([10L, 3L, 1L, 2L]))
+        
+    def test_chunker(self):
+        """
+           Check the slicing of imap ids in groups
+        """
+        self.assertEquals([[1, 2], [3, 4], [5]], list(gmvault_utils.chunker([1, 2, 3, 4, 5], 2)))
+        self.assertEquals([], list(gmvault_utils.chunker([], 500)))
+        
+    def test_search_changed_since(self):
+        """
+           Check the UID SEARCH MODSEQ command and the parsing of its response
+        """
+        class SearchIMAP4(object): #pylint:disable-msg=R0903
+            """ answer the SEARCH commands like a CONDSTORE server """
+            def __init__(self, data):
+                self.data     = data
+                self.commands = []
+            def uid(self, command, *args):
+                """ record the command """
+                self.commands.append(' '.join((command,) + args))
+                return 'OK', self.data
+        
+        client = mod_imap.MonkeyIMAPClient.__new__(mod_imap.MonkeyIMAPClient)
+        
+        client._imap = SearchIMAP4(['1 2 12 (MODSEQ 917162500)'])
+        self.assertEquals([1, 2, 12], client.search_changed_since('SINCE 1-Feb-2012', 917162400))
+        self.assertEquals(['SEARCH (SINCE 1-Feb-2012) MODSEQ 917162401'], client._imap.commands)
+        
+        client._imap = SearchIMAP4([None])
+        self.assertEquals([], client.search_changed_since('ALL', 12))
+        
+    def test_deletion_check(self):
+        """
+           Check the parsing of the gmail ids fetched by uid range and the sorted merge 
+           giving the gmail ids deleted from Gmail
+        """
+        class FetchIMAP4(object): #pylint:disable-msg=R0903
+            """ answer the UID FETCH commands """
+            def uid(self, command, *args): #pylint:disable-msg=W0613
+                """ return the untagged FETCH responses """
+                return 'OK', ['1 (X-GM-MSGID 1278455344230334865 UID 4)', \
+                              '2 (UID 7 X-GM-MSGID 1278455344230334870)']
+        
+        client = mod_imap.MonkeyIMAPClient.__new__(mod_imap.MonkeyIMAPClient)
+        client._imap = FetchIMAP4()
+        self.assertEquals([1278455344230334865, 1278455344230334870], client.fetch_gmail_ids(4, 7))
+        
+        self.assertEquals([1, 5, 9], gmvault.GMVaulter._get_deleted_ids([1, 2, 5, 7, 9], [2, 3, 7, 8]))
+        self.assertEquals([], gmvault.GMVaulter._get_deleted_ids([], [2, 3]))
+        self.assertEquals([4], gmvault.GMVaulter._get_deleted_ids([4], []))
+        
+    def test_restore_labels(self):
+        """
+           Check that the label pre-pass of a restore lists the Gmail folders once and that its labels cache
+           is reused when resuming
+        """
+        self.assertEquals(['Work/Done', 'new'], \
+                          imap_utils.GIMAPFetcher.get_missing_labels(['\\Inbox', 'Work/Done', 'work', 'new'], set(['work'])))
+        
+        class LabelsFetcher(object): #pylint:disable-msg=R0903
+            """ create the labels like GIMAPFetcher and count the folder listings """
+            def __init__(self):
+                self.nb_listings = 0
+            def create_gmail_labels(self, labels, existing_folders):
+                """ list the folders once and create the labels """
+                self.nb_listings += 1
+                existing_folders = set(existing_folders)
+                for label in labels:
+                    existing_folders.update([ directory.lower() for directory in imap_utils.GIMAPFetcher._get_dir_from_labels(label) ])
+                return existing_folders
+        
+        db_dir = '/tmp/gmvault-labels-tests'
+        gmvault_utils.delete_all_under(db_dir, delete_top_dir = True)
+        gstorer = gmvault.GmailStorer(db_dir)
+        for gm_id in range(1, 11):
+            gstorer.bury_metadata({ 'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'FLAGS': (), \
+                                    'X-GM-LABELS': ('\\Inbox', 'Projects/P%d' % (gm_id % 3)), \
+                                    'INTERNALDATE': datetime.datetime(2012, 5, 1), \
+                                    'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT)]': 'Subject: test\r\n\r\n' }, local_dir = '2012-05')
+        gstorer.flush()
+        
+        vaulter = gmvault.GMVaulter.__new__(gmvault.GMVaulter)
+        vaulter.login, vaulter.src = 'me@gmail.com', LabelsFetcher()
+        vaulter._existing_labels, vaulter._labels_lock = set(), threading.Lock()
+        
+        vaulter._prepare_labels(gstorer, vaulter.OP_EMAIL_RESTORE, gstorer.get_all_existing_gmail_ids(), ['restored'], False)
+        self.assertEquals(1, vaulter.src.nb_listings)
+        self.assertEquals(set(['projects', 'projects/p0', 'projects/p1', 'projects/p2', 'restored']), vaulter._existing_labels)
+        
+        # the pushers do not list the folders again
+        vaulter._create_labels(vaulter.src, ['\\Inbox', 'Projects/P1', 'restored'])
+        self.assertEquals(1, vaulter.src.nb_listings)
+        
+        # a resumed restore uses the cache
+        vaulter.src, vaulter._existing_labels = LabelsFetcher(), set()
+        vaulter._prepare_labels(gstorer, vaulter.OP_EMAIL_RESTORE, gstorer.get_all_existing_gmail_ids(), ['restored'], True)
+        self.assertEquals(0, vaulter.src.nb_listings)
+        self.assertEquals(5, len(vaulter._existing_labels))
+
+    def test_push_emails(self):
+        """
+           Check that a batch of emails is appended with one MULTIAPPEND (or one APPEND each) and labelled with
+           one UID STORE per set of labels
+        """
+        self.assertEquals([5, 6, 7, 9, 12, 11], imap_utils.GIMAPFetcher.parse_uid_set('5:7,9,12:11'))
+
+        class AppendServer(object): #pylint:disable-msg=R0903
+            """ answer the APPEND, SEARCH and STORE commands like Gmail """
+            def __init__(self, refused = (), appenduid = True, store_error = None, throttled = False): #pylint:disable-msg=R0913
+                self.commands    = []
+                self.refused     = refused
+                self.appenduid   = appenduid
+                self.store_error = store_error
+                self.throttled   = throttled
+                self.next_uid  = 100
+                self.bodies    = {}
+                self._imap     = self
+            def append(self, folder, msg, flags, msg_time): #pylint:disable-msg=W0613
+                """ one email """
+                return self.multiappend(folder, [(msg, flags, msg_time)])
+            def multiappend(self, folder, msgs): #pylint:disable-msg=W0613
+                """ all the emails or none """
+                self.commands.append('APPEND %d' % (len(msgs)))
+                if self.throttled:
+                    raise imaplib.IMAP4.error("APPEND command error: NO ['[THROTTLED] Account exceeded command or bandwidth limits. (Failure)']")
+                if [ msg for msg, _, _ in msgs if msg in self.refused ]:
+                    raise imaplib.IMAP4.error("APPEND command error: BAD ['Invalid Arguments: Unable to parse message']")
+                for msg, _, _ in msgs:
+                    self.next_uid += 1
+                    self.bodies[self.next_uid] = msg
+                if not self.appenduid:
+                    return '(Success)'
+                return '[APPENDUID 3 %d:%d] (Success)' % (self.next_uid - len(msgs) + 1, self.next_uid) if len(msgs) > 1 \
+                       else '[APPENDUID 3 %d] (Success)' % (self.next_uid)
+            def uid(self, command, *args):
+                """ record the command """
+                self.commands.append(' '.join((command,) + args))
+                if command == 'SEARCH':
+                    return 'OK', [' '.join([ str(uid) for uid, msg in sorted(self.bodies.items()) \
+                                             if 'Message-ID: %s' % (args[-1].strip('"')) in msg ])]
+                return ('NO', [self.store_error]) if self.store_error else ('OK', [None])
+
+        emails = [ ('Message-ID: <%d@test>\r\nSubject: %d\r\n\r\nbody' % (num, num), ('\\Seen',), datetime.datetime(2012, 6, 1), labels) \
+                   for num, labels in enumerate([set(['work']), set(['\\Inbox', 'my project']), set(), set(['work'])]) ]
+
+        fetcher = imap_utils.GIMAPFetcher('imap.gmail.com', 993, 'me@gmail.com', None)
+        fetcher.server, fetcher.multiappend = AppendServer(), True
+        self.assertEquals(([101, 102, 103, 104], []), fetcher.push_emails(emails))
+        self.assertEquals(['APPEND 4', 'STORE 101,104 +X-GM-LABELS (work)', 'STORE 102 +X-GM-LABELS (\\Inbox "my project")'], \
+                          sorted(fetcher.server.commands))
+
+        # without MULTIAPPEND the appends stop at the email that cannot be appended
+        fetcher.server, fetcher.multiappend = AppendServer([emails[2][0]]), False
+        self.assertEquals(([101, 102], []), fetcher.push_emails(emails))
+        self.assertEquals(['APPEND 1', 'APPEND 1', 'APPEND 1', \
+                           'STORE 101 +X-GM-LABELS (work)', 'STORE 102 +X-GM-LABELS (\\Inbox "my project")'], \
+                          sorted(fetcher.server.commands))
+
+        # a refused MULTIAPPEND appends nothing: the emails are appended one by one
+        fetcher.server, fetcher.multiappend = AppendServer([emails[3][0]]), True
+        self.assertEquals(([101, 102, 103], []), fetcher.push_emails(emails))
+        self.assertEquals(['APPEND 1', 'APPEND 1', 'APPEND 1', 'APPEND 1', 'APPEND 4'], \
+                          sorted(fetcher.server.commands)[:5])
+
+        # without APPENDUID the uids of the appended emails are searched with their Message-IDs
+        fetcher.server, fetcher.multiappend = AppendServer(appenduid = False), True
+        fetcher.server.bodies[50] = emails[0][0]
+        self.assertEquals(([101, 102, 103, 104], []), fetcher.push_emails(emails))
+        self.assertTrue('STORE 101,104 +X-GM-LABELS (work)' in fetcher.server.commands)
+
+        fetcher.server, fetcher.multiappend = AppendServer(appenduid = False), False
+        self.assertEquals(([101, None], [1]), fetcher.push_emails([emails[0], (emails[1][0].split('\r\n', 1)[1],) + emails[1][1:]]))
+        self.assertEquals(['APPEND 1', 'APPEND 1', 'SEARCH HEADER Message-ID "<0@test>"', 'STORE 101 +X-GM-LABELS (work)'], \
+                          sorted(fetcher.server.commands))
+
+        # the emails are pushed even if their labels cannot be stored
+        fetcher.server, fetcher.multiappend = AppendServer(store_error = 'STORE failed'), True
+        self.assertEquals(([101, 102, 103, 104], [0, 1, 3]), fetcher.push_emails(emails))
+
+        # a single email accepted by the server is never appended again
+        fetcher.server = AppendServer(appenduid = False)
+        self.assertEquals((101, True), fetcher.push_email(*emails[0]))
+        self.assertEquals(['APPEND 1', 'SEARCH HEADER Message-ID "<0@test>"', 'STORE 101 +X-GM-LABELS (work)'], \
+                          sorted(fetcher.server.commands))
+
+        fetcher.server = AppendServer(store_error = 'STORE failed')
+        self.assertEquals((101, False), fetcher.push_email(*emails[0]))
+        self.assertEquals(['APPEND 1', 'STORE 101 +X-GM-LABELS (work)'], sorted(fetcher.server.commands))
+
+        # a throttled MULTIAPPEND is not followed by one APPEND per email: the batch has to be pushed again after the pause
+        fetcher.server, fetcher.rate_controller = AppendServer(throttled = True), rate_utils.RateController(a_min_delay = 0.1)
+        self.assertRaises(imaplib.IMAP4.error, fetcher.push_emails, emails)
+        self.assertEquals((['APPEND 4'], 1, 0.5), (fetcher.server.commands, fetcher.rate_controller.nb_throttled, \
+                                                   fetcher.rate_controller.batch_ratio))
+
+        # a throttled STORE is measured as an error
+        fetcher.server = AppendServer(store_error = '[THROTTLED] Account exceeded command or bandwidth limits. (Failure)')
+        self.assertEquals(([101, 102, 103, 104], [0, 1, 3]), fetcher.push_emails(emails))
+        self.assertEquals(3, fetcher.rate_controller.nb_throttled)
+
+    def test_restore_pusher_throttled(self):
+        """
+           Check that the restore pusher pushes a throttled batch again in smaller batches once the pause is over
+        """
+        class ThrottledFetcher(object): #pylint:disable-msg=R0903
+            """ throttle the first batch """
+            def __init__(self, rate_controller):
+                self.rate_controller = rate_controller
+                self.batches         = []
+            def push_emails(self, emails):
+                """ measured like GIMAPFetcher.push_emails """
+                self.batches.append(len(emails))
+                if len(self.batches) == 1:
+                    err = imaplib.IMAP4.error("APPEND command error: NO ['[THROTTLED] Account exceeded command or bandwidth limits.']")
+                    self.rate_controller.on_error(err)
+                    raise err
+                return range(len(emails)), []
+
+        vaulter = gmvault.GMVaulter.__new__(gmvault.GMVaulter)
+        vaulter.rate_controller = rate_utils.RateController(a_min_delay = 0.1)
+        vaulter.rate_controller.set_workers(1)
+        vaulter._existing_labels, vaulter._labels_lock = set(), threading.Lock()
+
+        work_queue, result_queue = Queue.Queue(), Queue.Queue()
+        for index in range(8):
+            work_queue.put((index, 1000 + index, '2012-05', { 'flags' : (), 'internal_date' : datetime.datetime(2012, 5, 1) }, \
+                            'Subject: %d\r\n\r\nbody' % (index), set()))
+        work_queue.put(None)
+
+        src = ThrottledFetcher(vaulter.rate_controller)
+        vaulter._restore_pusher(src, gmvault.GmailStorer, 'emails', work_queue, result_queue, threading.Event())
+
+        self.assertEquals([8, 5, 3], src.batches)
+        self.assertEquals([ (index, 1000 + index, None) for index in range(8) ] + [(None, None, None)], \
+                          [ result_queue.get_nowait() for _ in range(9) ])
+
+        
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestIMAPUtils)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+ 
+if __name__ == '__main__':
+    
+    tests()
@@ -0,0 +1,160 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import os
+
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.index_utils as index_utils
+
+import test_utils
+
+
+class TestIndexUtils(test_utils.DbTestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the indexes of the db (gmail id index, directory manifests, metadata snapshot)
+    """
+
+    TEST_DB_DIR = "/tmp/gmvault-index-tests"
+
+    def test_index_maintained_by_storer(self):
+        """
+           Check that burying, quarantining and deleting emails maintain the index
+        """
+        gstorer = gmvault.GmailStorer(self.test_db_dir)
+
+        for gm_id, month in [(1001, 1), (1002, 2), (1003, 2)]:
+            a_date = datetime.datetime(2012, month, 3)
+            gstorer.bury_email(test_utils.create_email_info(gm_id, a_date), \
+                               local_dir = gmvault_utils.get_ym_from_datetime(a_date), compress = True)
+
+        gstorer.flush()
+
+        index = gstorer.get_index()
+        self.assertEquals(3, index.count())
+
+        the_dir, flags, size = index.get(1002)
+        self.assertEquals('2012-02', the_dir)
+        self.assertEquals(index_utils.GmailIndex.COMPRESSED, flags)
+        self.assertEquals(os.path.getsize('%s/db/2012-02/1002.eml.gz' % (self.test_db_dir)), size)
+
+        self.assertEquals('%s/db/2012-01' % (self.test_db_dir), gstorer.get_directory_from_id(1001))
+
+        gstorer.quarantine_email(1001)
+        self.assertEquals(None, index.get(1001))
+
+        gstorer.delete_emails([(1003, '2012-02')], 'email')
+        self.assertEquals(None, index.get(1003))
+        self.assertEquals(1, index.count())
+
+        # the index survives the storer once flushed
+        gstorer.flush()
+        gstorer = gmvault.GmailStorer(self.test_db_dir)
+        self.assertEquals(1, gstorer.get_index().count())
+
+    def test_rebuild_and_stale_index(self):
+        """
+           Check the rebuild of the index and the fallback on the filesystem when the index is stale
+        """
+        gstorer = gmvault.GmailStorer(self.test_db_dir)
+
+        a_date = datetime.datetime(2011, 12, 25)
+        gstorer.bury_email(test_utils.create_email_info(2001, a_date), local_dir = '2011-12')
+        gstorer.bury_email(test_utils.create_email_info(2002, a_date), local_dir = '2011-12', compress = True)
+
+        # move an email behind the back of the storer
+        os.makedirs('%s/db/2011-11' % (self.test_db_dir))
+        for ext in ['meta', 'eml']:
+            os.rename('%s/db/2011-12/2001.%s' % (self.test_db_dir, ext), '%s/db/2011-11/2001.%s' % (self.test_db_dir, ext))
+
+        self.assertEquals(os.path.abspath('%s/db/2011-11' % (self.test_db_dir)), gstorer.get_directory_from_id(2001))
+        self.assertEquals('2011-11', gstorer.get_index().get(2001)[0])
+
+        self.assertEquals(2, gstorer.rebuild_index())
+        self.assertEquals(('2011-11', 0, len('Subject: test\r\n\r\nbody of 2001')), gstorer.get_index().get(2001))
+        self.assertEquals(index_utils.GmailIndex.COMPRESSED, gstorer.get_index().get(2002)[1])
+
+    def test_dir_manifests(self):
+        """
+           Check that the db inventory is loaded from the manifests and that a directory
+           is rescanned when its mtime doesn't match its manifest
+        """
+        gstorer = gmvault.GmailStorer(self.test_db_dir)
+
+        a_date = datetime.datetime(2012, 3, 7)
+        for gm_id in [3001, 3002, 3003]:
+            gstorer.bury_email(test_utils.create_email_info(gm_id, a_date), local_dir = '2012-03')
+        gstorer.flush()
+
+        self.assertEquals([(3001, '2012-03'), (3002, '2012-03'), (3003, '2012-03')], \
+                          gstorer.get_all_existing_gmail_ids().items())
+
+        # age the dir: the manifest is rewritten and trusted from now on
+        month_dir = '%s/db/2012-03' % (self.test_db_dir)
+        os.utime(month_dir, (1000000000, 1000000000))
+        self.assertEquals(3, len(gstorer.get_all_existing_gmail_ids()))
+
+        # remove an email behind the back of the storer without changing the dir mtime
+        os.remove('%s/3002.meta' % (month_dir))
+        os.utime(month_dir, (1000000000, 1000000000))
+        self.assertEquals([3001, 3002, 3003], gstorer.get_all_existing_gmail_ids().keys())
+
+        # a different mtime makes the storer rescan the dir
+        os.utime(month_dir, (1000000100, 1000000100))
+        self.assertEquals([3001, 3003], gstorer.get_all_existing_gmail_ids().keys())
+
+        # deleting through the storer updates the manifest
+        gstorer.delete_emails([(3003, '2012-03')], 'email')
+        gstorer.flush()
+        self.assertEquals([3001], gstorer.get_all_existing_gmail_ids(pivot_dir = '2012-01').keys())
+
+    def test_metadata_snapshot(self):
+        """
+           Check that the metadata snapshot loads the stored flags and labels of the requested months
+        """
+        gstorer = gmvault.GmailStorer(self.test_db_dir)
+
+        for gm_id, month in [(4001, 4), (4002, 4), (4003, 5)]:
+            a_date = datetime.datetime(2012, month, 1)
+            gstorer.bury_email(test_utils.create_email_info(gm_id, a_date), local_dir = gmvault_utils.get_ym_from_datetime(a_date))
+        gstorer.flush()
+
+        snapshot = gmvault.MetadataSnapshot(gstorer, 2)
+        snapshot.NB_IDS_PER_TASK = 1 # one task per file to go through the pool
+        snapshot.load(['2012-04', '2012-06'])
+
+        self.assertEquals(((u'\\Seen',), ('work',), 4002), snapshot.get(4002, '2012-04'))
+        self.assertEquals(None, snapshot.get(4002, '2012-05')) # stored in another month
+        self.assertEquals(None, snapshot.get(4003, '2012-05')) # month not loaded
+
+        snapshot.load(['2012-05'])
+        self.assertEquals(('work',), snapshot.get(4003, '2012-05')[1])
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestIndexUtils)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
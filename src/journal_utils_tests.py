@@ -0,0 +1,157 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+
+import gmv.gmvault_utils as gmvault_utils
+import gmv.journal_utils as journal_utils
+import gmv.gmvault as gmvault
+
+import test_utils
+
+
+class TestJournalUtils(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the resume journals
+    """
+
+    def __init__(self, stuff):
+        """ constructor """
+        super(TestJournalUtils, self).__init__(stuff)
+
+        self.test_dir = "/tmp/gmvault-journal-tests"
+
+    def setUp(self): #pylint:disable-msg=C0103
+        """
+           Start from an empty dir
+        """
+        gmvault_utils.delete_all_under(self.test_dir, delete_top_dir = True)
+        gmvault_utils.makedirs(self.test_dir)
+
+    def test_record_and_resume(self):
+        """
+           Check that the recorded ids are reloaded, that an interrupted last line is ignored
+           and that a new operation forgets the previous ids
+        """
+        journal = journal_utils.OperationJournal('%s/email_sync.journal' % (self.test_dir), a_fsync_every = 2)
+
+        self.assertFalse(journal.exists())
+        self.assertEquals(set(), journal.load())
+
+        journal.open(a_truncate = True)
+        for imap_id, gm_id in [(3, 1003), (1, 1001), (12, 1012)]:
+            journal.record(imap_id, gm_id)
+        journal.close()
+
+        self.assertEquals(set([1, 3, 12]), journal.load())
+
+        # resume: append to the journal then crash in the middle of a line
+        journal.open(a_truncate = False)
+        journal.record(5L, 1005L)
+        journal.close()
+
+        the_fd = open(journal.path, 'a')
+        the_fd.write('7 10')
+        the_fd.close()
+
+        self.assertEquals(set([1, 3, 5, 12]), journal.load())
+
+        # new operation
+        journal.open(a_truncate = True)
+        journal.close()
+        self.assertEquals(set(), journal.load())
+
+    def test_validity(self):
+        """
+           Check that the validity value is written at the start of a new journal and kept when resuming
+        """
+        journal = journal_utils.OperationJournal('%s/email_sync.journal' % (self.test_dir))
+        self.assertEquals(None, journal.get_validity())
+
+        journal.open(a_truncate = True, a_validity = 600000001)
+        journal.record(3, 1003)
+        journal.close()
+
+        journal.open(a_truncate = False, a_validity = 600000001)
+        journal.record(4, 1004)
+        journal.close()
+
+        self.assertEquals(600000001, journal.get_validity())
+        self.assertEquals(set([3, 4]), journal.load())
+
+        journal.remove()
+        self.assertFalse(journal.exists())
+
+        # resume without journal: a new one is created with the validity
+        journal.open(a_truncate = False, a_validity = 7)
+        journal.close()
+        self.assertEquals(7, journal.get_validity())
+
+    def test_before_sync(self):
+        """
+           Check that the data vouched for by the recorded ids is synced before each fsync of the journal
+        """
+        synced = []
+        journal = journal_utils.OperationJournal('%s/email_sync.journal' % (self.test_dir), a_fsync_every = 2, \
+                                                 a_before_sync = lambda: synced.append(len(open(journal.path).read())))
+
+        journal.open(a_truncate = True)
+        journal.record(1, 1001)
+        self.assertEquals([], synced)
+        journal.record(2, 1002)
+        journal.record(3, 1003)
+        journal.close()
+
+        # called with the ids still unsynced in the buffer of the journal
+        self.assertEquals([0, 14], synced)
+
+    def test_storer_sync_data(self):
+        """
+           Check that the storer fsyncs the files of the written emails and their directory once
+        """
+        gstorer = gmvault.GmailStorer('%s/db' % (self.test_dir))
+        fsynced = []
+
+        fsync_paths = gmvault_utils.fsync_paths
+        gmvault_utils.fsync_paths = lambda paths: fsynced.append(sorted(paths))
+        try:
+            gstorer.bury_email(test_utils.create_email_info(1001), local_dir = '2012-06')
+            gstorer.sync_data()
+            gstorer.sync_data()
+        finally:
+            gmvault_utils.fsync_paths = fsync_paths
+
+        the_dir = '%s/db/db/2012-06' % (self.test_dir)
+        # the blobs then the emails
+        self.assertEquals([[], ['%s/1001.eml' % (the_dir), '%s/1001.meta' % (the_dir)], [], []], fsynced)
+
+        # really fsynced
+        gstorer.bury_email(test_utils.create_email_info(1002), local_dir = '2012-06')
+        gstorer.sync_data()
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestJournalUtils)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,286 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import time
+
+import imapclient
+
+import gmv.gmvault as gmvault
+import gmv.imap_utils as imap_utils
+import gmv.mock_gmail_server as mock_gmail_server
+
+import test_utils
+
+
+class TestMockGmailServer(test_utils.DbTestCase): #pylint:disable-msg=R0904
+    """
+       Sync and restore against the mock Gmail server (no Gmail account needed)
+    """
+
+    TEST_DB_DIR = "/tmp/gmvault-mock-server-tests"
+
+    def __init__(self, stuff):
+        """ constructor """
+        super(TestMockGmailServer, self).__init__(stuff)
+
+        self.credential  = { 'type' : 'passwd', 'value' : 'a password' }
+        self.server      = None
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        """
+           Stop the server
+        """
+        if self.server:
+            self.server.stop()
+            self.server = None
+
+    def _start(self, a_mailbox, **kwargs):
+        """
+           Start a server on a_mailbox
+        """
+        self.server = mock_gmail_server.MockGmailServer(a_mailbox, **kwargs).start()
+        return self.server
+
+    def test_parse_args(self):
+        """
+           Check the parsing of the arguments of the commands
+        """
+        self.assertEquals(['1:3', ['X-GM-MSGID', 'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID SUBJECT)]']], \
+                          mock_gmail_server.parse_args(['1:3 (X-GM-MSGID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID SUBJECT)])']))
+        self.assertEquals(['[Gmail]/All Mail', ['\\Seen'], '01-Jun-2012 10:00:00 +0200', 'body', [], 'body 2'], \
+                          mock_gmail_server.parse_args(['"[Gmail]/All Mail" (\\Seen) "01-Jun-2012 10:00:00 +0200" ', 'body', \
+                                                        ' () ', 'body 2', '']))
+        self.assertEquals(datetime.datetime(2012, 6, 1, 8), mock_gmail_server.parse_date_time('01-Jun-2012 10:00:00 +0200'))
+        self.assertEquals('"\\\\Inbox"', mock_gmail_server.quote('\\Inbox'))
+
+    def test_fetcher(self):
+        """
+           Check the commands of GIMAPFetcher
+        """
+        mailbox = mock_gmail_server.MockMailbox.generate(30, a_nb_chats = 3)
+        server  = self._start(mailbox)
+
+        fetcher = imap_utils.GIMAPFetcher(server.host, server.port, mailbox.login, self.credential, use_ssl = False)
+        fetcher.connect()
+
+        self.assertTrue(fetcher.condstore and fetcher.multiappend)
+        self.assertTrue(fetcher.server._imap.compressor is not None) #pylint:disable-msg=W0212
+        self.assertEquals({ 'folder' : mailbox.ALL_MAIL, 'uidvalidity' : 1, 'highestmodseq' : mailbox.highestmodseq }, \
+                          fetcher.get_folder_state())
+
+        emails = mailbox.get_emails()
+        self.assertEquals(range(1, 31), fetcher.search(imap_utils.GIMAPFetcher.IMAP_ALL))
+
+        data = fetcher.fetch([2, 3], imap_utils.GIMAPFetcher.GET_ALL_INFO)
+        for email in emails[1:3]:
+            info = data[email.uid]
+            self.assertEquals((email.gm_id, email.thread_id, email.body, tuple(email.labels), email.internal_date), \
+                              (info['X-GM-MSGID'], info['X-GM-THRID'], info['BODY[]'], info['X-GM-LABELS'], \
+                               info['INTERNALDATE'].replace(tzinfo = None)))
+            self.assertTrue(info[imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY].startswith('Subject: '))
+
+        self.assertEquals([ email.uid for email in emails if 'label-1' in email.labels ], \
+                          fetcher.search({ 'type' : 'gmail', 'req' : 'label:label-1' }))
+        self.assertEquals(range(1, 25), fetcher.search({ 'type' : 'imap', 'req' : 'Since 1-Jan-2010 Before 2-Jan-2010' }))
+        self.assertEquals([ email.uid for email in emails if email.modseq > 20 ], \
+                          fetcher.search_changed_since(imap_utils.GIMAPFetcher.IMAP_ALL, 20))
+        self.assertEquals([ email.gm_id for email in emails[3:8] ], fetcher.fetch_gmail_ids(4, 8))
+
+        self.assertEquals(mailbox.CHATS, fetcher.find_and_select_chats_folder())
+        self.assertEquals([1, 2, 3], fetcher.search(imap_utils.GIMAPFetcher.IMAP_ALL))
+
+        fetcher.disconnect()
+
+    def test_resume_sync(self):
+        """
+           Check that a resumed sync skips the journaled imap ids unless the UIDVALIDITY of All Mail changed
+        """
+        mailbox = mock_gmail_server.MockMailbox.generate(20)
+        server  = self._start(mailbox)
+        emails  = mailbox.get_emails()
+
+        syncer  = gmvault.GMVaulter(self.test_db_dir, server.host, server.port, mailbox.login, self.credential, use_ssl = False)
+        journal = syncer._get_journal(syncer.OP_EMAIL_SYNC) #pylint:disable-msg=W0212
+        journal.open(a_truncate = True, a_validity = mailbox.folders[mailbox.ALL_MAIL].uidvalidity)
+        for email in emails[:10]:
+            journal.record(email.uid, email.gm_id)
+        journal.close()
+
+        syncer.sync(imap_utils.GIMAPFetcher.IMAP_ALL, restart = True, emails_only = True)
+        gstorer = gmvault.get_storer(self.test_db_dir)
+        self.assertEquals([ email.gm_id for email in emails[10:] ], list(gstorer.get_all_existing_gmail_ids()))
+        gstorer.flush()
+
+        # the uids of the journal are not the ones of the folder anymore
+        mailbox.folders[mailbox.ALL_MAIL].uidvalidity += 1
+        journal.open(a_truncate = True, a_validity = mailbox.folders[mailbox.ALL_MAIL].uidvalidity - 1)
+        for email in emails:
+            journal.record(email.uid, email.gm_id)
+        journal.close()
+
+        syncer = gmvault.GMVaulter(self.test_db_dir, server.host, server.port, mailbox.login, self.credential, use_ssl = False)
+        syncer.sync(imap_utils.GIMAPFetcher.IMAP_ALL, restart = True, emails_only = True)
+        gstorer = gmvault.get_storer(self.test_db_dir)
+        self.assertEquals([ email.gm_id for email in emails ], list(gstorer.get_all_existing_gmail_ids()))
+
+    def test_sync(self):
+        """
+           Check a sync, a sync after changes in Gmail and the mailbox loaded from the db
+        """
+        mailbox = mock_gmail_server.MockMailbox.generate(100, a_nb_chats = 5)
+        server  = self._start(mailbox)
+
+        syncer = gmvault.GMVaulter(self.test_db_dir, server.host, server.port, mailbox.login, self.credential, use_ssl = False)
+        syncer.sync(imap_utils.GIMAPFetcher.IMAP_ALL)
+
+        gstorer = gmvault.get_storer(self.test_db_dir)
+        self.assertEquals([ email.gm_id for email in mailbox.get_emails() ], list(gstorer.get_all_existing_gmail_ids()))
+        self.assertEquals(5, len(gstorer.get_all_chats_gmail_ids()))
+
+        email = mailbox.get_emails()[10]
+        metadata, body = gstorer.unbury_email(email.gm_id)
+        self.assertEquals((email.body, email.labels), (body, metadata[gstorer.LABELS_K]))
+        gstorer.flush()
+
+        # new email, deleted email and new labels
+        new_email = mailbox.add_email('Subject: new email\r\n\r\nbody of the new email', ['work'], ['\\Seen'], \
+                                      datetime.datetime(2012, 3, 4, 5, 6, 7))
+        deleted   = mailbox.get_emails()[3]
+        mailbox.folders[mailbox.ALL_MAIL].remove(deleted.uid)
+        email.labels.append('new label')
+        email.modseq = mailbox.next_modseq()
+
+        syncer = gmvault.GMVaulter(self.test_db_dir, server.host, server.port, mailbox.login, self.credential, use_ssl = False)
+        syncer.sync(imap_utils.GIMAPFetcher.IMAP_ALL, db_cleaning = True)
+
+        gstorer = gmvault.get_storer(self.test_db_dir)
+        gm_ids  = gstorer.get_all_existing_gmail_ids()
+        self.assertTrue(new_email.gm_id in gm_ids and deleted.gm_id not in gm_ids)
+        self.assertEquals(email.labels, gstorer.unbury_metadata(email.gm_id)[gstorer.LABELS_K])
+
+        # a mailbox seeded from the db
+        loaded = mock_gmail_server.MockMailbox.from_gmvault_db(self.test_db_dir)
+        self.assertEquals([ (email.gm_id, email.body, email.internal_date) for email in mailbox.get_emails() ], \
+                          [ (email.gm_id, email.body, email.internal_date) for email in loaded.get_emails() ])
+        self.assertEquals(5, len(loaded.get_emails(loaded.CHATS)))
+
+    def test_parallel_sync(self):
+        """
+           Check that a sync with several connections opens only that number of connections
+        """
+        mailbox = mock_gmail_server.MockMailbox.generate(1200)
+        server  = self._start(mailbox)
+
+        syncer = gmvault.GMVaulter(self.test_db_dir, server.host, server.port, mailbox.login, self.credential, use_ssl = False)
+        syncer.sync(imap_utils.GIMAPFetcher.IMAP_ALL, emails_only = True, nb_connections = 3)
+
+        self.assertEquals(3, server.stats['connections'])
+        gstorer = gmvault.get_storer(self.test_db_dir)
+        self.assertEquals([ email.gm_id for email in mailbox.get_emails() ], list(gstorer.get_all_existing_gmail_ids()))
+
+    def test_restore(self):
+        """
+           Check that a restore appends the emails of the db with their labels
+        """
+        if not hasattr(imapclient.IMAPClient, '_encode_folder_name'):
+            # MonkeyIMAPClient.append uses the IMAPClient 0.9 API (setup.py)
+            self.skipTest('IMAPClient 0.9 is needed to append emails')
+
+        mailbox = mock_gmail_server.MockMailbox.generate(50)
+        server  = self._start(mailbox)
+        syncer  = gmvault.GMVaulter(self.test_db_dir, server.host, server.port, mailbox.login, self.credential, use_ssl = False)
+        syncer.sync(imap_utils.GIMAPFetcher.IMAP_ALL, emails_only = True)
+        self.server.stop()
+
+        restored = mock_gmail_server.MockMailbox()
+        server   = self._start(restored)
+        restorer = gmvault.GMVaulter(self.test_db_dir, server.host, server.port, restored.login, self.credential, \
+                                     read_only_access = False, use_ssl = False)
+        restorer.restore(extra_labels = ['restored'], emails_only = True)
+
+        self.assertEquals([ (email.body, email.internal_date, sorted(email.labels + ['restored'])) for email in mailbox.get_emails() ], \
+                          [ (email.body, email.internal_date, sorted(email.labels)) for email in restored.get_emails() ])
+
+    def test_restore_without_appenduid(self):
+        """
+           Check that the emails appended without APPENDUID are labelled with the uids found with their Message-IDs,
+           journaled and not quarantined
+        """
+        if not hasattr(imapclient.IMAPClient, '_encode_folder_name'):
+            # MonkeyIMAPClient.append uses the IMAPClient 0.9 API (setup.py)
+            self.skipTest('IMAPClient 0.9 is needed to append emails')
+
+        mailbox = mock_gmail_server.MockMailbox.generate(20)
+        server  = self._start(mailbox)
+        syncer  = gmvault.GMVaulter(self.test_db_dir, server.host, server.port, mailbox.login, self.credential, use_ssl = False)
+        syncer.sync(imap_utils.GIMAPFetcher.IMAP_ALL, emails_only = True)
+        self.server.stop()
+
+        # pushed by batches then one by one
+        for batch_ratio in (1.0, 0.0):
+            restored = mock_gmail_server.MockMailbox()
+            server   = self._start(restored, a_appenduid = False)
+            restorer = gmvault.GMVaulter(self.test_db_dir, server.host, server.port, restored.login, self.credential, \
+                                         read_only_access = False, use_ssl = False)
+            restorer.rate_controller.batch_ratio, restorer.rate_controller._increase_every = batch_ratio, 1000 #pylint:disable-msg=W0212
+            restorer.restore(emails_only = True)
+            self.server.stop()
+
+            self.assertEquals(([], []), (restorer.error_report['emails_in_quarantine'], restorer.error_report['pushed_without_labels']))
+            self.assertEquals([ (email.body, sorted(email.labels)) for email in mailbox.get_emails() ], \
+                              [ (email.body, sorted(email.labels)) for email in restored.get_emails() ])
+
+            journal = restorer._get_journal(restorer.OP_EMAIL_RESTORE) #pylint:disable-msg=W0212
+            self.assertEquals(20, len(journal.load()))
+
+    def test_latency_bandwidth(self):
+        """
+           Check the latency and the bandwidth injected by the server
+        """
+        mailbox = mock_gmail_server.MockMailbox.generate(4, a_body_size = 20000)
+        server  = self._start(mailbox, a_latency = 0.1, a_bandwidth = 100000)
+
+        fetcher = imap_utils.GIMAPFetcher(server.host, server.port, mailbox.login, self.credential, use_ssl = False)
+        fetcher.connect()
+
+        start = time.time()
+        fetcher.search(imap_utils.GIMAPFetcher.IMAP_ALL)
+        self.assertTrue(time.time() - start >= 0.1)
+
+        start = time.time()
+        data  = fetcher.fetch([1, 2, 3, 4], imap_utils.GIMAPFetcher.GET_DATA_ONLY)
+        size  = sum([ len(info['BODY[]']) for info in data.values() ])
+        self.assertTrue(size > 40000 and time.time() - start >= 0.1 + size / 100000.0)
+
+        fetcher.disconnect()
+
+        self.assertTrue(server.stats['bytes_sent'] > size)
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMockGmailServer)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -19,14 +19,99 @@
 import unittest
 import datetime
 import os
+import socket
+import threading
+import cStringIO
+import zlib
+import gzip
+
 import gmv.gmvault_utils as gmvault_utils
 import gmv.collections_utils as collections_utils
+import gmv.mod_imap as mod_imap
+import gmv.blowfish as blowfish
+import gmv.gmvault as gmvault
+import gmv.vault_generator as vault_generator
+
+class SocketReader(object):
+    """
+       Give a ssl object interface (read) to a plain socket
+    """
+    def __init__(self, sock):
+        self.sock = sock
+    
+    def read(self, size):
+        """ read at most size bytes """
+        return self.sock.recv(size)
+    
+    def sendall(self, data):
+        """ send all data """
+        return self.sock.sendall(data)
+
+def legacy_read(imap, size):
+    """
+       previous IMAP4COMPSSL read implementation (without receive buffer)
+    """
+    chunks = cStringIO.StringIO()
+    read = 0
+    while read < size:
+        data = imap._intern_read(min(size-read, 16384))
+        if not data: raise imap.abort('Gmvault ssl socket error: EOF')
+        read += len(data)
+        chunks.write(data)
+    
+    return chunks.getvalue()
+
+def legacy_encrypt_ctr(cipher, data):
+    """
+       previous Blowfish.encryptCTR implementation xoring the data byte by byte with the keystream
+    """
+    return ''.join([chr(ord(ch) ^ cipher._nextCTRByte()) for ch in data])
+
+def legacy_readline(imap):
+    """
+       previous IMAP4COMPSSL readline implementation reading one byte at a time
+    """
+    line = cStringIO.StringIO()
+    while 1:
+        char = legacy_read(imap, 1) 
+        line.write(char)
+        if char in ("\n", ""): 
+            return line.getvalue()
+
+class SocketPairIMAP4(mod_imap.IMAP4COMPSSL): #pylint:disable-msg=R0904
+    """
+       IMAP4COMPSSL reading from a local socket instead of a ssl connection to a server
+    """
+    def __init__(self, sock): #pylint:disable-msg=W0231
+        """
+           Do not call IMAP4COMPSSL constructor as it connects to the server
+        """
+        self.compressor   = None
+        self.decompressor = None
+        self._reset_buffer()
+        self.sslobj = SocketReader(sock)
+
+def create_socket_imap(compress = False):
+    """
+       Create an IMAP4COMPSSL reading from a local socket pair (no connection to a server)
+       Return the IMAP4COMPSSL and the server side socket
+    """
+    server_side, client_side = socket.socketpair()
+    
+    imap = SocketPairIMAP4(client_side)
+    
+    if compress:
+        imap.activate_compression()
+        
+    return imap, server_side
 
 
 class TestPerf(unittest.TestCase): #pylint:disable-msg=R0904
     """
        Current Main test class
     """
+    
+    HEADER_FIELDS = 'Message-ID: <CAF1234567890@mail.gmail.com>\r\nSubject: Hello World\r\n\r\n'
 
     def __init__(self, stuff):
         """ constructor """
@@ -77,16 +162,17 @@ class TestPerf(unittest.TestCase): #pylint:disable-msg=R0904
                       60  000 meta files in 60 dirs (60,1000) => 9.96 sec to list them
            
         """
-        root_dir = '/tmp/dirs'
-        #create dirs and files
-        #t1 = datetime.datetime.now()
-        #self._create_dirs('/tmp/dirs', 50, 5000)
-        #t2 = datetime.datetime.now()
+        root_dir = '/tmp/gmvault-files-perf'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
         
-        #print("\nTime to create dirs : %s\n" % (t2-t1))
-        #print("\nFiles and dirs created.\n")
+        #create a synthetic db (120 month dirs)
+        t1 = datetime.datetime.now()
+        vault_generator.generate_vault(root_dir, vault_generator.VaultGenerator(20000, a_attachment_ratio = 0))
+        t2 = datetime.datetime.now()
+        
+        print("\nTime to create the db : %s\n" % (t2-t1))
         
-        the_iter = gmvault_utils.dirwalk(root_dir, a_wildcards= '*.meta')
+        the_iter = gmvault_utils.dirwalk('%s/db' % (root_dir), a_wildcards= '*.meta')
         t1 = datetime.datetime.now()
         
         gmail_ids = collections_utils.OrderedDict()
@@ -99,6 +185,214 @@ class TestPerf(unittest.TestCase): #pylint:disable-msg=R0904
         print("\nnb of files = %s" % (len(gmail_ids.keys())))
         print("\nTime to read all meta files : %s\n" % (t2-t1))
         
+        t1 = datetime.datetime.now()
+        ids = gmvault.get_storer(root_dir).get_all_existing_gmail_ids()
+        t2 = datetime.datetime.now()
+        
+        self.assertEquals(len(gmail_ids), len(ids))
+        print("\nTime to load the inventory with the manifests : %s\n" % (t2-t1))
+        
+    def _send_fetch_responses(self, sock, nb_msgs, compress):
+        """
+           Send nb_msgs GET_ALL_BUT_DATA like responses followed by a literal to sock
+        """
+        lines = []
+        for i in xrange(1, nb_msgs + 1):
+            lines.append('* %d FETCH (X-GM-THRID 1394283747712345678 X-GM-MSGID 1394283747712%06d '\
+                         'X-GM-LABELS ("\\\\Inbox" "\\\\Important" work) UID %d FLAGS (\\Seen) '\
+                         'INTERNALDATE "02-Mar-2012 10:11:12 +0000" BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT)] {70}\r\n'
+                         'Message-ID: <CAF1234567890@mail.gmail.com>\r\nSubject: Hello World %06d\r\n\r\n'\
+                         ')\r\n' % (i, i, i, i))
+        
+        data = ''.join(lines)
+        
+        if compress:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        
+        sock.sendall(data)
+        
+    def _time_readlines(self, readline_func, read_func, nb_msgs, compress):
+        """
+           Read nb_msgs fetch responses with readline_func and read_func from a socket pair
+           return the lines read and the time spent
+        """
+        imap, server_side = create_socket_imap(compress)
+        
+        sender = threading.Thread(target = self._send_fetch_responses, args = (server_side, nb_msgs, compress))
+        sender.start()
+        
+        lines = []
+        t1 = datetime.datetime.now()
+        for _ in xrange(nb_msgs):
+            #response line, literal, end of response
+            lines.append(readline_func(imap))
+            lines.append(read_func(imap, len(self.HEADER_FIELDS)))
+            lines.append(readline_func(imap))
+        t2 = datetime.datetime.now()
+        
+        sender.join()
+        server_side.close()
+        
+        return lines, (t2-t1)
+        
+    def test_imap_readline(self):
+        """
+           Micro benchmark of the IMAP4COMPSSL receive layer against a local socket pair.
+           Compare the buffered readline with the previous one byte at a time readline.
+        """
+        nb_msgs = 5000
+        
+        for compress in (False, True):
+            legacy_lines, legacy_time = self._time_readlines(legacy_readline, legacy_read, nb_msgs, compress)
+            lines, buffered_time      = self._time_readlines(mod_imap.IMAP4COMPSSL.readline, \
+                                                             mod_imap.IMAP4COMPSSL.read, nb_msgs, compress)
+            
+            self.assertEquals(legacy_lines, lines)
+            
+            print("\n%d fetch responses (compression = %s): one byte readline %s, buffered readline %s\n" \
+                  % (nb_msgs, compress, legacy_time, buffered_time))
+    
+    def _send_big_fetch_response(self, sock, body, compress):
+        """
+           Send a GET_DATA_ONLY like response with body as literal to sock
+        """
+        data = '* 1 FETCH (X-GM-MSGID 1394283747712000001 BODY[] {%d}\r\n%s)\r\n' % (len(body), body)
+        
+        if compress:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        
+        sock.sendall(data)
+    
+    def test_stream_literal_to_disk(self):
+        """
+           Stream a big literal from the socket to a compressed and encrypted data file
+           through the literal sink of IMAP4COMPSSL and check what has been stored
+        """
+        db_dir = '/tmp/gmvault-perf-tests'
+        gmvault_utils.delete_all_under(db_dir, delete_top_dir = True)
+        gstorer = gmvault.GmailStorer(db_dir, encrypt_data = True)
+        
+        body = ''.join([ 'Line %08d of a big email with an attachment\r\n' % (i) for i in xrange(20000) ])
+        
+        for compress in (False, True):
+            imap, server_side = create_socket_imap(compress)
+            
+            sender = threading.Thread(target = self._send_big_fetch_response, args = (server_side, body, compress))
+            sender.start()
+            
+            writer = gstorer.get_email_writer(1394283747712000001, local_dir = '2012-03', compress = True)
+            writer.write('garbage of a previous try')
+            writer.reset()
+            
+            t1 = datetime.datetime.now()
+            imap.readline()
+            imap.literal_sink = writer
+            self.assertEquals('', imap.read(len(body)))
+            imap.literal_sink = None
+            self.assertEquals(')\r\n', imap.readline())
+            data_path = writer.close()
+            t2 = datetime.datetime.now()
+            
+            sender.join()
+            server_side.close()
+            
+            print("\nStream a %d bytes literal to disk (compression = %s): %s\n" % (len(body), compress, t2-t1))
+            
+            self.assertEquals(len(body), writer.nb_bytes)
+            
+            the_fd = gzip.open(data_path, 'rb')
+            cipher = gstorer.get_encryption_cipher()
+            cipher.initCTR()
+            self.assertEquals(body, cipher.decryptCTR(the_fd.read()))
+            the_fd.close()
+        
+    def test_blowfish_ctr_compatibility(self):
+        """
+           The bulk CTR encryption must produce the same bytes and leave the same CTR state 
+           as the byte by byte encryption, whatever the size of the successive strings
+        """
+        cipher        = blowfish.Blowfish('This is a test key')
+        legacy_cipher = blowfish.Blowfish('This is a test key')
+        
+        for sizes in ([0, 1, 7, 8, 9], [8, 16, 65536], [3, 65537, 5], [70001, 12, 131072]):
+            cipher.initCTR()
+            legacy_cipher.initCTR()
+            for size in sizes:
+                data = os.urandom(size)
+                self.assertEquals(legacy_encrypt_ctr(legacy_cipher, data), cipher.encryptCTR(data))
+                self.assertEquals((legacy_cipher._ctr_iv, legacy_cipher._ctr_cks, legacy_cipher._ctr_pos), \
+                                  (cipher._ctr_iv, cipher._ctr_cks, cipher._ctr_pos))
+            
+        # decrypt what has been encrypted by the previous implementation
+        data = os.urandom(100000)
+        legacy_cipher.initCTR()
+        encrypted = legacy_encrypt_ctr(legacy_cipher, data)
+        cipher    = blowfish.Blowfish('This is a test key')
+        cipher.initCTR()
+        self.assertEquals(data, cipher.decryptCTR(encrypted))
+        
+    def _time_encrypt_ctr(self, encrypt_func, cipher, data):
+        """
+           Encrypt data from the beginning of the keystream and return the throughput in MB/s
+        """
+        cipher.initCTR()
+        timer = gmvault_utils.Timer()
+        timer.start()
+        encrypt_func(cipher, data)
+        
+        return (len(data) / (1024.0 * 1024.0)) / max(timer.elapsed_ms(), 0.000001)
+    
+    def test_blowfish_ctr_speed(self):
+        """
+           Micro benchmark of the Blowfish CTR encryption in MB/s.
+           Bulk CTR with a new cipher (keystream to compute) and with the keystream already computed
+           against the previous byte by byte encryption
+        """
+        data = os.urandom(2 * 1024 * 1024)
+        
+        legacy_speed = self._time_encrypt_ctr(legacy_encrypt_ctr, blowfish.Blowfish('This is a test key'), data[:256 * 1024])
+        
+        cipher     = blowfish.Blowfish('This is a test key')
+        cold_speed = self._time_encrypt_ctr(blowfish.Blowfish.encryptCTR, cipher, data)
+        warm_speed = self._time_encrypt_ctr(blowfish.Blowfish.encryptCTR, cipher, data)
+        
+        print("\nBlowfish CTR: byte by byte %.2f MB/s, bulk %.2f MB/s, bulk with computed keystream %.2f MB/s\n" \
+              % (legacy_speed, cold_speed, warm_speed))
+        
+    def test_restore_prefetch(self):
+        """
+           Read an encrypted db sequentially like the restore did and with the EmailPrefetcher.
+           The emails have to come in the same order
+        """
+        db_dir = '/tmp/gmvault-prefetch-perf'
+        gmvault_utils.delete_all_under(db_dir, delete_top_dir = True)
+        
+        gstorer = gmvault.GmailStorer(db_dir, encrypt_data = True)
+        for gm_id in xrange(1, 301):
+            gstorer.bury_email({ 'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': ('work',), 'FLAGS': ('\\Seen',), \
+                                 'INTERNALDATE': datetime.datetime(2012, 3, 1 + gm_id % 28), \
+                                 'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT)]': self.HEADER_FIELDS, \
+                                 'BODY[]': 'Subject: Hello World\r\n\r\n%s' % (os.urandom(20000).encode('base64')) }, \
+                               local_dir = '2012-03', compress = True)
+        gstorer.flush()
+        
+        ids = gstorer.get_all_existing_gmail_ids().keys()
+        
+        t1 = datetime.datetime.now()
+        expected = [ (gm_id, ) + gstorer.unbury_email(gm_id) for gm_id in ids ]
+        t2 = datetime.datetime.now()
+        
+        prefetcher = gmvault.EmailPrefetcher(gstorer, ids, 4, 16)
+        emails = list(prefetcher)
+        prefetcher.close()
+        t3 = datetime.datetime.now()
+        
+        self.assertEquals(expected, emails)
+        
+        print("\nUnbury %d emails: sequential %s, prefetched with 4 threads %s\n" % (len(ids), t2 - t1, t3 - t2))
+        
 
 def tests():
     """
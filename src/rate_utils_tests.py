@@ -0,0 +1,145 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import threading
+import imaplib
+import time
+
+import gmv.imap_utils as imap_utils
+import gmv.rate_utils as rate_utils
+
+
+class TestRateUtils(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the rate controller adapting the IMAP exchanges to the limits of Gmail
+    """
+
+    def __init__(self, stuff):
+        """ constructor """
+        super(TestRateUtils, self).__init__(stuff)
+
+    def test_throttle_code(self):
+        """
+           Check the detection of the throttled responses of Gmail
+        """
+        self.assertEquals('THROTTLED', rate_utils.get_throttle_code(imaplib.IMAP4.error("FETCH command error: NO ['[THROTTLED] Slow down']")))
+        self.assertEquals('UNAVAILABLE', rate_utils.get_throttle_code(imaplib.IMAP4.error("[UNAVAILABLE] Temporary System Error")))
+        self.assertEquals('THROTTLED', rate_utils.get_throttle_code(imaplib.IMAP4.error("LOGIN command error: BAD ['Too many simultaneous connections. (Failure)']")))
+        self.assertEquals('THROTTLED', rate_utils.get_throttle_code(imaplib.IMAP4.abort("[ALERT] Account exceeded bandwidth limits. (Failure)")))
+        self.assertEquals(None, rate_utils.get_throttle_code(imaplib.IMAP4.error("'Some messages could not be FETCHed (Failure)'")))
+
+    def test_aimd(self):
+        """
+           Check the multiplicative decreases on errors and the additive increases after successful commands
+        """
+        controller = rate_utils.RateController(a_increase_every = 2, a_min_delay = 0.1, a_max_delay = 1)
+        controller.set_workers(4)
+        self.assertEquals((4, 50), (controller.concurrency, controller.get_batch_size(50)))
+
+        # a throttled response halves the batches and the connections and pauses all the connections
+        self.assertEquals('THROTTLED', controller.on_error(imaplib.IMAP4.error("NO [THROTTLED]")))
+        self.assertEquals((2, 25), (controller.concurrency, controller.get_batch_size(50)))
+        self.assertTrue('paused' in controller.get_status())
+
+        start = time.time()
+        controller.wait()
+        self.assertTrue(time.time() - start >= 0.05)
+
+        # a connection error halves the batches, an error of a command does not change anything
+        controller.on_error(imaplib.IMAP4.abort("socket error: EOF"))
+        controller.on_error(imaplib.IMAP4.error("'Some messages could not be FETCHed (Failure)'"))
+        self.assertEquals((2, 13), (controller.concurrency, controller.get_batch_size(50)))
+
+        for _ in range(4):
+            controller.on_success('fetch', 0.01)
+        self.assertEquals((4, 22), (controller.concurrency, controller.get_batch_size(50)))
+
+        # no increase while the latency of a command is increasing
+        controller.on_success('append', 1)
+        for _ in range(4):
+            controller.on_success('append', 10)
+        self.assertEquals(22, controller.get_batch_size(50))
+
+        self.assertTrue(controller.get_status().startswith('batches at 45%, 4/4 connection(s)'))
+
+    def test_wait_workers(self):
+        """
+           Check that only the first running workers can send commands
+        """
+        controller = rate_utils.RateController(a_min_delay = 0.1)
+        controller.set_workers(3)
+        controller.on_error(imaplib.IMAP4.error("[THROTTLED]"))
+        controller.on_error(imaplib.IMAP4.error("[THROTTLED]"))
+        self.assertEquals(1, controller.concurrency)
+
+        waiting = threading.Thread(target = controller.wait, args = (2,))
+        waiting.daemon = True
+        waiting.start()
+
+        controller.wait(0)
+        waiting.join(0.5)
+        self.assertTrue(waiting.is_alive())
+
+        # the worker 2 takes the place of the stopped ones
+        controller.worker_done(0)
+        controller.worker_done(1)
+        waiting.join(3)
+        self.assertFalse(waiting.is_alive())
+
+    def test_retry(self):
+        """
+           Check that the commands retried by the imap_utils retry decorator are measured by the controller
+        """
+        class Fetcher(object): #pylint:disable-msg=R0903
+            """ fetcher throttled once """
+            def __init__(self):
+                self.rate_controller  = rate_utils.RateController(a_min_delay = 0.1)
+                self.total_nb_reconns = 0
+                self.nb_calls         = 0
+            def connect(self):
+                """ reconnect """
+                pass
+            def disconnect(self):
+                """ disconnect """
+                pass
+            @imap_utils.retry(3, 0.1, 1)
+            def fetch(self):
+                """ throttled the first time """
+                self.nb_calls += 1
+                if self.nb_calls == 1:
+                    raise imaplib.IMAP4.abort("[THROTTLED] Slow down")
+                return 'data'
+
+        fetcher = Fetcher()
+        self.assertEquals('data', fetcher.fetch())
+        self.assertEquals((1, 1, 0.5), (fetcher.total_nb_reconns, fetcher.rate_controller.nb_throttled, \
+                                        fetcher.rate_controller.batch_ratio))
+        self.assertTrue(fetcher.rate_controller.latency is not None)
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRateUtils)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,183 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import os
+
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.segment_storer as segment_storer
+
+import test_utils
+
+
+class TestSegmentStorer(test_utils.DbTestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the segments storage (append-only segment files per month)
+    """
+
+    TEST_DB_DIR = "/tmp/gmvault-segment-tests"
+
+    def _bury_emails(self, gstorer, ids_and_months, compress = True):
+        """
+           Bury fake emails in their month dir
+        """
+        for gm_id, month in ids_and_months:
+            a_date = datetime.datetime(2012, month, 2)
+            gstorer.bury_email(test_utils.create_email_info(gm_id, a_date), \
+                               local_dir = gmvault_utils.get_ym_from_datetime(a_date), compress = compress)
+
+    def test_bury_unbury_delete(self):
+        """
+           Check that the emails are stored in segments, that deleting appends tombstones and that
+           the records appended after the last commit are indexed again when the db is reopened
+        """
+        gstorer = segment_storer.SegmentStorer(self.test_db_dir, encrypt_data = True)
+        self._bury_emails(gstorer, [(1001, 1), (1002, 1), (1003, 2)])
+        gstorer.bury_metadata(test_utils.create_email_info(1002, datetime.datetime(2012, 1, 2), a_labels = ('work', 'done')), \
+                              local_dir = '2012-01')
+        gstorer.flush()
+
+        self.assertEquals(['000001.seg'], os.listdir('%s/db/2012-01' % (self.test_db_dir)))
+        self.assertEquals([(1001, '2012-01'), (1002, '2012-01'), (1003, '2012-02')], gstorer.get_all_existing_gmail_ids().items())
+        self.assertEquals([1003], gstorer.get_all_existing_gmail_ids(pivot_dir = '2012-02').keys())
+
+        meta, data = gstorer.unbury_email(1002)
+        self.assertEquals('Subject: test\r\n\r\nbody of 1002', data)
+        self.assertEquals(['work', 'done'], meta['labels'])
+        self.assertEquals(datetime.datetime(2012, 1, 2), meta['internal_date'])
+        self.assertEquals('%s/db/2012-01' % (self.test_db_dir), gstorer.get_directory_from_id(1001, '2012-01'))
+        self.assertEquals(None, gstorer.get_directory_from_id(1001, '2012-02'))
+
+        gstorer.delete_emails([(1001, '2012-01')], 'email')
+        self.assertEquals(None, gstorer.get_directory_from_id(1001))
+
+        # records appended without commit (the storer is dropped without flush) are replayed by the next storer
+        self._bury_emails(gstorer, [(1004, 2)])
+        del gstorer
+        gstorer = gmvault.get_storer(self.test_db_dir, True)
+        self.assertTrue(isinstance(gstorer, segment_storer.SegmentStorer))
+        self.assertEquals([1002, 1003, 1004], gstorer.get_all_existing_gmail_ids().keys())
+        self.assertEquals('Subject: test\r\n\r\nbody of 1004', gstorer.unbury_email(1004)[1])
+
+        # an interrupted write leaves an incomplete record that is ignored and truncated
+        seg_fd = open('%s/db/2012-02/000001.seg' % (self.test_db_dir), 'ab')
+        seg_fd.write('GMVR1 E 1005 1 300 20')
+        seg_fd.close()
+        self.assertEquals(3, segment_storer.SegmentStorer(self.test_db_dir).rebuild_index())
+
+    def test_move_between_dirs(self):
+        """
+           Check that an email moved to another dir is tombstoned in its old dir so rebuilding the index,
+           replaying the segments and compacting keep the new record
+        """
+        gstorer = segment_storer.SegmentStorer(self.test_db_dir)
+        gstorer.bury_email(test_utils.create_email_info(7, datetime.datetime(2013, 1, 5)), local_dir = '2013-01', compress = True)
+        gstorer.bury_metadata(test_utils.create_email_info(7, datetime.datetime(2012, 12, 5), a_labels = ('moved',)), \
+                              local_dir = '2012-12')
+        gstorer.bury_email(test_utils.create_email_info(8, datetime.datetime(2013, 1, 6)), local_dir = '2013-01', compress = True)
+        gstorer.bury_email(test_utils.create_email_info(8, datetime.datetime(2012, 12, 6)), local_dir = '2012-12', compress = True)
+        gstorer.flush()
+
+        self.assertEquals(2, gstorer.rebuild_index())
+        self.assertEquals([(7, '2012-12'), (8, '2012-12')], gstorer.get_all_existing_gmail_ids().items())
+        self.assertEquals(['moved'], gstorer.unbury_metadata(7)['labels'])
+
+        gstorer.compact()
+        self.assertEquals([], gstorer.get_dir_gmail_ids('2013-01'))
+        self.assertEquals(['moved'], gstorer.unbury_metadata(7)['labels'])
+        self.assertEquals('Subject: test\r\n\r\nbody of 7', gstorer.unbury_email(7)[1])
+        self.assertEquals(2, gstorer.rebuild_index())
+
+        # moved back and forth without commit: the replayed segments give the last dir
+        gstorer.bury_metadata(test_utils.create_email_info(7, datetime.datetime(2013, 1, 5)), local_dir = '2013-01')
+        gstorer.bury_metadata(test_utils.create_email_info(7, datetime.datetime(2012, 11, 5)), local_dir = '2012-11')
+        gstorer.bury_metadata(test_utils.create_email_info(7, datetime.datetime(2013, 1, 5), a_labels = ('back',)), \
+                              local_dir = '2013-01')
+        del gstorer
+        gstorer = segment_storer.SegmentStorer(self.test_db_dir)
+        self.assertEquals([(7, '2013-01'), (8, '2012-12')], gstorer.get_all_existing_gmail_ids().items())
+        self.assertEquals(['back'], gstorer.unbury_metadata(7)['labels'])
+        self.assertEquals(2, gstorer.rebuild_index())
+        self.assertEquals('2013-01', gstorer.get_all_existing_gmail_ids()[7])
+
+    def test_compact(self):
+        """
+           Check that compacting rewrites the live records and reclaims the space of the dead ones
+        """
+        gstorer = segment_storer.SegmentStorer(self.test_db_dir)
+        self._bury_emails(gstorer, [(gm_id, 3) for gm_id in range(2001, 2011)])
+        gstorer.delete_emails([(gm_id, '2012-03') for gm_id in range(2001, 2008)], 'email')
+        gstorer.flush()
+
+        seg_path = '%s/db/2012-03/000001.seg' % (self.test_db_dir)
+        old_size = os.path.getsize(seg_path)
+
+        self.assertEquals((0, 0), gstorer.compact(0.99))
+
+        nb_dirs, nb_bytes = gstorer.compact()
+        self.assertEquals(1, nb_dirs)
+        self.assertEquals(['000002.seg'], os.listdir('%s/db/2012-03' % (self.test_db_dir)))
+        self.assertEquals(old_size - nb_bytes, os.path.getsize('%s/db/2012-03/000002.seg' % (self.test_db_dir)))
+
+        self.assertEquals([2008, 2009, 2010], gstorer.get_dir_gmail_ids('2012-03'))
+        self.assertEquals('Subject: test\r\n\r\nbody of 2009', gstorer.unbury_email(2009)[1])
+
+        # the compacted segments are enough to rebuild the index
+        self.assertEquals(3, gstorer.rebuild_index())
+
+    def test_convert_files(self):
+        """
+           Check the conversion of a files db to the segments storage
+        """
+        gstorer = gmvault.GmailStorer(self.test_db_dir)
+        self._bury_emails(gstorer, [(3001, 4), (3002, 5)])
+        self._bury_emails(gstorer, [(3003, 5)], compress = False)
+        gstorer.bury_chat(test_utils.create_email_info(3004, datetime.datetime(2012, 5, 3)), local_dir = gstorer.get_sub_chats_dir())
+        gstorer.flush()
+
+        self.assertEquals(gmvault.GmailStorer.FILES_BACKEND, gmvault.GmailStorer.get_storage_backend(self.test_db_dir))
+
+        sstorer = segment_storer.SegmentStorer(self.test_db_dir)
+        self.assertEquals(4, sstorer.convert_files())
+        self.assertEquals(['000001.seg'], os.listdir('%s/db/2012-05' % (self.test_db_dir)))
+
+        gstorer = gmvault.get_storer(self.test_db_dir)
+        self.assertTrue(isinstance(gstorer, segment_storer.SegmentStorer))
+        self.assertEquals([3001, 3002, 3003], gstorer.get_all_existing_gmail_ids().keys())
+        self.assertEquals([(3004, 'subchats-1')], gstorer.get_all_chats_gmail_ids().items())
+        self.assertEquals('Subject: test\r\n\r\nbody of 3003', gstorer.unbury_email(3003)[1])
+        self.assertEquals(['work', 'gmvault-chats'], gstorer.unbury_metadata(3004)['labels'])
+
+        # the quarantine is still made of files
+        gstorer.quarantine_email(3002)
+        self.assertEquals(['3002.eml.gz', '3002.meta'], sorted(os.listdir('%s/quarantine' % (self.test_db_dir))))
+        self.assertEquals([3001, 3003], gstorer.get_all_existing_gmail_ids().keys())
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSegmentStorer)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,66 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Helpers shared by the test modules
+
+'''
+
+import unittest
+import datetime
+
+import gmv.gmvault_utils as gmvault_utils
+import gmv.imap_utils as imap_utils
+
+
+class DbTestCase(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Base of the tests working in a db dir which is emptied before each test.
+       The subclasses set TEST_DB_DIR
+    """
+    TEST_DB_DIR = None
+
+    def __init__(self, stuff):
+        """ constructor """
+        super(DbTestCase, self).__init__(stuff)
+
+        self.test_db_dir = self.TEST_DB_DIR
+
+    def setUp(self): #pylint:disable-msg=C0103
+        """
+           Start from an empty db
+        """
+        gmvault_utils.delete_all_under(self.test_db_dir, delete_top_dir = True)
+
+
+def create_email_info(a_gm_id, a_date = datetime.datetime(2012, 1, 1), a_labels = ('work',), a_nb_lines = None):
+    """
+       Create the info of a fake email as returned by the fetcher.
+       The body is "body of <gm_id>" or a_nb_lines lines of it
+    """
+    if a_nb_lines:
+        body = 'body of %s\r\n' % (a_gm_id) * a_nb_lines
+    else:
+        body = 'body of %s' % (a_gm_id)
+
+    return { imap_utils.GIMAPFetcher.GMAIL_ID               : a_gm_id,
+             imap_utils.GIMAPFetcher.GMAIL_THREAD_ID        : a_gm_id,
+             imap_utils.GIMAPFetcher.GMAIL_LABELS           : a_labels,
+             imap_utils.GIMAPFetcher.IMAP_FLAGS             : ('\\Seen',),
+             imap_utils.GIMAPFetcher.IMAP_INTERNALDATE      : a_date,
+             imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY : 'Message-ID: <%s@test>\r\nSubject: test\r\n\r\n' % (a_gm_id),
+             imap_utils.GIMAPFetcher.EMAIL_BODY             : 'Subject: test\r\n\r\n%s' % (body)
+           }
@@ -0,0 +1,118 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import threading
+import os
+
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.imap_utils as imap_utils
+import gmv.blowfish as blowfish
+import gmv.codec_utils as codec_utils
+import gmv.transform_utils as transform_utils
+import gmv.segment_storer as segment_storer
+
+import test_utils
+
+
+class TestTransformUtils(test_utils.DbTestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the processes compressing and encrypting the emails
+    """
+
+    TEST_DB_DIR = "/tmp/gmvault-transform-tests"
+
+    def test_transform_pool(self):
+        """
+           Check the transformed data and that the data in the pool is bounded
+        """
+        data = 'Subject: test\r\n\r\n%s' % ('a line of the email\r\n' * 1000)
+        key  = 'a secret key'
+
+        pool = transform_utils.TransformPool(2, len(data) * 2)
+        try:
+            result = pool.submit(data, codec_utils.GzipCodec(), key)
+
+            cipher = blowfish.Blowfish(key)
+            cipher.initCTR()
+            self.assertEquals(data, cipher.decryptCTR(codec_utils.GzipCodec().decompress(result.get())))
+
+            self.assertEquals(data, pool.submit(data, codec_utils.Codec()).get())
+
+            # a third submit waits until a result is collected
+            results   = [ pool.submit(data, codec_utils.Bz2Codec()) for _ in range(2) ]
+            submitted = threading.Event()
+
+            def submit():
+                """ submit over the limit """
+                results.append(pool.submit(data, codec_utils.Bz2Codec()))
+                submitted.set()
+
+            thread = threading.Thread(target = submit)
+            thread.start()
+            submitted.wait(0.5)
+            self.assertFalse(submitted.is_set())
+
+            results[0].get()
+            thread.join()
+            self.assertEquals([data, data], [ codec_utils.Bz2Codec().decompress(res.get()) for res in results[1:] ])
+        finally:
+            pool.close()
+
+    def test_storers(self):
+        """
+           Check that both storages store the transformed emails like the ones written by the storer
+        """
+        attachment = os.urandom(100000).encode('base64')
+
+        for storer_class in [gmvault.GmailStorer, segment_storer.SegmentStorer]:
+            gmvault_utils.delete_all_under(self.test_db_dir, delete_top_dir = True)
+            gstorer = storer_class(self.test_db_dir, encrypt_data = True)
+            gstorer._dedup_attachments = True #pylint:disable-msg=W0212
+            gstorer.start_transformers(2)
+            gstorer.start_writers(2)
+
+            infos = {}
+            for gm_id in range(1, 21):
+                infos[gm_id] = test_utils.create_email_info(gm_id, datetime.datetime(2012, 9, 1), a_nb_lines = 50)
+                if gm_id % 2:
+                    infos[gm_id][imap_utils.GIMAPFetcher.EMAIL_BODY] = 'Content-Transfer-Encoding: base64\r\n\r\n%s' \
+                                                                        % (attachment.replace('\n', '\r\n'))
+                gstorer.bury_email(dict(infos[gm_id]), local_dir = '2012-09', compress = gm_id < 15)
+            gstorer.close()
+
+            self.assertEquals(1, len(os.listdir('%s/blobs' % (self.test_db_dir))))
+
+            gstorer = gmvault.get_storer(self.test_db_dir, True)
+            for gm_id in range(1, 21):
+                self.assertEquals(infos[gm_id][imap_utils.GIMAPFetcher.EMAIL_BODY], gstorer.unbury_email(gm_id)[1])
+            gstorer.flush()
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTransformUtils)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,164 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import hashlib
+import json
+import os
+
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.index_utils as index_utils
+import gmv.vault_generator as vault_generator
+
+import test_utils
+
+
+class TestVaultGenerator(test_utils.DbTestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the synthetic gmvault-db generator
+    """
+
+    TEST_DB_DIR = "/tmp/gmvault-generator-tests"
+
+    def _get_files(self, a_db_dir):
+        """
+           Return the md5 of the files of the db area
+        """
+        files = {}
+        for the_dir, _, fnames in os.walk('%s/db' % (a_db_dir)):
+            for fname in fnames:
+                the_fd = open(os.path.join(the_dir, fname), 'rb')
+                files[os.path.relpath(os.path.join(the_dir, fname), a_db_dir)] = hashlib.md5(the_fd.read()).hexdigest()
+                the_fd.close()
+        return files
+
+    def test_deterministic(self):
+        """
+           Check that a seed gives the same db whatever the number of processes
+        """
+        generator = vault_generator.VaultGenerator(300, 10, a_seed = 4)
+
+        self.assertEquals(310, sum([ last - first for _, _, first, last in generator.get_units(1500) ]))
+
+        vault_generator.generate_vault('%s/1' % (self.test_db_dir), generator, a_nb_processes = 1)
+        vault_generator.generate_vault('%s/3' % (self.test_db_dir), generator, a_nb_processes = 3)
+
+        files = self._get_files('%s/1' % (self.test_db_dir))
+        self.assertEquals(620, len(files))
+        self.assertEquals(files, self._get_files('%s/3' % (self.test_db_dir)))
+
+        other = vault_generator.VaultGenerator(300, 10, a_seed = 5)
+        self.assertNotEquals(generator.build_email(7), other.build_email(7))
+
+    def test_layout(self):
+        """
+           Check that the generated db is read by the storer like a synced one
+        """
+        generator = vault_generator.VaultGenerator(500, 30, a_seed = 1)
+        nb_messages, nb_bytes = vault_generator.generate_vault(self.test_db_dir, generator, a_nb_processes = 2)
+
+        self.assertEquals(530, nb_messages)
+        self.assertEquals(nb_bytes, sum([ os.path.getsize(os.path.join(the_dir, fname)) \
+                                          for the_dir, _, fnames in os.walk('%s/db' % (self.test_db_dir)) \
+                                          for fname in fnames if '.eml' in fname ]))
+
+        gstorer = gmvault.get_storer(self.test_db_dir)
+        self.assertEquals([generator.owner], gstorer.get_db_owners())
+        self.assertEquals(530, gstorer.get_index().count())
+
+        gm_ids = gstorer.get_all_existing_gmail_ids()
+        self.assertEquals([ generator.get_gm_id(vault_generator.EMAIL, num) for num in xrange(500) ], list(gm_ids))
+        self.assertEquals(30, len(gstorer.get_all_chats_gmail_ids()))
+
+        for num in [0, 123, 499]:
+            gm_id = generator.get_gm_id(vault_generator.EMAIL, num)
+            metadata, body = gstorer.unbury_email(gm_id)
+            self.assertEquals(generator.build_email(num)[0], body)
+            self.assertEquals(gmvault_utils.get_ym_from_datetime(metadata[gstorer.INT_DATE_K]), gm_ids[gm_id])
+            self.assertEquals(generator.get_gm_id(vault_generator.EMAIL, generator.get_thread(num)[1]), \
+                              metadata[gstorer.THREAD_IDS_K])
+            self.assertTrue(os.path.exists('%s/db/%s/%s.eml.gz' % (self.test_db_dir, gm_ids[gm_id], gm_id)))
+            self.assertEquals((gm_ids[gm_id], index_utils.GmailIndex.COMPRESSED), gstorer.get_index().get(gm_id)[:2])
+
+        metadata = gstorer.unbury_metadata(generator.get_gm_id(vault_generator.CHAT, 3))
+        self.assertEquals([gstorer.CHAT_GM_LABEL], metadata[gstorer.LABELS_K])
+
+        # the manifests can be used without listing the dirs
+        the_dir  = gm_ids.values()[0]
+        the_fd   = open('%s/.info/manifests/%s' % (self.test_db_dir, the_dir))
+        manifest = json.load(the_fd)
+        the_fd.close()
+        self.assertEquals(os.stat('%s/db/%s' % (self.test_db_dir, the_dir)).st_mtime, manifest['mtime'])
+        self.assertTrue(manifest['generated'] - manifest['mtime'] >= index_utils.DirManifests.RACY_DELAY)
+
+    def test_encryption(self):
+        """
+           Check an encrypted db
+        """
+        generator = vault_generator.VaultGenerator(50, a_seed = 2)
+        vault_generator.generate_vault(self.test_db_dir, generator, a_use_encryption = True, a_nb_processes = 2)
+
+        gstorer = gmvault.get_storer(self.test_db_dir, True)
+        gm_id   = generator.get_gm_id(vault_generator.EMAIL, 10)
+        the_dir = gstorer.get_all_existing_gmail_ids()[gm_id]
+
+        self.assertTrue(os.path.exists('%s/db/%s/%s.eml.crypt.gz' % (self.test_db_dir, the_dir, gm_id)))
+        self.assertEquals(generator.build_email(10)[0], gstorer.unbury_email(gm_id)[1])
+
+    def test_distributions(self):
+        """
+           Check the distributions of the subjects, threads, labels, sizes and attachments
+        """
+        generator = vault_generator.VaultGenerator(3000, a_seed = 3, a_start_date = datetime.datetime(2010, 1, 1), \
+                                                   a_end_date = datetime.datetime(2011, 1, 1))
+
+        emails  = [ generator.build_email(num) for num in xrange(0, 3000, 3) ]
+        sizes   = sorted([ len(body) for body, _, _, _ in emails ])
+        replies = [ subject for _, subject, _, _ in emails if subject.startswith('Re: ') ]
+        attached = [ body for body, _, _, _ in emails if 'Content-Disposition: attachment' in body ]
+        labels  = [ label for _, _, email_labels, _ in emails for label in email_labels if not label.startswith('\\') ]
+
+        self.assertTrue(2000 < sizes[len(sizes) / 2] < 8000)
+        self.assertTrue(0.25 < len(replies) / 1000.0 < 0.45)
+        self.assertTrue(0.1 < len(attached) / 1000.0 < 0.2)
+        self.assertTrue(set(labels) <= set(generator.labels))
+        self.assertTrue(labels.count(generator.labels[0]) > 5 * labels.count(generator.labels[-1]))
+
+        # 12 month dirs, the dates and the gmail ids grow with the emails
+        units = generator.get_units(1500)
+        self.assertEquals(['2010-%02d' % (month) for month in xrange(1, 13)], [ unit[1] for unit in units ])
+        for _, month, first, last in units:
+            for num in [first, last - 1]:
+                self.assertEquals(month, gmvault_utils.get_ym_from_datetime( \
+                                  datetime.datetime.utcfromtimestamp(generator.get_date(vault_generator.EMAIL, num))))
+        gm_ids = [ generator.get_gm_id(vault_generator.EMAIL, num) for num in xrange(3000) ]
+        self.assertEquals(sorted(gm_ids), gm_ids)
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestVaultGenerator)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
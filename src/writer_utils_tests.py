@@ -0,0 +1,109 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <2011-2012>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import threading
+import time
+
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.writer_utils as writer_utils
+import gmv.segment_storer as segment_storer
+
+import test_utils
+
+
+class TestWriterUtils(test_utils.DbTestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the background writer threads of the storer
+    """
+
+    TEST_DB_DIR = "/tmp/gmvault-writer-tests"
+
+    def test_background_writer(self):
+        """
+           Check that flush waits for the queued tasks, that on_done follows each task and that errors are raised
+        """
+        lock, done = threading.Lock(), []
+
+        def write(value):
+            """ slow write """
+            time.sleep(0.01)
+            return value * 2
+
+        def on_done(result):
+            """ record the result """
+            with lock:
+                done.append(result)
+
+        writer = writer_utils.BackgroundWriter(3, 2)
+        for value in range(20):
+            writer.submit(write, (value,), a_on_done = on_done)
+        writer.flush()
+        self.assertEquals(range(0, 40, 2), sorted(done))
+
+        def fail(value):
+            """ failed write """
+            raise IOError("cannot write %s" % (value))
+
+        writer.submit(fail, (1,), a_on_done = on_done)
+        self.assertRaises(IOError, writer.flush)
+        self.assertEquals(20, len(done))
+
+        # the error is raised once and the writer still works
+        writer.submit(write, (50,), a_on_done = on_done)
+        writer.close()
+        self.assertEquals(100, done[-1])
+
+    def test_storers(self):
+        """
+           Check that both storages write the emails in background and call on_stored once they are written
+        """
+        for storer_class in [gmvault.GmailStorer, segment_storer.SegmentStorer]:
+            gmvault_utils.delete_all_under(self.test_db_dir, delete_top_dir = True)
+            gstorer = storer_class(self.test_db_dir)
+            gstorer.start_writers(2, 5)
+
+            stored = []
+            for gm_id in range(1, 31):
+                self.assertEquals(gm_id, gstorer.bury_email(test_utils.create_email_info(gm_id, datetime.datetime(2012, 8, 1)), local_dir = '2012-08', \
+                                                            compress = True, on_stored = stored.append))
+            gstorer.bury_metadata(test_utils.create_email_info(31, datetime.datetime(2012, 8, 1)), local_dir = '2012-08', on_stored = stored.append)
+            gstorer.close()
+
+            self.assertEquals(range(1, 32), sorted(stored))
+            self.assertEquals(range(1, 32), gstorer.get_all_existing_gmail_ids().keys())
+            self.assertEquals('Subject: test\r\n\r\nbody of 17', gstorer.unbury_email(17)[1])
+
+            # without writer threads the emails are written right away
+            gstorer.bury_email(test_utils.create_email_info(40, datetime.datetime(2012, 8, 1)), local_dir = '2012-08', on_stored = stored.append)
+            self.assertEquals(40, stored[-1])
+            gstorer.flush()
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestWriterUtils)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()